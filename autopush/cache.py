@@ -0,0 +1,200 @@
+"""In-process caches for hot lookups
+
+These caches sit in front of work that is repeated for every notification an
+AppServer sends to the same subscription, so that bursts of pushes don't each
+pay a DynamoDB round-trip and a thread hop.
+
+"""
+from boto.dynamodb2.items import Item
+from cryptography.fernet import InvalidToken
+from repoze.lru import ExpiringLRUCache
+
+
+class RouteRecord(dict):
+    """Router record of just some attributes of a router item
+
+    Returned by :meth:`~autopush.db.Router.get_uaid` when it's given the
+    attributes to read, as a plain dict of the decoded values rather than a
+    boto :class:`~boto.dynamodb2.items.Item`. ``attributes`` are the names
+    that were read, one of them missing from the record isn't set on the
+    item.
+
+    """
+    __slots__ = ("attributes",)
+
+    def __init__(self, attributes, values=()):
+        dict.__init__(self, values)
+        self.attributes = attributes
+
+
+def copy_record(record):
+    """Return a shallow copy of a router record
+
+    Router records are mutated by their consumers (for example
+    :meth:`~autopush.db.Router.clear_node` removes the ``node_id`` and
+    :meth:`~autopush.db.Router.register_user` pops the ``uaid``), so a cached
+    record must never be handed out directly.
+
+    """
+    if isinstance(record, Item):
+        return Item(record.table, data=dict(record.items()))
+    if isinstance(record, RouteRecord):
+        return RouteRecord(record.attributes, record)
+    return type(record)(record)
+
+
+class RouterCache(object):
+    """TTL and LRU bounded cache of router table records keyed by UAID
+
+    A ``size`` of 0 disables the cache, every lookup is then a miss and no
+    metrics are recorded.
+
+    """
+    def __init__(self, metrics, size=0, ttl=30):
+        """Create a new RouterCache
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param size: Maximum amount of records to hold.
+        :param ttl: Seconds a record may be served from the cache.
+
+        """
+        self.metrics = metrics
+        self.ttl = ttl
+        self._cache = ExpiringLRUCache(size, default_timeout=ttl) \
+            if size > 0 else None
+
+    @property
+    def enabled(self):
+        """Whether records are being cached at all"""
+        return self._cache is not None
+
+    def get(self, uaid):
+        """Return a copy of the cached record for the UAID, or None"""
+        if self._cache is None:
+            return None
+        record = self._cache.get(uaid)
+        if record is None:
+            self.metrics.increment("router.cache.miss")
+            return None
+        self.metrics.increment("router.cache.hit")
+        return copy_record(record)
+
+    def put(self, uaid, record):
+        """Store a copy of a freshly read router record for the UAID
+
+        A :class:`RouteRecord` is never cached on its own, as lookups expect
+        whole records, it only updates its attributes in the record already
+        cached for the UAID.
+
+        """
+        if self._cache is None or not record:
+            return
+        if isinstance(record, RouteRecord):
+            self._update(uaid, record)
+            return
+        self._cache.put(uaid, copy_record(record))
+
+    def _update(self, uaid, route):
+        cached = self._cache.get(uaid)
+        if cached is None:
+            return
+        for name in route.attributes:
+            if name in route:
+                cached[name] = route[name]
+            elif name in cached:
+                del cached[name]
+
+    def invalidate(self, uaid):
+        """Drop the record for the UAID as it's known to be stale"""
+        if self._cache is None or uaid not in self._cache.data:
+            return
+        self._cache.invalidate(uaid)
+        self.metrics.increment("router.cache.invalidate")
+
+    def clear(self):
+        """Drop every cached record"""
+        if self._cache is not None:
+            self._cache.clear()
+
+
+class TokenCache(object):
+    """LRU bounded cache of decrypted endpoint and message tokens
+
+    Valid tokens map to their decrypted contents for ``ttl`` seconds, tokens
+    that failed to decrypt are remembered for the much shorter
+    ``negative_ttl`` so a flood of bad tokens is rejected without any crypto
+    work. A ``size`` of 0 disables the cache.
+
+    The cache must be cleared whenever the crypto keys change, see
+    :meth:`autopush.settings.AutopushSettings.update`.
+
+    """
+    _invalid = object()
+
+    def __init__(self, metrics, size=0, ttl=300, negative_ttl=5):
+        """Create a new TokenCache
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param size: Maximum amount of tokens to hold.
+        :param ttl: Seconds a decrypted token may be served from the cache.
+        :param negative_ttl: Seconds an invalid token is remembered.
+
+        """
+        self.metrics = metrics
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = ExpiringLRUCache(size, default_timeout=ttl) \
+            if size > 0 else None
+
+    @property
+    def enabled(self):
+        """Whether tokens are being cached at all"""
+        return self._cache is not None
+
+    @property
+    def hit_ratio(self):
+        """Fraction of lookups served from the cache"""
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def get(self, token):
+        """Return the decrypted contents of the token, or None
+
+        :raises:
+            :exc:`~cryptography.fernet.InvalidToken` if the token is known
+            to be invalid.
+
+        """
+        if self._cache is None:
+            return None
+        value = self._cache.get(token)
+        if value is None:
+            self.misses += 1
+            self.metrics.increment("token.cache.miss")
+            return None
+        self.hits += 1
+        if value is self._invalid:
+            self.metrics.increment("token.cache.invalid")
+            raise InvalidToken()
+        self.metrics.increment("token.cache.hit")
+        return value
+
+    def put(self, token, value):
+        """Store the decrypted contents of a token"""
+        if self._cache is not None:
+            self._cache.put(token, value)
+
+    def put_invalid(self, token):
+        """Remember that a token failed to decrypt"""
+        if self._cache is not None:
+            self._cache.put(token, self._invalid, self.negative_ttl)
+
+    def clear(self):
+        """Drop every cached token"""
+        if self._cache is not None:
+            self._cache.clear()
+        self.hits = self.misses = 0
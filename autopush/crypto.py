@@ -0,0 +1,319 @@
+"""Crypto executors for token encryption and decryption
+
+Token work used to run on the reactor's shared thread pool, where it queued
+behind every DynamoDB call while gaining little from the threads due to the
+GIL. A crypto executor decides where the Fernet work runs instead:
+
+``inline``
+    Directly on the reactor, a Fernet operation is cheap enough that the
+    thread hop usually costs more than the crypto itself.
+
+``thread``
+    On the ``crypto`` pool of :mod:`autopush.executors`, dedicated to crypto
+    work.
+
+``process``
+    On a pool of worker processes, with the jobs queued during a reactor
+    iteration sent to a worker as a single batch to amortize the IPC.
+
+Every executor returns deferreds and records the time from submission to
+result as ``crypto.<mode>.<operation>``.
+
+"""
+import multiprocessing
+import pickle
+import time
+
+from cryptography.fernet import Fernet, MultiFernet
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, maybeDeferred
+
+from autopush.executors import Executor
+from autopush.tokens import (
+    EndpointTokens,
+    decode_endpoint_token,
+    encode_endpoint_token,
+)
+
+
+CRYPTO_MODES = ("inline", "thread", "process")
+FERNET_OPERATIONS = ("encrypt", "decrypt")
+
+
+class CryptoExecutor(object):
+    """Runs token encryption and decryption for an
+    :class:`~autopush.settings.AutopushSettings`
+
+    Runs the work inline on the reactor, subclasses override :meth:`_run`
+    to move it elsewhere.
+
+    """
+    mode = "inline"
+
+    def __init__(self, ap_settings, workers=1):
+        """Create a new CryptoExecutor
+
+        :param ap_settings: Settings whose ``fernet`` (and for the process
+                            executor, crypto keys) are used for the tokens.
+        :param workers: Amount of threads or processes to run the work on.
+
+        """
+        self.ap_settings = ap_settings
+        self.workers = workers
+        self.started = False
+
+    def start(self):
+        """Start any pool the work runs on"""
+        self.started = True
+
+    def stop(self):
+        """Stop any pool the work runs on"""
+        self.started = False
+
+    def update_keys(self, keys):
+        """Called with the new crypto keys whenever they change"""
+
+    def encrypt(self, data):
+        """Returns a deferred for the encrypted ``data`` token"""
+        return self._timed("encrypt", data)
+
+    def decrypt(self, token):
+        """Returns a deferred for the decrypted ``token``"""
+        return self._timed("decrypt", token)
+
+    def make_endpoint_token(self, data):
+        """Returns a deferred for the endpoint token of ``uaid:chid`` data"""
+        return self._timed("make_endpoint_token", data)
+
+    def parse_endpoint_token(self, token):
+        """Returns a deferred for the ``uaid:chid`` of an endpoint token"""
+        return self._timed("parse_endpoint_token", token)
+
+    def _operation(self, op):
+        """Returns the settings callable for an operation"""
+        if op in FERNET_OPERATIONS:
+            return getattr(self.ap_settings.fernet, op)
+        return getattr(self.ap_settings, op)
+
+    def _timed(self, op, value):
+        if not self.started:
+            self.start()
+        start = time.time()
+        d = self._run(op, value)
+
+        def record(result):
+            self.ap_settings.metrics.timing(
+                "crypto.%s.%s" % (self.mode, op),
+                duration=(time.time() - start) * 1000)
+            return result
+        d.addBoth(record)
+        return d
+
+    def _run(self, op, value):
+        return maybeDeferred(self._operation(op), value)
+
+
+class ThreadCryptoExecutor(CryptoExecutor):
+    """Runs the token work on a dedicated thread pool"""
+    mode = "thread"
+
+    def __init__(self, ap_settings, workers=2, pool=None):
+        """Create a new ThreadCryptoExecutor
+
+        :param pool: :class:`~autopush.executors.Executor` to run the work
+                     on, a pool of ``workers`` threads is made otherwise.
+
+        """
+        CryptoExecutor.__init__(self, ap_settings, workers)
+        self.pool = pool or Executor("crypto", ap_settings.metrics,
+                                     size=workers)
+
+    def start(self):
+        if self.started:
+            return
+        CryptoExecutor.start(self)
+        self.pool.start()
+
+    def stop(self):
+        if not self.started:
+            return
+        CryptoExecutor.stop(self)
+        self.pool.stop()
+
+    def _run(self, op, value):
+        return self.pool.run(self._operation(op), value)
+
+
+_worker_fernet = None
+_worker_tokens = None
+_worker_keys = None
+
+
+def _worker_operation(op, value, token_version):
+    if op in FERNET_OPERATIONS:
+        return getattr(_worker_fernet, op)(value)
+    if op == "make_endpoint_token":
+        return encode_endpoint_token(_worker_tokens, _worker_fernet, value,
+                                     token_version)
+    if op == "parse_endpoint_token":
+        return decode_endpoint_token(_worker_tokens, _worker_fernet, value)
+    raise ValueError("Unknown crypto operation: %s" % op)
+
+
+def _picklable(exc):
+    """Returns the exception if it survives the trip back from a worker,
+    a plain :exc:`Exception` describing it otherwise"""
+    try:
+        pickle.loads(pickle.dumps(exc))
+    except Exception:
+        return Exception("%s: %s" % (type(exc).__name__, exc))
+    return exc
+
+
+def run_batch(keys, jobs, token_version=0):
+    """Run a batch of ``(op, value)`` crypto jobs in a worker process
+
+    Returns a ``(success, result)`` tuple for every job, with the exception
+    as result for jobs that failed so that a single bad token doesn't fail
+    the rest of the batch. Every job fails with the exception if the keys
+    are unusable or the batch fails as a whole. The pool only calls back
+    with a result it could pickle, so exceptions that can't make the trip
+    are replaced with a plain :exc:`Exception`.
+
+    """
+    try:
+        results = _run_batch(keys, jobs, token_version)
+    except Exception as exc:
+        results = [(False, exc)] * len(jobs)
+    return [(success, result if success else _picklable(result))
+            for success, result in results]
+
+
+def _run_batch(keys, jobs, token_version):
+    global _worker_fernet, _worker_tokens, _worker_keys
+    if keys != _worker_keys:
+        try:
+            fernet = MultiFernet([Fernet(key) for key in keys])
+            tokens = EndpointTokens(keys)
+        except Exception as exc:
+            return [(False, exc)] * len(jobs)
+        _worker_fernet, _worker_tokens, _worker_keys = fernet, tokens, keys
+    results = []
+    for op, value in jobs:
+        try:
+            results.append(
+                (True, _worker_operation(op, value, token_version)))
+        except Exception as exc:
+            results.append((False, exc))
+    return results
+
+
+class ProcessCryptoExecutor(CryptoExecutor):
+    """Runs the token work in batches on a pool of worker processes
+
+    Jobs submitted during a reactor iteration are sent together, a batch is
+    sent early once it holds ``batch_size`` jobs. Every batch carries the
+    current crypto keys, so workers pick up a key rotation with their next
+    batch. Jobs still pending or in a worker when the executor stops fail
+    with :exc:`~twisted.internet.defer.CancelledError`.
+
+    """
+    mode = "process"
+
+    def __init__(self, ap_settings, workers=2, batch_size=100):
+        CryptoExecutor.__init__(self, ap_settings, workers)
+        self.batch_size = batch_size
+        self.pool = None
+        self.keys = ()
+        self._pending = []
+        self._batches = {}
+        self._next_batch = 0
+        self._flush_call = None
+
+    def start(self):
+        if self.started:
+            return
+        CryptoExecutor.start(self)
+        self.pool = multiprocessing.Pool(self.workers)
+        reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    def stop(self):
+        if not self.started:
+            return
+        CryptoExecutor.stop(self)
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        # Pool.terminate joins the workers, which never returns once the
+        # reactor's SIGCHLD handling is installed, the workers exit on their
+        # own after a close.
+        self.pool.close()
+        self.pool = None
+        deferreds = [d for _, _, d in self._pending]
+        for batch in self._batches.values():
+            deferreds.extend(batch)
+        self._pending = []
+        self._batches = {}
+        for d in deferreds:
+            d.errback(CancelledError("Crypto executor stopped"))
+
+    def update_keys(self, keys):
+        self.keys = tuple(keys)
+
+    def _run(self, op, value):
+        d = Deferred()
+        self._pending.append((op, value, d))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self.flush)
+        return d
+
+    def flush(self):
+        """Send all the pending jobs to a worker as one batch"""
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.ap_settings.metrics.gauge("crypto.process.batch_size",
+                                       len(batch))
+        jobs = [(op, value) for op, value, _ in batch]
+        self._next_batch += 1
+        batch_id = self._next_batch
+        self._batches[batch_id] = [d for _, _, d in batch]
+        self.pool.apply_async(
+            run_batch, (self.keys, jobs, self.ap_settings.token_version),
+            callback=lambda results: reactor.callFromThread(
+                self._batch_done, batch_id, results)
+        )
+
+    def _batch_done(self, batch_id, results):
+        deferreds = self._batches.pop(batch_id, None)
+        if deferreds is None:
+            # Already failed by stop
+            return
+        for d, (success, result) in zip(deferreds, results):
+            if success:
+                d.callback(result)
+            else:
+                d.errback(result)
+
+
+def make_crypto_executor(ap_settings, mode="inline", workers=None,
+                         pool=None):
+    """Create the crypto executor for a mode out of :data:`CRYPTO_MODES`
+
+    :param pool: :class:`~autopush.executors.Executor` the ``thread`` mode
+                 runs the work on.
+
+    """
+    if mode == "inline":
+        return CryptoExecutor(ap_settings)
+    workers = workers or max(1, multiprocessing.cpu_count() - 1)
+    if mode == "thread":
+        return ThreadCryptoExecutor(ap_settings, workers, pool)
+    if mode == "process":
+        return ProcessCryptoExecutor(ap_settings, workers)
+    raise ValueError("Unknown crypto mode: %s" % mode)
@@ -1,12 +1,16 @@
 """Database Interaction"""
 from __future__ import absolute_import
 
+import binascii
 import datetime
 import logging
 import time
 import uuid
-from functools import wraps
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import partial, wraps
+from multiprocessing.pool import ThreadPool
 
+from boto.dynamodb.types import Binary
 from boto.exception import JSONResponseError
 from boto.dynamodb2.exceptions import (
     ConditionalCheckFailedException,
@@ -17,7 +21,19 @@ from boto.dynamodb2.fields import HashKey, RangeKey, GlobalKeysOnlyIndex
 from boto.dynamodb2.layer1 import DynamoDBConnection
 from boto.dynamodb2.table import Table
 from boto.dynamodb2.types import NUMBER
-
+from twisted.internet.threads import deferToThread
+
+from autopush.cache import RouteRecord, RouterCache
+from autopush.dynamodb import (
+    AsyncMessage,
+    AsyncRouter,
+    AsyncStorage,
+    MessageRecord,
+    UserRecord,
+    decode_item,
+    decode_value,
+)
+from autopush.executors import db_executor
 
 log = logging.getLogger(__file__)
 
@@ -104,6 +120,16 @@ def create_message_table(tablename="message", read_throughput=5,
                         )
 
 
+def create_topic_table(tablename="topic", read_throughput=5,
+                       write_throughput=5):
+    """Create a new topic table for topic fan-out subscriptions"""
+    return Table.create(tablename,
+                        schema=[HashKey("topic"), RangeKey("token")],
+                        throughput=dict(read=read_throughput,
+                                        write=write_throughput),
+                        )
+
+
 def _make_table(table_func, tablename, read_throughput, write_throughput):
     """Private common function to make a table with a table func"""
     db = DynamoDBConnection()
@@ -150,6 +176,18 @@ def get_message_table(tablename="message", read_throughput=5,
                        write_throughput)
 
 
+def get_topic_table(tablename="topic", read_throughput=5,
+                    write_throughput=5):
+    """Get the main topic table object
+
+    Creates the table if it doesn't already exist, otherwise returns the
+    existing table.
+
+    """
+    return _make_table(create_topic_table, tablename, read_throughput,
+                       write_throughput)
+
+
 def preflight_check(storage, router):
     """Performs a pre-flight check of the storage/router/message to ensure
     appropriate permissions for operation.
@@ -191,19 +229,243 @@ def track_provisioned(func):
     return wrapper
 
 
+# Crypto headers of a webpush message, in the order they're packed in
+# version 2 message items
+MESSAGE_HEADERS = ("encoding", "encryption", "encryption_key")
+
+
+def make_message_item(uaid, channel_id, message_id, ttl, data=None,
+                      headers=None, timestamp=None, version=1):
+    """Returns the message table item of a webpush message
+
+    Version 2 items are compact, they're marked with a ``v`` of 2 and hold:
+
+    - ``t`` and ``s``, the ttl and timestamp.
+    - ``u``, the updateid as 16 bytes of binary.
+    - ``d``, the payload as binary when it's base64url, as it is for
+      messages from the endpoint, otherwise as it was given.
+    - ``h``, the crypto headers packed into a newline separated string in
+      the order of :data:`MESSAGE_HEADERS`.
+
+    Messages with other headers are stored as version 1 items.
+    :func:`read_message_item` reads both versions.
+
+    """
+    timestamp = timestamp or int(time.time())
+    chidmessageid = "%s:%s" % (channel_id, message_id)
+    packed = pack_headers(headers) if version == 2 else None
+    if packed is not None:
+        item = dict(uaid=uaid, chidmessageid=chidmessageid, v=2, t=ttl,
+                    s=timestamp, u=Binary(uuid.uuid4().bytes))
+        if data:
+            item["h"] = packed
+            item["d"] = pack_data(data)
+        return item
+    item = dict(
+        uaid=uaid,
+        chidmessageid=chidmessageid,
+        ttl=ttl,
+        timestamp=timestamp,
+        updateid=uuid.uuid4().hex
+    )
+    if data:
+        item["headers"] = headers
+        item["data"] = data
+    return item
+
+
+def pack_headers(headers):
+    """Returns the crypto headers of a message packed for a version 2 item,
+    or None if they can't be"""
+    headers = headers or {}
+    if not set(headers) <= set(MESSAGE_HEADERS):
+        return None
+    values = [headers.get(name) or "" for name in MESSAGE_HEADERS]
+    for value in values:
+        if not isinstance(value, basestring) or "\n" in value:
+            return None
+    return "\n".join(values).rstrip("\n")
+
+
+def pack_data(data):
+    """Returns the payload of a message as binary when it's base64url"""
+    try:
+        raw = urlsafe_b64decode(str(data))
+    except (TypeError, ValueError, UnicodeError):
+        return data
+    if urlsafe_b64encode(raw) != data:
+        return data
+    return Binary(raw)
+
+
+def packed_updateid(updateid):
+    """Returns the version 2 item form of an updateid, or None if it isn't
+    one of ours"""
+    try:
+        return Binary(binascii.unhexlify(updateid))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+
+def read_message_item(item):
+    """Returns a dict of a message item of either version, in the version 1
+    form
+
+    :param item: Message item, a :class:`~autopush.dynamodb.MessageRecord`
+                 or a dict of decoded attribute values.
+
+    """
+    if item.get("v") != 2:
+        return item
+    message = dict(
+        uaid=item["uaid"],
+        chidmessageid=item["chidmessageid"],
+        ttl=item["t"],
+        timestamp=item["s"],
+        updateid=binascii.hexlify(item["u"].value),
+    )
+    data = item.get("d")
+    if data:
+        if isinstance(data, Binary):
+            data = urlsafe_b64encode(data.value)
+        message["data"] = data
+        message["headers"] = dict(
+            (name, value)
+            for name, value in zip(MESSAGE_HEADERS,
+                                   item.get("h", "").split("\n"))
+            if value)
+    return message
+
+
+def defer_db(func, *args, **kwargs):
+    """Returns a deferred for calling a function, usually a method of a
+    table object
+
+    Methods of table objects set up with a
+    :class:`~autopush.dynamodb.DynamoDBClient` run their non-blocking
+    variant on the reactor, anything else is called in a thread, on the
+    ``db-read`` or ``db-write`` pool of the table object's
+    :class:`~autopush.executors.Executors` if it has them. Methods of
+    table objects set up with a :class:`~autopush.governor.CapacityGovernor`
+    are paced by it, and with a :class:`~autopush.deadlines.RequestDeadlines`
+    bounded and hedged by it.
+
+    """
+    owner = getattr(func, "__self__", None)
+    call = _defer_db
+    deadlines = getattr(owner, "deadlines", None)
+    if deadlines is not None:
+        call = partial(deadlines.call, call)
+    governor = getattr(owner, "governor", None)
+    if governor is not None:
+        return governor.call(owner.table.table_name, func.__name__,
+                             call, func, *args, **kwargs)
+    return call(func, *args, **kwargs)
+
+
+def _defer_db(func, *args, **kwargs):
+    owner = getattr(func, "__self__", None)
+    nonblocking = getattr(owner, "nonblocking", None)
+    if nonblocking is not None:
+        return getattr(nonblocking, func.__name__)(*args, **kwargs)
+    executors = getattr(owner, "executors", None)
+    if executors is not None:
+        return executors.run(db_executor(func.__name__), func, *args,
+                             **kwargs)
+    return deferToThread(func, *args, **kwargs)
+
+
+class ReadPolicy(object):
+    """Chooses between strongly and eventually consistent reads per
+    operation
+
+    Eventually consistent reads cost half the read capacity, but may miss a
+    write made just before. Only the :attr:`guarded` reads can be made
+    eventually consistent: each of them reads again strongly consistent
+    when an item is missing, like a user or channel that was just
+    registered. An item that's present but stale isn't detected, so only
+    reads whose callers cope with one are guarded: a stale ``node_id`` is
+    found out by the node the delivery goes to. Every other read stays
+    strongly consistent. Messages and notifications are read right after
+    the endpoint stored them and told the client, so a stale read would
+    lose them until the next check. A stale ``current_month`` from
+    :meth:`Router.get_uaid_and_channel` right after a rotation would store
+    a notification in a table the client no longer reads.
+
+    ``read.eventual.<operation>`` counts the eventually consistent reads and
+    ``read.fallback.<operation>`` the strongly consistent reads that
+    followed a stale looking one.
+
+    """
+    guarded = ("get_uaids", "channel_exists")
+
+    def __init__(self, metrics, eventual=()):
+        """Create a new ReadPolicy
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param eventual: Names of the :attr:`guarded` operations to read
+                         eventually consistent.
+
+        """
+        unknown = set(eventual) - set(self.guarded)
+        if unknown:
+            raise ValueError("Reads can't be eventually consistent for: %s" %
+                             ", ".join(sorted(unknown)))
+        self.metrics = metrics
+        self.eventual = frozenset(eventual)
+
+    def consistent(self, operation, consistent=None):
+        """Returns whether a read for the operation is strongly consistent
+
+        :param consistent: Consistency the caller requires, if any, which
+                           overrides the policy.
+
+        """
+        if consistent is not None:
+            return consistent
+        if operation not in self.eventual:
+            return True
+        self.metrics.increment("read.eventual.%s" % operation)
+        return False
+
+    def stale(self, operation):
+        """Record that an eventually consistent read of the operation may be
+        stale and is made again strongly consistent"""
+        self.metrics.increment("read.fallback.%s" % operation)
+
+
 class Storage(object):
     """Create a Storage table abstraction on top of a DynamoDB Table object"""
-    def __init__(self, table, metrics):
+    def __init__(self, table, metrics, client=None, governor=None,
+                 deadlines=None, executors=None):
         """Create a new Storage object
 
         :param table: :class:`Table` object.
         :param metrics: Metrics object that implements the
                         :class:`autopush.metrics.IMetrics` interface.
+        :param client: Optional :class:`~autopush.dynamodb.DynamoDBClient`
+                       for the non-blocking variants of the methods.
+        :param governor: Optional
+                         :class:`~autopush.governor.CapacityGovernor`
+                         pacing the methods called with :func:`defer_db`.
+        :param deadlines: Optional
+                          :class:`~autopush.deadlines.RequestDeadlines`
+                          bounding the methods called with
+                          :func:`defer_db`.
+        :param executors: Optional :class:`~autopush.executors.Executors`
+                          whose ``db-read`` and ``db-write`` pools the
+                          blocking methods called with :func:`defer_db` run
+                          on, instead of the reactor's thread pool.
 
         """
         self.table = table
         self.metrics = metrics
         self.encode = table._encode_keys
+        self.governor = governor
+        self.deadlines = deadlines
+        self.executors = executors
+        self.nonblocking = AsyncStorage(self, client) if client else None
 
     @track_provisioned
     def fetch_notifications(self, uaid):
@@ -260,20 +522,86 @@ class Storage(object):
             self.metrics.increment("error.provisioned.delete_notification")
             return False
 
+    def delete_notifications(self, uaid, notifications):
+        """Delete several notifications for a UAID
+
+        Every delete is conditional on the version, like
+        :meth:`delete_notification`, so they're made one after another
+        rather than with BatchWriteItem.
+
+        :param notifications: List of ``(chid, version)`` tuples.
+        :returns: Whether all the notifications were able to be deleted.
+        :rtype: bool
+
+        """
+        results = [self.delete_notification(uaid, chid, version)
+                   for chid, version in notifications]
+        return all(results)
+
 
 class Message(object):
-    """Create a Message table abstraction on top of a DynamoDB Table object"""
-    def __init__(self, table, metrics):
+    """Create a Message table abstraction on top of a DynamoDB Table object
+
+    Items of a uaid are sorted by ``chidmessageid``: ``" "`` holds the set of
+    registered channels, ``" :<chid>"`` marks each registered channel so it
+    can be checked without reading the whole set, and messages are stored as
+    ``"<chid>:<message id>"`` from :attr:`messages_start` on.
+
+    Connection nodes older than the markers read messages from ``" "`` on
+    and would take a marker for a message, so markers are only written with
+    ``channel_markers`` set, once every connection node reads from
+    :attr:`messages_start`. Until then channels are checked in the set.
+
+    """
+    channel_key = " :%s"
+    messages_start = " ;"
+    packed_updateid = staticmethod(packed_updateid)
+    #: How many conditional deletes of acked messages are made at once
+    ack_threads = 8
+    _ack_pool = None
+
+    def __init__(self, table, metrics, client=None, item_version=1,
+                 policy=None, governor=None, deadlines=None,
+                 executors=None, channel_markers=False):
         """Create a new Message object
 
         :param table: :class:`Table` object.
         :param metrics: Metrics object that implements the
                         :class:`autopush.metrics.IMetrics` interface.
+        :param client: Optional :class:`~autopush.dynamodb.DynamoDBClient`
+                       for the non-blocking variants of the methods.
+        :param item_version: Version of the message items to store, see
+                             :func:`make_message_item`. Both versions are
+                             always read.
+        :param policy: Optional :class:`ReadPolicy`, every read is strongly
+                       consistent without one.
+        :param governor: Optional
+                         :class:`~autopush.governor.CapacityGovernor`
+                         pacing the methods called with :func:`defer_db`.
+        :param deadlines: Optional
+                          :class:`~autopush.deadlines.RequestDeadlines`
+                          bounding the methods called with
+                          :func:`defer_db`.
+        :param executors: Optional :class:`~autopush.executors.Executors`
+                          whose ``db-read`` and ``db-write`` pools the
+                          blocking methods called with :func:`defer_db` run
+                          on, instead of the reactor's thread pool.
+        :param channel_markers: Whether a marker item is written for every
+                                registered channel and read to check it.
 
         """
         self.table = table
         self.metrics = metrics
         self.encode = table._encode_keys
+        self.item_version = item_version
+        self.channel_markers = channel_markers
+        if policy is None:
+            policy = ReadPolicy(metrics)
+        self.policy = policy
+        self.governor = governor
+        self.deadlines = deadlines
+        self.executors = executors
+        self.nonblocking = AsyncMessage(self, client) if client else None
 
     @track_provisioned
     def register_channel(self, uaid, channel_id):
@@ -289,12 +617,23 @@ class Message(object):
             update_expression=expr,
             expression_attribute_values=expr_values,
         )
+        if self.channel_markers:
+            self._put_channel_marker(uaid, channel_id)
         return True
 
+    def _put_channel_marker(self, uaid, channel_id):
+        self.table.put_item(data=dict(
+            uaid=uaid,
+            chidmessageid=self.channel_key % channel_id,
+        ), overwrite=True)
+
     @track_provisioned
     def unregister_channel(self, uaid, channel_id, **kwargs):
         """Remove a channel registration for a given uaid"""
         conn = self.table.connection
+        if self.channel_markers:
+            self.table.delete_item(
+                uaid=uaid, chidmessageid=self.channel_key % channel_id)
         db_key = self.encode({"uaid": uaid, "chidmessageid": " "})
         expr = "DELETE chids :channel_id"
         expr_values = self.encode({":channel_id": set([channel_id])})
@@ -329,6 +668,41 @@ class Message(object):
         except ItemNotFound:
             return False, set([])
 
+    @track_provisioned
+    def channel_exists(self, uaid, channel_id, consistent=None):
+        """Returns whether a channel is registered for a given uaid
+
+        Only the channel's marker item is read, so the cost doesn't grow
+        with the amount of channels. Channels registered before markers
+        were written are looked up in the set of channels instead, and get
+        their marker written. Without ``channel_markers`` only the set is
+        read.
+
+        :param consistent: Whether the marker is read strongly consistent,
+                           by default as the :class:`ReadPolicy` says. The
+                           set of channels is always read strongly
+                           consistent, which covers a missed marker of a
+                           channel that was just registered.
+
+        """
+        if not self.channel_markers:
+            _, chans = self.all_channels(uaid)
+            return channel_id in chans
+        consistent = self.policy.consistent("channel_exists", consistent)
+        try:
+            self.table.get_item(consistent=consistent, uaid=uaid,
+                                chidmessageid=self.channel_key % channel_id,
+                                attributes=("uaid",))
+            return True
+        except ItemNotFound:
+            if not consistent:
+                self.policy.stale("channel_exists")
+        _, chans = self.all_channels(uaid)
+        if channel_id not in chans:
+            return False
+        self._put_channel_marker(uaid, channel_id)
+        return True
+
     @track_provisioned
     def save_channels(self, uaid, channels):
         """Save out a set of channels"""
@@ -337,25 +711,43 @@ class Message(object):
             chidmessageid=" ",
             chids=channels
         ))
+        if not self.channel_markers:
+            return
+        with self.table.batch_write() as batch:
+            for channel_id in channels:
+                batch.put_item(data=dict(
+                    uaid=uaid,
+                    chidmessageid=self.channel_key % channel_id,
+                ))
 
     @track_provisioned
     def store_message(self, uaid, channel_id, message_id, ttl, data=None,
                       headers=None, timestamp=None):
         """Stores a message in the message table for the given uaid/channel with
         the message id"""
-        item = dict(
-            uaid=uaid,
-            chidmessageid="%s:%s" % (channel_id, message_id),
-            data=data,
-            headers=headers,
-            ttl=ttl,
-            timestamp=timestamp or int(time.time()),
-            updateid=uuid.uuid4().hex
-        )
-        if data:
-            item["headers"] = headers
-            item["data"] = data
-        self.table.put_item(data=item)
+        self.table.put_item(data=self.message_item(
+            uaid, channel_id, message_id, ttl, data, headers, timestamp))
+        return True
+
+    def message_item(self, uaid, channel_id, message_id, ttl, data=None,
+                     headers=None, timestamp=None):
+        """Returns the item of a message in the :attr:`item_version` of
+        this table"""
+        return make_message_item(uaid, channel_id, message_id, ttl, data,
+                                 headers, timestamp, self.item_version)
+
+    @track_provisioned
+    def store_messages(self, items):
+        """Stores several message items, made with
+        :func:`make_message_item`, with BatchWriteItem
+
+        Unlike :meth:`store_message` an existing message with the same id is
+        overwritten, as BatchWriteItem has no conditions.
+
+        """
+        with self.table.batch_write() as batch:
+            for item in items:
+                batch.put_item(data=item)
         return True
 
     @track_provisioned
@@ -364,7 +756,8 @@ class Message(object):
         """Updates a message in the message table for the given uaid/channel
         /message_id.
 
-        If the message is not present, False is returned.
+        If the message is not present, or a version 2 item, False is
+        returned.
 
         """
         conn = self.table.connection
@@ -404,12 +797,21 @@ class Message(object):
 
     @track_provisioned
     def delete_message(self, uaid, channel_id, message_id, updateid=None):
-        """Deletes a specific message"""
+        """Deletes a specific message
+
+        With an ``updateid`` the message is only deleted if it wasn't
+        updated since, whichever version its item is.
+
+        """
         if updateid:
+            expected = {'updateid__eq': updateid}
+            packed = packed_updateid(updateid)
+            if packed is not None:
+                expected['u__eq'] = packed
             try:
                 self.table.delete_item(uaid=uaid, chidmessageid="%s:%s" % (
                     channel_id, message_id),
-                    expected={'updateid__eq': updateid})
+                    expected=expected, conditional_operator="OR")
             except ConditionalCheckFailedException:
                 return False
         else:
@@ -417,6 +819,39 @@ class Message(object):
                 channel_id, message_id))
         return True
 
+    def delete_acked(self, uaid, messages):
+        """Deletes the messages a client acknowledged
+
+        :param messages: List of ``(channel_id, message_id, updateid)``
+                         tuples. A message with an ``updateid`` is only
+                         deleted if it wasn't updated since, which takes a
+                         conditional delete of its own. These are made
+                         concurrently, the others are deleted together with
+                         BatchWriteItem.
+
+        """
+        conditional = []
+        chidmessageids = []
+        for channel_id, message_id, updateid in messages:
+            if updateid:
+                conditional.append((channel_id, message_id, updateid))
+            else:
+                chidmessageids.append("%s:%s" % (channel_id, message_id))
+        if len(conditional) > 1:
+            self._get_ack_pool().map(
+                lambda args: self.delete_message(uaid, *args), conditional)
+        elif conditional:
+            self.delete_message(uaid, *conditional[0])
+        if chidmessageids:
+            self.delete_messages(uaid, chidmessageids)
+        return True
+
+    def _get_ack_pool(self):
+        """Returns the thread pool making the conditional deletes"""
+        if self._ack_pool is None:
+            self._ack_pool = ThreadPool(self.ack_threads)
+        return self._ack_pool
+
     def delete_messages(self, uaid, chidmessageids):
         with self.table.batch_write() as batch:
             for chidmessageid in chidmessageids:
@@ -454,40 +889,281 @@ class Message(object):
             self.delete_messages(uaid, chidmessageids)
 
     @track_provisioned
-    def fetch_messages(self, uaid, limit=10):
-        """Fetches messages for a uaid"""
-        # Eagerly fetches all results in the result set.
-        return list(self.table.query_2(uaid__eq=uaid, chidmessageid__gt=" ",
-                                       consistent=True, limit=limit))
+    def scan_expired(self, segment, total_segments, start_key=None,
+                     limit=100, now=None):
+        """Scans a page of a segment of the table for expired messages
+
+        :param start_key: ``LastEvaluatedKey`` of the previous page of the
+                          segment.
+        :param now: Time messages are expired by, defaults to the current
+                    time.
+        :returns: Tuple of a list of the ``(uaid, chidmessageid)`` keys of
+                  the expired messages, the ``LastEvaluatedKey`` to scan the
+                  next page with or None at the end of the segment, and the
+                  read capacity consumed.
+
+        """
+        now = now or int(time.time())
+        kwargs = {}
+        if start_key:
+            kwargs["exclusive_start_key"] = start_key
+        result = self.table.connection.scan(
+            self.table.table_name,
+            segment=segment,
+            total_segments=total_segments,
+            limit=limit,
+            projection_expression="uaid, chidmessageid, #tl, #ts, #t, #s",
+            expression_attribute_names={"#tl": "ttl", "#ts": "timestamp",
+                                        "#t": "t", "#s": "s"},
+            return_consumed_capacity="TOTAL",
+            **kwargs
+        )
+        return (self.expired_keys(result.get("Items", []), now),
+                result.get("LastEvaluatedKey"),
+                result.get("ConsumedCapacity", {}).get("CapacityUnits", 0))
+
+    def expired_keys(self, items, now):
+        """Returns the ``(uaid, chidmessageid)`` keys of the expired messages
+        among scanned items in DynamoDB JSON form
+
+        Channel records have no ``ttl`` and never expire.
+
+        """
+        decode = self.table._dynamizer.decode
+        keys = []
+        for item in items:
+            ttl = item.get("ttl", item.get("t"))
+            timestamp = item.get("timestamp", item.get("s"))
+            if ttl is None or timestamp is None:
+                continue
+            if decode(ttl) + decode(timestamp) <= now:
+                keys.append((decode(item["uaid"]),
+                             decode(item["chidmessageid"])))
+        return keys
+
+    @track_provisioned
+    def delete_expired(self, keys):
+        """Deletes messages by their ``(uaid, chidmessageid)`` keys with
+        BatchWriteItem
+
+        :returns: The write capacity consumed.
+
+        """
+        conn = self.table.connection
+        capacity = 0
+        attempt = 0
+        while keys:
+            chunk, keys = keys[:25], keys[25:]
+            pending = {self.table.table_name: [
+                dict(DeleteRequest=dict(Key=self.encode(
+                    dict(uaid=uaid, chidmessageid=chidmessageid))))
+                for uaid, chidmessageid in chunk
+            ]}
+            while pending:
+                result = conn.batch_write_item(
+                    pending, return_consumed_capacity="TOTAL")
+                for consumed in result.get("ConsumedCapacity", []):
+                    capacity += consumed.get("CapacityUnits", 0)
+                pending = result.get("UnprocessedItems")
+                if pending:
+                    attempt += 1
+                    time.sleep(0.05 * (2 ** min(attempt, 8)))
+        return capacity
+
+    @track_provisioned
+    def fetch_messages(self, uaid, limit=10, start=None):
+        """Fetches messages for a uaid
+
+        :param start: Only fetch messages after this ``chidmessageid``, the
+                      last one of the previous page to continue after it.
+
+        """
+        conn = self.table.connection
+        key_conditions = {
+            "uaid": dict(AttributeValueList=[{"S": uaid}],
+                         ComparisonOperator="EQ"),
+            "chidmessageid": dict(
+                AttributeValueList=[{"S": start or self.messages_start}],
+                ComparisonOperator="GT"),
+        }
+        messages = []
+        last_key = None
+        while len(messages) < limit:
+            result = conn.query(self.table.table_name,
+                                key_conditions=key_conditions,
+                                consistent_read=True,
+                                limit=limit - len(messages),
+                                exclusive_start_key=last_key)
+            messages.extend(decode_item(raw, MessageRecord)
+                            for raw in result.get("Items", []))
+            last_key = result.get("LastEvaluatedKey")
+            if not last_key:
+                break
+        return messages
+
+
+class Topic(object):
+    """Create a Topic table abstraction on top of a DynamoDB Table object
+
+    A topic is a set of subscriptions, each stored under the endpoint token
+    it was registered with along with the UAID and CHID the token decrypted
+    to, so publishing to a topic needs no token decryption.
+
+    """
+    def __init__(self, table, metrics):
+        """Create a new Topic object
+
+        :param table: :class:`Table` object.
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+
+        """
+        self.table = table
+        self.metrics = metrics
+
+    @track_provisioned
+    def add_subscriptions(self, topic, subscriptions):
+        """Add subscriptions to a topic
+
+        :param subscriptions: Dict of endpoint token to a ``(uaid, chid)``
+                              tuple.
+
+        """
+        with self.table.batch_write() as batch:
+            for token, (uaid, chid) in subscriptions.items():
+                batch.put_item(data=dict(
+                    topic=topic,
+                    token=token,
+                    uaid=uaid,
+                    chid=chid,
+                ))
+        return True
+
+    @track_provisioned
+    def remove_subscriptions(self, topic, tokens):
+        """Remove the subscriptions of the endpoint tokens from a topic"""
+        with self.table.batch_write() as batch:
+            for token in tokens:
+                batch.delete_item(topic=topic, token=token)
+        return True
+
+    @track_provisioned
+    def delete_topic(self, topic):
+        """Remove every subscription of a topic
+
+        :returns: Whether the topic had any subscriptions.
+        :rtype: bool
+
+        """
+        results = self.table.query_2(
+            topic__eq=topic,
+            consistent=True,
+            attributes=("token",),
+        )
+        tokens = [x["token"] for x in results]
+        if tokens:
+            self.remove_subscriptions(topic, tokens)
+        return len(tokens) > 0
+
+    def fetch_subscriptions(self, topic, chunk_size=100):
+        """Returns an iterator over the subscriptions of a topic in lists of
+        up to ``chunk_size`` items
+
+        Every step of the iterator may query DynamoDB, so it should be
+        advanced in a thread.
+
+        """
+        results = self.table.query_2(
+            topic__eq=topic,
+            max_page_size=chunk_size,
+        )
+        chunk = []
+        for item in results:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
 
 class Router(object):
     """Create a Router table abstraction on top of a DynamoDB Table object"""
-    def __init__(self, table, metrics):
+    def __init__(self, table, metrics, cache=None, client=None,
+                 policy=None, governor=None, deadlines=None,
+                 executors=None):
         """Create a new Router object
 
         :param table: :class:`Table` object.
         :param metrics: Metrics object that implements the
                         :class:`autopush.metrics.IMetrics` interface.
+        :param cache: Optional :class:`~autopush.cache.RouterCache` that is
+                      invalidated whenever this object changes a record.
+        :param client: Optional :class:`~autopush.dynamodb.DynamoDBClient`
+                       for the non-blocking variants of the methods.
+        :param policy: Optional :class:`ReadPolicy`, every read is strongly
+                       consistent without one.
+        :param governor: Optional
+                         :class:`~autopush.governor.CapacityGovernor`
+                         pacing the methods called with :func:`defer_db`.
+        :param deadlines: Optional
+                          :class:`~autopush.deadlines.RequestDeadlines`
+                          bounding the methods called with
+                          :func:`defer_db`.
+        :param executors: Optional :class:`~autopush.executors.Executors`
+                          whose ``db-read`` and ``db-write`` pools the
+                          blocking methods called with :func:`defer_db` run
+                          on, instead of the reactor's thread pool.
 
         """
         self.table = table
         self.metrics = metrics
         self.encode = table._encode_keys
-
-    def get_uaid(self, uaid):
+        if cache is None:
+            cache = RouterCache(metrics)
+        self.cache = cache
+        if policy is None:
+            policy = ReadPolicy(metrics)
+        self.policy = policy
+        self.governor = governor
+        self.deadlines = deadlines
+        self.executors = executors
+        self.nonblocking = AsyncRouter(self, client) if client else None
+
+    @staticmethod
+    def projection(attributes):
+        """Returns the names of the attributes to read for a
+        :class:`~autopush.cache.RouteRecord`, always including the
+        ``uaid``"""
+        return ("uaid",) + tuple(name for name in attributes
+                                 if name != "uaid")
+
+    def get_uaid(self, uaid, attributes=None):
         """Get the database record for the UAID
 
-        :returns: User item
-        :rtype: :class:`~boto.dynamodb2.items.Item`
+        :param attributes: Optional names of the attributes the caller uses,
+                           only those and the ``uaid`` are then read.
+
+        :returns: User record, or a :class:`~autopush.cache.RouteRecord` of
+                  the ``attributes``
+        :rtype: :class:`~autopush.dynamodb.UserRecord`
         :raises:
             :exc:`ItemNotFound` if there is no record for this UAID.
             :exc:`ProvisionedThroughputExceededException` if dynamodb table
             exceeds throughput.
 
         """
+        conn = self.table.connection
+        key = self.encode(dict(uaid=uaid))
         try:
-            return self.table.get_item(consistent=True, uaid=uaid)
+            if attributes is None:
+                raw = conn.get_item(self.table.table_name, key,
+                                    consistent_read=True)
+            else:
+                attributes = self.projection(attributes)
+                raw = conn.get_item(self.table.table_name, key,
+                                    attributes_to_get=list(attributes),
+                                    consistent_read=True)
         except ProvisionedThroughputExceededException:
             # We unfortunately have to catch this here, as track_provisioned
             # will not see this, since JSONResponseError is a subclass and
@@ -499,6 +1175,122 @@ class Router(object):
             # JSON when looking up values in empty tables. We re-throw the
             # correct ItemNotFound exception
             raise ItemNotFound("uaid not found")
+        if "Item" not in raw:
+            raise ItemNotFound("uaid not found")
+        if attributes is None:
+            return decode_item(raw["Item"], UserRecord)
+        return RouteRecord(attributes, ((name, decode_value(value))
+                                        for name, value in raw["Item"].items()
+                                        if name in attributes))
+
+    def get_uaids(self, uaids, consistent=None):
+        """Get the database records for several UAIDs with BatchGetItem
+
+        Requests for more than 100 UAIDs are split over several BatchGetItem
+        calls, and unprocessed keys are retried.
+
+        :param consistent: Whether the records are read strongly consistent,
+                           by default as the :class:`ReadPolicy` says.
+                           Records missing from an eventually consistent
+                           read are read again strongly consistent.
+
+        :returns: Dict of UAID to user record for the UAIDs that were found
+        :rtype: dict
+        :raises:
+            :exc:`ProvisionedThroughputExceededException` if dynamodb table
+            exceeds throughput.
+
+        """
+        consistent = self.policy.consistent("get_uaids", consistent)
+        uaids = set(uaids)
+        try:
+            found = self._get_uaids(uaids, consistent)
+            missing = uaids.difference(found)
+            if missing and not consistent:
+                self.policy.stale("get_uaids")
+                found.update(self._get_uaids(missing, True))
+            return found
+        except ProvisionedThroughputExceededException:
+            self.metrics.increment("error.provisioned.get_uaids")
+            raise
+
+    def _get_uaids(self, uaids, consistent):
+        conn = self.table.connection
+        name = self.table.table_name
+        uaids = list(uaids)
+        found = {}
+        for start in range(0, len(uaids), 100):
+            pending = {name: dict(
+                Keys=[self.encode(dict(uaid=uaid))
+                      for uaid in uaids[start:start + 100]],
+                ConsistentRead=consistent,
+            )}
+            while pending:
+                result = conn.batch_get_item(pending)
+                for raw in result.get("Responses", {}).get(name, []):
+                    record = decode_item(raw, UserRecord)
+                    found[record["uaid"]] = record
+                pending = result.get("UnprocessedKeys")
+        return found
+
+    @track_provisioned
+    def get_uaid_and_channel(self, uaid, channel_id, messages):
+        """Get the database record for the UAID along with the channel's
+        marker items in the message tables, with one strongly consistent
+        BatchGetItem
+
+        The webpush endpoint doesn't know yet which message table the UAID
+        uses, so the marker is read from each of the ``messages`` tables
+        that writes markers. The others are left to
+        :meth:`Message.channel_exists`.
+
+        :param messages: :class:`Message` tables to look for the channel in.
+
+        :returns: Tuple of the user record, and the set of names of the
+                  message tables the channel's marker was found in
+        :rtype: tuple
+        :raises:
+            :exc:`ItemNotFound` if there is no record for this UAID.
+            :exc:`ProvisionedThroughputExceededException` if dynamodb table
+            exceeds throughput.
+
+        """
+        pending = self.subscription_keys(uaid, channel_id, messages)
+        responses = {}
+        while pending:
+            result = self.table.connection.batch_get_item(pending)
+            for name, items in result.get("Responses", {}).items():
+                responses.setdefault(name, []).extend(items)
+            pending = result.get("UnprocessedKeys")
+        return self.subscription_found(responses)
+
+    def subscription_keys(self, uaid, channel_id, messages):
+        """Returns the BatchGetItem request items reading the record of the
+        UAID and the channel's marker items, strongly consistent"""
+        keys = {self.table.table_name: dict(
+            Keys=[self.encode(dict(uaid=uaid))],
+            ConsistentRead=True,
+        )}
+        for message in messages:
+            if not message.channel_markers:
+                continue
+            keys[message.table.table_name] = dict(
+                Keys=[message.encode(dict(
+                    uaid=uaid,
+                    chidmessageid=message.channel_key % channel_id))],
+                AttributesToGet=["uaid"],
+                ConsistentRead=True,
+            )
+        return keys
+
+    def subscription_found(self, responses):
+        """Returns the user record and the set of message tables with the
+        channel's marker from the items of a BatchGetItem"""
+        records = responses.pop(self.table.table_name, None)
+        if not records:
+            raise ItemNotFound("uaid not found")
+        item = decode_item(records[0], UserRecord)
+        return item, set(name for name, items in responses.items() if items)
 
     @track_provisioned
     def register_user(self, data):
@@ -516,7 +1308,8 @@ class Router(object):
         """
         # Fetch a senderid for this user
         conn = self.table.connection
-        db_key = self.encode({"uaid": data.pop("uaid")})
+        uaid = data.pop("uaid")
+        db_key = self.encode({"uaid": uaid})
         # Generate our update expression
         expr = "SET " + ", ".join(["%s=:%s" % (x, x) for x in data.keys()])
         expr_values = self.encode({":%s" % k: v for k, v in data.items()})
@@ -536,24 +1329,20 @@ class Router(object):
                 expression_attribute_values=expr_values,
                 return_values="ALL_OLD",
             )
+            self.cache.invalidate(uaid)
             if "Attributes" in result:
-                r = {}
-                for key, value in result["Attributes"].items():
-                    try:
-                        r[key] = self.table._dynamizer.decode(value)
-                    except (TypeError, AttributeError):  # pragma: nocover
-                        # Included for safety as moto has occasionally made
-                        # this not work
-                        r[key] = value
-                result = r
+                result = decode_item(result["Attributes"], UserRecord)
             return (True, result)
         except ConditionalCheckFailedException:
+            # Someone else owns a newer record, ours is stale
+            self.cache.invalidate(uaid)
             return (False, {})
 
     @track_provisioned
     def drop_user(self, uaid):
         # The following hack ensures that only uaids that exist and are
         # deleted return true.
+        self.cache.invalidate(uaid)
         return self.table.delete_item(uaid=uaid, expected={"uaid__eq": uaid})
 
     @track_provisioned
@@ -569,6 +1358,7 @@ class Router(object):
             update_expression=expr,
             expression_attribute_values=expr_values,
         )
+        self.cache.invalidate(uaid)
         return True
 
     @track_provisioned
@@ -576,7 +1366,9 @@ class Router(object):
         """Given a router item and remove the node_id
 
         The node_id will only be cleared if the ``connected_at`` matches up
-        with the item's ``connected_at``.
+        with the item's ``connected_at``. A
+        :class:`~autopush.cache.RouteRecord` of the ``node_id`` and
+        ``connected_at`` will do.
 
         :returns: Whether the node was cleared or not.
         :rtype: bool
@@ -589,12 +1381,13 @@ class Router(object):
         # Pop out the node_id
         node_id = item["node_id"]
         del item["node_id"]
+        self.cache.invalidate(item["uaid"])
 
         try:
             cond = "(node_id = :node) and (connected_at = :conn)"
             conn.put_item(
                 self.table.table_name,
-                item=item.get_raw_keys(),
+                item=self.encode(dict(uaid=item["uaid"])),
                 condition_expression=cond,
                 expression_attribute_values=self.encode({
                     ":node": node_id,
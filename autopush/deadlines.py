@@ -0,0 +1,188 @@
+"""Deadlines and hedged requests for DynamoDB calls
+
+A DynamoDB call that hangs otherwise holds its caller, and for blocking
+calls one of the reactor's threads, for as long as boto keeps retrying.
+:class:`RequestDeadlines` bounds the calls :func:`~autopush.db.defer_db`
+makes: a call still running at its operation's deadline is cancelled and
+fails with :exc:`DeadlineExceeded`. A cancelled blocking call still finishes
+in its thread, its result is dropped.
+
+Idempotent reads can also be hedged. Once a hedged read has run longer than
+a percentile of its recent latencies the same read is made again, and
+whichever answers first is used while the other is cancelled. A hedge costs
+another read, at the default 95th percentile about one read in twenty.
+``hedge.sent.<operation>`` counts the hedges and ``hedge.won.<operation>``
+the hedges that answered first.
+
+"""
+from collections import deque
+
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.python.failure import Failure
+
+# Reads that can be made twice without a different outcome
+HEDGEABLE = ("get_uaid", "get_uaids", "get_uaid_and_channel", "all_channels",
+             "channel_exists", "fetch_messages", "fetch_notifications")
+
+
+class DeadlineExceeded(ProvisionedThroughputExceededException):
+    """A call cancelled at its deadline
+
+    Callers handle it like a throttled call, as a table too slow to answer
+    is most likely overloaded.
+
+    """
+    def __init__(self, operation, deadline):
+        super(DeadlineExceeded, self).__init__(
+            504, "Deadline Exceeded",
+            {"message": "%s took longer than %ss" % (operation, deadline)})
+
+
+class HedgedCall(object):
+    """The attempts of one hedged read, the first answer wins
+
+    A failed attempt only fails the read when no other attempt is left to
+    answer.
+
+    """
+    def __init__(self, deadlines, operation, attempt, delay):
+        self.deadlines = deadlines
+        self.operation = operation
+        self.attempt = attempt
+        self.pending = []
+        self.result = Deferred(self._cancel)
+        self._start(False)
+        self._timer = deadlines.clock.callLater(delay, self._hedge)
+
+    def _start(self, hedge):
+        d = self.attempt()
+        self.pending.append(d)
+        d.addBoth(self._answered, d, hedge)
+
+    def _hedge(self):
+        self._timer = None
+        self.deadlines.metrics.increment("hedge.sent.%s" % self.operation)
+        self._start(True)
+
+    def _answered(self, outcome, d, hedge):
+        self.pending.remove(d)
+        if self.result.called:
+            return None
+        failed = isinstance(outcome, Failure)
+        if failed and self.pending:
+            return None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if hedge and not failed:
+            self.deadlines.metrics.increment("hedge.won.%s" % self.operation)
+        if failed:
+            self.result.errback(outcome)
+        else:
+            self.result.callback(outcome)
+        for other in list(self.pending):
+            other.cancel()
+        return None
+
+    def _cancel(self, result):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for d in list(self.pending):
+            d.cancel()
+
+
+class RequestDeadlines(object):
+    """Bounds DynamoDB calls by deadlines, and hedges idempotent reads"""
+    # Testing purposes
+    clock = reactor
+
+    def __init__(self, metrics, deadline=0, deadlines=None, hedged=(),
+                 hedge_percentile=95, samples=100):
+        """Create a new RequestDeadlines
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param deadline: Seconds a call may take, 0 for no deadline.
+        :param deadlines: Dict of operations to their own deadline in
+                          seconds, 0 for no deadline.
+        :param hedged: Names of the :data:`HEDGEABLE` operations to hedge.
+        :param hedge_percentile: Percentile of the recent latencies of an
+                                 operation after which a read is hedged.
+        :param samples: Amount of recent latencies kept per operation.
+
+        """
+        unknown = set(hedged) - set(HEDGEABLE)
+        if unknown:
+            raise ValueError("Calls can't be hedged for: %s" %
+                             ", ".join(sorted(unknown)))
+        self.metrics = metrics
+        self.deadline = deadline
+        self.deadlines = deadlines or {}
+        self.hedged = frozenset(hedged)
+        self.hedge_percentile = hedge_percentile
+        self.samples = samples
+        self._latencies = {}
+        self._seen = {}
+        self._delays = {}
+
+    def call(self, call, func, *args, **kwargs):
+        """Returns the deferred of ``call(func, *args, **kwargs)`` bounded
+        by the deadline of the operation ``func`` is named after, and
+        hedged if it's one of the hedged reads"""
+        operation = func.__name__
+        if operation in self.hedged:
+            d = self._hedged(operation, call, func, args, kwargs)
+        else:
+            d = call(func, *args, **kwargs)
+        deadline = self.deadlines.get(operation, self.deadline)
+        if deadline > 0:
+            d = self._bounded(d, operation, deadline)
+        return d
+
+    def hedge_delay(self, operation):
+        """Returns the seconds after which a read of the operation is
+        hedged, None until enough latencies were seen"""
+        return self._delays.get(operation)
+
+    def _hedged(self, operation, call, func, args, kwargs):
+        def attempt():
+            started = self.clock.seconds()
+            d = call(func, *args, **kwargs)
+            d.addCallback(self._record, operation, started)
+            return d
+        delay = self._delays.get(operation)
+        if delay is None:
+            return attempt()
+        return HedgedCall(self, operation, attempt, delay).result
+
+    def _record(self, result, operation, started):
+        latencies = self._latencies.get(operation)
+        if latencies is None:
+            latencies = self._latencies[operation] = deque(
+                maxlen=self.samples)
+        latencies.append(self.clock.seconds() - started)
+        # The percentile is recomputed every tenth of the samples, once all
+        # of them were seen
+        seen = self._seen[operation] = self._seen.get(operation, 0) + 1
+        if seen >= self.samples and seen % max(self.samples // 10, 1) == 0:
+            ordered = sorted(latencies)
+            index = len(ordered) * self.hedge_percentile // 100
+            self._delays[operation] = ordered[min(index, len(ordered) - 1)]
+        return result
+
+    def _bounded(self, d, operation, deadline):
+        timer = self.clock.callLater(deadline, d.cancel)
+
+        def finished(result):
+            if timer.active():
+                timer.cancel()
+            elif isinstance(result, Failure) and \
+                    result.check(CancelledError):
+                self.metrics.increment("deadline.exceeded.%s" % operation)
+                raise DeadlineExceeded(operation, deadline)
+            return result
+        d.addBoth(finished)
+        return d
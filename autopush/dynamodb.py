@@ -0,0 +1,920 @@
+"""Non-blocking DynamoDB access on the reactor
+
+The table objects of :mod:`autopush.db` make blocking boto calls, so each of
+them costs a thread from the reactor's thread pool, which caps how many
+DynamoDB operations a node can have in flight.
+
+:class:`DynamoDBClient` makes the same requests to the DynamoDB JSON API with
+the reactor's HTTP client over a pool of persistent connections, signed with
+AWS Signature Version 4 using the credentials and region boto was configured
+with. Failed requests errback with the same boto exceptions boto raises, and
+throttled requests are retried with boto's backoff.
+
+:class:`AsyncStorage`, :class:`AsyncMessage` and :class:`AsyncRouter` are
+Deferred returning variants of :class:`~autopush.db.Storage`,
+:class:`~autopush.db.Message` and :class:`~autopush.db.Router` with the same
+methods, arguments, results and exceptions. They're set up as the
+``nonblocking`` attribute of those objects when the client is enabled, see
+:func:`autopush.db.defer_db`.
+
+"""
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import time
+import uuid
+from functools import wraps
+from StringIO import StringIO
+
+from boto.dynamodb.types import DYNAMODB_CONTEXT, Binary
+from boto.dynamodb2 import exceptions
+from boto.dynamodb2.exceptions import (
+    ConditionalCheckFailedException,
+    ItemNotFound,
+    ProvisionedThroughputExceededException,
+)
+from boto.dynamodb2.items import Item
+from boto.exception import JSONResponseError
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    gatherResults,
+    inlineCallbacks,
+    returnValue,
+)
+from twisted.internet.task import deferLater
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody,
+)
+from twisted.web.http_headers import Headers
+
+from autopush.cache import RouteRecord
+
+API_VERSION = "DynamoDB_20120810"
+RETRIED_ERRORS = ("ProvisionedThroughputExceededException",
+                  "ThrottlingException")
+
+
+def _sign(key, msg):
+    return hmac.new(key, msg.encode("utf8"), hashlib.sha256).digest()
+
+
+def is_storable(value):
+    """Whether boto would store an attribute value, it skips empty ones"""
+    return bool(value) or value in (0, 0.0, False)
+
+
+class Record(dict):
+    """Item decoded from DynamoDB JSON into a plain dict
+
+    Like a boto :class:`~boto.dynamodb2.items.Item`, a missing attribute
+    reads as None, but without an object and a dynamizer per item.
+
+    """
+    __slots__ = ()
+
+    def __missing__(self, key):
+        return None
+
+
+class UserRecord(Record):
+    """Router table record of a UAID"""
+    __slots__ = ()
+
+
+class MessageRecord(Record):
+    """Stored webpush message, or channel record, of a message table"""
+    __slots__ = ()
+
+
+def _decode_binary(value):
+    return Binary(base64.b64decode(value))
+
+
+_DECODERS = {
+    "S": lambda value: value,
+    "N": DYNAMODB_CONTEXT.create_decimal,
+    "B": _decode_binary,
+    "SS": set,
+    "NS": lambda values: set(DYNAMODB_CONTEXT.create_decimal(value)
+                             for value in values),
+    "BS": lambda values: set(_decode_binary(value) for value in values),
+    "BOOL": bool,
+    "NULL": lambda value: None,
+}
+
+
+def decode_value(value):
+    """Decode an attribute value in DynamoDB JSON form to the value boto's
+    dynamizer decodes it to"""
+    for kind, raw in value.iteritems():
+        decoder = _DECODERS.get(kind)
+        if decoder is not None:
+            return decoder(raw)
+        if kind == "M":
+            return dict((name, decode_value(item))
+                        for name, item in raw.iteritems())
+        if kind == "L":
+            return [decode_value(item) for item in raw]
+        raise TypeError("Unsupported attribute type %s" % kind)
+
+
+def decode_item(raw, record=Record):
+    """Decode an item in DynamoDB JSON form into a :class:`Record`"""
+    return record((name, decode_value(value))
+                  for name, value in raw.iteritems())
+
+
+class DynamoDBClient(object):
+    """Makes DynamoDB API requests on the reactor"""
+    def __init__(self, host, region, provider, port=None, is_secure=True,
+                 connections=50, retries=10):
+        """Create a new DynamoDBClient
+
+        :param host: Hostname of the DynamoDB endpoint.
+        :param region: Region name requests are signed for.
+        :param provider: :class:`boto.provider.Provider` holding the
+                         credentials requests are signed with.
+        :param port: Port of the endpoint, if not the default one.
+        :param is_secure: Whether to use HTTPS.
+        :param connections: Maximum persistent connections to the endpoint.
+        :param retries: Times a throttled request is retried.
+
+        """
+        scheme = "https" if is_secure else "http"
+        default_port = 443 if is_secure else 80
+        self.host = host
+        if port and port != default_port:
+            self.host = "%s:%s" % (host, port)
+        self.url = "%s://%s/" % (scheme, self.host)
+        self.region = region
+        self.provider = provider
+        self.retries = retries
+        pool = HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = connections
+        self.agent = Agent(reactor, connectTimeout=5, pool=pool)
+
+    @classmethod
+    def from_connection(cls, connection, **kwargs):
+        """Create a client for the endpoint and credentials of a boto
+        :class:`~boto.dynamodb2.layer1.DynamoDBConnection`"""
+        return cls(connection.host, connection.region.name,
+                   connection.provider, port=connection.port,
+                   is_secure=connection.is_secure, **kwargs)
+
+    def sign(self, operation, body, now=None):
+        """Returns the headers of a request, including its SigV4
+        Authorization header"""
+        now = now or datetime.datetime.utcnow()
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = now.strftime("%Y%m%d")
+        headers = {
+            "content-type": "application/x-amz-json-1.0",
+            "host": self.host,
+            "x-amz-date": amz_date,
+            "x-amz-target": "%s.%s" % (API_VERSION, operation),
+        }
+        token = self.provider.security_token
+        if token:
+            headers["x-amz-security-token"] = token
+        signed_headers = ";".join(sorted(headers))
+        canonical = "\n".join([
+            "POST",
+            "/",
+            "",
+            "".join("%s:%s\n" % (name, headers[name])
+                    for name in sorted(headers)),
+            signed_headers,
+            hashlib.sha256(body).hexdigest(),
+        ])
+        scope = "%s/%s/dynamodb/aws4_request" % (datestamp, self.region)
+        to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical).hexdigest(),
+        ])
+        key = _sign(("AWS4" + self.provider.secret_key).encode("utf8"),
+                    datestamp)
+        for part in (self.region, "dynamodb", "aws4_request"):
+            key = _sign(key, part)
+        signature = hmac.new(key, to_sign, hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, "
+            "Signature=%s" % (self.provider.access_key, scope,
+                              signed_headers, signature))
+        return headers
+
+    @inlineCallbacks
+    def request(self, operation, params):
+        """Returns a deferred for the decoded response of an API operation
+
+        Throttled requests are retried with boto's exponential backoff.
+
+        :raises:
+            The boto exception of the error DynamoDB returned, such as
+            :exc:`ProvisionedThroughputExceededException` or
+            :exc:`ConditionalCheckFailedException`.
+
+        """
+        body = json.dumps(params)
+        attempt = 0
+        while True:
+            try:
+                result = yield self._send(operation, body)
+                returnValue(result)
+            except JSONResponseError as exc:
+                retry = exc.error_code in RETRIED_ERRORS or exc.status >= 500
+                if not retry or attempt >= self.retries:
+                    raise
+            delay = 0 if attempt == 0 else 0.05 * (2 ** attempt)
+            attempt += 1
+            yield deferLater(reactor, delay, lambda: None)
+
+    def _send(self, operation, body):
+        """Send one request for an API operation"""
+        headers = Headers(dict((name, [value]) for name, value in
+                               self.sign(operation, body).items()))
+        d = self.agent.request("POST", self.url, headers,
+                               FileBodyProducer(StringIO(body)))
+        d.addCallback(self._response)
+        return d
+
+    def _response(self, response):
+        d = readBody(response)
+        d.addCallback(self._decode, response.code, response.phrase)
+        return d
+
+    def _decode(self, body, status, reason):
+        """Decode a response body, raising the boto exception of errors"""
+        data = json.loads(body) if body else {}
+        if status == 200:
+            return data
+        fault = data.get("__type", "").split("#")[-1]
+        exc = getattr(exceptions, fault, None)
+        if not isinstance(exc, type) or \
+                not issubclass(exc, JSONResponseError):
+            exc = JSONResponseError
+        raise exc(status, reason, data)
+
+
+def track_provisioned(func):
+    """Tracks provisioned exceptions of a deferred and increments a metric
+    for them named after the function decorated"""
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        d = func(self, *args, **kwargs)
+        d.addErrback(self._provisioned_err, func.__name__)
+        return d
+    return wrapper
+
+
+def gather(deferreds):
+    """Returns a deferred for the list of results of several deferreds,
+    failing with the first failure"""
+    d = gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(lambda fail: fail.value.subFailure)
+    return d
+
+
+class AsyncTable(object):
+    """Common helpers of the Deferred returning table objects"""
+    #: :class:`Record` class items are decoded into
+    record = None
+
+    def __init__(self, parent, client):
+        """Create a Deferred returning variant of a table object
+
+        :param parent: The :mod:`autopush.db` table object.
+        :param client: :class:`DynamoDBClient` making the requests.
+
+        """
+        self.parent = parent
+        self.client = client
+        self.table = parent.table
+        self.table_name = parent.table.table_name
+        self.metrics = parent.metrics
+        self.encode = parent.encode
+        self.decode = decode_value
+
+    def encode_item(self, data):
+        """Encode a dict of attribute values for a PutItem, skipping the
+        values boto wouldn't store"""
+        return self.encode(dict((key, value) for key, value in data.items()
+                                if is_storable(value)))
+
+    def make_item(self, raw):
+        """Returns the :attr:`record` for an item in DynamoDB JSON form, or
+        a boto :class:`~boto.dynamodb2.items.Item` if it has none"""
+        if self.record is not None:
+            return decode_item(raw, self.record)
+        item = Item(self.table)
+        item.load(dict(Item=raw))
+        return item
+
+    def _provisioned_err(self, fail, name):
+        """errBack counting provisioned exceptions"""
+        fail.trap(ProvisionedThroughputExceededException)
+        self.metrics.increment("error.provisioned.%s" % name)
+        return fail
+
+    def _request(self, operation, **params):
+        params["TableName"] = self.table_name
+        return self.client.request(operation, params)
+
+    def _conditional(self, d):
+        """Fires with True, or False if the request's condition failed"""
+        def failed(fail):
+            fail.trap(ConditionalCheckFailedException)
+            return False
+        d.addCallback(lambda result: True)
+        d.addErrback(failed)
+        return d
+
+    @inlineCallbacks
+    def _query(self, limit=None, **params):
+        """Returns a deferred for the items of a query, following its
+        pages"""
+        items = []
+        while True:
+            if limit:
+                params["Limit"] = limit - len(items)
+            result = yield self._request("Query", **params)
+            items.extend(self.make_item(raw)
+                         for raw in result.get("Items", []))
+            last_key = result.get("LastEvaluatedKey")
+            if not last_key or (limit and len(items) >= limit):
+                returnValue(items)
+            params["ExclusiveStartKey"] = last_key
+
+    @inlineCallbacks
+    def _batch_write(self, requests):
+        """Send write requests with BatchWriteItem, 25 at a time, retrying
+        unprocessed ones"""
+        while requests:
+            chunk, requests = requests[:25], requests[25:]
+            pending = {self.table_name: chunk}
+            attempt = 0
+            while pending:
+                result = yield self.client.request(
+                    "BatchWriteItem", dict(RequestItems=pending))
+                pending = result.get("UnprocessedItems")
+                if pending:
+                    attempt += 1
+                    yield deferLater(reactor, 0.05 * (2 ** min(attempt, 8)),
+                                     lambda: None)
+
+
+class AsyncStorage(AsyncTable):
+    """Deferred returning variant of :class:`~autopush.db.Storage`"""
+    @track_provisioned
+    def fetch_notifications(self, uaid):
+        """Fetch all notifications for a UAID"""
+        return self._query(
+            KeyConditionExpression="uaid = :uaid and chid > :chid",
+            ExpressionAttributeValues=self.encode({":uaid": uaid,
+                                                   ":chid": " "}),
+            ConsistentRead=True,
+        )
+
+    @track_provisioned
+    def save_notification(self, uaid, chid, version):
+        """Save a notification for the UAID"""
+        return self._conditional(self._request(
+            "PutItem",
+            Item=self.encode(dict(uaid=uaid, chid=chid, version=version)),
+            ConditionExpression="attribute_not_exists(version) or "
+                                "version < :ver",
+            ExpressionAttributeValues={":ver": {"N": str(version)}},
+        ))
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification for a UAID"""
+        params = dict(Key=self.encode(dict(uaid=uaid, chid=chid)))
+        if version:
+            params["ConditionExpression"] = "version = :ver"
+            params["ExpressionAttributeValues"] = self.encode(
+                {":ver": version})
+        d = self._request("DeleteItem", **params)
+        d.addCallback(lambda result: True)
+        d.addErrback(self._delete_provisioned_err)
+        return d
+
+    def delete_notifications(self, uaid, notifications):
+        """Delete several notifications for a UAID at once"""
+        d = gather([self.delete_notification(uaid, chid, version)
+                    for chid, version in notifications])
+        d.addCallback(all)
+        return d
+
+    def _delete_provisioned_err(self, fail):
+        fail.trap(ProvisionedThroughputExceededException)
+        self.metrics.increment("error.provisioned.delete_notification")
+        return False
+
+
+class AsyncMessage(AsyncTable):
+    """Deferred returning variant of :class:`~autopush.db.Message`"""
+    record = MessageRecord
+
+    def _key(self, uaid, chidmessageid=" "):
+        return self.encode(dict(uaid=uaid, chidmessageid=chidmessageid))
+
+    @track_provisioned
+    def register_channel(self, uaid, channel_id):
+        """Register a channel for a given uaid"""
+        d = self._request(
+            "UpdateItem",
+            Key=self._key(uaid),
+            UpdateExpression="ADD chids :channel_id",
+            ExpressionAttributeValues=self.encode(
+                {":channel_id": set([channel_id])}),
+        )
+        if self.parent.channel_markers:
+            d.addCallback(lambda result: self._put_channel_marker(
+                uaid, channel_id))
+        else:
+            d.addCallback(lambda result: True)
+        return d
+
+    def _channel_marker(self, uaid, channel_id):
+        return self._key(uaid, self.parent.channel_key % channel_id)
+
+    def _put_channel_marker(self, uaid, channel_id):
+        d = self._request("PutItem",
+                          Item=self._channel_marker(uaid, channel_id))
+        d.addCallback(lambda result: True)
+        return d
+
+    @track_provisioned
+    @inlineCallbacks
+    def unregister_channel(self, uaid, channel_id, **kwargs):
+        """Remove a channel registration for a given uaid"""
+        if self.parent.channel_markers:
+            yield self._request("DeleteItem",
+                                Key=self._channel_marker(uaid, channel_id))
+        result = yield self._request(
+            "UpdateItem",
+            Key=self._key(uaid),
+            UpdateExpression="DELETE chids :channel_id",
+            ExpressionAttributeValues=self.encode(
+                {":channel_id": set([channel_id])}),
+            ReturnValues="UPDATED_OLD",
+        )
+        returnValue(self._channel_removed(result, channel_id))
+
+    def _channel_removed(self, result, channel_id):
+        chids = result.get("Attributes", {}).get("chids")
+        if chids:
+            return channel_id in self.decode(chids)
+        return False
+
+    @track_provisioned
+    def all_channels(self, uaid):
+        """Retrieve a list of all channels for a given uaid"""
+        d = self._request("GetItem", Key=self._key(uaid),
+                          ConsistentRead=True)
+        d.addCallback(self._channels_found)
+        return d
+
+    def _channels_found(self, result):
+        if "Item" not in result:
+            return False, set([])
+        chids = result["Item"].get("chids")
+        if not chids:
+            return True, set([])
+        return True, self.decode(chids)
+
+    @track_provisioned
+    @inlineCallbacks
+    def channel_exists(self, uaid, channel_id, consistent=None):
+        """Returns whether a channel is registered for a given uaid, from
+        its marker item"""
+        if not self.parent.channel_markers:
+            _, chans = yield self.all_channels(uaid)
+            returnValue(channel_id in chans)
+        policy = self.parent.policy
+        consistent = policy.consistent("channel_exists", consistent)
+        result = yield self._request(
+            "GetItem",
+            Key=self._channel_marker(uaid, channel_id),
+            ProjectionExpression="uaid",
+            ConsistentRead=consistent,
+        )
+        if "Item" in result:
+            returnValue(True)
+        if not consistent:
+            policy.stale("channel_exists")
+        _, chans = yield self.all_channels(uaid)
+        if channel_id not in chans:
+            returnValue(False)
+        yield self._put_channel_marker(uaid, channel_id)
+        returnValue(True)
+
+    @track_provisioned
+    @inlineCallbacks
+    def save_channels(self, uaid, channels):
+        """Save out a set of channels"""
+        yield self._put_new(dict(uaid=uaid, chidmessageid=" ",
+                                 chids=channels))
+        if not self.parent.channel_markers:
+            return
+        yield self._batch_write([
+            dict(PutRequest=dict(Item=self._channel_marker(uaid,
+                                                           channel_id)))
+            for channel_id in channels
+        ])
+
+    @track_provisioned
+    def store_message(self, uaid, channel_id, message_id, ttl, data=None,
+                      headers=None, timestamp=None):
+        """Stores a message in the message table for the given uaid/channel
+        with the message id"""
+        return self._put_new(self.parent.message_item(
+            uaid, channel_id, message_id, ttl, data, headers, timestamp))
+
+    @track_provisioned
+    def store_messages(self, items):
+        """Stores several message items with BatchWriteItem"""
+        d = self._batch_write([
+            dict(PutRequest=dict(Item=self.encode_item(item)))
+            for item in items
+        ])
+        d.addCallback(lambda result: True)
+        return d
+
+    def _put_new(self, item):
+        """Put an item that must not exist yet, like boto's
+        ``Table.put_item`` without ``overwrite``"""
+        d = self._request(
+            "PutItem",
+            Item=self.encode_item(item),
+            ConditionExpression="attribute_not_exists(uaid)",
+        )
+        d.addCallback(lambda result: True)
+        return d
+
+    @track_provisioned
+    def update_message(self, uaid, channel_id, message_id, ttl, data=None,
+                       headers=None, timestamp=None):
+        """Updates a message in the message table for the given
+        uaid/channel/message_id.
+
+        If the message is not present, or a version 2 item, False is
+        returned.
+
+        """
+        item = dict(
+            ttl=ttl,
+            timestamp=timestamp or int(time.time()),
+            updateid=uuid.uuid4().hex
+        )
+        if data:
+            item["headers"] = headers
+            item["data"] = data
+        expr = "SET #tl=:ttl, #ts=:timestamp, updateid=:updateid"
+        if data:
+            expr += ", #dd=:data, headers=:headers"
+        else:
+            expr += " REMOVE #dd, headers"
+        return self._conditional(self._request(
+            "UpdateItem",
+            Key=self._key(uaid, "%s:%s" % (channel_id, message_id)),
+            ConditionExpression="attribute_exists(updateid)",
+            UpdateExpression=expr,
+            ExpressionAttributeNames={"#tl": "ttl", "#ts": "timestamp",
+                                      "#dd": "data"},
+            ExpressionAttributeValues=self.encode(
+                dict((":%s" % k, v) for k, v in item.items())),
+        ))
+
+    @track_provisioned
+    def delete_message(self, uaid, channel_id, message_id, updateid=None):
+        """Deletes a specific message"""
+        params = dict(Key=self._key(uaid, "%s:%s" % (channel_id,
+                                                     message_id)))
+        if updateid:
+            params["ConditionExpression"] = "updateid = :updateid"
+            values = {":updateid": updateid}
+            packed = self.parent.packed_updateid(updateid)
+            if packed is not None:
+                params["ConditionExpression"] += " or #u = :u"
+                params["ExpressionAttributeNames"] = {"#u": "u"}
+                values[":u"] = packed
+            params["ExpressionAttributeValues"] = self.encode(values)
+            return self._conditional(self._request("DeleteItem", **params))
+        d = self._request("DeleteItem", **params)
+        d.addCallback(lambda result: True)
+        return d
+
+    def delete_acked(self, uaid, messages):
+        """Deletes the messages a client acknowledged, the conditional
+        deletes are made concurrently"""
+        chidmessageids = []
+        deletes = []
+        for channel_id, message_id, updateid in messages:
+            if updateid:
+                deletes.append(self.delete_message(uaid, channel_id,
+                                                   message_id,
+                                                   updateid=updateid))
+            else:
+                chidmessageids.append("%s:%s" % (channel_id, message_id))
+        if chidmessageids:
+            deletes.append(self.delete_messages(uaid, chidmessageids))
+        d = gather(deletes)
+        d.addCallback(lambda result: True)
+        return d
+
+    def delete_messages(self, uaid, chidmessageids):
+        """Deletes messages with BatchWriteItem"""
+        return self._batch_write([
+            dict(DeleteRequest=dict(Key=self._key(uaid, chidmessageid)))
+            for chidmessageid in chidmessageids if chidmessageid
+        ])
+
+    @track_provisioned
+    @inlineCallbacks
+    def delete_messages_for_channel(self, uaid, channel_id):
+        """Deletes all messages for a uaid/channel_id"""
+        chidmessageids = yield self._message_ids(
+            "uaid = :uaid and begins_with(chidmessageid, :chid)",
+            {":uaid": uaid, ":chid": "%s:" % channel_id})
+        if chidmessageids:
+            yield self.delete_messages(uaid, chidmessageids)
+        returnValue(len(chidmessageids) > 0)
+
+    @track_provisioned
+    @inlineCallbacks
+    def delete_user(self, uaid):
+        """Deletes all messages and channel info for a given uaid"""
+        chidmessageids = yield self._message_ids(
+            "uaid = :uaid and chidmessageid >= :chid",
+            {":uaid": uaid, ":chid": " "})
+        if chidmessageids:
+            yield self.delete_messages(uaid, chidmessageids)
+
+    def _message_ids(self, condition, values):
+        d = self._query(
+            KeyConditionExpression=condition,
+            ExpressionAttributeValues=self.encode(values),
+            ProjectionExpression="chidmessageid",
+            ConsistentRead=True,
+        )
+        d.addCallback(lambda items: [x["chidmessageid"] for x in items])
+        return d
+
+    @track_provisioned
+    def scan_expired(self, segment, total_segments, start_key=None,
+                     limit=100, now=None):
+        """Scans a page of a segment of the table for expired messages"""
+        now = now or int(time.time())
+        params = dict(
+            Segment=segment,
+            TotalSegments=total_segments,
+            Limit=limit,
+            ProjectionExpression="uaid, chidmessageid, #tl, #ts, #t, #s",
+            ExpressionAttributeNames={"#tl": "ttl", "#ts": "timestamp",
+                                      "#t": "t", "#s": "s"},
+            ReturnConsumedCapacity="TOTAL",
+        )
+        if start_key:
+            params["ExclusiveStartKey"] = start_key
+        d = self._request("Scan", **params)
+        d.addCallback(lambda result: (
+            self.parent.expired_keys(result.get("Items", []), now),
+            result.get("LastEvaluatedKey"),
+            result.get("ConsumedCapacity", {}).get("CapacityUnits", 0)))
+        return d
+
+    @track_provisioned
+    @inlineCallbacks
+    def delete_expired(self, keys):
+        """Deletes messages by their ``(uaid, chidmessageid)`` keys with
+        BatchWriteItem, returns the write capacity consumed"""
+        capacity = 0
+        attempt = 0
+        while keys:
+            chunk, keys = keys[:25], keys[25:]
+            pending = {self.table_name: [
+                dict(DeleteRequest=dict(Key=self._key(uaid, chidmessageid)))
+                for uaid, chidmessageid in chunk
+            ]}
+            while pending:
+                result = yield self.client.request(
+                    "BatchWriteItem", dict(RequestItems=pending,
+                                           ReturnConsumedCapacity="TOTAL"))
+                for consumed in result.get("ConsumedCapacity", []):
+                    capacity += consumed.get("CapacityUnits", 0)
+                pending = result.get("UnprocessedItems")
+                if pending:
+                    attempt += 1
+                    yield deferLater(reactor, 0.05 * (2 ** min(attempt, 8)),
+                                     lambda: None)
+        returnValue(capacity)
+
+    @track_provisioned
+    def fetch_messages(self, uaid, limit=10, start=None):
+        """Fetches messages for a uaid, after the ``start`` message"""
+        return self._query(
+            limit=limit,
+            KeyConditionExpression="uaid = :uaid and chidmessageid > :chid",
+            ExpressionAttributeValues=self.encode(
+                {":uaid": uaid,
+                 ":chid": start or self.parent.messages_start}),
+            ConsistentRead=True,
+        )
+
+
+class AsyncRouter(AsyncTable):
+    """Deferred returning variant of :class:`~autopush.db.Router`"""
+    record = UserRecord
+
+    def __init__(self, parent, client):
+        super(AsyncRouter, self).__init__(parent, client)
+        self.cache = parent.cache
+        self._projections = {}
+
+    @track_provisioned
+    def get_uaid(self, uaid, attributes=None):
+        """Get the database record for the UAID, or a
+        :class:`~autopush.cache.RouteRecord` of just the ``attributes``
+
+        :raises:
+            :exc:`ItemNotFound` if there is no record for this UAID.
+
+        """
+        params = {}
+        if attributes is not None:
+            attributes = self.parent.projection(attributes)
+            params = self._projection(attributes)
+        d = self._request("GetItem", Key=self.encode(dict(uaid=uaid)),
+                          ConsistentRead=True, **params)
+        d.addCallback(self._uaid_found, attributes)
+        return d
+
+    def _projection(self, attributes):
+        """Returns the projection parameters reading the attributes, built
+        once per set of attributes"""
+        params = self._projections.get(attributes)
+        if params is None:
+            names = dict(("#a%d" % i, name)
+                         for i, name in enumerate(attributes))
+            params = self._projections[attributes] = dict(
+                ProjectionExpression=", ".join(sorted(names)),
+                ExpressionAttributeNames=names,
+            )
+        return params
+
+    def _uaid_found(self, result, attributes=None):
+        if not result.get("Item"):
+            raise ItemNotFound("uaid not found")
+        if attributes is None:
+            return self.make_item(result["Item"])
+        return RouteRecord(attributes, (
+            (name, self.decode(value))
+            for name, value in result["Item"].items()))
+
+    @track_provisioned
+    @inlineCallbacks
+    def get_uaids(self, uaids, consistent=None):
+        """Get the database records for several UAIDs with BatchGetItem,
+        100 at a time, retrying unprocessed keys"""
+        policy = self.parent.policy
+        consistent = policy.consistent("get_uaids", consistent)
+        uaids = set(uaids)
+        found = yield self._get_uaids(uaids, consistent)
+        missing = uaids.difference(found)
+        if missing and not consistent:
+            policy.stale("get_uaids")
+            found.update((yield self._get_uaids(missing, True)))
+        returnValue(found)
+
+    @inlineCallbacks
+    def _get_uaids(self, uaids, consistent):
+        keys = [self.encode(dict(uaid=uaid)) for uaid in uaids]
+        found = {}
+        while keys:
+            chunk, keys = keys[:100], keys[100:]
+            pending = {self.table_name: dict(Keys=chunk,
+                                             ConsistentRead=consistent)}
+            while pending:
+                result = yield self.client.request(
+                    "BatchGetItem", dict(RequestItems=pending))
+                for raw in result.get("Responses", {}).get(
+                        self.table_name, []):
+                    item = self.make_item(raw)
+                    found[item["uaid"]] = item
+                pending = result.get("UnprocessedKeys")
+        returnValue(found)
+
+    @track_provisioned
+    @inlineCallbacks
+    def get_uaid_and_channel(self, uaid, channel_id, messages):
+        """Get the database record for the UAID along with the set of
+        message tables the channel's marker was found in, with one strongly
+        consistent BatchGetItem"""
+        pending = self.parent.subscription_keys(uaid, channel_id, messages)
+        responses = {}
+        while pending:
+            result = yield self.client.request(
+                "BatchGetItem", dict(RequestItems=pending))
+            for name, items in result.get("Responses", {}).items():
+                responses.setdefault(name, []).extend(items)
+            pending = result.get("UnprocessedKeys")
+        returnValue(self.parent.subscription_found(responses))
+
+    @track_provisioned
+    def register_user(self, data):
+        """Register this user
+
+        If a record exists with a newer ``connected_at``, then the user will
+        not be registered.
+
+        """
+        uaid = data.pop("uaid")
+        expr = "SET " + ", ".join(["%s=:%s" % (x, x) for x in data.keys()])
+        d = self._request(
+            "UpdateItem",
+            Key=self.encode(dict(uaid=uaid)),
+            UpdateExpression=expr,
+            ConditionExpression="""(
+                attribute_not_exists(router_type) or
+                (router_type = :router_type)
+            ) and (
+                attribute_not_exists(node_id) or
+                (connected_at < :connected_at)
+            )""",
+            ExpressionAttributeValues=self.encode(
+                dict((":%s" % k, v) for k, v in data.items())),
+            ReturnValues="ALL_OLD",
+        )
+        d.addCallback(self._user_registered, uaid)
+        d.addErrback(self._user_stale, uaid)
+        return d
+
+    def _user_registered(self, result, uaid):
+        self.cache.invalidate(uaid)
+        if "Attributes" in result:
+            result = decode_item(result["Attributes"], UserRecord)
+        return (True, result)
+
+    def _user_stale(self, fail, uaid):
+        fail.trap(ConditionalCheckFailedException)
+        # Someone else owns a newer record, ours is stale
+        self.cache.invalidate(uaid)
+        return (False, {})
+
+    @track_provisioned
+    def drop_user(self, uaid):
+        """Drop the record of a UAID, returns whether it existed"""
+        self.cache.invalidate(uaid)
+        return self._conditional(self._request(
+            "DeleteItem",
+            Key=self.encode(dict(uaid=uaid)),
+            ConditionExpression="uaid = :uaid",
+            ExpressionAttributeValues=self.encode({":uaid": uaid}),
+        ))
+
+    @track_provisioned
+    def update_message_month(self, uaid, month):
+        """Update the route tables current_message_month"""
+        d = self._request(
+            "UpdateItem",
+            Key=self.encode(dict(uaid=uaid)),
+            UpdateExpression="SET current_month=:curmonth",
+            ExpressionAttributeValues=self.encode({":curmonth": month}),
+        )
+
+        def updated(result):
+            self.cache.invalidate(uaid)
+            return True
+        d.addCallback(updated)
+        return d
+
+    @track_provisioned
+    def clear_node(self, item):
+        """Given a router item and remove the node_id
+
+        The node_id will only be cleared if the ``connected_at`` matches up
+        with the item's ``connected_at``. A
+        :class:`~autopush.cache.RouteRecord` of the ``node_id`` and
+        ``connected_at`` will do.
+
+        """
+        node_id = item["node_id"]
+        del item["node_id"]
+        self.cache.invalidate(item["uaid"])
+        return self._conditional(self._request(
+            "PutItem",
+            Item=self.encode(dict(uaid=item["uaid"])),
+            ConditionExpression="(node_id = :node) and "
+                                "(connected_at = :conn)",
+            ExpressionAttributeValues=self.encode({
+                ":node": node_id,
+                ":conn": item["connected_at"],
+            }),
+        ))
@@ -3,14 +3,18 @@
 This is the primary running code of the `autoendpoint` script that handles
 the reception of HTTP notification requests for AppServers.
 
-Three HTTP endpoints are exposed by default:
+Five HTTP endpoints are exposed by default:
 
 1. :class:`EndpointHandler` - Handles Push notification deliveries from the
    :term:`AppServer`.
-2. :class:`RegistrationHandler` - Handles Registration requests for registering
+2. :class:`BatchHandler` - Handles many Push notification deliveries in a
+   single request from the :term:`AppServer`.
+3. :class:`TopicHandler` - Handles topics, sets of subscriptions that a
+   single notification from the :term:`AppServer` is delivered to.
+4. :class:`RegistrationHandler` - Handles Registration requests for registering
    additional router type/data when not using the default notification delivery
    scheme.
-3. :class:`MessageHandler` - Handles individual message operations such as
+5. :class:`MessageHandler` - Handles individual message operations such as
    deleting a message before delivery, or updating the contents/ttl of an
    existing message pending delivery.
 
@@ -73,6 +77,7 @@ Unless otherwise specified, all calls return the following error codes:
    - errno 101 - Missing neccessary crypto keys
    - errno 108 - Router type is invalid
    - errno 110 - Invalid crypto keys specified
+   - errno 111 - Invalid request body
 
 -  401 - Bad Authorization
 
@@ -85,6 +90,16 @@ Unless otherwise specified, all calls return the following error codes:
    - errno 105 - Endpoint became unavailable during request
    - errno 106 - Invalid subscription
 
+-  413 - Request too large
+
+   - errno 104 - Data payload too large
+   - errno 113 - Too many messages or tokens in request
+
+-  429 - Too many notifications from the sender, or to the subscription.
+   Retry after the seconds in the `Retry-After` header.
+
+   - errno 112 - Rate limit exceeded
+
 -  500 - Unknown server error
 
    - errno 999 - Unknown error
@@ -131,6 +146,164 @@ Errors:
                      time.
     :statuscode 200: Message delivered to node client is connected to.
 
+Send Notifications in Batch
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Send many notifications, each to its own endpoint `token`, in one request.
+
+Call:
+^^^^^
+.. http:post:: /push/batch
+
+    The body is a JSON object with a list of messages, at most `max_batch`
+    of them:
+
+    .. code-block:: json
+
+        {"messages": [
+            {"token": {token},
+             "ttl": 60,
+             "data": "base64url encoded data",
+             "headers": {"encryption": "...", "encryption-key": "..."}},
+            {"token": {token}, "version": 12}
+        ]}
+
+    `data` is base64url encoded for webpush subscriptions and sent as is to
+    simplepush subscriptions, `headers` holds the crypto headers that would
+    otherwise be sent with a **Send Notification** call.
+
+Reply:
+^^^^^^
+
+    One result per message, in the order of the request, with the status
+    code and headers or the extended error of its delivery. Messages to a
+    UAID over its rate limit fail with a 429 (errno 112):
+
+.. code-block:: json
+
+    {"results": [
+        {"code": 201, "headers": {"Location": "..."}},
+        {"code": 404, "errno": 103, "error": "Not Found"}
+    ]}
+
+Errors:
+^^^^^^^
+
+    :statuscode 400: The body is malformed (errno 111).
+    :statuscode 413: The batch holds more than `max_batch` messages, or
+                     more than the sender's rate limit per minute
+                     (errno 113).
+    :statuscode 429: Every message of the batch counts against the rate
+                     limit of the sender, which it exceeds (errno 112).
+    :statuscode 200: Every message has a result.
+
+Create Topic
+~~~~~~~~~~~~
+
+Create a topic that subscriptions can be added to, to later send a
+notification to all of them at once.
+
+Call:
+^^^^^
+.. http:post:: /topic
+
+Reply:
+^^^^^^
+
+    The `secret` authorizes the other topic calls as a bearer token in the
+    Authorization header, it's only present if `auth_key` is set.
+
+.. code-block:: json
+
+    {"topic": {topic}, "secret": {auth_token}}
+
+Update Topic
+~~~~~~~~~~~~
+
+Add subscriptions to and remove subscriptions from a topic by their
+endpoint `token`, at most `max_batch` tokens at once.
+
+Call:
+^^^^^
+.. http:put:: /topic/{topic}
+
+::
+
+    Authorization: Bearer {auth_token}
+
+Parameters:
+^^^^^^^^^^^
+
+    {"add": [{token}, ...], "remove": [{token}, ...]}
+
+Reply:
+^^^^^^
+
+    The tokens that could not be added as they are invalid:
+
+.. code-block:: json
+
+    {"invalid": [{token}, ...]}
+
+Errors:
+^^^^^^^
+
+    :statuscode 400: The body is malformed (errno 111).
+    :statuscode 413: The request holds more than `max_batch` tokens
+                     (errno 113).
+
+Publish to Topic
+~~~~~~~~~~~~~~~~
+
+Send a notification to every subscription of a topic. The body and headers
+are those of a **Send Notification** call, simplepush subscriptions get the
+current time as version and no data.
+
+Call:
+^^^^^
+.. http:post:: /topic/{topic}
+
+::
+
+    Authorization: Bearer {auth_token}
+
+Reply:
+^^^^^^
+
+    The subscriptions are routed a chunk at a time, and a line of JSON is
+    streamed as each chunk completes with the extended error of the
+    subscriptions that failed. The last line holds the totals:
+
+.. code-block:: json
+
+    {"recipients": 100, "sent": 99, "failed": [
+        {"token": {token}, "code": 404, "errno": 103, "error": "Not Found"}
+    ]}
+    {"recipients": 100, "sent": 99, "failed": 1, "done": true}
+
+    Should publishing fail midway, the last line is an extended error
+    instead.
+
+Delete Topic
+~~~~~~~~~~~~
+
+Remove every subscription of a topic.
+
+Call:
+^^^^^
+.. http:delete:: /topic/{topic}
+
+::
+
+    Authorization: Bearer {auth_token}
+
+Reply:
+^^^^^^
+
+.. code-block:: json
+
+    {}
+
 Cancel Notification
 ~~~~~~~~~~~~~~~~~~~
 
@@ -464,19 +637,30 @@ import uuid
 import re
 
 from collections import namedtuple
-from base64 import urlsafe_b64encode
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 
 import cyclone.web
+from cyclone.httputil import HTTPHeaders
 from boto.dynamodb2.exceptions import (
     ItemNotFound,
     ProvisionedThroughputExceededException,
 )
 from cryptography.fernet import InvalidToken
-from twisted.internet.defer import Deferred
-from twisted.internet.threads import deferToThread
+from twisted.internet.defer import (
+    Deferred,
+    DeferredList,
+    DeferredSemaphore,
+    fail,
+    inlineCallbacks,
+    maybeDeferred,
+    succeed,
+)
 from twisted.python import log
 
+from autopush.cache import copy_record
+from autopush.db import defer_db
 from autopush.router.interface import RouterException
+from autopush.tokens import is_compact_token
 from autopush.utils import (
     generate_hash,
     validate_uaid,
@@ -493,14 +677,24 @@ status_codes = {
     401: "Unauthorized",
     404: "Not Found",
     413: "Payload Too Large",
+    429: "Too Many Requests",
     500: "Internal Server Error",
     503: "Service Unavailable",
 }
 
 
 class Notification(namedtuple("Notification",
-                   "version data channel_id headers ttl")):
-    """Parsed notification from the request"""
+                   "version data channel_id headers ttl subscribed")):
+    """Parsed notification from the request
+
+    ``subscribed`` is the set of message tables the channel was found in
+    when it was looked up along with the router record, or None.
+
+    """
+    def __new__(cls, version, data, channel_id, headers, ttl,
+                subscribed=None):
+        return super(Notification, cls).__new__(
+            cls, version, data, channel_id, headers, ttl, subscribed)
 
 
 def parse_request_params(request):
@@ -535,6 +729,34 @@ def parse_request_params(request):
     return version, data
 
 
+def parse_ttl(value):
+    """Parse a TTL header value, capped to :data:`MAX_TTL`
+
+    :returns: The TTL in seconds, 0 if the value is invalid.
+
+    """
+    try:
+        return min(int(value), MAX_TTL)
+    except (TypeError, ValueError):
+        return 0
+
+
+def check_crypto_headers(headers, data):
+    """Check the crypto headers of a WebPush notification
+
+    :returns: Tuple of (errno, message) if the headers are invalid, otherwise
+              None.
+
+    """
+    # We need crypto headers for messages with payloads.
+    req_fields = ["content-encoding", "encryption"]
+    if data and not all([x in headers for x in req_fields]):
+        return 101, None
+    if "encryption-key" in headers and "crypto-key" in headers:
+        return 110, "Invalid crypto headers"
+    return None
+
+
 class AutoendpointHandler(ErrorLogger, cyclone.web.RequestHandler):
     """Common overrides for Autoendpoint handlers"""
     cors_methods = ""
@@ -599,6 +821,32 @@ class AutoendpointHandler(ErrorLogger, cyclone.web.RequestHandler):
             "channel_id": getattr(self, "chid", ""),
         }
 
+    def _sender_key(self):
+        """Returns the identity of the sender the request is rate limited
+        by: its remote IP
+
+        Senders pick their own headers, so ``X-Forwarded-For`` is only
+        used for requests from one of the ``trusted_proxies``.
+
+        """
+        remote_ip = self.request.remote_ip
+        forwarded = self.request.headers.get("x-forwarded-for")
+        if forwarded and remote_ip in self.ap_settings.trusted_proxies:
+            # The last address was added by the trusted proxy
+            return forwarded.split(",")[-1].strip()
+        return remote_ip
+
+    def _throttled(self, limiter, key, kind, cost=1):
+        """Writes a 429 response and returns True if the key is over the
+        limiter's rate"""
+        retry_after = limiter.throttle(key, cost)
+        if not retry_after:
+            return False
+        self.metrics.increment("updates.throttled.%s" % kind, count=cost)
+        self._write_response(429, 112, message="Rate limit exceeded",
+                             headers={"Retry-After": str(retry_after)})
+        return True
+
     #############################################################
     #                    Error Callbacks
     #############################################################
@@ -680,6 +928,81 @@ class AutoendpointHandler(ErrorLogger, cyclone.web.RequestHandler):
     #############################################################
     #                    Utility Methods
     #############################################################
+    def _decrypt_token(self, token):
+        """Returns a deferred for the decrypted token, served from the
+        token cache when possible"""
+        token = token.encode('utf8')
+        cache = self.ap_settings.token_cache
+        try:
+            result = cache.get(token)
+        except InvalidToken:
+            return fail()
+        if result is not None:
+            return succeed(result)
+        fernet = self.ap_settings.fernet
+        d = self._decrypt(token)
+        d.addCallbacks(self._cache_token, self._cache_invalid_token,
+                       callbackArgs=(token, fernet),
+                       errbackArgs=(token, fernet))
+        return d
+
+    def _make_message_id(self, uaid, chid):
+        """Returns a deferred for a new message id, compact message ids are
+        created inline"""
+        message = ':'.join(['m', uaid, chid]).encode('utf8')
+        if self.ap_settings.token_version:
+            return succeed(self.ap_settings.message_ids.encode(message))
+        return self.ap_settings.crypto.encrypt(message)
+
+    def _decrypt(self, token):
+        """Returns a deferred for a decrypted message token, compact message
+        ids are verified inline"""
+        if is_compact_token(token):
+            return maybeDeferred(self.ap_settings.message_ids.decode, token)
+        return self.ap_settings.crypto.decrypt(token)
+
+    def _cache_token(self, result, token, fernet):
+        """Save a decrypted token, unless the keys rotated meanwhile"""
+        if fernet is self.ap_settings.fernet:
+            self.ap_settings.token_cache.put(token, result)
+        return result
+
+    def _cache_invalid_token(self, fail, token, fernet):
+        """Remember a token that failed to decrypt, unless the keys rotated
+        meanwhile"""
+        fail.trap(InvalidToken)
+        if fernet is self.ap_settings.fernet:
+            self.ap_settings.token_cache.put_invalid(token)
+        return fail
+
+    def _validate_auth(self, uaid):
+        """Validates the Authorization header in a request
+
+        Validate the given request bearer token
+        """
+
+        test, _ = validate_uaid(uaid)
+        if not test:
+            return False
+        header = self.request.headers.get("Authorization")
+        if header is None:
+            return False
+        try:
+            token_type, rtoken = re.sub(r' +', ' ',
+                                        header.strip()).split(" ", 2)
+        except ValueError:
+            return False
+        if "bearer" != token_type.lower():
+            return False
+        if self.ap_settings.auth_key:
+            for key in self.ap_settings.auth_key:
+                token = generate_hash(key, uaid)
+                if rtoken == token:
+                    return True
+            return False
+        else:
+            return True
+
     def _db_error_handling(self, d):
         """Tack on the common error handling for a dynamodb request and
         uncaught exceptions"""
@@ -713,16 +1036,15 @@ class MessageHandler(AutoendpointHandler):
         yet, will not be dropped.
         """
         self.version = token
-        d = deferToThread(self.ap_settings.fernet.decrypt,
-                          self.version.encode('utf8'))
+        d = self._decrypt_token(self.version)
         d.addCallback(self._token_valid, self._delete_message)
         d.addErrback(self._token_err)
         d.addErrback(self._response_err)
         return d
 
     def _delete_message(self, kind, uaid, chid):
-        d = deferToThread(self.ap_settings.message.delete_message, uaid,
-                          chid, self.version)
+        d = defer_db(self.ap_settings.message.delete_message, uaid,
+                     chid, self.version)
         d.addCallback(self._delete_completed)
         self._db_error_handling(d)
         return d
@@ -738,6 +1060,8 @@ class EndpointHandler(AutoendpointHandler):
                             "crypto-key",
                             "encryption-key", "content-type"]
     cors_response_headers = ["location"]
+    # Message tables the channel was found in by the router lookup
+    subscribed = None
 
     #############################################################
     #                    Cyclone HTTP Methods
@@ -750,9 +1074,11 @@ class EndpointHandler(AutoendpointHandler):
 
         """
         self.start_time = time.time()
-        fernet = self.ap_settings.fernet
+        if self._throttled(self.ap_settings.sender_limiter,
+                           self._sender_key(), "sender"):
+            return
 
-        d = deferToThread(fernet.decrypt, token.encode('utf8'))
+        d = self._decrypt_token(token)
         d.addCallback(self._token_valid)
         d.addErrback(self._token_err)
         d.addErrback(self._response_err)
@@ -761,6 +1087,11 @@ class EndpointHandler(AutoendpointHandler):
     #############################################################
     #                    Callbacks
     #############################################################
+    def _decrypt(self, token):
+        """Returns a deferred for the data of a legacy or compact endpoint
+        token"""
+        return self.ap_settings.crypto.parse_endpoint_token(token)
+
     def _token_valid(self, result):
         """Called after the token is decrypted successfully"""
         info = result.split(":")
@@ -768,11 +1099,37 @@ class EndpointHandler(AutoendpointHandler):
             raise ValueError("Wrong subscription token components")
 
         self.uaid, self.chid = info
-        d = deferToThread(self.ap_settings.router.get_uaid, self.uaid)
+        if self._throttled(self.ap_settings.uaid_limiter, self.uaid, "uaid"):
+            return
+        d = self._lookup_uaid(self.uaid)
         d.addCallback(self._uaid_lookup_results)
         d.addErrback(self._uaid_not_found_err)
         self._db_error_handling(d)
 
+    def _lookup_uaid(self, uaid):
+        """Returns a deferred for the router record of a UAID, served from
+        the router cache when possible
+
+        Records that aren't cached are read along with the channel's marker
+        items in one BatchGetItem, so the webpush preflight check doesn't
+        have to read them again.
+
+        """
+        cache = self.ap_settings.router_cache
+        record = cache.get(uaid)
+        if record is not None:
+            return succeed(record)
+        d = defer_db(self.ap_settings.router.get_uaid_and_channel, uaid,
+                     self.chid, self.ap_settings.message_tables.values())
+        d.addCallback(self._cache_uaid, uaid)
+        return d
+
+    def _cache_uaid(self, result, uaid):
+        """Save a freshly read router record in the router cache"""
+        record, self.subscribed = result
+        self.ap_settings.router_cache.put(uaid, record)
+        return record
+
     def _uaid_lookup_results(self, result):
         """Process the result of the AWS UAID lookup"""
         # Save the whole record
@@ -791,25 +1148,14 @@ class EndpointHandler(AutoendpointHandler):
         else:
             data = self.request.body
             if router_key == "webpush":
-                # We need crypto headers for messages with payloads.
-                req_fields = ["content-encoding", "encryption"]
-                if data and not all([x in self.request.headers
-                                     for x in req_fields]):
-                    log.msg("Missing Crypto headers", **self._client_info())
-                    return self._write_response(400, 101)
-                if ("encryption-key" in self.request.headers and
-                        "crypto-key" in self.request.headers):
-                    log.msg("Both encryption and crypto keys in headers",
+                error = check_crypto_headers(self.request.headers, data)
+                if error:
+                    log.msg("Invalid crypto headers", errno=error[0],
                             **self._client_info())
-                    return self._write_response(
-                        400, 110, message="Invalid crypto headers")
+                    return self._write_response(400, error[0],
+                                                message=error[1])
 
-        try:
-            ttl = int(self.request.headers.get("ttl", "0"))
-            # Cap the TTL to our MAX_TTL
-            ttl = min(ttl, MAX_TTL)
-        except ValueError:
-            ttl = 0
+        ttl = parse_ttl(self.request.headers.get("ttl", "0"))
         if data and len(data) > self.ap_settings.max_data:
             return self._write_response(
                 413, 104, message="Data payload too large")
@@ -823,8 +1169,7 @@ class EndpointHandler(AutoendpointHandler):
         if router_key == "webpush":
             data = urlsafe_b64encode(self.request.body)
 
-        d = deferToThread(self.ap_settings.fernet.encrypt, ':'.join([
-            'm', self.uaid, self.chid]).encode('utf8'))
+        d = self._make_message_id(self.uaid, self.chid)
         d.addCallback(self._route_notification, result, data, ttl)
         return d
 
@@ -832,7 +1177,8 @@ class EndpointHandler(AutoendpointHandler):
         notification = Notification(version=version, data=data,
                                     channel_id=self.chid,
                                     headers=self.request.headers,
-                                    ttl=ttl)
+                                    ttl=ttl,
+                                    subscribed=self.subscribed)
 
         d = Deferred()
         d.addCallback(self.router.route_notification, result)
@@ -849,14 +1195,15 @@ class EndpointHandler(AutoendpointHandler):
 
         # Were we told to update the router data?
         if response.router_data is not None:
+            self.ap_settings.router_cache.invalidate(self.uaid)
             if not response.router_data:
                 del uaid_data["router_data"]
                 del uaid_data["router_type"]
             else:
                 uaid_data["router_data"] = response.router_data
             uaid_data["connected_at"] = int(time.time() * 1000)
-            d = deferToThread(self.ap_settings.router.register_user,
-                              uaid_data)
+            d = defer_db(self.ap_settings.router.register_user,
+                         uaid_data)
             response.router_data = None
             d.addCallback(lambda x: self._router_completed(response,
                                                            uaid_data))
@@ -871,6 +1218,564 @@ class EndpointHandler(AutoendpointHandler):
             self._router_response(response)
 
 
+class BatchItem(object):
+    """A single notification of a batch push request, and its result"""
+    def __init__(self, token, ttl=0, data=None, version=None, headers=None):
+        self.token = token
+        self.ttl = ttl
+        self.data = data
+        self.version = version
+        self.headers = headers
+        self.uaid = None
+        self.chid = None
+        self.result = None
+
+    def fail(self, status_code, errno, message=None):
+        """Set an error result, formatted like a single push error"""
+        self.result = dict(
+            code=status_code,
+            errno=errno,
+            error=status_codes.get(status_code, "")
+        )
+        if message:
+            self.result["message"] = message
+
+    def respond(self, response):
+        """Set the result from a :class:`RouterResponse` or
+        :class:`RouterException`"""
+        if 200 <= response.status_code < 300:
+            self.result = dict(code=response.status_code)
+            if response.headers:
+                self.result["headers"] = response.headers
+        else:
+            self.fail(response.status_code, response.errno or 999,
+                      response.response_body)
+
+
+class BatchHandler(AutoendpointHandler):
+    cors_methods = "POST"
+    cors_request_headers = ["content-type"]
+
+    #############################################################
+    #                    Cyclone HTTP Methods
+    #############################################################
+    @cyclone.web.asynchronous
+    def post(self):
+        """HTTP POST Handler
+
+        Entry-point for delivering many notifications, each to its own
+        endpoint token, in a single request.
+
+        """
+        self.start_time = time.time()
+        try:
+            self.items = self._parse_batch(self.request.body)
+        except ValueError as exc:
+            log.msg("Invalid batch", **self._client_info())
+            return self._write_response(400, 111, message=str(exc))
+        sender = self._sender_key()
+        limit = self.ap_settings.sender_limiter.limit(sender)
+        # A batch over the sender's rate would never be accepted
+        if len(self.items) > self.ap_settings.max_batch or \
+                limit and len(self.items) > limit:
+            return self._write_response(
+                413, 113, message="Too many messages in batch")
+        if self._throttled(self.ap_settings.sender_limiter, sender,
+                           "sender", cost=len(self.items)):
+            return
+        self.metrics.increment("updates.batch.messages",
+                               count=len(self.items))
+
+        d = DeferredList([self._decrypt_token(item.token)
+                          for item in self.items], consumeErrors=True)
+        d.addCallback(self._tokens_decrypted)
+        d.addCallback(self._route_items)
+        d.addCallback(self._batch_completed)
+        self._db_error_handling(d)
+        return d
+
+    #############################################################
+    #                    Callbacks
+    #############################################################
+    def _decrypt(self, token):
+        """Returns a deferred for the data of a legacy or compact endpoint
+        token"""
+        return self.ap_settings.crypto.parse_endpoint_token(token)
+
+    def _parse_batch(self, body):
+        """Returns the :class:`BatchItem` list of a batch request body
+
+        :raises: :exc:`ValueError` if the body is malformed.
+
+        """
+        batch = json.loads(body)
+        if not isinstance(batch, dict) or \
+                not isinstance(batch.get("messages"), list):
+            raise ValueError("Missing messages")
+        items = []
+        for message in batch["messages"]:
+            if not isinstance(message, dict) or \
+                    not isinstance(message.get("token"), basestring):
+                raise ValueError("Missing message token")
+            data = message.get("data")
+            headers = message.get("headers", {})
+            if data is not None and not isinstance(data, basestring) or \
+                    not isinstance(headers, dict):
+                raise ValueError("Invalid message")
+            version = message.get("version")
+            if not isinstance(version, int) or version < 1:
+                version = None
+            items.append(BatchItem(
+                token=message["token"],
+                ttl=parse_ttl(message.get("ttl", 0)),
+                data=data.encode("utf8") if data else data,
+                version=version,
+                headers=HTTPHeaders(
+                    (str(k), unicode(v).encode("utf8"))
+                    for k, v in headers.items()),
+            ))
+        return items
+
+    def _tokens_decrypted(self, results):
+        """Called with the decrypted tokens, returns a deferred for the
+        router records of their UAIDs"""
+        for item, (success, result) in zip(self.items, results):
+            if not success:
+                if not result.check(InvalidToken, ValueError):
+                    log.err(result, **self._client_info())
+                item.fail(404, 102)
+                continue
+            info = result.split(":")
+            if len(info) != 2:
+                item.fail(404, 102)
+                continue
+            item.uaid, item.chid = info
+        return self._lookup_records()
+
+    def _throttle_items(self):
+        """Fail the items for a UAID over the per-UAID rate"""
+        limiter = self.ap_settings.uaid_limiter
+        if not limiter.enabled:
+            return
+        for item in self.items:
+            if item.uaid and item.result is None and \
+                    limiter.throttle(item.uaid):
+                self.metrics.increment("updates.throttled.uaid")
+                item.fail(429, 112, "Rate limit exceeded")
+
+    def _lookup_records(self):
+        """Returns the router records of the UAIDs of the items, or a
+        deferred for them when some have to be read from the router table
+
+        Items for a UAID over the per-UAID rate are failed first.
+
+        """
+        self._throttle_items()
+        uaids = set(item.uaid for item in self.items
+                    if item.uaid and item.result is None)
+        records = {}
+        for uaid in uaids:
+            record = self.ap_settings.router_cache.get(uaid)
+            if record is not None:
+                records[uaid] = record
+        misses = [uaid for uaid in uaids if uaid not in records]
+        if not misses:
+            return records
+        d = defer_db(self.ap_settings.router.get_uaids, misses)
+        d.addCallback(self._uaids_found, records)
+        return d
+
+    def _uaids_found(self, found, records):
+        """Save freshly read router records in the router cache"""
+        for uaid, record in found.items():
+            self.ap_settings.router_cache.put(uaid, record)
+        records.update(found)
+        return records
+
+    def _route_items(self, records):
+        """Route every item that has a router record
+
+        Items for the same connection node are routed one after the other,
+        different nodes and stored messages are routed concurrently.
+
+        """
+        groups = {}
+        for item in self.items:
+            if item.result is not None:
+                continue
+            record = records.get(item.uaid)
+            if record is None:
+                item.fail(404, 103)
+                continue
+            node_id = record.get("node_id") or id(item)
+            groups.setdefault(node_id, []).append((item, record))
+        return DeferredList([self._route_group(group)
+                             for group in groups.values()])
+
+    @inlineCallbacks
+    def _route_group(self, group):
+        """Route a group of items one after the other"""
+        for item, record in group:
+            yield self._route_item(item, record)
+
+    def _route_item(self, item, record):
+        """Returns a deferred that routes a single item and sets its result,
+        it never fails"""
+        router_key = record.get("router_type", "simplepush")
+        router = self.ap_settings.routers.get(router_key)
+        if router is None:
+            item.fail(400, 108, "Invalid router type")
+            return succeed(None)
+
+        notification = self._item_notification(item, router_key)
+        if notification is None:
+            return succeed(None)
+        if router_key == "simplepush":
+            d = succeed(notification.version)
+        else:
+            d = self._make_message_id(item.uaid, item.chid)
+
+        uaid_data = copy_record(record)
+        d.addCallback(lambda version: router.route_notification(
+            notification._replace(version=version), uaid_data))
+        d.addCallback(self._item_routed, item, uaid_data)
+        d.addErrback(self._item_router_err, item)
+        d.addErrback(self._item_err, item)
+        return d
+
+    def _item_notification(self, item, router_key):
+        """Returns the :class:`Notification` for an item, with the version
+        set for simplepush only, or None after failing the item"""
+        data = item.data
+        if router_key != "simplepush" and data:
+            # Binary payloads are sent base64url encoded
+            try:
+                data = urlsafe_b64decode(data + "=" * (-len(data) % 4))
+            except TypeError:
+                item.fail(400, 111, "Invalid data encoding")
+                return None
+        if router_key == "webpush":
+            error = check_crypto_headers(item.headers, data)
+            if error:
+                item.fail(400, *error)
+                return None
+        if data and len(data) > self.ap_settings.max_data:
+            item.fail(413, 104, "Data payload too large")
+            return None
+
+        if router_key == "simplepush":
+            return Notification(version=item.version or int(time.time()),
+                                data=data, channel_id=item.chid,
+                                headers=item.headers, ttl=None)
+        if router_key == "webpush" and data:
+            data = urlsafe_b64encode(data)
+        return Notification(version=None, data=data, channel_id=item.chid,
+                            headers=item.headers, ttl=item.ttl)
+
+    def _item_routed(self, response, item, uaid_data):
+        """Called after the router has completed an item successfully"""
+        if response.router_data is None:
+            item.respond(response)
+            return
+        self.ap_settings.router_cache.invalidate(item.uaid)
+        if not response.router_data:
+            del uaid_data["router_data"]
+            del uaid_data["router_type"]
+        else:
+            uaid_data["router_data"] = response.router_data
+        uaid_data["connected_at"] = int(time.time() * 1000)
+        response.router_data = None
+        d = defer_db(self.ap_settings.router.register_user, uaid_data)
+        d.addCallback(lambda x: item.respond(response))
+        return d
+
+    def _batch_completed(self, result):
+        """Called once every item has a result"""
+        time_diff = time.time() - self.start_time
+        self.metrics.timing("updates.batch.handled", duration=time_diff)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(dict(results=[item.result
+                                            for item in self.items])))
+        self.finish()
+
+    #############################################################
+    #                    Error Callbacks
+    #############################################################
+    def _item_router_err(self, fail, item):
+        """errBack for router failures of an item"""
+        fail.trap(RouterException)
+        exc = fail.value
+        if exc.log_exception:
+            log.err(fail, **self._client_info())
+        item.respond(exc)
+
+    def _item_err(self, fail, item):
+        """errBack for unexpected failures of an item"""
+        fail.trap(Exception)
+        if fail.check(ProvisionedThroughputExceededException):
+            item.fail(503, 201)
+        else:
+            log.err(fail, **self._client_info())
+            item.fail(500, 999)
+
+
+class TopicHandler(BatchHandler):
+    cors_methods = "POST,PUT,DELETE"
+    cors_request_headers = ["content-encoding", "encryption",
+                            "crypto-key", "encryption-key", "content-type",
+                            "authorization"]
+
+    #############################################################
+    #                    Cyclone HTTP Methods
+    #############################################################
+    @cyclone.web.asynchronous
+    def post(self, topic=None):
+        """HTTP POST Handler
+
+        Creates a new topic when no topic is given, otherwise publishes the
+        request body to every subscription of the topic.
+
+        """
+        self.start_time = time.time()
+        if not topic:
+            return self._create_topic()
+        if not self._validate_auth(topic):
+            return self._write_response(
+                401, 109, message="Invalid Authentication")
+        data = self.request.body
+        if data and len(data) > self.ap_settings.max_data:
+            return self._write_response(
+                413, 104, message="Data payload too large")
+
+        self.topic = topic
+        self.ttl = parse_ttl(self.request.headers.get("ttl", "0"))
+        self.version = int(time.time())
+        self.payloads = {}
+        self.totals = dict(recipients=0, sent=0, failed=0)
+        self.semaphore = DeferredSemaphore(self.ap_settings.topic_concurrency)
+        d = self._publish()
+        d.addErrback(self._stream_err)
+        self._db_error_handling(d)
+        return d
+
+    @cyclone.web.asynchronous
+    def put(self, topic=None):
+        """HTTP PUT Handler
+
+        Adds the endpoint tokens listed in ``add`` to the subscriptions of a
+        topic, and removes those listed in ``remove``.
+
+        """
+        if not self._validate_auth(topic):
+            return self._write_response(
+                401, 109, message="Invalid Authentication")
+        try:
+            add, remove = self._parse_changes(self.request.body)
+        except ValueError as exc:
+            log.msg("Invalid topic changes", **self._client_info())
+            return self._write_response(400, 111, message=str(exc))
+        if len(add) + len(remove) > self.ap_settings.max_batch:
+            return self._write_response(
+                413, 113, message="Too many tokens in request")
+
+        self.topic = topic
+        d = DeferredList([self._decrypt_token(token) for token in add],
+                         consumeErrors=True)
+        d.addCallback(self._save_subscriptions, add, remove)
+        d.addCallback(self._subscriptions_saved)
+        self._db_error_handling(d)
+        return d
+
+    @cyclone.web.asynchronous
+    def delete(self, topic=None):
+        """HTTP DELETE Handler
+
+        Removes every subscription of a topic.
+
+        """
+        if not self._validate_auth(topic):
+            return self._write_response(
+                401, 109, message="Invalid Authentication")
+        d = self.ap_settings.executors.run(
+            "db-write", self.ap_settings.topic.delete_topic, topic)
+        d.addCallback(self._topic_deleted)
+        self._db_error_handling(d)
+        return d
+
+    #############################################################
+    #                    Callbacks
+    #############################################################
+    def _create_topic(self):
+        """Create a new topic id, and the secret to authorize it with"""
+        topic = uuid.uuid4().hex
+        msg = dict(topic=topic)
+        if self.ap_settings.auth_key:
+            msg["secret"] = generate_hash(self.ap_settings.auth_key[0], topic)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(msg))
+        self.finish()
+
+    def _parse_changes(self, body):
+        """Returns the lists of endpoint tokens to add and to remove of a
+        topic update request body
+
+        :raises: :exc:`ValueError` if the body is malformed.
+
+        """
+        changes = json.loads(body)
+        if not isinstance(changes, dict):
+            raise ValueError("Missing topic changes")
+        lists = []
+        for key in ("add", "remove"):
+            tokens = changes.get(key, [])
+            if not isinstance(tokens, list) or \
+                    not all(isinstance(x, basestring) for x in tokens):
+                raise ValueError("Invalid %s tokens" % key)
+            lists.append(tokens)
+        return lists
+
+    def _save_subscriptions(self, results, add, remove):
+        """Called with the decrypted tokens to add, returns a deferred for
+        the tokens that were invalid once the topic is updated"""
+        subscriptions = {}
+        invalid = []
+        for token, (success, result) in zip(add, results):
+            if not success:
+                if not result.check(InvalidToken, ValueError):
+                    log.err(result, **self._client_info())
+                invalid.append(token)
+                continue
+            info = result.split(":")
+            if len(info) != 2:
+                invalid.append(token)
+                continue
+            subscriptions[token] = tuple(info)
+        d = self.ap_settings.executors.run("db-write", self._update_topic,
+                                           subscriptions, remove)
+        d.addCallback(lambda x: invalid)
+        return d
+
+    def _update_topic(self, subscriptions, remove):
+        """Add and remove the subscriptions of the topic"""
+        topic = self.ap_settings.topic
+        if subscriptions:
+            topic.add_subscriptions(self.topic, subscriptions)
+        if remove:
+            topic.remove_subscriptions(self.topic, remove)
+
+    def _subscriptions_saved(self, invalid):
+        """Writes out the tokens that could not be added"""
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(dict(invalid=invalid)))
+        self.finish()
+
+    def _topic_deleted(self, result):
+        """Writes out empty 200 response"""
+        self.write({})
+        self.finish()
+
+    @inlineCallbacks
+    def _publish(self):
+        """Route the notification to the subscriptions of the topic, one
+        chunk of subscriptions at a time"""
+        chunks = self.ap_settings.topic.fetch_subscriptions(
+            self.topic, self.ap_settings.topic_chunk_size)
+        while True:
+            subscriptions = yield self.ap_settings.executors.run(
+                "db-read", next, chunks, None)
+            if subscriptions is None:
+                break
+            self.items = []
+            for subscription in subscriptions:
+                item = BatchItem(subscription["token"])
+                item.uaid = subscription["uaid"]
+                item.chid = subscription["chid"]
+                self.items.append(item)
+            records = yield self._lookup_records()
+            yield self._route_items(records)
+            self._chunk_completed()
+        self._publish_completed()
+
+    def _route_group(self, group):
+        """Route a group of items once fewer than ``topic_concurrency``
+        groups are being routed"""
+        return self.semaphore.run(super(TopicHandler, self)._route_group,
+                                  group)
+
+    def _item_notification(self, item, router_key):
+        """Returns the :class:`Notification` for an item, sharing the
+        payload of every subscription of the router type, or None after
+        failing the item"""
+        if router_key not in self.payloads:
+            self.payloads[router_key] = self._make_payload(router_key)
+        payload = self.payloads[router_key]
+        if not isinstance(payload, Notification):
+            item.fail(*payload)
+            return None
+        return payload._replace(channel_id=item.chid)
+
+    def _make_payload(self, router_key):
+        """Returns the :class:`Notification`, less the channel id, sent to
+        the subscriptions of a router type, or the (status_code, errno,
+        message) they fail with"""
+        data = self.request.body
+        if router_key == "simplepush":
+            return Notification(version=self.version, data=None,
+                                channel_id=None,
+                                headers=self.request.headers, ttl=None)
+        if router_key == "webpush":
+            error = check_crypto_headers(self.request.headers, data)
+            if error:
+                return (400,) + error
+            # Web Push messages are delivered as Base64-encoded strings.
+            data = urlsafe_b64encode(data)
+        return Notification(version=None, data=data, channel_id=None,
+                            headers=self.request.headers, ttl=self.ttl)
+
+    def _chunk_completed(self):
+        """Streams the results of a chunk of subscriptions"""
+        failed = [dict(item.result, token=item.token) for item in self.items
+                  if not 200 <= item.result["code"] < 300]
+        sent = len(self.items) - len(failed)
+        self.totals["recipients"] += len(self.items)
+        self.totals["sent"] += sent
+        self.totals["failed"] += len(failed)
+        self.metrics.increment("updates.topic.messages",
+                               count=len(self.items))
+        self._write_line(dict(recipients=len(self.items), sent=sent,
+                              failed=failed))
+
+    def _publish_completed(self):
+        """Called once every subscription has a result"""
+        time_diff = time.time() - self.start_time
+        self.metrics.timing("updates.topic.handled", duration=time_diff)
+        self._write_line(dict(self.totals, done=True))
+        self.finish()
+
+    def _write_line(self, data):
+        """Writes and flushes a line of JSON to the client"""
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(data) + "\n")
+        self.flush()
+
+    #############################################################
+    #                    Error Callbacks
+    #############################################################
+    def _stream_err(self, fail):
+        """errBack for publish failures once results are being streamed,
+        which end the stream with an extended error line"""
+        if not self._headers_written:
+            return fail
+        if fail.check(ProvisionedThroughputExceededException):
+            status_code, errno = 503, 201
+        else:
+            log.err(fail, **self._client_info())
+            status_code, errno = 500, 999
+        self._write_line(dict(code=status_code, errno=errno,
+                              error=status_codes.get(status_code, "")))
+        self.finish()
+
+
 class RegistrationHandler(AutoendpointHandler):
     cors_methods = "POST,PUT,DELETE"
     _base_tags = []
@@ -1032,14 +1937,15 @@ class RegistrationHandler(AutoendpointHandler):
             # mark channel as dead
             self.ap_settings.metrics.increment("updates.client.unregister",
                                                tags=self.base_tags())
-            d = deferToThread(self._delete_channel, uaid, chid)
+            d = self.ap_settings.executors.run(
+                "db-write", self._delete_channel, uaid, chid)
             d.addCallback(self._success)
             d.addErrback(self._chid_not_found_err)
             d.addErrback(self._response_err)
             return d
         # nuke uaid
-        d = deferToThread(self._delete_uaid, uaid,
-                          self.ap_settings.router)
+        d = self.ap_settings.executors.run(
+            "db-write", self._delete_uaid, uaid, self.ap_settings.router)
         d.addCallback(self._success)
         d.addErrback(self._uaid_not_found_err)
         d.addErrback(self._response_err)
@@ -1056,11 +1962,12 @@ class RegistrationHandler(AutoendpointHandler):
             router_data=router_data,
             connected_at=int(time.time() * 1000),
         )
-        return deferToThread(self.ap_settings.router.register_user, user_item)
+        return defer_db(self.ap_settings.router.register_user, user_item)
 
     def _create_endpoint(self, result=None):
         """Called to register a new channel and create its endpoint."""
-        return deferToThread(self._register_channel)
+        return self.ap_settings.executors.run("db-write",
+                                              self._register_channel)
 
     def _return_endpoint(self, endpoint, new_uaid, router=None):
         """Called after the endpoint was made and should be returned to the
@@ -1092,34 +1999,6 @@ class RegistrationHandler(AutoendpointHandler):
     #############################################################
     #                    Utility Methods
     #############################################################
-    def _validate_auth(self, uaid):
-        """Validates the Authorization header in a request
-
-        Validate the given request bearer token
-        """
-
-        test, _ = validate_uaid(uaid)
-        if not test:
-            return False
-        header = self.request.headers.get("Authorization")
-        if header is None:
-            return False
-        try:
-            token_type, rtoken = re.sub(r' +', ' ',
-                                        header.strip()).split(" ", 2)
-        except ValueError:
-            return False
-        if "bearer" != token_type.lower():
-            return False
-        if self.ap_settings.auth_key:
-            for key in self.ap_settings.auth_key:
-                token = generate_hash(key, uaid)
-                if rtoken == token:
-                    return True
-            return False
-        else:
-            return True
-
     def _load_params(self):
         """Load and parse a JSON body out of the request body, or return an
         empty dict"""
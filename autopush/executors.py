@@ -0,0 +1,212 @@
+"""Named thread pools for the blocking work of the nodes
+
+Blocking work used to share the reactor's thread pool, where a slow bridge
+or S3 could hold every thread while DynamoDB calls queued behind it.
+:class:`Executors` gives each kind of work its own pool instead:
+
+``db-read``
+    DynamoDB reads made with :func:`~autopush.db.defer_db`, and topic
+    subscription pages.
+
+``db-write``
+    Every other DynamoDB call, and the endpoint handlers' blocking table
+    work.
+
+``crypto``
+    Token work of the ``thread`` crypto mode, see :mod:`autopush.crypto`.
+
+``bridges``
+    GCM and APNS sends and UDP wake requests.
+
+``admin``
+    SenderID refreshes from S3, health checks and table rotation.
+
+Each pool has its own size and a limit on the work waiting for a thread.
+Work submitted to a full pool is rejected with :exc:`ExecutorRejected`, which
+callers handle like a throttled DynamoDB call, or with the ``shared`` policy
+run on the reactor's thread pool instead. Every
+pool records the time work waited for a thread as
+``executor.<name>.wait`` and the time it ran as ``executor.<name>.exec``.
+
+"""
+import time
+
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from twisted.internet import reactor
+from twisted.internet.defer import fail
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread, deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+EXECUTORS = ("db-read", "db-write", "crypto", "bridges", "admin")
+DEFAULT_SIZES = {
+    "db-read": 20,
+    "db-write": 20,
+    "crypto": 2,
+    "bridges": 10,
+    "admin": 2,
+}
+REJECTION_POLICIES = ("reject", "shared")
+
+# Table methods run on the db-read pool, everything else writes
+DB_READS = frozenset([
+    "get_uaid", "get_uaids", "get_uaid_and_channel", "all_channels",
+    "channel_exists", "fetch_messages", "fetch_notifications",
+    "scan_expired",
+])
+
+
+def db_executor(operation):
+    """Returns the name of the pool a table method runs on"""
+    return "db-read" if operation in DB_READS else "db-write"
+
+
+class ExecutorRejected(ProvisionedThroughputExceededException):
+    """Work rejected by an executor with a full queue
+
+    Callers handle it like a throttled call, so the node answers with its
+    overload response.
+
+    """
+    def __init__(self, name):
+        super(ExecutorRejected, self).__init__(
+            503, "Service Unavailable",
+            {"message": "Executor %s has no room for more work" % name})
+        self.name = name
+
+
+class Executor(object):
+    """Thread pool for one kind of blocking work"""
+    def __init__(self, name, metrics, size=10, max_queue=0,
+                 policy="reject"):
+        """Create a new Executor
+
+        :param name: Name of the pool, used for its threads and metrics.
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param size: Most threads the work runs on.
+        :param max_queue: Most work waiting for a thread, 0 for no limit.
+        :param policy: What happens to work submitted once ``max_queue``
+                       work waits, one of :data:`REJECTION_POLICIES`.
+
+        """
+        if policy not in REJECTION_POLICIES:
+            raise ValueError("Unknown rejection policy: %s" % policy)
+        self.name = name
+        self.metrics = metrics
+        self.size = size
+        self.max_queue = max_queue
+        self.policy = policy
+        self.pool = ThreadPool(minthreads=1, maxthreads=size, name=name)
+        self.started = False
+
+    @property
+    def queued(self):
+        """Amount of work waiting for a thread"""
+        return self.pool.q.qsize()
+
+    @property
+    def busy(self):
+        """Amount of threads running work"""
+        return len(self.pool.working)
+
+    def start(self):
+        """Start the pool's threads"""
+        if self.started:
+            return
+        self.started = True
+        self.pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    def stop(self):
+        """Stop the pool's threads"""
+        if not self.started:
+            return
+        self.started = False
+        self.pool.stop()
+
+    def run(self, func, *args, **kwargs):
+        """Returns a deferred for calling ``func`` on the pool"""
+        if not self.started:
+            self.start()
+        if self.max_queue and self.queued >= self.max_queue:
+            if self.policy == "shared":
+                self.metrics.increment("executor.%s.overflow" % self.name)
+                return deferToThread(func, *args, **kwargs)
+            self.metrics.increment("executor.%s.rejected" % self.name)
+            return fail(ExecutorRejected(self.name))
+        times = [time.time()]
+
+        def timed():
+            times.append(time.time())
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times.append(time.time())
+        d = deferToThreadPool(reactor, self.pool, timed)
+        d.addBoth(self._record, times)
+        return d
+
+    def _record(self, result, times):
+        submitted, started, finished = times
+        self.metrics.timing("executor.%s.wait" % self.name,
+                            duration=(started - submitted) * 1000)
+        self.metrics.timing("executor.%s.exec" % self.name,
+                            duration=(finished - started) * 1000)
+        return result
+
+
+class Executors(object):
+    """The named :class:`Executor` pools of a node"""
+    # Testing purposes
+    clock = reactor
+
+    def __init__(self, metrics, conf=None):
+        """Create the pools
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param conf: Dict of pool names to a dict of the ``size``,
+                     ``max_queue`` and ``policy`` of the pool, the
+                     :data:`DEFAULT_SIZES` are used otherwise.
+
+        """
+        conf = conf or {}
+        unknown = set(conf) - set(EXECUTORS)
+        if unknown:
+            raise ValueError("Unknown executors: %s" %
+                             ", ".join(sorted(unknown)))
+        self.metrics = metrics
+        self.pools = {}
+        for name in EXECUTORS:
+            options = dict(size=DEFAULT_SIZES[name])
+            options.update(conf.get(name) or {})
+            self.pools[name] = Executor(name, metrics, **options)
+        self._looper = None
+
+    def __getitem__(self, name):
+        return self.pools[name]
+
+    def run(self, name, func, *args, **kwargs):
+        """Returns a deferred for calling ``func`` on the named pool"""
+        return self.pools[name].run(func, *args, **kwargs)
+
+    def report(self):
+        """Record the waiting work and busy threads of every pool as
+        gauges"""
+        for name, executor in self.pools.items():
+            self.metrics.gauge("executor.%s.queued" % name, executor.queued)
+            self.metrics.gauge("executor.%s.busy" % name, executor.busy)
+
+    def start(self, interval=10):
+        """Report the gauges every ``interval`` seconds"""
+        self._looper = LoopingCall(self.report)
+        self._looper.clock = self.clock
+        self._looper.start(interval)
+
+    def stop(self):
+        """Stop reporting the gauges and stop every pool"""
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
+        for executor in self.pools.values():
+            executor.stop()
@@ -0,0 +1,219 @@
+"""Client-side capacity governor for the DynamoDB tables
+
+Throttled DynamoDB calls otherwise surface as a
+:exc:`ProvisionedThroughputExceededException` for every caller at once: the
+connection nodes stall and close their clients, the endpoints answer 503.
+:class:`CapacityGovernor` instead paces the calls :func:`~autopush.db.defer_db`
+makes, with a rate per operation on each table learned from the throttling
+(AIMD): the rate grows by ``increase`` calls per second for every second the
+calls keep up with it, and is multiplied by ``decrease`` when DynamoDB
+throttles a call, at most once a second.
+
+Calls over their rate wait in a queue per table, made by priority as the
+rates allow: registering a user on hello goes first, then deleting
+acknowledged messages, then everything else, and fetching stored
+notifications last. Once ``max_queue`` calls wait for a table, the lowest
+priority one is shed with a :exc:`CapacityShed`, which callers already handle
+as a throttled call.
+
+"""
+import heapq
+import itertools
+
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.internet.task import LoopingCall
+
+# Lower priorities are called first
+PRIORITIES = dict(
+    register_user=0,
+    delete_message=1,
+    delete_acked=1,
+    delete_notification=1,
+    delete_notifications=1,
+    fetch_messages=3,
+    fetch_notifications=3,
+)
+DEFAULT_PRIORITY = 2
+
+
+class CapacityShed(ProvisionedThroughputExceededException):
+    """A call shed by the governor before it was made"""
+    def __init__(self, operation):
+        super(CapacityShed, self).__init__(
+            400, "Bad Request",
+            {"__type": "com.amazonaws.dynamodb.v20120810#"
+                       "ProvisionedThroughputExceededException",
+             "message": "Capacity governor shed %s" % operation})
+
+
+class OperationLimit(object):
+    """AIMD rate of the calls of one operation on one table"""
+    def __init__(self, governor, table_name, operation):
+        self.governor = governor
+        self.name = "%s.%s" % (table_name, operation)
+        self.operation = operation
+        self.rate = float(governor.rate)
+        self.tokens = max(self.rate, 1.0)
+        self.updated = governor.clock.seconds()
+        self.decreased = None
+        self.waiting = 0
+
+    def _refill(self):
+        now = self.governor.clock.seconds()
+        # Up to a second of unused rate is saved for bursts
+        self.tokens = min(max(self.rate, 1.0),
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Returns whether the rate allows a call now, and counts it"""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        """Returns the seconds until the rate allows a call"""
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def run(self, func, args, kwargs):
+        """Returns the deferred of the call, learning the rate from its
+        result"""
+        d = maybeDeferred(func, *args, **kwargs)
+        d.addCallbacks(self._succeeded, self._failed)
+        return d
+
+    def _succeeded(self, result):
+        # Only a rate the calls are held to is raised
+        if self.waiting or self.tokens < 1:
+            self.rate = min(self.governor.max_rate,
+                            self.rate + self.governor.increase / self.rate)
+        return result
+
+    def _failed(self, failure):
+        if failure.check(ProvisionedThroughputExceededException):
+            now = self.governor.clock.seconds()
+            if self.decreased is None or now - self.decreased >= 1:
+                self.decreased = now
+                self.rate = max(self.governor.min_rate,
+                                self.rate * self.governor.decrease)
+                self.tokens = min(self.tokens, 1.0)
+                self.governor.metrics.increment(
+                    "governor.decrease.%s" % self.operation)
+        return failure
+
+
+class CapacityGovernor(object):
+    """Paces the calls to each table operation to the rate DynamoDB
+    sustains"""
+    # Testing purposes
+    clock = reactor
+
+    def __init__(self, metrics, rate=50, min_rate=1, max_rate=1000,
+                 increase=1, decrease=0.5, max_queue=100):
+        """Create a new CapacityGovernor
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param rate: Calls per second each operation on each table starts
+                     at.
+        :param min_rate: Lowest calls per second an operation is throttled
+                         down to.
+        :param max_rate: Highest calls per second an operation grows to.
+        :param increase: Calls per second added for every second the calls
+                         keep up with the rate.
+        :param decrease: Factor the rate is multiplied by when DynamoDB
+                         throttles a call.
+        :param max_queue: Most calls waiting their turn for a table.
+
+        """
+        self.metrics = metrics
+        self.rate = rate
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.increase = float(increase)
+        self.decrease = decrease
+        self.max_queue = max_queue
+        self.limits = {}
+        self.queues = {}
+        self._counter = itertools.count()
+        self._timers = {}
+        self._looper = None
+
+    def call(self, table_name, operation, func, *args, **kwargs):
+        """Returns a deferred for calling ``func``, which returns a deferred
+        for the ``operation`` on the table, paced to its rate"""
+        limit = self.limits.get((table_name, operation))
+        if limit is None:
+            limit = self.limits[(table_name, operation)] = OperationLimit(
+                self, table_name, operation)
+        if not limit.waiting and limit.take():
+            return limit.run(func, args, kwargs)
+        priority = PRIORITIES.get(operation, DEFAULT_PRIORITY)
+        queue = self.queues.setdefault(table_name, [])
+        if len(queue) >= self.max_queue:
+            lowest = max(queue)
+            if lowest[0] <= priority:
+                return self._shed(operation)
+            queue.remove(lowest)
+            heapq.heapify(queue)
+            lowest[2].waiting -= 1
+            self._shed(lowest[2].operation).chainDeferred(lowest[3])
+        d = Deferred()
+        limit.waiting += 1
+        heapq.heappush(queue, (priority, next(self._counter), limit, d,
+                               func, args, kwargs))
+        self._schedule(table_name)
+        return d
+
+    def _shed(self, operation):
+        self.metrics.increment("governor.shed.%s" % operation)
+        return fail(CapacityShed(operation))
+
+    def _schedule(self, table_name):
+        queue = self.queues.get(table_name)
+        if queue and table_name not in self._timers:
+            delay = min(entry[2].delay() for entry in queue)
+            self._timers[table_name] = self.clock.callLater(
+                delay, self._drain, table_name)
+
+    def _drain(self, table_name):
+        """Make the waiting calls of a table the rates allow, by
+        priority"""
+        del self._timers[table_name]
+        queue = self.queues[table_name]
+        held = []
+        while queue:
+            entry = heapq.heappop(queue)
+            limit = entry[2]
+            if not limit.take():
+                held.append(entry)
+                continue
+            limit.waiting -= 1
+            limit.run(*entry[4:]).chainDeferred(entry[3])
+        queue.extend(held)
+        heapq.heapify(queue)
+        self._schedule(table_name)
+
+    def report(self):
+        """Record the rate of every operation and the waiting calls of
+        every table as gauges"""
+        for limit in self.limits.values():
+            self.metrics.gauge("governor.rate.%s" % limit.name, limit.rate)
+        for table_name, queue in self.queues.items():
+            self.metrics.gauge("governor.queued.%s" % table_name, len(queue))
+
+    def start(self, interval=10):
+        """Report the gauges every ``interval`` seconds"""
+        self._looper = LoopingCall(self.report)
+        self._looper.clock = self.clock
+        self._looper.start(interval)
+
+    def stop(self):
+        """Stop reporting the gauges"""
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
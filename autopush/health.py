@@ -5,7 +5,6 @@ from boto.dynamodb2.exceptions import (
     InternalServerError,
 )
 from twisted.internet.defer import DeferredList
-from twisted.internet.threads import deferToThread
 from twisted.python import log
 
 from autopush import __version__
@@ -40,7 +39,8 @@ class HealthHandler(cyclone.web.RequestHandler):
 
     def _check_table(self, table):
         """Checks the tables known about in DynamoDB"""
-        d = deferToThread(table.connection.list_tables)
+        d = self.ap_settings.executors.run("admin",
+                                           table.connection.list_tables)
         d.addCallback(self._check_success, table.table_name)
         d.addErrback(self._check_error, table.table_name)
         return d
@@ -0,0 +1,307 @@
+"""Persistent multiplexed links between endpoint and connection nodes
+
+Instead of an HTTP request per delivery, an endpoint node can keep a single
+TCP connection, a link, to every connection node it delivers to. Deliveries
+are sent over the link as length prefixed JSON frames carrying a request id,
+so any amount of them can be in flight at once, and the connection node
+answers each with a result frame for that id.
+
+Frames are JSON objects whose ``t`` member is their type:
+
+``hello``
+    Sent by the endpoint node first with its ``heartbeat`` interval, the
+    connection node replies with the ``window``: the most requests the
+    endpoint may have in flight on the link. Further requests are queued by
+    the endpoint until results come in.
+
+``push`` and ``notif``
+    A request with an ``id`` and the ``uaid`` to deliver an ``update`` to,
+    or to check stored notifications for, the same as the ``/push/`` and
+    ``/notif/`` HTTP routes.
+
+``result``
+    The ``code`` of the request ``id``, the status code the HTTP route would
+    have returned.
+
+``ping`` and ``pong``
+    Heartbeats sent by the endpoint node every ``heartbeat`` seconds. A link
+    that's silent for two heartbeats is dropped, and the connection node
+    drops links silent for three.
+
+Deliveries use HTTP while a link isn't up. Of the requests on a link that's
+lost, those still queued and the ``notif`` requests are retried over HTTP,
+which then detects whether the node is gone. A ``push`` frame that was
+already written may have been delivered, so it fails with
+:exc:`LinkRequestLost` instead of being delivered twice, like an HTTP
+request whose response never came.
+
+"""
+import json
+import time
+from collections import deque
+from urlparse import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ClientFactory, Factory
+from twisted.internet.ssl import optionsForClientTLS
+from twisted.internet.task import LoopingCall
+from twisted.protocols import policies
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+from autopush.exceptions import AutopushException
+from autopush.nodes import NodeClient, NodeResponse
+from autopush.websocket import check_notifications, deliver_notification
+
+
+class LinkLost(AutopushException):
+    """The link a request was queued on was lost, or a request that's safe
+    to repeat was sent on"""
+
+
+class LinkRequestLost(AutopushException):
+    """The link a ``push`` request was sent on was lost before its result
+    came in"""
+
+
+class LinkServerProtocol(Int32StringReceiver, policies.TimeoutMixin):
+    """Connection node end of a link"""
+    def connectionMade(self):
+        """Drop the link if the hello doesn't arrive in time"""
+        self.setTimeout(self.factory.hello_timeout)
+
+    def stringReceived(self, data):
+        """Process a frame from the endpoint node"""
+        self.resetTimeout()
+        try:
+            frame = json.loads(data)
+            kind = frame["t"]
+            if kind == "hello":
+                self.setTimeout(frame["heartbeat"] * 3)
+                self.send_frame(dict(t="hello", window=self.factory.window))
+            elif kind == "ping":
+                self.send_frame(dict(t="pong"))
+            elif kind in ("push", "notif"):
+                self.process_request(frame)
+            else:
+                raise ValueError("Invalid frame type")
+        except (ValueError, KeyError, TypeError):
+            log.err(None, "Invalid link frame")
+            self.transport.loseConnection()
+
+    def process_request(self, frame):
+        """Deliver a ``push`` or ``notif`` request and reply its result"""
+        settings = self.factory.ap_settings
+        if frame["t"] == "push":
+            code, _ = deliver_notification(settings, frame["uaid"],
+                                           frame["update"])
+        else:
+            code, _ = check_notifications(settings, frame["uaid"])
+        settings.metrics.increment("updates.link.%s" % frame["t"])
+        self.send_frame(dict(t="result", id=frame["id"], code=code))
+
+    def send_frame(self, frame):
+        self.sendString(json.dumps(frame))
+
+    def timeoutConnection(self):
+        """Drop a silent link"""
+        self.factory.ap_settings.metrics.increment("updates.link.timeout")
+        self.transport.abortConnection()
+
+
+class LinkServerFactory(Factory):
+    """Accepts links from endpoint nodes on a connection node"""
+    protocol = LinkServerProtocol
+
+    def __init__(self, ap_settings, window=100, hello_timeout=10):
+        """Create a new LinkServerFactory
+
+        :param ap_settings: Settings whose clients get the deliveries.
+        :param window: Most requests an endpoint may have in flight on a
+                       link.
+        :param hello_timeout: Seconds a new link has to send its hello.
+
+        """
+        self.ap_settings = ap_settings
+        self.window = window
+        self.hello_timeout = hello_timeout
+
+
+class LinkClientProtocol(Int32StringReceiver):
+    """Endpoint node end of a link"""
+    clock = reactor
+
+    def connectionMade(self):
+        self.window = 0
+        self.next_id = 0
+        self.outstanding = {}
+        self.queued = deque()
+        self.last_seen = self.clock.seconds()
+        self.heartbeat = LoopingCall(self.beat)
+        self.heartbeat.clock = self.clock
+        self.heartbeat.start(self.factory.heartbeat, now=False)
+        self.send_frame(dict(t="hello", heartbeat=self.factory.heartbeat))
+
+    def request(self, frame):
+        """Returns a deferred for the result of a ``push`` or ``notif``
+        request frame"""
+        d = Deferred()
+        self.queued.append((frame, d))
+        self._send_queued()
+        return d
+
+    def _send_queued(self):
+        """Send queued requests while the window allows"""
+        while self.queued and len(self.outstanding) < self.window:
+            frame, d = self.queued.popleft()
+            self.next_id += 1
+            frame["id"] = self.next_id
+            self.outstanding[self.next_id] = (frame["t"], d)
+            self.send_frame(frame)
+
+    def stringReceived(self, data):
+        """Process a frame from the connection node"""
+        self.last_seen = self.clock.seconds()
+        frame = json.loads(data)
+        kind = frame["t"]
+        if kind == "result":
+            _, d = self.outstanding.pop(frame["id"])
+            d.callback(NodeResponse(frame["code"]))
+            self._send_queued()
+        elif kind == "hello":
+            self.window = frame["window"]
+            self.factory.link_ready(self)
+            self._send_queued()
+
+    def beat(self):
+        """Send a heartbeat, or drop the link if the node went silent"""
+        if self.clock.seconds() - self.last_seen > \
+                self.factory.heartbeat * 2:
+            self.factory.metrics.increment("router.link.timeout")
+            self.transport.abortConnection()
+            return
+        self.send_frame(dict(t="ping"))
+
+    def send_frame(self, frame):
+        self.sendString(json.dumps(frame))
+
+    def connectionLost(self, reason):
+        """Fail every request in flight or queued"""
+        if self.heartbeat.running:
+            self.heartbeat.stop()
+        pending = self.outstanding.values() + \
+            [("queued", d) for _, d in self.queued]
+        self.outstanding = {}
+        self.queued.clear()
+        self.factory.link_lost(self)
+        for kind, d in pending:
+            if kind == "push":
+                # The node may have delivered it already
+                self.factory.metrics.increment("router.link.unanswered")
+                d.errback(LinkRequestLost("Link to node lost"))
+            else:
+                d.errback(LinkLost("Link to node lost"))
+
+
+class LinkClientFactory(ClientFactory):
+    """Connects a link to a connection node for a :class:`LinkNodeClient`"""
+    protocol = LinkClientProtocol
+
+    def __init__(self, client, node_id):
+        self.client = client
+        self.node_id = node_id
+        self.heartbeat = client.heartbeat
+        self.metrics = client.metrics
+
+    def link_ready(self, link):
+        self.client.link_ready(self.node_id, link)
+
+    def link_lost(self, link):
+        self.client.link_lost(self.node_id, link)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.client.link_lost(self.node_id, None)
+
+
+class LinkNodeClient(NodeClient):
+    """Delivers to connection nodes over links, falling back to HTTP"""
+    def __init__(self, ap_settings, port, heartbeat=5, retry_delay=10):
+        """Create a new LinkNodeClient
+
+        :param ap_settings: Settings whose ``agent`` makes the HTTP
+                            requests.
+        :param port: Port the connection nodes accept links on.
+        :param heartbeat: Seconds between heartbeats on a link.
+        :param retry_delay: Seconds HTTP is used for a node after its link
+                            was lost or couldn't connect.
+
+        """
+        super(LinkNodeClient, self).__init__(ap_settings)
+        self.port = port
+        self.heartbeat = heartbeat
+        self.retry_delay = retry_delay
+        self.links = {}
+        self._connecting = set()
+        self._retry_at = {}
+
+    def push(self, node_id, uaid, payload):
+        """Returns a deferred for the delivery of the ``payload``
+        notification dict to the client of the UAID on a node"""
+        return self._request(
+            node_id, dict(t="push", uaid=uaid, update=payload),
+            NodeClient.push, node_id, uaid, payload)
+
+    def notify(self, node_id, uaid):
+        """Returns a deferred for telling the client of the UAID on a node
+        to check for stored notifications"""
+        return self._request(
+            node_id, dict(t="notif", uaid=uaid),
+            NodeClient.notify, node_id, uaid)
+
+    def link_ready(self, node_id, link):
+        """Called once a link to a node has been set up"""
+        self._connecting.discard(node_id)
+        self.links[node_id] = link
+        self.metrics.increment("router.link.connected")
+
+    def link_lost(self, node_id, link):
+        """Called when a link to a node was lost or couldn't connect"""
+        self._connecting.discard(node_id)
+        if self.links.get(node_id) is link:
+            self.links.pop(node_id, None)
+        self._retry_at[node_id] = time.time() + self.retry_delay
+        self.metrics.increment("router.link.lost")
+
+    def _request(self, node_id, frame, fallback, *args):
+        """Send a request frame over the link to a node, or with the HTTP
+        ``fallback`` if there's no link"""
+        link = self.links.get(node_id)
+        if link is None:
+            self._connect(node_id)
+            return fallback(self, *args)
+        d = link.request(frame)
+        d.addErrback(self._link_err, fallback, *args)
+        return d
+
+    def _connect(self, node_id):
+        """Start connecting a link to a node, unless it already is or
+        recently failed"""
+        if node_id in self._connecting or \
+                time.time() < self._retry_at.get(node_id, 0):
+            return
+        self._connecting.add(node_id)
+        url = urlparse(node_id)
+        factory = LinkClientFactory(self, node_id)
+        if url.scheme == "https":
+            reactor.connectSSL(url.hostname, self.port, factory,
+                               optionsForClientTLS(unicode(url.hostname)),
+                               timeout=5)
+        else:
+            reactor.connectTCP(url.hostname, self.port, factory, timeout=5)
+
+    def _link_err(self, fail, fallback, *args):
+        """errBack retrying a request over HTTP when its link was lost"""
+        fail.trap(LinkLost)
+        self.metrics.increment("router.link.fallback")
+        return fallback(self, *args)
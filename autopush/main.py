@@ -1,4 +1,5 @@
 """autopush/autoendpoint daemon scripts"""
+import argparse
 import configargparse
 import cyclone.web
 import json
@@ -8,16 +9,22 @@ from twisted.internet import reactor, task
 from twisted.python import log
 from twisted.web.server import Site
 
+from autopush.crypto import CRYPTO_MODES
 from autopush.endpoint import (
+    BatchHandler,
     EndpointHandler,
     MessageHandler,
     RegistrationHandler,
+    TopicHandler,
 )
 from autopush.health import (HealthHandler, StatusHandler)
+from autopush.link import LinkServerFactory
 from autopush.logging import setup_logging
+from autopush.reaper import MessageReaper
 from autopush.settings import AutopushSettings
 from autopush.ssl import AutopushSSLContextFactory
 from autopush.websocket import (
+    BatchRouterHandler,
     PushServerProtocol,
     RouterHandler,
     NotificationHandler,
@@ -35,6 +42,16 @@ shared_config_files = [
 ]
 
 
+def json_arg(value):
+    """Parse the value of an option holding JSON, empty for none"""
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError("invalid JSON: %s" % exc)
+
+
 def add_shared_args(parser):
     """Add's a large common set of shared arguments"""
     parser.add_argument('--config-shared',
@@ -97,6 +114,23 @@ def add_shared_args(parser):
     parser.add_argument('--router_write_throughput',
                         help="DynamoDB router write throughput",
                         type=int, default=5, env_var="ROUTER_WRITE_THROUGHPUT")
+    parser.add_argument('--dynamodb_async',
+                        help="Make DynamoDB requests on the reactor instead "
+                             "of blocking calls in threads",
+                        action="store_true", default=False,
+                        env_var="DYNAMODB_ASYNC")
+    parser.add_argument('--dynamodb_connections',
+                        help="Max persistent connections to DynamoDB for "
+                             "the non-blocking requests",
+                        type=int, default=50, env_var="DYNAMODB_CONNECTIONS")
+    parser.add_argument('--write_batch_window',
+                        help="Milliseconds stored notifications are held to "
+                             "be written together, 0 to write each on its "
+                             "own",
+                        type=int, default=0, env_var="WRITE_BATCH_WINDOW")
+    parser.add_argument('--write_batch_size',
+                        help="Max stored messages written together",
+                        type=int, default=25, env_var="WRITE_BATCH_SIZE")
     parser.add_argument('--log_level', type=int, default=40,
                         env_var="LOG_LEVEL")
     parser.add_argument('--max_data', help="Max data segment length in bytes",
@@ -113,6 +147,94 @@ def add_shared_args(parser):
     parser.add_argument('--gcm_enabled', help="Enable GCM Bridge",
                         action="store_true", default=False,
                         env_var="GCM_ENABLED")
+    parser.add_argument('--crypto_mode',
+                        help="Where token crypto runs: inline, thread or "
+                             "process",
+                        type=str, default="inline", choices=CRYPTO_MODES,
+                        env_var="CRYPTO_MODE")
+    parser.add_argument('--crypto_workers',
+                        help="Threads or processes for token crypto, "
+                             "defaults to the CPU count less one",
+                        type=int, default=None, env_var="CRYPTO_WORKERS")
+    parser.add_argument('--token_version',
+                        help="Endpoint token and message id format to "
+                             "create: 0 for legacy Fernet tokens, 1 for "
+                             "compact tokens. Both are always accepted",
+                        type=int, default=0, choices=[0, 1],
+                        env_var="TOKEN_VERSION")
+    parser.add_argument('--message_item_version',
+                        help="Webpush message item format to store: 1 for "
+                             "the original items, 2 for compact items. Both "
+                             "are always read",
+                        type=int, default=1, choices=[1, 2],
+                        env_var="MESSAGE_ITEM_VERSION")
+    parser.add_argument('--channel_markers',
+                        help="Write a marker item for every registered "
+                             "channel and check channels with it. Enable "
+                             "only once every connection node is upgraded",
+                        action="store_true", default=False,
+                        env_var="CHANNEL_MARKERS")
+    parser.add_argument('--eventual_reads',
+                        help="Comma separated reads to make eventually "
+                             "consistent, read again strongly consistent "
+                             "when an item is missing: get_uaids, "
+                             "channel_exists",
+                        type=str, default="", env_var="EVENTUAL_READS")
+    parser.add_argument('--governor_rate',
+                        help="Calls per second each DynamoDB operation on "
+                             "each table starts at before adapting to "
+                             "throttling, 0 to not pace them",
+                        type=int, default=0, env_var="GOVERNOR_RATE")
+    parser.add_argument('--governor_max_rate',
+                        help="Highest calls per second a DynamoDB operation "
+                             "on a table is paced to",
+                        type=int, default=1000, env_var="GOVERNOR_MAX_RATE")
+    parser.add_argument('--governor_queue',
+                        help="Most paced DynamoDB calls of an operation "
+                             "waiting, lower priority calls are shed first",
+                        type=int, default=100, env_var="GOVERNOR_QUEUE")
+    parser.add_argument('--db_deadline',
+                        help="Seconds a DynamoDB call may take before it's "
+                             "cancelled, 0 for no deadline",
+                        type=float, default=0, env_var="DB_DEADLINE")
+    parser.add_argument('--db_deadlines',
+                        help="JSON object of DynamoDB operations to their "
+                             "own deadline in seconds, 0 for no deadline",
+                        type=json_arg, default=None, env_var="DB_DEADLINES")
+    parser.add_argument('--hedge_reads',
+                        help="Comma separated reads to make again when they "
+                             "take longer than usual, using the first "
+                             "answer: get_uaid, get_uaids, "
+                             "get_uaid_and_channel, all_channels, "
+                             "channel_exists, fetch_messages, "
+                             "fetch_notifications",
+                        type=str, default="", env_var="HEDGE_READS")
+    parser.add_argument('--hedge_percentile',
+                        help="Percentile of the recent latencies of a read "
+                             "after which it's hedged",
+                        type=int, default=95, env_var="HEDGE_PERCENTILE")
+    parser.add_argument('--executors',
+                        help="JSON object of the db-read, db-write, crypto, "
+                             "bridges and admin thread pools to their size, "
+                             "max_queue and rejection policy (reject or "
+                             "shared)",
+                        type=json_arg, default=None, env_var="EXECUTORS")
+    parser.add_argument('--retry_budget',
+                        help="Most retries of failed deletes pending at "
+                             "once on a node",
+                        type=int, default=100, env_var="RETRY_BUDGET")
+    parser.add_argument('--retry_caps',
+                        help="JSON object of operations to the most retries "
+                             "of it pending at once",
+                        type=json_arg, default=None, env_var="RETRY_CAPS")
+    parser.add_argument('--retry_attempts',
+                        help="Times a failed delete is tried before it's "
+                             "given up",
+                        type=int, default=10, env_var="RETRY_ATTEMPTS")
+    parser.add_argument('--retry_overflow',
+                        help="Most retries waiting for room in the budget, "
+                             "further ones are given up",
+                        type=int, default=1000, env_var="RETRY_OVERFLOW")
     parser.add_argument('--human_logs', help="Enable human readable logs",
                         action="store_true", default=False)
     # No ENV because this is for humans
@@ -186,6 +308,14 @@ def _parse_connection(sysargs):
     parser.add_argument('--router_ssl_cert',
                         help="Routing listener SSL cert path", type=str,
                         default="", env_var="ROUTER_SSL_CERT")
+    parser.add_argument('--router_link_port',
+                        help="Port for persistent links from endpoint nodes, "
+                             "0 to only route over HTTP",
+                        type=int, default=0, env_var="ROUTER_LINK_PORT")
+    parser.add_argument('--router_link_window',
+                        help="Max deliveries in flight on a link from an "
+                             "endpoint node",
+                        type=int, default=100, env_var="ROUTER_LINK_WINDOW")
     parser.add_argument('--auto_ping_interval',
                         help="Interval between Websocket pings", default=0,
                         type=float, env_var="AUTO_PING_INTERVAL")
@@ -207,6 +337,45 @@ def _parse_connection(sysargs):
                         help="The client handshake timeout. Set to 0 to"
                         "disable.", default=0, type=int,
                         env_var="HELLO_TIMEOUT")
+    parser.add_argument('--message_page_size',
+                        help="Webpush messages read at first when checking "
+                             "storage",
+                        type=int, default=10, env_var="MESSAGE_PAGE_SIZE")
+    parser.add_argument('--message_page_max',
+                        help="Most webpush messages read at once while "
+                             "draining a backlog",
+                        type=int, default=100, env_var="MESSAGE_PAGE_MAX")
+    parser.add_argument('--reaper_interval',
+                        help="Seconds between passes deleting expired "
+                             "webpush messages, 0 to disable. Enable it on "
+                             "one node, or on reaper_shards nodes",
+                        type=int, default=0, env_var="REAPER_INTERVAL")
+    parser.add_argument('--reaper_segments',
+                        help="Segments each message table is scanned in "
+                             "parallel, split between the reaper shards",
+                        type=int, default=4, env_var="REAPER_SEGMENTS")
+    parser.add_argument('--reaper_read_budget',
+                        help="Read capacity units per second for the "
+                             "reaper, split between the reaper shards. "
+                             "Every node running the same shard uses all "
+                             "of its share",
+                        type=float, default=10,
+                        env_var="REAPER_READ_BUDGET")
+    parser.add_argument('--reaper_write_budget',
+                        help="Write capacity units per second for the "
+                             "reaper, split between the reaper shards. "
+                             "Every node running the same shard uses all "
+                             "of its share",
+                        type=float, default=10,
+                        env_var="REAPER_WRITE_BUDGET")
+    parser.add_argument('--reaper_shards',
+                        help="Connection nodes running the reaper, each "
+                             "with its own reaper_shard",
+                        type=int, default=1, env_var="REAPER_SHARDS")
+    parser.add_argument('--reaper_shard',
+                        help="Which of the reaper_shards this node runs, "
+                             "from 0",
+                        type=int, default=0, env_var="REAPER_SHARD")
 
     add_external_router_args(parser)
     add_shared_args(parser)
@@ -243,6 +412,75 @@ def _parse_endpoint(sysargs):
     parser.add_argument('--auth_key', help='Bearer Token source key',
                         type=str, default=[], env_var='AUTH_KEY',
                         action="append")
+    parser.add_argument('--router_cache_size',
+                        help="Router records to cache, 0 to disable",
+                        type=int, default=10000, env_var='ROUTER_CACHE_SIZE')
+    parser.add_argument('--router_cache_ttl',
+                        help="Seconds a cached router record is used",
+                        type=int, default=30, env_var='ROUTER_CACHE_TTL')
+    parser.add_argument('--token_cache_size',
+                        help="Decrypted tokens to cache, 0 to disable",
+                        type=int, default=10000, env_var='TOKEN_CACHE_SIZE')
+    parser.add_argument('--token_cache_ttl',
+                        help="Seconds a decrypted token is cached",
+                        type=int, default=300, env_var='TOKEN_CACHE_TTL')
+    parser.add_argument('--token_cache_negative_ttl',
+                        help="Seconds an invalid token is remembered",
+                        type=int, default=5,
+                        env_var='TOKEN_CACHE_NEGATIVE_TTL')
+    parser.add_argument('--max_batch',
+                        help="Max messages in a batch push request",
+                        type=int, default=100, env_var='MAX_BATCH')
+    parser.add_argument('--topic_tablename',
+                        help="DynamoDB Topic Tablename, topics are only "
+                             "served when set",
+                        type=str, default="", env_var="TOPIC_TABLENAME")
+    parser.add_argument('--topic_chunk_size',
+                        help="Topic subscriptions read and routed at once "
+                             "when publishing",
+                        type=int, default=100, env_var='TOPIC_CHUNK_SIZE')
+    parser.add_argument('--topic_concurrency',
+                        help="Max concurrent deliveries when publishing to "
+                             "a topic",
+                        type=int, default=10, env_var='TOPIC_CONCURRENCY')
+    parser.add_argument('--node_batch_window',
+                        help="Milliseconds deliveries to a connection node "
+                             "are held to be sent as one batch, 0 to send "
+                             "each on its own",
+                        type=int, default=0, env_var='NODE_BATCH_WINDOW')
+    parser.add_argument('--node_batch_size',
+                        help="Max deliveries in a batch to a connection "
+                             "node",
+                        type=int, default=100, env_var='NODE_BATCH_SIZE')
+    parser.add_argument('--node_link_port',
+                        help="Port connection nodes accept persistent links "
+                             "on, 0 to only route over HTTP",
+                        type=int, default=0, env_var='NODE_LINK_PORT')
+    parser.add_argument('--node_link_heartbeat',
+                        help="Seconds between heartbeats on a link to a "
+                             "connection node",
+                        type=float, default=5, env_var='NODE_LINK_HEARTBEAT')
+    parser.add_argument('--sender_rate_limit',
+                        help="Notifications per minute accepted from each "
+                             "sender, by remote IP, 0 for no limit",
+                        type=int, default=0, env_var='SENDER_RATE_LIMIT')
+    parser.add_argument('--sender_rate_overrides',
+                        help="JSON object of senders to their own "
+                             "notifications per minute, 0 for no limit",
+                        type=str, default=None,
+                        env_var='SENDER_RATE_OVERRIDES')
+    parser.add_argument('--trusted_proxies',
+                        help="Comma separated addresses of the proxies "
+                             "whose X-Forwarded-For identifies the sender",
+                        type=str, default="", env_var='TRUSTED_PROXIES')
+    parser.add_argument('--uaid_rate_limit',
+                        help="Notifications per minute accepted for each "
+                             "UAID, 0 for no limit",
+                        type=int, default=0, env_var='UAID_RATE_LIMIT')
+    parser.add_argument('--rate_limit_keys',
+                        help="Max senders and UAIDs tracked by each rate "
+                             "limit",
+                        type=int, default=10000, env_var='RATE_LIMIT_KEYS')
 
     add_shared_args(parser)
     add_external_router_args(parser)
@@ -306,6 +544,30 @@ def make_settings(args, **kwargs):
         router_write_throughput=args.router_write_throughput,
         resolve_hostname=args.resolve_hostname,
         wake_timeout=args.wake_timeout,
+        crypto_mode=args.crypto_mode,
+        crypto_workers=args.crypto_workers,
+        token_version=args.token_version,
+        dynamodb_async=args.dynamodb_async,
+        dynamodb_connections=args.dynamodb_connections,
+        write_batch_window=args.write_batch_window,
+        write_batch_size=args.write_batch_size,
+        message_item_version=args.message_item_version,
+        channel_markers=args.channel_markers,
+        eventual_reads=[name.strip() for name in
+                        args.eventual_reads.split(",") if name.strip()],
+        governor_rate=args.governor_rate,
+        governor_max_rate=args.governor_max_rate,
+        governor_queue=args.governor_queue,
+        db_deadline=args.db_deadline,
+        db_deadlines=args.db_deadlines,
+        hedge_reads=[name.strip() for name in
+                     args.hedge_reads.split(",") if name.strip()],
+        hedge_percentile=args.hedge_percentile,
+        executors=args.executors,
+        retry_budget=args.retry_budget,
+        retry_caps=args.retry_caps,
+        retry_attempts=args.retry_attempts,
+        retry_overflow=args.retry_overflow,
         **kwargs
     )
 
@@ -342,17 +604,22 @@ def connection_main(sysargs=None):
         router_port=args.router_port,
         env=args.env,
         hello_timeout=args.hello_timeout,
+        message_page_size=args.message_page_size,
+        message_page_max=args.message_page_max,
     )
 
     r = RouterHandler
     r.ap_settings = settings
     n = NotificationHandler
     n.ap_settings = settings
+    b = BatchRouterHandler
+    b.ap_settings = settings
 
     # Internal HTTP notification router
     site = cyclone.web.Application([
         (r"/push/([^\/]+)", r),
         (r"/notif/([^\/]+)(/([^\/]+))?", n),
+        (r"/batch", b),
     ],
         default_host=settings.router_hostname, debug=args.debug,
         log_function=skip_request_logging
@@ -381,6 +648,11 @@ def connection_main(sysargs=None):
     settings.factory = factory
 
     settings.metrics.start()
+    settings.crypto.start()
+    if settings.governor:
+        settings.governor.start()
+    settings.executors.start()
+    settings.retries.start()
 
     # Wrap the WebSocket server in a default resource that exposes the
     # `/status` handler, and delegates to the WebSocket resource for all
@@ -400,15 +672,20 @@ def connection_main(sysargs=None):
     else:
         reactor.listenTCP(args.port, siteFactory)
 
-    # Start the internal routing listener.
+    # Start the internal routing listeners.
+    link = LinkServerFactory(settings, args.router_link_window)
     if args.router_ssl_key:
         contextFactory = AutopushSSLContextFactory(args.router_ssl_key,
                                                    args.router_ssl_cert)
         if args.ssl_dh_param:
             contextFactory.getContext().load_tmp_dh(args.ssl_dh_param)
         reactor.listenSSL(args.router_port, site, contextFactory)
+        if args.router_link_port:
+            reactor.listenSSL(args.router_link_port, link, contextFactory)
     else:
         reactor.listenTCP(args.router_port, site)
+        if args.router_link_port:
+            reactor.listenTCP(args.router_link_port, link)
 
     reactor.suggestThreadPoolSize(50)
 
@@ -418,6 +695,16 @@ def connection_main(sysargs=None):
     # Start the table rotation checker/updater
     l = task.LoopingCall(settings.update_rotating_tables)
     l.start(60)
+
+    # Delete expired messages in the background
+    if args.reaper_interval:
+        reaper = MessageReaper(settings,
+                               segments=args.reaper_segments,
+                               read_budget=args.reaper_read_budget,
+                               write_budget=args.reaper_write_budget,
+                               shard=args.reaper_shard,
+                               shards=args.reaper_shards)
+        reaper.start(args.reaper_interval)
     reactor.run()
 
 
@@ -432,6 +719,13 @@ def endpoint_main(sysargs=None):
         except (ValueError, TypeError), x:
             log.err("Invalid JSON specified for senderid_list.", x)
             return
+    sender_rate_overrides = None
+    if args.sender_rate_overrides:
+        try:
+            sender_rate_overrides = json.loads(args.sender_rate_overrides)
+        except (ValueError, TypeError), x:
+            log.err("Invalid JSON specified for sender_rate_overrides.", x)
+            return
 
     setup_logging("Autoendpoint", args.human_logs)
 
@@ -445,10 +739,30 @@ def endpoint_main(sysargs=None):
         senderid_expry=args.senderid_expry,
         senderid_list=senderid_list,
         auth_key=args.auth_key,
+        router_cache_size=args.router_cache_size,
+        router_cache_ttl=args.router_cache_ttl,
+        token_cache_size=args.token_cache_size,
+        token_cache_ttl=args.token_cache_ttl,
+        token_cache_negative_ttl=args.token_cache_negative_ttl,
+        max_batch=args.max_batch,
+        topic_tablename=args.topic_tablename,
+        topic_chunk_size=args.topic_chunk_size,
+        topic_concurrency=args.topic_concurrency,
+        node_batch_window=args.node_batch_window,
+        node_batch_size=args.node_batch_size,
+        node_link_port=args.node_link_port,
+        node_link_heartbeat=args.node_link_heartbeat,
+        sender_rate_limit=args.sender_rate_limit,
+        sender_rate_overrides=sender_rate_overrides,
+        trusted_proxies=[address.strip() for address in
+                         args.trusted_proxies.split(",") if address.strip()],
+        uaid_rate_limit=args.uaid_rate_limit,
+        rate_limit_keys=args.rate_limit_keys,
     )
 
     # Endpoint HTTP router
-    site = cyclone.web.Application([
+    handlers = [
+        (r"/push/batch", BatchHandler, dict(ap_settings=settings)),
         (r"/push/([^\/]+)", EndpointHandler, dict(ap_settings=settings)),
         (r"/m/([^\/]+)", MessageHandler, dict(ap_settings=settings)),
         # PUT /register/ => connect info
@@ -457,13 +771,22 @@ def endpoint_main(sysargs=None):
             "?(?:/subscription)?(?:/([^\/]+))?",
          RegistrationHandler,
          dict(ap_settings=settings)),
-    ],
+    ]
+    if settings.topic:
+        handlers.append((r"/topic(?:/([^\/]+))?", TopicHandler,
+                         dict(ap_settings=settings)))
+    site = cyclone.web.Application(
+        handlers,
         default_host=settings.hostname, debug=args.debug,
         log_function=skip_request_logging
     )
     mount_health_handlers(site, settings)
 
     settings.metrics.start()
+    settings.crypto.start()
+    if settings.governor:
+        settings.governor.start()
+    settings.executors.start()
 
     # start the senderIDs refresh timer
     if settings.routers.get('gcm') and settings.routers['gcm'].senderIDs:
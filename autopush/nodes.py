@@ -0,0 +1,178 @@
+"""Delivery of notifications from endpoint nodes to connection nodes
+
+Routers hand the notifications for clients connected to a connection node,
+and the checks for stored notifications, to a node client:
+
+:class:`NodeClient`
+    Sends every delivery as its own HTTP request to the ``/push/`` or
+    ``/notif/`` route of the node.
+
+:class:`BatchingNodeClient`
+    Holds the deliveries for each node for a few milliseconds, or until
+    enough are pending, and sends them to the ``/batch`` route of the node
+    as a single HTTP request.
+
+:class:`~autopush.link.LinkNodeClient`
+    Sends the deliveries over a persistent link to each node, see
+    :mod:`autopush.link`.
+
+All of them return deferreds that fire with a response whose ``code`` is
+the status code of the delivery, as the ``/push/`` or ``/notif/`` route
+returns it.
+
+"""
+import json
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.web.client import FileBodyProducer, readBody
+
+from autopush.protocol import IgnoreBody
+
+
+class NodeResponse(object):
+    """The response to a single delivery of a batch"""
+    def __init__(self, code):
+        self.code = code
+
+
+class NodeClient(object):
+    """Delivers to connection nodes with one HTTP request per delivery"""
+    def __init__(self, ap_settings):
+        """Create a new NodeClient
+
+        :param ap_settings: Settings whose ``agent`` makes the requests.
+
+        """
+        self.ap_settings = ap_settings
+        self.metrics = ap_settings.metrics
+
+    def push(self, node_id, uaid, payload):
+        """Returns a deferred for the delivery of the ``payload``
+        notification dict to the client of the UAID on a node"""
+        url = node_id + "/push/" + uaid
+        d = self.ap_settings.agent.request(
+            "PUT",
+            url.encode("utf8"),
+            bodyProducer=FileBodyProducer(StringIO(json.dumps(payload))),
+        )
+        d.addCallback(IgnoreBody.ignore)
+        return d
+
+    def notify(self, node_id, uaid):
+        """Returns a deferred for telling the client of the UAID on a node
+        to check for stored notifications"""
+        url = node_id + "/notif/" + uaid
+        return self.ap_settings.agent.request(
+            "PUT",
+            url.encode("utf8"),
+        ).addCallback(IgnoreBody.ignore)
+
+
+class BatchingNodeClient(NodeClient):
+    """Delivers to connection nodes with one HTTP request per batch of
+    deliveries to a node
+
+    Nodes that don't have the ``/batch`` route yet get the deliveries of
+    the batch as separate requests.
+
+    """
+    def __init__(self, ap_settings, window=5, size=100):
+        """Create a new BatchingNodeClient
+
+        :param ap_settings: Settings whose ``agent`` makes the requests.
+        :param window: Milliseconds a delivery is held for other deliveries
+                       to the same node.
+        :param size: Amount of held deliveries to a node that are sent
+                     without waiting for the window to end.
+
+        """
+        super(BatchingNodeClient, self).__init__(ap_settings)
+        self.window = window / 1000.0
+        self.size = size
+        self._pending = {}
+        self._timers = {}
+
+    def push(self, node_id, uaid, payload):
+        """Returns a deferred for the delivery of the ``payload``
+        notification dict to the client of the UAID on a node"""
+        return self._hold(node_id, dict(type="push", uaid=uaid,
+                                        update=payload))
+
+    def notify(self, node_id, uaid):
+        """Returns a deferred for telling the client of the UAID on a node
+        to check for stored notifications"""
+        return self._hold(node_id, dict(type="notif", uaid=uaid))
+
+    def flush(self, node_id):
+        """Send the deliveries held for a node"""
+        timer = self._timers.pop(node_id, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        batch = self._pending.pop(node_id, [])
+        if len(batch) == 1:
+            self._send_each(node_id, batch)
+            return
+        elif not batch:
+            return
+
+        self.metrics.increment("router.node.batch")
+        self.metrics.increment("router.node.batched", count=len(batch))
+        body = json.dumps([entry for entry, _ in batch])
+        d = self.ap_settings.agent.request(
+            "POST",
+            (node_id + "/batch").encode("utf8"),
+            bodyProducer=FileBodyProducer(StringIO(body)),
+        )
+        d.addCallback(self._batch_response, node_id, batch)
+        d.addErrback(self._batch_err, batch)
+
+    def _hold(self, node_id, entry):
+        """Hold a delivery for a node, returns a deferred for its
+        response"""
+        d = Deferred()
+        pending = self._pending.setdefault(node_id, [])
+        pending.append((entry, d))
+        if len(pending) >= self.size:
+            self.flush(node_id)
+        elif node_id not in self._timers:
+            self._timers[node_id] = reactor.callLater(self.window,
+                                                      self.flush, node_id)
+        return d
+
+    def _send_each(self, node_id, batch):
+        """Send the deliveries of a batch as separate requests"""
+        for entry, d in batch:
+            if entry["type"] == "push":
+                single = NodeClient.push(self, node_id, entry["uaid"],
+                                         entry["update"])
+            else:
+                single = NodeClient.notify(self, node_id, entry["uaid"])
+            single.chainDeferred(d)
+
+    def _batch_response(self, response, node_id, batch):
+        """Called with the response to a batch request"""
+        if response.code != 200:
+            # The node doesn't have the batch route
+            d = IgnoreBody.ignore(response)
+            d.addCallback(lambda x: self._send_each(node_id, batch))
+            return d
+        d = readBody(response)
+        d.addCallback(self._batch_results, batch)
+        return d
+
+    def _batch_results(self, body, batch):
+        """Fire the deferred of every delivery of a batch with its
+        response"""
+        results = json.loads(body)
+        if not isinstance(results, list) or len(results) != len(batch):
+            raise ValueError("Wrong amount of batch results")
+        for (entry, d), result in zip(batch, results):
+            d.callback(NodeResponse(result["code"]))
+
+    def _batch_err(self, fail, batch):
+        """errBack failing every delivery of a batch that's still waiting"""
+        for entry, d in batch:
+            if not d.called:
+                d.errback(fail)
@@ -0,0 +1,76 @@
+"""Admission control for AppServer traffic
+
+Rate limits are checked before a notification costs any crypto or DynamoDB
+work, so a single sender flooding an endpoint can't use up the table capacity
+every other sender relies on.
+
+"""
+import math
+import time
+
+from repoze.lru import LRUCache
+
+
+class RateLimiter(object):
+    """Token bucket rate limits keyed by client identity
+
+    Every key gets a bucket holding up to a minute worth of its ``rate``,
+    which refills continuously. Keys in ``overrides`` use their own rate per
+    minute instead, an override of 0 exempts the key. A ``rate`` of 0 and no
+    overrides disables the limiter.
+
+    """
+    def __init__(self, rate=0, overrides=None, size=10000):
+        """Create a new RateLimiter
+
+        :param rate: Requests per minute allowed for each key.
+        :param overrides: Dict of keys to their own requests per minute.
+        :param size: Maximum amount of keys tracked, the least recently
+                     seen keys start with a full bucket again.
+
+        """
+        self.rate = rate
+        self.overrides = overrides or {}
+        self._buckets = LRUCache(size) \
+            if rate > 0 or self.overrides else None
+
+    @property
+    def enabled(self):
+        """Whether any key is being limited at all"""
+        return self._buckets is not None
+
+    def limit(self, key):
+        """Returns the most tokens the bucket of a key ever holds, 0 if the
+        key isn't limited
+
+        A cost above it can never be taken from the bucket.
+
+        """
+        if self._buckets is None:
+            return 0
+        return self.overrides.get(key, self.rate)
+
+    def throttle(self, key, cost=1):
+        """Take ``cost`` tokens from the bucket of a key
+
+        Returns 0 if they were available, otherwise the seconds until they
+        will be. Nothing is taken from a bucket that's short.
+
+        """
+        if self._buckets is None:
+            return 0
+        rate = self.overrides.get(key, self.rate)
+        if not rate:
+            return 0
+        now = time.time()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = rate
+        else:
+            tokens, last = bucket
+            tokens = min(rate, tokens + (now - last) * rate / 60.0)
+        if tokens < cost:
+            self._buckets.put(key, (tokens, now))
+            return int(math.ceil((cost - tokens) * 60.0 / rate))
+        self._buckets.put(key, (tokens - cost, now))
+        return 0
@@ -0,0 +1,152 @@
+"""Background deletion of expired webpush messages
+
+Expired messages are otherwise only found, and deleted, when their user
+connects and reads them. :class:`MessageReaper` walks the rotating message
+tables with parallel segmented scans instead, and deletes the expired
+messages it finds with BatchWriteItem, paced to stay within a read and
+write capacity budget so it can't starve the connection and endpoint
+nodes.
+
+The segments and the budget can be split between several connection
+nodes: each of ``shards`` nodes runs its own ``shard``, scanning every
+``shards``-th segment with its share of the budget. Nodes running the same
+shard, or every node left at the default single shard, scan the same
+segments and each use the whole budget.
+
+Scans are eventually consistent and deletes unconditional, a message
+updated from expired to current between the scan and the delete of its
+page is deleted anyway.
+
+"""
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredList,
+    inlineCallbacks,
+    returnValue,
+)
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.python import log
+
+from autopush.db import defer_db
+
+
+class MessageReaper(object):
+    """Deletes the expired messages of the message tables"""
+    # Testing purposes
+    clock = reactor
+
+    def __init__(self, settings, segments=4, read_budget=10,
+                 write_budget=10, page_size=100, shard=0, shards=1):
+        """Create a new MessageReaper
+
+        :param settings: :class:`~autopush.settings.AutopushSettings` with
+                         the message tables.
+        :param segments: Amount of segments each table is scanned in, in
+                         parallel.
+        :param read_budget: Read capacity units per second for the scans
+                            of every shard together.
+        :param write_budget: Write capacity units per second for the
+                             deletes of every shard together.
+        :param page_size: Most items read by a scan request.
+        :param shard: Which of the ``shards`` this reaper runs.
+        :param shards: Amount of reapers the segments and budgets are split
+                       between.
+
+        """
+        if not 0 <= shard < shards <= segments:
+            raise ValueError("Reaper shard %s of %s can't split %s segments" %
+                             (shard, shards, segments))
+        self.settings = settings
+        self.metrics = settings.metrics
+        self.segments = segments
+        self.shard_segments = range(shard, segments, shards)
+        self.read_budget = float(read_budget) / shards
+        self.write_budget = float(write_budget) / shards
+        self.page_size = page_size
+        self._budget_at = 0
+        self._looper = None
+        self._running = None
+
+    def start(self, interval):
+        """Reap every ``interval`` seconds, a pass still running when the
+        next one is due is left to finish instead"""
+        self._looper = LoopingCall(self._run)
+        self._looper.clock = self.clock
+        self._looper.start(interval)
+
+    def stop(self):
+        """Stop reaping"""
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
+
+    def _run(self):
+        if self._running is not None:
+            return
+        self._running = d = self.reap()
+        d.addErrback(log.err, "Reaping failed")
+        d.addBoth(self._finished)
+
+    def _finished(self, result):
+        self._running = None
+
+    @inlineCallbacks
+    def reap(self):
+        """Returns a deferred for one pass over every message table, firing
+        with the totals of the pass
+
+        :returns: Tuple of the amount of messages deleted, and the read and
+                  write capacity consumed.
+
+        """
+        totals = [0, 0, 0]
+        started = time.time()
+        for message in self.settings.message_tables.values():
+            results = yield DeferredList(
+                [self._reap_segment(message, segment, totals)
+                 for segment in self.shard_segments],
+                consumeErrors=True)
+            for success, result in results:
+                if not success:
+                    log.err(result, "Reaping failed",
+                            table=message.table.table_name)
+        reclaimed, read, write = totals
+        self.metrics.timing("reaper.pass", duration=time.time() - started)
+        self.metrics.gauge("reaper.reclaimed", reclaimed)
+        self.metrics.gauge("reaper.capacity.read", read)
+        self.metrics.gauge("reaper.capacity.write", write)
+        returnValue((reclaimed, read, write))
+
+    @inlineCallbacks
+    def _reap_segment(self, message, segment, totals):
+        """Scan a segment of a table to its end, deleting expired messages
+        page by page"""
+        start_key = None
+        while True:
+            expired, start_key, read = yield defer_db(
+                message.scan_expired, segment, self.segments, start_key,
+                self.page_size)
+            write = 0
+            if expired:
+                write = yield defer_db(message.delete_expired, expired)
+                self.metrics.increment("reaper.deleted", count=len(expired))
+            totals[0] += len(expired)
+            totals[1] += read
+            totals[2] += write
+            if not start_key:
+                break
+            yield self._pace(read, write)
+
+    def _pace(self, read, write):
+        """Returns a deferred firing once the capacity just consumed fits
+        the budget
+
+        All the segments share one budget, every page reserves the time its
+        capacity takes at the budgeted rate.
+
+        """
+        cost = max(read / self.read_budget, write / self.write_budget)
+        now = self.clock.seconds()
+        self._budget_at = max(self._budget_at, now) + cost
+        return deferLater(self.clock, self._budget_at - now, lambda: None)
@@ -0,0 +1,162 @@
+"""Budgeted retries of the table writes that must eventually happen
+
+Deleting acknowledged or unregistered notifications can't be left undone,
+but retrying them right away until they succeed turns a DynamoDB throttle
+into a retry storm that keeps the table throttled, long after the clients
+that made the calls left. :class:`RetryScheduler` retries them with
+exponentially growing, fully jittered delays instead, with at most
+``budget`` retries pending on the node and at most the operation's cap for
+each operation.
+
+Retries over the budget or a cap wait in an overflow queue, taken in order
+as pending retries finish. A call is given up once it failed ``attempts``
+times, or when the overflow queue is full: the failure is logged, counted
+as ``retry.giveup.<operation>`` and returned from the call's deferred.
+
+"""
+import random
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from autopush.db import defer_db
+
+
+class Retry(object):
+    """A call retried by a :class:`RetryScheduler`"""
+    def __init__(self, func, args, kwargs):
+        self.operation = getattr(func, "__name__", type(func).__name__)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.holding = False
+        self.result = Deferred()
+
+
+class RetryScheduler(object):
+    """Retries failed calls within a budget, with jittered exponential
+    backoff"""
+    # Testing purposes
+    clock = reactor
+
+    def __init__(self, metrics, budget=100, caps=None, attempts=10,
+                 base_delay=0.1, max_delay=30, max_overflow=1000):
+        """Create a new RetryScheduler
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param budget: Most retries pending at once.
+        :param caps: Dict of operations to the most retries of it pending
+                     at once, ``budget`` for the others.
+        :param attempts: Times a call is made before it's given up.
+        :param base_delay: Seconds the delay before the first retry is
+                           picked from, doubled for every further retry.
+        :param max_delay: Most seconds the delays are picked from.
+        :param max_overflow: Most retries waiting for room in the budget or
+                             their cap.
+
+        """
+        self.metrics = metrics
+        self.budget = budget
+        self.caps = caps or {}
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_overflow = max_overflow
+        self.pending = 0
+        self.operations = {}
+        self.overflow = deque()
+        self._looper = None
+
+    def retry(self, func, *args, **kwargs):
+        """Returns a deferred for calling ``func`` with
+        :func:`~autopush.db.defer_db`, retried until it succeeds or is given
+        up"""
+        retry = Retry(func, args, kwargs)
+        self._attempt(retry)
+        return retry.result
+
+    def delay(self, attempts):
+        """Returns the seconds to wait before retrying a call that failed
+        ``attempts`` times"""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(0, ceiling)
+
+    def _attempt(self, retry):
+        d = defer_db(retry.func, *retry.args, **retry.kwargs)
+        d.addCallbacks(self._succeeded, self._failed, callbackArgs=(retry,),
+                       errbackArgs=(retry,))
+
+    def _succeeded(self, result, retry):
+        self._release(retry)
+        retry.result.callback(result)
+
+    def _failed(self, fail, retry):
+        retry.attempts += 1
+        if retry.attempts >= self.attempts:
+            self._give_up(retry, fail)
+        elif retry.holding or self._acquire(retry):
+            self._schedule(retry)
+        elif len(self.overflow) < self.max_overflow:
+            self.metrics.increment("retry.overflowed.%s" % retry.operation)
+            self.overflow.append(retry)
+        else:
+            self._give_up(retry, fail)
+
+    def _acquire(self, retry):
+        """Take room for a pending retry, if the budget and the cap of the
+        operation have any left"""
+        operation = retry.operation
+        count = self.operations.get(operation, 0)
+        if self.pending >= self.budget or \
+                count >= self.caps.get(operation, self.budget):
+            return False
+        self.pending += 1
+        self.operations[operation] = count + 1
+        retry.holding = True
+        return True
+
+    def _release(self, retry):
+        """Give back the room of a finished retry to the first overflowed
+        retry it fits"""
+        if not retry.holding:
+            return
+        retry.holding = False
+        self.pending -= 1
+        self.operations[retry.operation] -= 1
+        for waiting in list(self.overflow):
+            if self._acquire(waiting):
+                self.overflow.remove(waiting)
+                self._schedule(waiting)
+                break
+
+    def _schedule(self, retry):
+        self.metrics.increment("retry.scheduled.%s" % retry.operation)
+        self.clock.callLater(self.delay(retry.attempts), self._attempt, retry)
+
+    def _give_up(self, retry, fail):
+        self._release(retry)
+        self.metrics.increment("retry.giveup.%s" % retry.operation)
+        log.err(fail, "Gave up retrying %s after %d attempts" % (
+            retry.operation, retry.attempts))
+        retry.result.errback(fail)
+
+    def report(self):
+        """Record the pending and overflowed retries as gauges"""
+        self.metrics.gauge("retry.pending", self.pending)
+        self.metrics.gauge("retry.overflow", len(self.overflow))
+
+    def start(self, interval=10):
+        """Report the gauges every ``interval`` seconds"""
+        self._looper = LoopingCall(self.report)
+        self._looper.clock = self.clock
+        self._looper.start(interval)
+
+    def stop(self):
+        """Stop reporting the gauges"""
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
@@ -3,7 +3,6 @@ import time
 
 import apns
 from twisted.python import log
-from twisted.internet.threads import deferToThread
 
 from autopush.router.interface import RouterException, RouterResponse
 
@@ -58,8 +57,9 @@ class APNSRouter(object):
     def route_notification(self, notification, uaid_data):
         """Start the APNS notification routing, returns a deferred"""
         router_data = uaid_data["router_data"]
-        # Kick the entire notification routing off to a thread
-        return deferToThread(self._route, notification, router_data)
+        # Kick the entire notification routing off to a bridges thread
+        return self.ap_settings.executors.run("bridges", self._route,
+                                              notification, router_data)
 
     def _route(self, notification, router_data):
         """Blocking APNS call to route the notification"""
@@ -3,7 +3,6 @@ import gcmclient
 import json
 
 from twisted.python import log
-from twisted.internet.threads import deferToThread
 
 from autopush.router.interface import RouterException, RouterResponse
 from autopush.senderids import SenderIDs
@@ -19,6 +18,7 @@ class GCMRouter(object):
 
     def __init__(self, ap_settings, router_conf):
         """Create a new GCM router and connect to GCM"""
+        self.ap_settings = ap_settings
         self.config = router_conf
         self.ttl = router_conf.get("ttl", 60)
         self.dryRun = router_conf.get("dryrun", False)
@@ -26,6 +26,7 @@ class GCMRouter(object):
         self.senderIDs = router_conf.get("senderIDs")
         if not self.senderIDs:
             self.senderIDs = SenderIDs(router_conf)
+        self.senderIDs.executors = ap_settings.executors
         try:
             senderID = self.senderIDs.choose_ID()
             self.gcm = gcmclient.GCM(senderID.get("auth"))
@@ -53,8 +54,9 @@ class GCMRouter(object):
     def route_notification(self, notification, uaid_data):
         """Start the GCM notification routing, returns a deferred"""
         router_data = uaid_data["router_data"]
-        # Kick the entire notification routing off to a thread
-        return deferToThread(self._route, notification, router_data)
+        # Kick the entire notification routing off to a bridges thread
+        return self.ap_settings.executors.run("bridges", self._route,
+                                              notification, router_data)
 
     def _route(self, notification, router_data):
         """Blocking GCM call to route the notification"""
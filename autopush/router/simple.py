@@ -5,18 +5,15 @@ node, or stores it appropriately in DynamoDB for SimplePush style version
 based channel ID's (only newest version is stored, no data stored).
 
 """
-import json
 import requests
 import time
 from urllib import urlencode
-from StringIO import StringIO
 
 from boto.dynamodb2.exceptions import (
     ItemNotFound,
     ProvisionedThroughputExceededException,
 )
 from repoze.lru import LRUCache
-from twisted.internet.threads import deferToThread
 from twisted.internet.defer import (
     inlineCallbacks,
     returnValue,
@@ -27,9 +24,8 @@ from twisted.internet.error import (
     UserError
 )
 from twisted.python import log
-from twisted.web.client import FileBodyProducer
 
-from autopush.protocol import IgnoreBody
+from autopush.db import defer_db
 from autopush.router.interface import (
     RouterException,
     RouterResponse,
@@ -64,7 +60,7 @@ class SimpleRouter(object):
     def check_token(self, token):
         return (True, token)
 
-    def preflight_check(self, uaid, channel_id):
+    def preflight_check(self, uaid_data, notification):
         """Verifies this routing call can be done successfully"""
         return True
 
@@ -86,7 +82,7 @@ class SimpleRouter(object):
 
         # Preflight check, hook used by webpush to verify channel id, extra
         # stores any additional data to pass to storing the message
-        extra = yield self.preflight_check(uaid, notification.channel_id)
+        extra = yield self.preflight_check(uaid_data, notification)
 
         # Node_id is present, attempt delivery.
         # - Send Notification to node
@@ -101,14 +97,18 @@ class SimpleRouter(object):
             except (ConnectError, UserError, ConnectionRefusedError):
                 self.metrics.increment("updates.client.host_gone")
                 dead_cache.put(node_key(node_id), True)
-                yield deferToThread(router.clear_node,
-                                    uaid_data).addErrback(self._eat_db_err)
+                yield defer_db(router.clear_node,
+                               uaid_data).addErrback(self._eat_db_err)
                 raise RouterException("Node was invalid", status_code=503,
                                       response_body="Retry Request",
                                       log_exception=False, errno=202)
             if result.code == 200:
                 self.metrics.increment("router.broadcast.hit")
                 returnValue(self.delivered_response(notification))
+            elif result.code == 404:
+                # The client isn't on that node anymore, the record we
+                # routed with is stale
+                self.ap_settings.router_cache.invalidate(uaid)
 
         # Save notification, node is not present or busy
         # - Save notification
@@ -134,8 +134,14 @@ class SimpleRouter(object):
         #   - Success (no node): Done, return 202
         #   - Error (db error): Done, return 202
         #   - Error (no client) : Done, return 404
+        # This lookup always goes to the database, the client may have just
+        # connected and missed the notification we saved, so the read is
+        # strongly consistent. Only the route is read, it refreshes the
+        # cached record.
         try:
-            uaid_data = yield deferToThread(router.get_uaid, uaid)
+            uaid_data = yield defer_db(router.get_uaid, uaid,
+                                       attributes=("node_id", "connected_at"))
+            self.ap_settings.router_cache.put(uaid, uaid_data)
         except ProvisionedThroughputExceededException:
             self.metrics.increment("router.broadcast.miss")
             returnValue(self.stored_response(notification))
@@ -156,7 +162,7 @@ class SimpleRouter(object):
         except (ConnectError, UserError, ConnectionRefusedError):
             self.metrics.increment("updates.client.host_gone")
             dead_cache.put(node_key(node_id), True)
-            yield deferToThread(
+            yield defer_db(
                 router.clear_node,
                 uaid_data).addErrback(self._eat_db_err)
             self.metrics.increment("router.broadcast.miss")
@@ -171,12 +177,12 @@ class SimpleRouter(object):
             if self.udp is not None and "server" in self.conf:
                 # Attempt to send off the UDP wake request.
                 try:
-                    yield deferToThread(
-                        requests.post(
-                            self.conf["server"],
-                            data=urlencode(self.udp["data"]),
-                            cert=self.conf.get("cert"),
-                            timeout=self.conf.get("server_timeout", 3)))
+                    yield self.ap_settings.executors.run(
+                        "bridges", requests.post,
+                        self.conf["server"],
+                        data=urlencode(self.udp["data"]),
+                        cert=self.conf.get("cert"),
+                        timeout=self.conf.get("server_timeout", 3))
                 except Exception, x:
                     log.err("Could not send UDP wake request:", str(x))
             returnValue(retVal)
@@ -191,31 +197,25 @@ class SimpleRouter(object):
         message storage to subclass and override.
 
         """
-        return deferToThread(self.ap_settings.storage.save_notification,
-                             uaid=uaid, chid=notification.channel_id,
-                             version=notification.version)
+        batcher = self.ap_settings.write_batcher
+        if batcher is not None:
+            return batcher.save_notification(
+                self.ap_settings.storage, uaid, notification.channel_id,
+                notification.version)
+        return defer_db(self.ap_settings.storage.save_notification,
+                        uaid=uaid, chid=notification.channel_id,
+                        version=notification.version)
 
     def _send_notification(self, uaid, node_id, notification):
         """Send a notification to a specific node_id"""
-        payload = json.dumps({"channelID": notification.channel_id,
-                              "version": notification.version,
-                              "data": notification.data})
-        url = node_id + "/push/" + uaid
-        d = self.ap_settings.agent.request(
-            "PUT",
-            url.encode("utf8"),
-            bodyProducer=FileBodyProducer(StringIO(payload)),
-        )
-        d.addCallback(IgnoreBody.ignore)
-        return d
+        payload = {"channelID": notification.channel_id,
+                   "version": notification.version,
+                   "data": notification.data}
+        return self.ap_settings.node_client.push(node_id, uaid, payload)
 
     def _send_notification_check(self, uaid, node_id):
         """Send a command to the node to check for notifications"""
-        url = node_id + "/notif/" + uaid
-        return self.ap_settings.agent.request(
-            "PUT",
-            url.encode("utf8"),
-        ).addCallback(IgnoreBody.ignore)
+        return self.ap_settings.node_client.notify(node_id, uaid)
 
     #############################################################
     #                    Error Callbacks
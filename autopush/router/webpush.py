@@ -5,18 +5,14 @@ node, or stores each individual message, along with its data, in a Message
 table for retrieval by the client.
 
 """
-import json
 import time
-from StringIO import StringIO
 
 from twisted.internet.defer import (
     inlineCallbacks,
     returnValue,
 )
-from twisted.internet.threads import deferToThread
-from twisted.web.client import FileBodyProducer
 
-from autopush.protocol import IgnoreBody
+from autopush.db import defer_db
 from autopush.router.interface import RouterException, RouterResponse
 from autopush.router.simple import SimpleRouter
 
@@ -46,21 +42,38 @@ class WebPushRouter(SimpleRouter):
         return data
 
     @inlineCallbacks
-    def preflight_check(self, uaid, channel_id):
-        """Verifies this routing call can be done successfully"""
+    def preflight_check(self, uaid_data, notification):
+        """Verifies this routing call can be done successfully
+
+        When the endpoint read the router record along with the channel's
+        marker items both are used as they are, a cached router record may
+        be stale about the message table so it's read again, strongly
+        consistent.
+
+        """
+        uaid = uaid_data["uaid"]
+        subscribed = notification.subscribed
         # Locate the user agent's message table
-        record = yield deferToThread(self.ap_settings.router.get_uaid, uaid)
+        record = uaid_data
+        if subscribed is None:
+            record = yield defer_db(self.ap_settings.router.get_uaid, uaid,
+                                    attributes=("current_month",))
 
         if 'current_month' not in record:
             raise RouterException("No such subscription", status_code=404,
                                   log_exception=False, errno=106)
 
         month_table = record["current_month"]
-        exists, chans = yield deferToThread(
-            self.ap_settings.message_tables[month_table].all_channels,
-            uaid=uaid)
-
-        if not exists or channel_id not in chans:
+        if subscribed is not None and month_table in subscribed:
+            exists = True
+        else:
+            # Channels registered before their marker item are looked up in
+            # the set of channels
+            exists = yield defer_db(
+                self.ap_settings.message_tables[month_table].channel_exists,
+                uaid, notification.channel_id)
+
+        if not exists:
             raise RouterException("No such subscription", status_code=404,
                                   log_exception=False, errno=106)
         returnValue(month_table)
@@ -80,14 +93,7 @@ class WebPushRouter(SimpleRouter):
         if notification.data:
             payload["headers"] = self._crypto_headers(notification)
             payload["data"] = notification.data
-        url = node_id + "/push/" + uaid
-        d = self.ap_settings.agent.request(
-            "PUT",
-            url.encode("utf8"),
-            bodyProducer=FileBodyProducer(StringIO(json.dumps(payload))),
-        )
-        d.addCallback(IgnoreBody.ignore)
-        return d
+        return self.ap_settings.node_client.push(node_id, uaid, payload)
 
     def _save_notification(self, uaid, notification, month_table):
         """Saves a notification, returns a deferred.
@@ -104,8 +110,21 @@ class WebPushRouter(SimpleRouter):
         headers = None
         if notification.data:
             headers = self._crypto_headers(notification)
-        return deferToThread(
-            self.ap_settings.message_tables[month_table].store_message,
+        message = self.ap_settings.message_tables[month_table]
+        batcher = self.ap_settings.write_batcher
+        if batcher is not None:
+            return batcher.store_message(
+                message,
+                uaid=uaid,
+                channel_id=notification.channel_id,
+                data=notification.data,
+                headers=headers,
+                message_id=notification.version,
+                ttl=notification.ttl,
+                timestamp=int(time.time()),
+            )
+        return defer_db(
+            message.store_message,
             uaid=uaid,
             channel_id=notification.channel_id,
             data=notification.data,
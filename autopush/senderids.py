@@ -46,6 +46,9 @@ class SenderIDs(object):
     _use_s3 = True
     KEYNAME = "senderids"
     service = None
+    # Optional autopush.executors.Executors whose admin pool the refreshes
+    # run on, set by the GCM router
+    executors = None
 
     def __init__(self, args):
         """Optionally load or fetch the set of SenderIDs from S3"""
@@ -105,7 +108,11 @@ class SenderIDs(object):
         """Refresh the senderIDs from the S3 bucket"""
         if not self._use_s3:
             return
-        d = deferToThread(self._update_senderIDs, self._senderIDs)
+        if self.executors is not None:
+            d = self.executors.run("admin", self._update_senderIDs,
+                                   self._senderIDs)
+        else:
+            d = deferToThread(self._update_senderIDs, self._senderIDs)
         d.addCallback(self._set_senderIDs)
         d.addErrback(self._err)
         return d
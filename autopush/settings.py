@@ -8,33 +8,52 @@ from twisted.internet.defer import (
     inlineCallbacks,
     returnValue,
 )
-from twisted.internet.threads import deferToThread
 from twisted.python import log
 from twisted.web.client import Agent, HTTPConnectionPool
 
+from autopush.cache import RouterCache, TokenCache
+from autopush.crypto import make_crypto_executor
+from autopush.deadlines import RequestDeadlines
+from autopush.dynamodb import DynamoDBClient
+from autopush.executors import Executors
+from autopush.governor import CapacityGovernor
 from autopush.db import (
     create_rotating_message_table,
     get_router_table,
     get_storage_table,
+    get_topic_table,
     get_rotating_message_table,
     make_rotating_tablename,
     preflight_check,
+    ReadPolicy,
     Storage,
     Router,
-    Message
+    Message,
+    Topic,
 )
 from autopush.metrics import (
     DatadogMetrics,
     TwistedMetrics,
     SinkMetrics,
 )
+from autopush.link import LinkNodeClient
+from autopush.nodes import BatchingNodeClient, NodeClient
+from autopush.ratelimit import RateLimiter
+from autopush.retries import RetryScheduler
 from autopush.router import (
     APNSRouter,
     GCMRouter,
     SimpleRouter,
     WebPushRouter,
 )
+from autopush.tokens import (
+    EndpointTokens,
+    MessageIds,
+    decode_endpoint_token,
+    encode_endpoint_token,
+)
 from autopush.utils import canonical_url, resolve_ip
+from autopush.writes import WriteBatcher
 from autopush.senderids import SENDERID_EXPRY, DEFAULT_BUCKET
 
 
@@ -79,6 +98,48 @@ class AutopushSettings(object):
                  senderid_list={},
                  hello_timeout=0,
                  auth_key=None,
+                 router_cache_size=0,
+                 router_cache_ttl=30,
+                 token_cache_size=0,
+                 token_cache_ttl=300,
+                 token_cache_negative_ttl=5,
+                 crypto_mode="inline",
+                 crypto_workers=None,
+                 token_version=0,
+                 max_batch=100,
+                 topic_tablename=None,
+                 topic_chunk_size=100,
+                 topic_concurrency=10,
+                 node_batch_window=0,
+                 node_batch_size=100,
+                 node_link_port=0,
+                 node_link_heartbeat=5,
+                 sender_rate_limit=0,
+                 sender_rate_overrides=None,
+                 trusted_proxies=None,
+                 uaid_rate_limit=0,
+                 rate_limit_keys=10000,
+                 dynamodb_async=False,
+                 dynamodb_connections=50,
+                 write_batch_window=0,
+                 write_batch_size=25,
+                 message_page_size=10,
+                 message_page_max=100,
+                 message_item_version=1,
+                 channel_markers=False,
+                 eventual_reads=(),
+                 governor_rate=0,
+                 governor_max_rate=1000,
+                 governor_queue=100,
+                 db_deadline=0,
+                 db_deadlines=None,
+                 hedge_reads=(),
+                 hedge_percentile=95,
+                 executors=None,
+                 retry_budget=100,
+                 retry_caps=None,
+                 retry_attempts=10,
+                 retry_overflow=1000,
                  ):
         """Initialize the Settings object
 
@@ -102,6 +163,29 @@ class AutopushSettings(object):
             self.metrics = TwistedMetrics(statsd_host, statsd_port)
         else:
             self.metrics = SinkMetrics()
+        # Deliveries to connection nodes, over persistent links if the
+        # nodes accept them, or batched per node if a window is set
+        if node_link_port > 0:
+            self.node_client = LinkNodeClient(self, node_link_port,
+                                              node_link_heartbeat)
+        elif node_batch_window > 0:
+            self.node_client = BatchingNodeClient(self, node_batch_window,
+                                                  node_batch_size)
+        else:
+            self.node_client = NodeClient(self)
+        self.token_cache = TokenCache(self.metrics, token_cache_size,
+                                      token_cache_ttl,
+                                      token_cache_negative_ttl)
+        # Named thread pools for the blocking work, the crypto pool is as
+        # large as the crypto workers unless configured otherwise
+        executors = dict(executors or {})
+        if crypto_workers and "size" not in executors.get("crypto", {}):
+            executors["crypto"] = dict(executors.get("crypto", {}),
+                                       size=crypto_workers)
+        self.executors = Executors(self.metrics, executors)
+        self.crypto = make_crypto_executor(self, crypto_mode, crypto_workers,
+                                           self.executors["crypto"])
+        self.token_version = token_version
         if not crypto_key:
             crypto_key = [Fernet.generate_key()]
         if not isinstance(crypto_key, list):
@@ -116,6 +200,18 @@ class AutopushSettings(object):
         self.auth_key = auth_key
 
         self.max_data = max_data
+        self.max_batch = max_batch
+        # Per minute limits on notifications from each sender and to each
+        # UAID
+        self.sender_limiter = RateLimiter(sender_rate_limit,
+                                          sender_rate_overrides,
+                                          rate_limit_keys)
+        self.uaid_limiter = RateLimiter(uaid_rate_limit,
+                                        size=rate_limit_keys)
+        # Addresses of the proxies whose X-Forwarded-For is trusted
+        self.trusted_proxies = frozenset(trusted_proxies or ())
+        self.topic_chunk_size = topic_chunk_size
+        self.topic_concurrency = topic_concurrency
         self.clients = {}
 
         # Setup hosts/ports/urls
@@ -152,13 +248,70 @@ class AutopushSettings(object):
         self.message_table = get_rotating_message_table(
             message_tablename)
         self._message_prefix = message_tablename
-        self.storage = Storage(self.storage_table, self.metrics)
-        self.router = Router(self.router_table, self.metrics)
+        # Non-blocking DynamoDB requests on the reactor instead of boto
+        # calls in threads, for the table methods called with defer_db
+        self.db_client = None
+        if dynamodb_async:
+            self.db_client = DynamoDBClient.from_connection(
+                self.router_table.connection,
+                connections=dynamodb_connections)
+        # Paces the table methods called with defer_db to the rate DynamoDB
+        # sustains, if a starting rate is set
+        self.governor = None
+        if governor_rate > 0:
+            self.governor = CapacityGovernor(self.metrics,
+                                             rate=governor_rate,
+                                             max_rate=governor_max_rate,
+                                             max_queue=governor_queue)
+        # Bounds the table methods called with defer_db by deadlines, and
+        # hedges slow reads
+        self.db_deadlines = None
+        if db_deadline > 0 or db_deadlines or hedge_reads:
+            self.db_deadlines = RequestDeadlines(
+                self.metrics, deadline=db_deadline, deadlines=db_deadlines,
+                hedged=hedge_reads, hedge_percentile=hedge_percentile)
+        self.storage = Storage(self.storage_table, self.metrics,
+                               client=self.db_client, governor=self.governor,
+                               deadlines=self.db_deadlines,
+                               executors=self.executors)
+        # Notification writes from the routers, committed together if a
+        # window is set
+        self.write_batcher = None
+        if write_batch_window > 0:
+            self.write_batcher = WriteBatcher(self.metrics,
+                                              write_batch_window,
+                                              write_batch_size)
+        # Retries of the table writes the connection nodes can't leave
+        # undone, within a budget
+        self.retries = RetryScheduler(self.metrics, budget=retry_budget,
+                                      caps=retry_caps,
+                                      attempts=retry_attempts,
+                                      max_overflow=retry_overflow)
+        # Reads made eventually consistent, read again strongly consistent
+        # when they look stale
+        self.read_policy = ReadPolicy(self.metrics, eventual_reads)
+        self.router_cache = RouterCache(self.metrics, router_cache_size,
+                                        router_cache_ttl)
+        self.router = Router(self.router_table, self.metrics,
+                             cache=self.router_cache, client=self.db_client,
+                             policy=self.read_policy, governor=self.governor,
+                             deadlines=self.db_deadlines,
+                             executors=self.executors)
+        # Topics are only used by the endpoint nodes
+        self.topic = None
+        if topic_tablename:
+            self.topic = Topic(get_topic_table(topic_tablename),
+                               self.metrics)
 
         # Used to determine whether a connection is out of date with current
         # db objects
         self.current_msg_month = make_rotating_tablename(self._message_prefix)
         self.current_month = datetime.date.today().month
+        # Version of the message items stored, both are always read
+        self.message_item_version = message_item_version
+        # Whether channel marker items are written and read, only once
+        # every connection node reads messages after them
+        self.channel_markers = channel_markers
         self.create_initial_message_tables()
 
         # Run preflight check
@@ -187,6 +340,11 @@ class AutopushSettings(object):
 
         self.hello_timeout = hello_timeout
 
+        # Webpush messages are read a page at a time, growing from
+        # message_page_size up to message_page_max for large backlogs
+        self.message_page_size = message_page_size
+        self.message_page_max = max(message_page_size, message_page_max)
+
     @property
     def message(self):
         """Property that access the current message table"""
@@ -213,8 +371,18 @@ class AutopushSettings(object):
             create_rotating_message_table(prefix=self._message_prefix)
             this_month = get_rotating_message_table(self._message_prefix)
         self.message_tables = {
-            last_month.table_name: Message(last_month, self.metrics),
-            this_month.table_name: Message(this_month, self.metrics),
+            last_month.table_name: Message(
+                last_month, self.metrics, client=self.db_client,
+                item_version=self.message_item_version,
+                policy=self.read_policy, governor=self.governor,
+                deadlines=self.db_deadlines, executors=self.executors,
+                channel_markers=self.channel_markers),
+            this_month.table_name: Message(
+                this_month, self.metrics, client=self.db_client,
+                item_version=self.message_item_version,
+                policy=self.read_policy, governor=self.governor,
+                deadlines=self.db_deadlines, executors=self.executors,
+                channel_markers=self.channel_markers),
         }
 
     @inlineCallbacks
@@ -236,7 +404,7 @@ class AutopushSettings(object):
         message_table = get_rotating_message_table(self._message_prefix)
 
         try:
-            yield deferToThread(message_table.describe)
+            yield self.executors.run("admin", message_table.describe)
         except Exception:
             tblname = make_rotating_tablename(self._message_prefix)
             log.err("Unable to locate new message table: %s" % tblname)
@@ -246,12 +414,17 @@ class AutopushSettings(object):
         self.current_month = today.month
         self.current_msg_month = message_table.table_name
         self.message_tables[self.current_msg_month] = \
-            Message(message_table, self.metrics)
+            Message(message_table, self.metrics, client=self.db_client,
+                    item_version=self.message_item_version,
+                    policy=self.read_policy, governor=self.governor,
+                    deadlines=self.db_deadlines, executors=self.executors,
+                    channel_markers=self.channel_markers)
         returnValue(True)
 
     def update(self, **kwargs):
         """Update the arguments, if a ``crypto_key`` is in kwargs then the
-        ``self.fernet`` attribute will be initialized"""
+        ``self.fernet``, ``self.endpoint_tokens`` and ``self.message_ids``
+        attributes will be initialized and the token cache cleared"""
         for key, val in kwargs.items():
             if key == "crypto_key":
                 fkeys = []
@@ -260,10 +433,33 @@ class AutopushSettings(object):
                 for v in val:
                     fkeys.append(Fernet(v))
                 self.fernet = MultiFernet(fkeys)
+                self.endpoint_tokens = EndpointTokens(val)
+                self.message_ids = MessageIds(val)
+                self.crypto.update_keys(val)
+                self.token_cache.clear()
             else:
                 setattr(self, key, val)
 
+    def make_endpoint_token(self, data):
+        """Create an endpoint token for ``uaid:chid`` data, in the format
+        selected by ``token_version``"""
+        return encode_endpoint_token(self.endpoint_tokens, self.fernet, data,
+                                     self.token_version)
+
+    def parse_endpoint_token(self, token):
+        """Return the ``uaid:chid`` data of a legacy or compact endpoint
+        token"""
+        return decode_endpoint_token(self.endpoint_tokens, self.fernet, token)
+
     def make_endpoint(self, uaid, chid):
         """ Create an endpoint from the identifiers"""
         return self.endpoint_url + '/push/' + \
-            self.fernet.encrypt((uaid + ':' + chid).encode('utf8'))
+            self.make_endpoint_token((uaid + ':' + chid).encode('utf8'))
+
+    def defer_make_endpoint(self, uaid, chid):
+        """Returns a deferred for :meth:`make_endpoint` with the encryption
+        run on the crypto executor"""
+        d = self.crypto.make_endpoint_token(
+            (uaid + ':' + chid).encode('utf8'))
+        d.addCallback(lambda token: self.endpoint_url + '/push/' + token)
+        return d
@@ -0,0 +1,133 @@
+import unittest
+
+from boto.dynamodb2.items import Item
+from cryptography.fernet import InvalidToken
+from mock import Mock
+from nose.tools import eq_, ok_
+
+from autopush.cache import (
+    RouteRecord,
+    RouterCache,
+    TokenCache,
+    copy_record,
+)
+
+
+class RouterCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.cache = RouterCache(self.metrics, size=10, ttl=30)
+
+    def test_disabled(self):
+        cache = RouterCache(self.metrics)
+        eq_(cache.enabled, False)
+        cache.put("uaid", dict(uaid="uaid"))
+        eq_(cache.get("uaid"), None)
+        cache.invalidate("uaid")
+        cache.clear()
+        eq_(len(self.metrics.mock_calls), 0)
+
+    def test_hit_and_miss(self):
+        eq_(self.cache.get("uaid"), None)
+        self.metrics.increment.assert_called_with("router.cache.miss")
+
+        self.cache.put("uaid", dict(uaid="uaid", node_id="http://node"))
+        eq_(self.cache.get("uaid"), dict(uaid="uaid", node_id="http://node"))
+        self.metrics.increment.assert_called_with("router.cache.hit")
+
+    def test_empty_record_not_cached(self):
+        self.cache.put("uaid", {})
+        eq_(self.cache.get("uaid"), None)
+
+    def test_records_are_copies(self):
+        record = dict(uaid="uaid", node_id="http://node")
+        self.cache.put("uaid", record)
+        del record["node_id"]
+
+        cached = self.cache.get("uaid")
+        eq_(cached["node_id"], "http://node")
+        cached.pop("uaid")
+        eq_(self.cache.get("uaid")["uaid"], "uaid")
+
+    def test_item_copy(self):
+        table = Mock()
+        item = Item(table, data=dict(uaid="uaid", node_id="http://node"))
+        copied = copy_record(item)
+        ok_(isinstance(copied, Item))
+        eq_(copied.table, table)
+        del copied["node_id"]
+        eq_(item["node_id"], "http://node")
+
+    def test_route_record_copy(self):
+        route = RouteRecord(("uaid", "node_id"), dict(uaid="uaid"))
+        copied = copy_record(route)
+        ok_(isinstance(copied, RouteRecord))
+        eq_(copied.attributes, ("uaid", "node_id"))
+        eq_(copied, route)
+
+    def test_route_record_updates_cached_record(self):
+        self.cache.put("uaid", RouteRecord(("uaid",), dict(uaid="uaid")))
+        eq_(self.cache.get("uaid"), None)
+
+        self.cache.put("uaid", dict(uaid="uaid", node_id="http://node",
+                                    connected_at=1, router_data={}))
+        self.cache.put("uaid", RouteRecord(
+            ("uaid", "node_id", "connected_at"),
+            dict(uaid="uaid", connected_at=2)))
+        eq_(self.cache.get("uaid"),
+            dict(uaid="uaid", connected_at=2, router_data={}))
+
+    def test_invalidate(self):
+        self.cache.invalidate("uaid")
+        eq_(len(self.metrics.mock_calls), 0)
+
+        self.cache.put("uaid", dict(uaid="uaid"))
+        self.cache.invalidate("uaid")
+        self.metrics.increment.assert_called_with("router.cache.invalidate")
+        eq_(self.cache.get("uaid"), None)
+
+    def test_clear(self):
+        self.cache.put("uaid", dict(uaid="uaid"))
+        self.cache.clear()
+        eq_(self.cache.get("uaid"), None)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.cache = TokenCache(self.metrics, size=10)
+
+    def test_disabled(self):
+        cache = TokenCache(self.metrics)
+        eq_(cache.enabled, False)
+        cache.put("token", "uaid:chid")
+        cache.put_invalid("bad")
+        eq_(cache.get("token"), None)
+        eq_(cache.get("bad"), None)
+        eq_(len(self.metrics.mock_calls), 0)
+
+    def test_hit_and_miss(self):
+        eq_(self.cache.get("token"), None)
+        self.metrics.increment.assert_called_with("token.cache.miss")
+
+        self.cache.put("token", "uaid:chid")
+        eq_(self.cache.get("token"), "uaid:chid")
+        self.metrics.increment.assert_called_with("token.cache.hit")
+        eq_(self.cache.hit_ratio, 0.5)
+
+    def test_invalid(self):
+        self.cache.put_invalid("bad")
+        self.assertRaises(InvalidToken, self.cache.get, "bad")
+        self.metrics.increment.assert_called_with("token.cache.invalid")
+
+    def test_invalid_expires(self):
+        cache = TokenCache(self.metrics, size=10, negative_ttl=-1)
+        cache.put_invalid("bad")
+        eq_(cache.get("bad"), None)
+
+    def test_clear(self):
+        self.cache.put("token", "uaid:chid")
+        self.cache.get("token")
+        self.cache.clear()
+        eq_(self.cache.hit_ratio, 0.0)
+        eq_(self.cache.get("token"), None)
@@ -0,0 +1,166 @@
+import pickle
+import uuid
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from mock import ANY, Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import CancelledError, DeferredList
+from twisted.trial import unittest
+
+from autopush.crypto import (
+    CryptoExecutor,
+    ProcessCryptoExecutor,
+    ThreadCryptoExecutor,
+    make_crypto_executor,
+    run_batch,
+)
+from autopush.tokens import EndpointTokens, decode_endpoint_token
+
+
+class FakeSettings(object):
+    token_version = 1
+
+    def __init__(self, key):
+        self.metrics = Mock()
+        self.fernet = MultiFernet([Fernet(key)])
+        self.endpoint_tokens = EndpointTokens([key])
+
+    def make_endpoint_token(self, data):
+        return self.endpoint_tokens.encode(data)
+
+    def parse_endpoint_token(self, token):
+        return decode_endpoint_token(self.endpoint_tokens, self.fernet, token)
+
+
+class UnpicklableError(Exception):
+    """Error that pickles but doesn't unpickle, its args don't match"""
+    def __init__(self, token, reason):
+        Exception.__init__(self, "%s: %s" % (token, reason))
+
+
+class CryptoExecutorTestCase(unittest.TestCase):
+    executor_class = CryptoExecutor
+
+    def setUp(self):
+        self.key = Fernet.generate_key()
+        self.settings = FakeSettings(self.key)
+        self.executor = self.executor_class(self.settings)
+        self.executor.update_keys([self.key])
+        self.addCleanup(self.executor.stop)
+
+    def test_round_trip(self):
+        d = self.executor.encrypt("uaid:chid")
+        d.addCallback(self.executor.decrypt)
+
+        def check(result):
+            eq_(result, "uaid:chid")
+            self.settings.metrics.timing.assert_called_with(
+                "crypto.%s.decrypt" % self.executor.mode, duration=ANY)
+        d.addCallback(check)
+        return d
+
+    def test_endpoint_token_round_trip(self):
+        data = "%s:%s" % (uuid.uuid4().hex, uuid.uuid4())
+        d = self.executor.make_endpoint_token(data)
+
+        def check_token(token):
+            ok_(token.startswith("A"))
+            return self.executor.parse_endpoint_token(token)
+        d.addCallback(check_token)
+        d.addCallback(eq_, data)
+        return d
+
+    def test_invalid_token(self):
+        d = self.executor.decrypt("invalid")
+        return self.assertFailure(d, InvalidToken)
+
+
+class ThreadCryptoExecutorTestCase(CryptoExecutorTestCase):
+    executor_class = ThreadCryptoExecutor
+
+
+class ProcessCryptoExecutorTestCase(CryptoExecutorTestCase):
+    executor_class = ProcessCryptoExecutor
+
+    def test_batching(self):
+        self.executor.batch_size = 2
+        tokens = [self.settings.fernet.encrypt(str(i)) for i in range(3)]
+        ds = [self.executor.decrypt(token) for token in tokens]
+        self.settings.metrics.gauge.assert_called_with(
+            "crypto.process.batch_size", 2)
+        eq_(len(self.executor._pending), 1)
+
+        def check(result):
+            eq_([value for _, value in result], ["0", "1", "2"])
+        return DeferredList(ds).addCallback(check)
+
+    def test_stop(self):
+        self.executor.batch_size = 2
+        tokens = [self.settings.fernet.encrypt(str(i)) for i in range(3)]
+        ds = [self.executor.decrypt(token) for token in tokens]
+        eq_(len(self.executor._batches), 1)
+        self.executor.stop()
+        eq_(self.executor._batches, {})
+        eq_(self.executor._pending, [])
+        return DeferredList([self.assertFailure(d, CancelledError)
+                             for d in ds], fireOnOneErrback=True)
+
+
+class RunBatchTestCase(unittest.TestCase):
+    def test_run_batch(self):
+        key = Fernet.generate_key()
+        token = Fernet(key).encrypt("uaid:chid")
+        results = run_batch((key,), [("decrypt", token),
+                                     ("decrypt", "invalid")])
+        eq_(results[0], (True, "uaid:chid"))
+        eq_(results[1][0], False)
+        ok_(isinstance(results[1][1], InvalidToken))
+
+    def test_run_batch_endpoint_tokens(self):
+        key = Fernet.generate_key()
+        legacy = Fernet(key).encrypt("uaid:chid")
+        results = run_batch((key,), [("make_endpoint_token", "uaid:chid"),
+                                     ("parse_endpoint_token", legacy)],
+                            token_version=1)
+        ok_(results[0][1].startswith("A"))
+        eq_(results[1], (True, "uaid:chid"))
+
+    def test_run_batch_key_change(self):
+        old, new = Fernet.generate_key(), Fernet.generate_key()
+        run_batch((old,), [])
+        token = Fernet(new).encrypt("uaid:chid")
+        eq_(run_batch((new,), [("decrypt", token)]), [(True, "uaid:chid")])
+
+    def test_run_batch_bad_keys(self):
+        results = run_batch(("AAAA",), [("decrypt", "a"), ("decrypt", "b")])
+        eq_([success for success, _ in results], [False, False])
+        ok_(isinstance(results[0][1], ValueError))
+
+
+    @patch("autopush.crypto._worker_operation")
+    def test_run_batch_unpicklable_error(self, operation):
+        operation.side_effect = [InvalidToken(),
+                                 UnpicklableError("abc", "bad")]
+        results = run_batch((Fernet.generate_key(),),
+                            [("decrypt", "a"), ("decrypt", "b")])
+        eq_(results[0][0], False)
+        ok_(isinstance(results[0][1], InvalidToken))
+        eq_(results[1][0], False)
+        eq_(type(results[1][1]), Exception)
+        eq_(str(results[1][1]), "UnpicklableError: abc: bad")
+        pickle.loads(pickle.dumps(results))
+
+    def test_run_batch_fails(self):
+        # Malformed jobs fail the batch as a whole
+        results = run_batch((Fernet.generate_key(),), ["decrypt", "a"])
+        eq_([success for success, _ in results], [False, False])
+        pickle.loads(pickle.dumps(results))
+
+
+class MakeCryptoExecutorTestCase(unittest.TestCase):
+    def test_modes(self):
+        settings = FakeSettings(Fernet.generate_key())
+        eq_(make_crypto_executor(settings).mode, "inline")
+        eq_(make_crypto_executor(settings, "thread", 2).workers, 2)
+        eq_(make_crypto_executor(settings, "process").mode, "process")
+        self.assertRaises(ValueError, make_crypto_executor, settings, "gpu")
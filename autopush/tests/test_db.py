@@ -1,3 +1,5 @@
+import binascii
+import threading
 import unittest
 import uuid
 import time
@@ -9,21 +11,28 @@ from boto.dynamodb2.exceptions import (
 )
 from boto.dynamodb2.layer1 import DynamoDBConnection
 from boto.dynamodb2.items import Item
-from mock import Mock
+from mock import Mock, patch
 from moto import mock_dynamodb2
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
 from autopush.db import (
     get_message_table,
     get_router_table,
     get_storage_table,
+    get_topic_table,
     create_router_table,
     create_storage_table,
+    make_message_item,
     preflight_check,
+    read_message_item,
+    ReadPolicy,
     Storage,
     Message,
     Router,
+    Topic,
 )
+from autopush.cache import RouterCache
+from autopush.dynamodb import MessageRecord, UserRecord
 from autopush.metrics import SinkMetrics
 
 
@@ -61,6 +70,30 @@ class DbCheckTestCase(unittest.TestCase):
         eq_(next_month, month1.month)
 
 
+class ReadPolicyTestCase(unittest.TestCase):
+    def test_consistent(self):
+        metrics = Mock()
+        policy = ReadPolicy(metrics, ["get_uaids"])
+        eq_(policy.consistent("get_uaids"), False)
+        metrics.increment.assert_called_with("read.eventual.get_uaids")
+        eq_(policy.consistent("get_uaids", consistent=True), True)
+        eq_(policy.consistent("channel_exists"), True)
+        eq_(metrics.increment.call_count, 1)
+
+        policy.stale("get_uaids")
+        metrics.increment.assert_called_with("read.fallback.get_uaids")
+
+    def test_unguarded(self):
+        self.assertRaises(ValueError, ReadPolicy, SinkMetrics(),
+                          ["get_uaids", "fetch_messages"])
+        # Single record lookups route with the record right away
+        self.assertRaises(ValueError, ReadPolicy, SinkMetrics(),
+                          ["get_uaid"])
+        # A stale current_month would pick the wrong message table
+        self.assertRaises(ValueError, ReadPolicy, SinkMetrics(),
+                          ["get_uaid_and_channel"])
+
+
 class StorageTestCase(unittest.TestCase):
     def setUp(self):
         table = get_storage_table()
@@ -137,6 +170,23 @@ class StorageTestCase(unittest.TestCase):
         results = storage.delete_notification("asdf", "asdf")
         eq_(results, False)
 
+    def test_delete_notifications(self):
+        s = get_storage_table()
+        storage = Storage(s, SinkMetrics())
+        storage.table.connection = Mock()
+
+        def raise_error(*args, **kwargs):
+            raise ProvisionedThroughputExceededException(None, None)
+
+        results = storage.delete_notifications("uaid", [("chid", 12),
+                                                        ("chid2", 8)])
+        eq_(results, True)
+        eq_(storage.table.connection.delete_item.call_count, 2)
+
+        storage.table.connection.delete_item.side_effect = raise_error
+        results = storage.delete_notifications("uaid", [("chid", 12)])
+        eq_(results, False)
+
 
 class MessageTestCase(unittest.TestCase):
     def setUp(self):
@@ -207,6 +257,66 @@ class MessageTestCase(unittest.TestCase):
         assert(chid2 not in chans)
         assert(chid in chans)
 
+    def test_channel_exists(self):
+        chid = str(uuid.uuid4())
+        chid2 = str(uuid.uuid4())
+        m = get_message_table()
+        message = Message(m, SinkMetrics(), channel_markers=True)
+        message.register_channel(self.uaid, chid)
+        eq_(message.channel_exists(self.uaid, chid), True)
+        eq_(message.channel_exists(self.uaid, chid2), False)
+
+        # Channel markers aren't messages
+        eq_(message.fetch_messages(self.uaid), [])
+
+        message.unregister_channel(self.uaid, chid)
+        eq_(message.channel_exists(self.uaid, chid), False)
+
+    def test_channel_exists_without_marker(self):
+        chid = str(uuid.uuid4())
+        m = get_message_table()
+        message = Message(m, SinkMetrics(), channel_markers=True)
+        m.put_item(data=dict(uaid=self.uaid, chidmessageid=" ",
+                             chids=set([chid])))
+        eq_(message.channel_exists(self.uaid, chid), True)
+
+        # The marker was written from the set of channels
+        m.get_item(consistent=True, uaid=self.uaid,
+                   chidmessageid=" :%s" % chid)
+
+    def test_channel_exists_eventual(self):
+        chid = str(uuid.uuid4())
+        metrics = Mock()
+        m = get_message_table()
+        message = Message(m, metrics, channel_markers=True,
+                          policy=ReadPolicy(metrics, ["channel_exists"]))
+        message.register_channel(self.uaid, chid)
+        eq_(message.channel_exists(self.uaid, chid), True)
+        metrics.increment.assert_called_with("read.eventual.channel_exists")
+
+        # A missing marker may be stale, the set of channels is read
+        # strongly consistent
+        eq_(message.channel_exists(self.uaid, str(uuid.uuid4())), False)
+        metrics.increment.assert_called_with("read.fallback.channel_exists")
+
+    def test_channel_exists_markers_disabled(self):
+        chid = str(uuid.uuid4())
+        m = get_message_table()
+        message = Message(m, SinkMetrics())
+        message.register_channel(self.uaid, chid)
+        message.save_channels(self.uaid, set([chid]))
+        eq_(message.channel_exists(self.uaid, chid), True)
+        eq_(message.channel_exists(self.uaid, str(uuid.uuid4())), False)
+
+        # Nothing but the set of channels was written
+        items = list(m.query_2(uaid__eq=self.uaid, consistent=True))
+        eq_([x["chidmessageid"] for x in items], [" "])
+
+        # Nor is a marker deleted
+        with patch.object(m, "delete_item") as delete_item:
+            eq_(message.unregister_channel(self.uaid, chid), True)
+        eq_(delete_item.called, False)
+
     def test_save_channels(self):
         chid = str(uuid.uuid4())
         chid2 = str(uuid.uuid4())
@@ -254,6 +364,100 @@ class MessageTestCase(unittest.TestCase):
         all_messages = list(message.fetch_messages(self.uaid))
         eq_(len(all_messages), 0)
 
+    def test_store_messages(self):
+        chid = str(uuid.uuid4())
+        message = Message(get_message_table(), SinkMetrics())
+        ttl = int(time.time())+100
+        items = [make_message_item(self.uaid, chid, self._nstime() + i, ttl,
+                                   str(i), {})
+                 for i in range(30)]
+        eq_(message.store_messages(items), True)
+        all_messages = list(message.fetch_messages(self.uaid, limit=50))
+        eq_(len(all_messages), 30)
+        message.delete_user(self.uaid)
+
+    def test_fetch_messages_start(self):
+        chid = str(uuid.uuid4())
+        message = Message(get_message_table(), SinkMetrics())
+        ttl = int(time.time())+100
+        for i in range(5):
+            message.store_message(self.uaid, chid, "%02d" % i, ttl)
+        first = message.fetch_messages(self.uaid, limit=3)
+        eq_(len(first), 3)
+        rest = message.fetch_messages(self.uaid, limit=3,
+                                      start=first[-1]["chidmessageid"])
+        eq_([x["chidmessageid"] for x in rest],
+            ["%s:03" % chid, "%s:04" % chid])
+        ok_(isinstance(rest[0], MessageRecord))
+        message.delete_user(self.uaid)
+
+    def test_fetch_messages_pages(self):
+        message = Message(get_message_table(), SinkMetrics())
+        message.table = Mock()
+        item = dict(uaid={"S": self.uaid}, chidmessageid={"S": "a:01"},
+                    ttl={"N": "60"})
+        message.table.connection.query.side_effect = [
+            dict(Items=[item], LastEvaluatedKey=dict(uaid={"S": self.uaid})),
+            dict(Items=[item]),
+        ]
+        messages = message.fetch_messages(self.uaid, limit=3)
+        eq_(len(messages), 2)
+        eq_(messages[0]["ttl"], 60)
+        eq_(messages[0]["data"], None)
+        calls = message.table.connection.query.call_args_list
+        eq_([call[1]["limit"] for call in calls], [3, 2])
+        eq_(calls[1][1]["exclusive_start_key"], dict(uaid={"S": self.uaid}))
+
+    def test_store_item_version_2(self):
+        chid = str(uuid.uuid4())
+        message = Message(get_message_table(), SinkMetrics(),
+                          item_version=2)
+        headers = dict(encoding="aesgcm", encryption="salt=abc",
+                       encryption_key="dh=def")
+        ttl = int(time.time())+100
+        message.store_message(self.uaid, chid, "01", ttl, data="aGk=",
+                              headers=headers, timestamp=1000)
+        message.store_message(self.uaid, chid, "02", ttl)
+
+        items = message.fetch_messages(self.uaid)
+        eq_(items[0]["v"], 2)
+        eq_(items[0]["d"].value, "hi")
+        first, second = [read_message_item(item) for item in items]
+        eq_(first["chidmessageid"], "%s:01" % chid)
+        eq_(first["data"], "aGk=")
+        eq_(first["headers"], headers)
+        eq_((first["ttl"], first["timestamp"]), (ttl, 1000))
+        eq_(len(first["updateid"]), 32)
+        eq_("data" in second, False)
+        message.delete_user(self.uaid)
+
+    def test_make_message_item_version_2_fallback(self):
+        # Headers that can't be packed keep the original item
+        item = make_message_item("uaid", "chid", "01", 60, data="aGk=",
+                                 headers={"crypto_key": "abc"}, version=2)
+        eq_(item["data"], "aGk=")
+        eq_("v" in item, False)
+
+        # Payloads that aren't base64url are stored as they are
+        item = make_message_item("uaid", "chid", "01", 60, data="hi there",
+                                 headers={"encoding": "aesgcm"}, version=2)
+        eq_(item["d"], "hi there")
+        eq_(read_message_item(item)["data"], "hi there")
+
+        # Original items are read as they are
+        item = make_message_item("uaid", "chid", "01", 60)
+        ok_(read_message_item(item) is item)
+
+    def test_delete_message_item_version_2(self):
+        message = Message(get_message_table(), SinkMetrics())
+        message.table.delete_item = Mock()
+        updateid = uuid.uuid4().hex
+        message.delete_message(self.uaid, "chid", "01", updateid=updateid)
+        kwargs = message.table.delete_item.call_args[1]
+        eq_(kwargs["expected"]["updateid__eq"], updateid)
+        eq_(kwargs["expected"]["u__eq"].value, binascii.unhexlify(updateid))
+        eq_(kwargs["conditional_operator"], "OR")
+
     def test_delete_user(self):
         chid = str(uuid.uuid4())
         chid2 = str(uuid.uuid4())
@@ -318,6 +522,71 @@ class MessageTestCase(unittest.TestCase):
                                         message_id="asdf", updateid="asdf")
         eq_(result, False)
 
+    def test_delete_acked(self):
+        message = Message(get_message_table(), SinkMetrics())
+        message.table = Mock()
+        batch = message.table.batch_write.return_value.__enter__.return_value
+        result = message.delete_acked("uaid", [("chid", "1", "abc"),
+                                               ("chid", "2", None),
+                                               ("chid", "3", "")])
+        eq_(result, True)
+        message.table.delete_item.assert_called_once_with(
+            uaid="uaid", chidmessageid="chid:1",
+            expected={"updateid__eq": "abc"}, conditional_operator="OR")
+        eq_([kwargs["chidmessageid"] for _, kwargs in
+             batch.delete_item.call_args_list], ["chid:2", "chid:3"])
+
+    def test_delete_acked_concurrent(self):
+        message = Message(get_message_table(), SinkMetrics())
+        message.table = Mock()
+        started = []
+        all_started = threading.Event()
+        waited = []
+
+        def delete_item(**kwargs):
+            started.append(kwargs["chidmessageid"])
+            if len(started) == 3:
+                all_started.set()
+            # Deletes made one after the other never see the others start
+            waited.append(all_started.wait(5))
+        message.table.delete_item.side_effect = delete_item
+
+        result = message.delete_acked(
+            "uaid", [("chid", str(i), "abc") for i in range(3)])
+        eq_(result, True)
+        eq_(sorted(started), ["chid:0", "chid:1", "chid:2"])
+        eq_(waited, [True] * 3)
+        eq_(message.table.batch_write.called, False)
+
+    def test_expired_keys(self):
+        message = Message(get_message_table(), SinkMetrics())
+        items = [
+            dict(uaid={"S": "a"}, chidmessageid={"S": " "}),
+            dict(uaid={"S": "a"}, chidmessageid={"S": "chid:1"},
+                 ttl={"N": "10"}, timestamp={"N": "100"}),
+            dict(uaid={"S": "b"}, chidmessageid={"S": "chid:2"},
+                 ttl={"N": "60"}, timestamp={"N": "100"}),
+            dict(uaid={"S": "c"}, chidmessageid={"S": "chid:3"},
+                 t={"N": "10"}, s={"N": "100"}),
+        ]
+        eq_(message.expired_keys(items, 110),
+            [("a", "chid:1"), ("c", "chid:3")])
+
+    def test_delete_expired(self):
+        message = Message(get_message_table(), SinkMetrics())
+        conn = message.table.connection = Mock()
+        conn.batch_write_item.side_effect = [
+            dict(UnprocessedItems={"message": []},
+                 ConsumedCapacity=[dict(CapacityUnits=20.0)]),
+            dict(ConsumedCapacity=[dict(CapacityUnits=5.0)]),
+            dict(ConsumedCapacity=[dict(CapacityUnits=5.0)]),
+        ]
+        keys = [("uaid", "chid:%s" % i) for i in range(30)]
+        with patch("autopush.db.time.sleep") as sleep_mock:
+            eq_(message.delete_expired(keys), 30.0)
+        eq_(sleep_mock.call_count, 1)
+        eq_(conn.batch_write_item.call_count, 3)
+
     def test_update_message(self):
         chid = uuid.uuid4().hex
         m = get_message_table()
@@ -353,6 +622,36 @@ class MessageTestCase(unittest.TestCase):
         eq_(b, False)
 
 
+class TopicTestCase(unittest.TestCase):
+    def setUp(self):
+        self.topic = Topic(get_topic_table(), SinkMetrics())
+        self.name = uuid.uuid4().hex
+
+    def _fetch(self, chunk_size=100):
+        return list(self.topic.fetch_subscriptions(self.name, chunk_size))
+
+    def test_add_and_fetch(self):
+        self.topic.add_subscriptions(self.name, dict(
+            ("token%s" % i, ("uaid%s" % i, "chid%s" % i)) for i in range(5)))
+        chunks = self._fetch(chunk_size=2)
+        eq_([len(chunk) for chunk in chunks], [2, 2, 1])
+        items = dict((x["token"], (x["uaid"], x["chid"]))
+                     for chunk in chunks for x in chunk)
+        eq_(items["token3"], ("uaid3", "chid3"))
+
+    def test_remove(self):
+        self.topic.add_subscriptions(self.name, dict(
+            a=("uaid", "chid1"), b=("uaid", "chid2")))
+        self.topic.remove_subscriptions(self.name, ["a"])
+        eq_([x["token"] for x in self._fetch()[0]], ["b"])
+
+    def test_delete_topic(self):
+        self.topic.add_subscriptions(self.name, dict(a=("uaid", "chid")))
+        eq_(self.topic.delete_topic(self.name), True)
+        eq_(self._fetch(), [])
+        eq_(self.topic.delete_topic(self.name), False)
+
+
 class RouterTestCase(unittest.TestCase):
     def setUp(self):
         table = get_router_table()
@@ -385,6 +684,37 @@ class RouterTestCase(unittest.TestCase):
         router = Router(r, SinkMetrics())
         self.assertRaises(ItemNotFound, router.get_uaid, uaid)
 
+    def test_get_uaids(self):
+        uaids = [str(uuid.uuid4()) for _ in range(3)]
+        r = get_router_table()
+        router = Router(r, SinkMetrics())
+        for uaid in uaids[:2]:
+            router.register_user(dict(uaid=uaid, node_id="me",
+                                      connected_at=1234))
+        results = router.get_uaids(uaids)
+        eq_(sorted(results.keys()), sorted(uaids[:2]))
+        eq_(results[uaids[0]]["node_id"], "me")
+
+    def test_get_uaids_eventual(self):
+        uaids = [str(uuid.uuid4()) for _ in range(2)]
+        metrics = Mock()
+        router = Router(get_router_table(), metrics,
+                        policy=ReadPolicy(metrics, ["get_uaids"]))
+        router.register_user(dict(uaid=uaids[0], node_id="me",
+                                  connected_at=1234))
+        results = router.get_uaids(uaids)
+        eq_(results.keys(), [uaids[0]])
+        metrics.increment.assert_called_with("read.fallback.get_uaids")
+
+    def test_get_uaids_provision_failed(self):
+        r = get_router_table()
+        router = Router(r, SinkMetrics())
+        router.table = Mock()
+        router.table.connection.batch_get_item.side_effect = \
+            ProvisionedThroughputExceededException(None, None)
+        self.assertRaises(ProvisionedThroughputExceededException,
+                          router.get_uaids, ["uaid"])
+
     def test_uaid_provision_failed(self):
         r = get_router_table()
         router = Router(r, SinkMetrics())
@@ -393,7 +723,7 @@ class RouterTestCase(unittest.TestCase):
         def raise_error(*args, **kwargs):
             raise ProvisionedThroughputExceededException(None, None)
 
-        router.table.get_item.side_effect = raise_error
+        router.table.connection.get_item.side_effect = raise_error
         with self.assertRaises(ProvisionedThroughputExceededException):
             router.get_uaid(uaid="asdf")
 
@@ -448,6 +778,17 @@ class RouterTestCase(unittest.TestCase):
                                            connected_at=1234))
         eq_(result[0], True)
 
+    def test_save_invalidates_cache(self):
+        r = get_router_table()
+        cache = RouterCache(SinkMetrics(), size=10)
+        router = Router(r, SinkMetrics(), cache=cache)
+        router.table.connection = Mock()
+        router.table.connection.update_item.return_value = {}
+        cache.put("asdf", dict(uaid="asdf", node_id="old"))
+        router.register_user(dict(uaid="asdf", node_id="me",
+                                  connected_at=1234))
+        eq_(cache.get("asdf"), None)
+
     def test_save_fail(self):
         r = get_router_table()
         router = Router(r, SinkMetrics())
@@ -480,6 +821,88 @@ class RouterTestCase(unittest.TestCase):
         user = router.get_uaid("asdf")
         eq_(user.get("node_id"), None)
 
+    def test_get_uaid_and_channel(self):
+        chid = str(uuid.uuid4())
+        router = Router(get_router_table(), SinkMetrics())
+        message = Message(get_message_table(), SinkMetrics(),
+                          channel_markers=True)
+        router.register_user(dict(uaid="asdf", node_id="asdf",
+                                  connected_at=1234,
+                                  router_type="webpush"))
+        message.register_channel("asdf", chid)
+
+        user, subscribed = router.get_uaid_and_channel("asdf", chid,
+                                                       [message])
+        eq_(user["node_id"], "asdf")
+        eq_(subscribed, set([message.table.table_name]))
+
+        user, subscribed = router.get_uaid_and_channel(
+            "asdf", str(uuid.uuid4()), [message])
+        eq_(user["node_id"], "asdf")
+        eq_(subscribed, set())
+
+        self.assertRaises(ItemNotFound, router.get_uaid_and_channel,
+                          str(uuid.uuid4()), chid, [message])
+
+    def test_get_uaid_and_channel_consistent(self):
+        chid = str(uuid.uuid4())
+        metrics = Mock()
+        router = Router(get_router_table(), metrics,
+                        policy=ReadPolicy(metrics, ["get_uaids"]))
+        message = Message(get_message_table(), SinkMetrics(),
+                          channel_markers=True)
+        router.register_user(dict(uaid="asdf", node_id="asdf",
+                                  connected_at=1234,
+                                  router_type="webpush"))
+        message.register_channel("asdf", chid)
+
+        connection = router.table.connection
+        with patch.object(connection, "batch_get_item",
+                          wraps=connection.batch_get_item) as batch_get:
+            user, subscribed = router.get_uaid_and_channel("asdf", chid,
+                                                           [message])
+        eq_(subscribed, set([message.table.table_name]))
+        keys = batch_get.call_args[0][0]
+        eq_([keys[name]["ConsistentRead"] for name in sorted(keys)],
+            [True, True])
+        eq_(metrics.increment.called, False)
+
+    def test_get_uaid_consistent(self):
+        metrics = Mock()
+        router = Router(get_router_table(), metrics,
+                        policy=ReadPolicy(metrics, ["get_uaids"]))
+        router.register_user(dict(uaid="asdf", node_id="asdf",
+                                  connected_at=1234,
+                                  router_type="simplepush"))
+        item = router.get_uaid("asdf")
+        router.table = Mock()
+        get_item = router.table.connection.get_item
+        get_item.return_value = {}
+
+        self.assertRaises(ItemNotFound, router.get_uaid, "asdf")
+        eq_([call[1]["consistent_read"] for call in get_item.call_args_list],
+            [True])
+        eq_(metrics.increment.called, False)
+        ok_(isinstance(item, UserRecord))
+
+    def test_get_uaid_attributes(self):
+        r = get_router_table()
+        router = Router(r, SinkMetrics())
+        router.register_user(dict(uaid="asdf", node_id="asdf",
+                                  connected_at=1234,
+                                  router_type="simplepush",
+                                  router_data=dict(token="abc")))
+
+        user = router.get_uaid("asdf", attributes=("node_id",
+                                                   "connected_at"))
+        eq_(user.attributes, ("uaid", "node_id", "connected_at"))
+        eq_(user, dict(uaid="asdf", node_id="asdf", connected_at=1234))
+
+        # A route record is enough to clear the node
+        router.clear_node(user)
+        user = router.get_uaid("asdf", attributes=("node_id",))
+        eq_(user, dict(uaid="asdf"))
+
     def test_node_clear_fail(self):
         r = get_router_table()
         router = Router(r, SinkMetrics())
@@ -0,0 +1,136 @@
+from mock import Mock
+from nose.tools import eq_
+from twisted.internet.defer import CancelledError, Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.db import Storage, defer_db
+from autopush.deadlines import DeadlineExceeded, RequestDeadlines
+
+
+def get_uaid(result):
+    return result
+
+
+def save_notification(result):
+    return result
+
+
+def call(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+class RequestDeadlinesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.deadlines = RequestDeadlines(
+            self.metrics, deadline=2, deadlines=dict(get_uaid=5),
+            hedged=["get_uaid"], hedge_percentile=50, samples=10)
+        self.deadlines.clock = self.clock = Clock()
+
+    def _learn(self, latency):
+        """Answer enough reads in ``latency`` seconds to set the hedge
+        delay"""
+        for _ in range(10):
+            pending = Deferred()
+            self.deadlines.call(call, get_uaid, pending)
+            self.clock.advance(latency)
+            pending.callback(None)
+
+    def test_unhedgeable(self):
+        self.assertRaises(ValueError, RequestDeadlines, self.metrics,
+                          hedged=["register_user"])
+
+    def test_answered(self):
+        d = self.deadlines.call(call, save_notification, succeed(True))
+        d.addCallback(eq_, True)
+        eq_(self.clock.getDelayedCalls(), [])
+        return d
+
+    def test_deadline(self):
+        pending = Deferred()
+        d = self.deadlines.call(call, save_notification, pending)
+        self.clock.advance(1)
+        eq_(d.called, False)
+        self.clock.advance(1)
+        self.metrics.increment.assert_called_with(
+            "deadline.exceeded.save_notification")
+        return self.assertFailure(d, DeadlineExceeded)
+
+    def test_operation_deadline(self):
+        d = self.deadlines.call(call, get_uaid, Deferred())
+        self.clock.advance(5)
+        return self.assertFailure(d, DeadlineExceeded)
+
+    def test_cancelled(self):
+        d = self.deadlines.call(call, save_notification, Deferred())
+        d.cancel()
+        eq_(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, CancelledError)
+
+    def test_hedge(self):
+        eq_(self.deadlines.hedge_delay("get_uaid"), None)
+        self._learn(1)
+        eq_(self.deadlines.hedge_delay("get_uaid"), 1)
+
+        slow = Deferred()
+        attempts = [slow, succeed("hedged")]
+        d = self.deadlines.call(lambda func: attempts.pop(0), get_uaid)
+        self.clock.advance(1)
+        self.metrics.increment.assert_any_call("hedge.sent.get_uaid")
+        self.metrics.increment.assert_called_with("hedge.won.get_uaid")
+        d.addCallback(eq_, "hedged")
+        # The slow attempt was cancelled
+        eq_(slow.called, True)
+        return d
+
+    def test_hedge_not_needed(self):
+        self._learn(1)
+        d = self.deadlines.call(call, get_uaid, succeed("first"))
+        d.addCallback(eq_, "first")
+        eq_(self.clock.getDelayedCalls(), [])
+        return d
+
+    def test_hedge_after_failure(self):
+        self._learn(1)
+        first = Deferred()
+        attempts = [first, succeed("hedged")]
+        d = self.deadlines.call(lambda func: attempts.pop(0), get_uaid)
+        self.clock.advance(1)
+
+        # The hedge answered first, the failure of the other is dropped
+        first.errback(Exception("too late"))
+        d.addCallback(eq_, "hedged")
+        return d
+
+    def test_hedges_failed(self):
+        self._learn(1)
+        attempts = [Deferred(), Deferred()]
+        waiting = list(attempts)
+        d = self.deadlines.call(lambda func: attempts.pop(0), get_uaid)
+        self.clock.advance(1)
+        waiting[0].errback(ValueError("first"))
+        eq_(d.called, False)
+        waiting[1].errback(KeyError("second"))
+        return self.assertFailure(d, KeyError)
+
+    def test_hedged_deadline(self):
+        self._learn(1)
+        attempts = [Deferred(), Deferred()]
+        waiting = list(attempts)
+        d = self.deadlines.call(lambda func: attempts.pop(0), get_uaid)
+        self.clock.advance(5)
+        eq_([attempt.called for attempt in waiting], [True, True])
+        self.metrics.increment.assert_called_with(
+            "deadline.exceeded.get_uaid")
+        return self.assertFailure(d, DeadlineExceeded)
+
+    def test_defer_db(self):
+        storage = Storage(Mock(), self.metrics, deadlines=self.deadlines)
+        storage.nonblocking = Mock()
+        storage.nonblocking.save_notification.return_value = Deferred()
+        d = defer_db(storage.save_notification, "abc", "chid", 1)
+        storage.nonblocking.save_notification.assert_called_with(
+            "abc", "chid", 1)
+        self.clock.advance(2)
+        return self.assertFailure(d, DeadlineExceeded)
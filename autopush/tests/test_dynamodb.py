@@ -0,0 +1,621 @@
+import datetime
+import json
+import uuid
+from decimal import Decimal
+
+from boto.dynamodb.types import Binary, Dynamizer
+from boto.dynamodb2.exceptions import (
+    ConditionalCheckFailedException,
+    ItemNotFound,
+    ProvisionedThroughputExceededException,
+)
+from boto.dynamodb2.table import Table
+from boto.exception import JSONResponseError
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.trial import unittest
+
+from autopush.cache import RouteRecord
+from autopush.db import (
+    Message,
+    ReadPolicy,
+    Router,
+    Storage,
+    defer_db,
+    make_message_item,
+)
+from autopush.dynamodb import (
+    DynamoDBClient,
+    MessageRecord,
+    UserRecord,
+    decode_item,
+    decode_value,
+)
+
+
+def error(fault, status=400):
+    return JSONResponseError(status, "Bad Request",
+                             {"__type": "com.amazonaws#" + fault})
+
+
+class DecodeTestCase(unittest.TestCase):
+    def test_decode_value(self):
+        dynamizer = Dynamizer()
+        values = ["abc", 12, Decimal("1.5"), Binary("\x00\xff"),
+                  set(["a", "b"]), set([1, 2]), True, None,
+                  dict(a=1, b=["x", 2]), [1, "y"]]
+        for value in values:
+            encoded = dynamizer.encode(value)
+            eq_(decode_value(encoded), dynamizer.decode(encoded))
+            eq_(decode_value(encoded), value)
+        self.assertRaises(TypeError, decode_value, {"X": "abc"})
+
+    def test_decode_item(self):
+        item = decode_item({"uaid": {"S": "abc"}, "connected_at": {"N": "12"}},
+                           UserRecord)
+        ok_(isinstance(item, UserRecord))
+        eq_(item, dict(uaid="abc", connected_at=12))
+        # Missing attributes read as None, like on a boto Item
+        eq_(item["node_id"], None)
+        eq_(item.get("node_id", "default"), "default")
+        ok_("node_id" not in item)
+
+
+class DynamoDBClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.provider = Mock(access_key="AKID", secret_key="secret",
+                             security_token=None)
+        self.client = DynamoDBClient("dynamodb.us-east-1.amazonaws.com",
+                                     "us-east-1", self.provider)
+
+    def test_from_connection(self):
+        conn = Mock(host="localhost", port=8000, is_secure=False)
+        conn.region.name = "us-west-2"
+        client = DynamoDBClient.from_connection(conn)
+        eq_(client.url, "http://localhost:8000/")
+        eq_(client.region, "us-west-2")
+
+    def test_sign(self):
+        now = datetime.datetime(2016, 1, 2, 3, 4, 5)
+        headers = self.client.sign("GetItem", "{}", now)
+        eq_(headers["x-amz-date"], "20160102T030405Z")
+        eq_(headers["x-amz-target"], "DynamoDB_20120810.GetItem")
+        auth = headers["authorization"]
+        ok = auth.startswith(
+            "AWS4-HMAC-SHA256 Credential=AKID/20160102/us-east-1/dynamodb/"
+            "aws4_request, SignedHeaders=content-type;host;x-amz-date;"
+            "x-amz-target, Signature=")
+        eq_(ok, True)
+
+        # Signatures depend on the body and the credentials
+        eq_(self.client.sign("GetItem", "{}", now)["authorization"], auth)
+        self.assertNotEqual(
+            self.client.sign("GetItem", "[]", now)["authorization"], auth)
+        self.provider.security_token = "token"
+        headers = self.client.sign("GetItem", "{}", now)
+        eq_(headers["x-amz-security-token"], "token")
+        self.assertIn("x-amz-security-token", headers["authorization"])
+
+    def test_decode(self):
+        eq_(self.client._decode('{"Item": {}}', 200, "OK"), {"Item": {}})
+        body = json.dumps({"__type": "com.amazonaws.dynamodb.v20120810#"
+                                     "ConditionalCheckFailedException"})
+        self.assertRaises(ConditionalCheckFailedException,
+                          self.client._decode, body, 400, "Bad Request")
+        body = json.dumps({"__type": "com.amazonaws#UnknownException"})
+        self.assertRaises(JSONResponseError,
+                          self.client._decode, body, 400, "Bad Request")
+
+    @patch("autopush.dynamodb.deferLater", return_value=succeed(None))
+    def test_request_retries(self, later_mock):
+        self.client.retries = 2
+        self.client._send = Mock(side_effect=[
+            fail(error("ProvisionedThroughputExceededException")),
+            fail(error("InternalServerError", status=500)),
+            succeed({"Item": {}}),
+        ])
+        d = self.client.request("GetItem", {})
+
+        def check(result):
+            eq_(result, {"Item": {}})
+            eq_([args[1] for args, _ in later_mock.call_args_list],
+                [0, 0.1])
+        d.addCallback(check)
+        return d
+
+    @patch("autopush.dynamodb.deferLater", return_value=succeed(None))
+    def test_request_gives_up(self, later_mock):
+        self.client.retries = 1
+        self.client._send = Mock(side_effect=lambda *args: fail(
+            error("ProvisionedThroughputExceededException")))
+        d = self.client.request("GetItem", {})
+        self.assertFailure(d, JSONResponseError)
+        d.addCallback(lambda exc: eq_(self.client._send.call_count, 2))
+        return d
+
+    def test_request_not_retried(self):
+        self.client._send = Mock(return_value=fail(
+            error("ValidationException")))
+        d = self.client.request("GetItem", {})
+        self.assertFailure(d, JSONResponseError)
+        d.addCallback(lambda exc: eq_(self.client._send.call_count, 1))
+        return d
+
+
+class AsyncTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = DynamoDBClient("localhost", "us-east-1", Mock(),
+                                     is_secure=False)
+        self.request_mock = self.client.request = Mock()
+        self.metrics = Mock()
+
+    def _table(self, name):
+        return Table(name, connection=Mock())
+
+    def test_defer_db(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client)
+        self.request_mock.return_value = succeed(
+            {"Item": {"uaid": {"S": "abc"}, "node_id": {"S": "node"}}})
+        d = defer_db(router.get_uaid, "abc")
+
+        def check(item):
+            ok_(isinstance(item, UserRecord))
+            eq_(item["node_id"], "node")
+            args, _ = self.request_mock.call_args
+            eq_(args, ("GetItem", dict(TableName="router",
+                                       Key={"uaid": {"S": "abc"}},
+                                       ConsistentRead=True)))
+        d.addCallback(check)
+        return d
+
+    def test_get_uaid_attributes(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client)
+        self.request_mock.return_value = succeed(
+            {"Item": {"uaid": {"S": "abc"}, "node_id": {"S": "node"}}})
+        d = router.nonblocking.get_uaid(
+            "abc", attributes=("node_id", "connected_at"))
+
+        def check(record):
+            ok_(isinstance(record, RouteRecord))
+            eq_(record, dict(uaid="abc", node_id="node"))
+            eq_(record.attributes, ("uaid", "node_id", "connected_at"))
+            args, _ = self.request_mock.call_args
+            eq_(args[1]["ProjectionExpression"], "#a0, #a1, #a2")
+            eq_(args[1]["ExpressionAttributeNames"],
+                {"#a0": "uaid", "#a1": "node_id", "#a2": "connected_at"})
+            ok_(router.nonblocking._projections[record.attributes] is
+                router.nonblocking._projection(record.attributes))
+        d.addCallback(check)
+        return d
+
+    def test_get_uaid_and_channel(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client)
+        messages = [Message(self._table(name), self.metrics,
+                            channel_markers=True)
+                    for name in ("message_1", "message_2")]
+        self.request_mock.side_effect = [
+            succeed({
+                "Responses": {
+                    "router": [{"uaid": {"S": "abc"},
+                                "current_month": {"S": "message_2"}}],
+                    "message_1": [],
+                },
+                "UnprocessedKeys": {"message_2": {"Keys": []}},
+            }),
+            succeed({"Responses": {"message_2": [{"uaid": {"S": "abc"}}]}}),
+        ]
+        d = router.nonblocking.get_uaid_and_channel("abc", "chid", messages)
+
+        def check(result):
+            record, subscribed = result
+            eq_(record["current_month"], "message_2")
+            eq_(subscribed, set(["message_2"]))
+            args, _ = self.request_mock.call_args_list[0]
+            eq_(args[0], "BatchGetItem")
+            items = args[1]["RequestItems"]
+            eq_(items["router"]["Keys"], [{"uaid": {"S": "abc"}}])
+            eq_(items["router"]["ConsistentRead"], True)
+            eq_(items["message_1"]["Keys"],
+                [{"uaid": {"S": "abc"}, "chidmessageid": {"S": " :chid"}}])
+            args, _ = self.request_mock.call_args
+            eq_(args[1]["RequestItems"], {"message_2": {"Keys": []}})
+        d.addCallback(check)
+        return d
+
+    def test_get_uaid_and_channel_not_found(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client)
+        self.request_mock.return_value = succeed({"Responses": {"router": []}})
+        d = router.nonblocking.get_uaid_and_channel("abc", "chid", [])
+        return self.assertFailure(d, ItemNotFound)
+
+    def test_get_uaid_not_found(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client)
+        self.request_mock.return_value = succeed({})
+        d = router.nonblocking.get_uaid("abc")
+        return self.assertFailure(d, ItemNotFound)
+
+    def test_get_uaid_consistent(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client,
+                        policy=ReadPolicy(self.metrics, ["get_uaids"]))
+        self.request_mock.return_value = succeed({})
+        d = self.assertFailure(router.nonblocking.get_uaid("abc"),
+                               ItemNotFound)
+
+        def check(result):
+            eq_([call[0][1]["ConsistentRead"]
+                 for call in self.request_mock.call_args_list],
+                [True])
+        d.addCallback(check)
+        return d
+
+    def test_get_uaids_eventual(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client,
+                        policy=ReadPolicy(self.metrics, ["get_uaids"]))
+        self.request_mock.side_effect = [
+            succeed({"Responses": {"router": [{"uaid": {"S": "abc"}}]}}),
+            succeed({"Responses": {"router": [{"uaid": {"S": "def"}}]}}),
+        ]
+        d = router.nonblocking.get_uaids(["abc", "def"])
+
+        def check(found):
+            eq_(sorted(found), ["abc", "def"])
+            items = self.request_mock.call_args[0][1]["RequestItems"]
+            eq_(items["router"], dict(Keys=[{"uaid": {"S": "def"}}],
+                                      ConsistentRead=True))
+            self.metrics.increment.assert_called_with(
+                "read.fallback.get_uaids")
+        d.addCallback(check)
+        return d
+
+    def test_provisioned(self):
+        storage = Storage(self._table("storage"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = fail(
+            ProvisionedThroughputExceededException(400, "Bad Request"))
+        d = storage.nonblocking.fetch_notifications("abc")
+        self.assertFailure(d, ProvisionedThroughputExceededException)
+        d.addCallback(lambda exc: self.metrics.increment.assert_called_with(
+            "error.provisioned.fetch_notifications"))
+        return d
+
+    def test_save_notification_stale(self):
+        storage = Storage(self._table("storage"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = fail(
+            ConditionalCheckFailedException(400, "Bad Request"))
+        d = storage.nonblocking.save_notification("abc", "chid", 12)
+        d.addCallback(eq_, False)
+        return d
+
+    def test_fetch_messages_pages(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.side_effect = [
+            succeed({"Items": [{"uaid": {"S": "abc"},
+                                "chidmessageid": {"S": "a:1"}}],
+                     "LastEvaluatedKey": {"uaid": {"S": "abc"}}}),
+            succeed({"Items": [{"uaid": {"S": "abc"},
+                                "chidmessageid": {"S": "a:2"}}]}),
+        ]
+        d = message.nonblocking.fetch_messages("abc", limit=5)
+
+        def check(items):
+            ok_(isinstance(items[0], MessageRecord))
+            eq_([x["chidmessageid"] for x in items], ["a:1", "a:2"])
+            args, _ = self.request_mock.call_args
+            eq_(args[1]["Limit"], 4)
+            eq_(args[1]["ExclusiveStartKey"], {"uaid": {"S": "abc"}})
+        d.addCallback(check)
+        return d
+
+    def test_store_message(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = succeed({})
+        d = message.nonblocking.store_message("abc", "chid", "msg", 60)
+
+        def check(result):
+            eq_(result, True)
+            args, _ = self.request_mock.call_args
+            eq_(args[0], "PutItem")
+            item = args[1]["Item"]
+            eq_(item["chidmessageid"], {"S": "chid:msg"})
+            eq_("data" in item, False)
+        d.addCallback(check)
+        return d
+
+    def test_store_message_item_version_2(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client, item_version=2)
+        self.request_mock.return_value = succeed({})
+        d = message.nonblocking.store_message(
+            "abc", "chid", "msg", 60, data="aGk=",
+            headers={"encoding": "aesgcm"}, timestamp=10)
+
+        def check(result):
+            args, _ = self.request_mock.call_args
+            item = args[1]["Item"]
+            eq_(item["v"], {"N": "2"})
+            eq_(item["t"], {"N": "60"})
+            eq_(item["d"], {"B": "aGk="})
+            eq_(item["h"], {"S": "aesgcm"})
+            eq_(len(item["u"]["B"]), 24)
+        d.addCallback(check)
+        return d
+
+    def test_delete_message_updateid(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = succeed({})
+        updateid = uuid.uuid4().hex
+        d = message.nonblocking.delete_message("abc", "chid", "msg",
+                                               updateid=updateid)
+
+        def check(result):
+            eq_(result, True)
+            args, _ = self.request_mock.call_args
+            eq_(args[1]["ConditionExpression"],
+                "updateid = :updateid or #u = :u")
+            eq_(args[1]["ExpressionAttributeValues"][":updateid"],
+                {"S": updateid})
+            eq_(args[1]["ExpressionAttributeNames"], {"#u": "u"})
+        d.addCallback(check)
+        return d
+
+    def test_store_messages(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = succeed({})
+        items = [make_message_item("abc", "chid", str(i), 60)
+                 for i in range(3)]
+        d = message.nonblocking.store_messages(items)
+
+        def check(result):
+            eq_(result, True)
+            args, _ = self.request_mock.call_args
+            eq_(args[0], "BatchWriteItem")
+            puts = args[1]["RequestItems"]["message"]
+            eq_(len(puts), 3)
+            eq_(puts[2]["PutRequest"]["Item"]["chidmessageid"],
+                {"S": "chid:2"})
+        d.addCallback(check)
+        return d
+
+    @patch("autopush.dynamodb.deferLater", return_value=succeed(None))
+    def test_delete_messages(self, later_mock):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        unprocessed = {"message": [{"DeleteRequest": {}}]}
+        self.request_mock.side_effect = [
+            succeed({"UnprocessedItems": unprocessed}),
+            succeed({}),
+            succeed({}),
+        ]
+        ids = ["a:%s" % i for i in range(30)]
+        d = message.nonblocking.delete_messages("abc", ids)
+
+        def check(result):
+            calls = self.request_mock.call_args_list
+            eq_(len(calls), 3)
+            eq_(len(calls[0][0][1]["RequestItems"]["message"]), 25)
+            eq_(calls[1][0][1]["RequestItems"], unprocessed)
+            eq_(len(calls[2][0][1]["RequestItems"]["message"]), 5)
+        d.addCallback(check)
+        return d
+
+    def test_delete_acked(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.side_effect = [
+            fail(ConditionalCheckFailedException(400, "Bad Request")),
+            succeed({}),
+            succeed({}),
+        ]
+        d = message.nonblocking.delete_acked(
+            "abc", [("a", "1", "x"), ("a", "2", "y"), ("a", "3", None)])
+
+        def check(result):
+            eq_(result, True)
+            ops = [args[0] for args, _ in self.request_mock.call_args_list]
+            eq_(ops, ["DeleteItem", "DeleteItem", "BatchWriteItem"])
+            params = self.request_mock.call_args_list[1][0][1]
+            eq_(params["ConditionExpression"], "updateid = :updateid")
+        d.addCallback(check)
+        return d
+
+    def test_delete_acked_concurrent(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        pending = [Deferred() for _ in range(3)]
+        self.request_mock.side_effect = pending
+        d = message.nonblocking.delete_acked(
+            "abc", [("a", str(i), "x") for i in range(3)])
+
+        # Every conditional delete is sent before any of them completes
+        eq_(self.request_mock.call_count, 3)
+        ok_(not d.called)
+        for request in pending:
+            request.callback({})
+        d.addCallback(eq_, True)
+        return d
+
+    def test_delete_notifications_fail(self):
+        storage = Storage(self._table("storage"), self.metrics,
+                          client=self.client)
+        self.request_mock.side_effect = [
+            succeed({}),
+            fail(error("ValidationException")),
+        ]
+        d = storage.nonblocking.delete_notifications(
+            "abc", [("a", 1), ("b", 2)])
+        return self.assertFailure(d, JSONResponseError)
+
+    def test_scan_expired(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = succeed({
+            "Items": [{"uaid": {"S": "abc"}, "chidmessageid": {"S": "a:1"},
+                       "ttl": {"N": "10"}, "timestamp": {"N": "10"}}],
+            "LastEvaluatedKey": {"uaid": {"S": "abc"}},
+            "ConsumedCapacity": {"CapacityUnits": 0.5},
+        })
+        d = message.nonblocking.scan_expired(1, 4, limit=50, now=20)
+
+        def check(result):
+            eq_(result, ([("abc", "a:1")], {"uaid": {"S": "abc"}}, 0.5))
+            params = self.request_mock.call_args[0][1]
+            eq_((params["Segment"], params["TotalSegments"]), (1, 4))
+            eq_("ExclusiveStartKey" in params, False)
+        d.addCallback(check)
+        return d
+
+    def test_channel_exists(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client, channel_markers=True)
+        self.request_mock.side_effect = [
+            succeed({}),
+            succeed({"Item": {"chids": {"SS": ["chid"]}}}),
+            succeed({}),
+        ]
+        d = message.nonblocking.channel_exists("abc", "chid")
+
+        def check(result):
+            eq_(result, True)
+            calls = self.request_mock.call_args_list
+            eq_(calls[0][0][1]["Key"]["chidmessageid"], {"S": " :chid"})
+            eq_(calls[2][0][0], "PutItem")
+            eq_(calls[2][0][1]["Item"]["chidmessageid"], {"S": " :chid"})
+        d.addCallback(check)
+        return d
+
+    def test_channel_exists_eventual(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client, channel_markers=True,
+                          policy=ReadPolicy(self.metrics, ["channel_exists"]))
+        self.request_mock.side_effect = [succeed({}), succeed({})]
+        d = message.nonblocking.channel_exists("abc", "chid")
+
+        def check(result):
+            eq_(result, False)
+            calls = self.request_mock.call_args_list
+            eq_(calls[0][0][1]["ConsistentRead"], False)
+            eq_(calls[1][0][1]["ConsistentRead"], True)
+            self.metrics.increment.assert_called_with(
+                "read.fallback.channel_exists")
+        d.addCallback(check)
+        return d
+
+    def test_channel_exists_unknown(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client, channel_markers=True)
+        self.request_mock.side_effect = [succeed({}), succeed({})]
+        d = message.nonblocking.channel_exists("abc", "chid")
+        d.addCallback(eq_, False)
+        return d
+
+    def test_channel_exists_markers_disabled(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = succeed(
+            {"Item": {"chids": {"SS": ["chid"]}}})
+        d = message.nonblocking.channel_exists("abc", "chid")
+
+        def check(result):
+            eq_(result, True)
+            args, _ = self.request_mock.call_args
+            eq_(self.request_mock.call_count, 1)
+            eq_(args[1]["Key"]["chidmessageid"], {"S": " "})
+        d.addCallback(check)
+        return d
+
+    def test_register_channel_markers_disabled(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = succeed({})
+        d = message.nonblocking.register_channel("abc", "chid")
+
+        def check(result):
+            eq_(result, True)
+            eq_([args[0] for args, _ in self.request_mock.call_args_list],
+                ["UpdateItem"])
+        d.addCallback(check)
+        return d
+
+    def test_unregister_channel_markers_disabled(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client)
+        self.request_mock.return_value = succeed(
+            {"Attributes": {"chids": {"SS": ["chid"]}}})
+        d = message.nonblocking.unregister_channel("abc", "chid")
+
+        def check(result):
+            eq_(result, True)
+            eq_([args[0] for args, _ in self.request_mock.call_args_list],
+                ["UpdateItem"])
+        d.addCallback(check)
+        return d
+
+    def test_unregister_channel_markers(self):
+        message = Message(self._table("message"), self.metrics,
+                          client=self.client, channel_markers=True)
+        self.request_mock.return_value = succeed({})
+        d = message.nonblocking.unregister_channel("abc", "chid")
+
+        def check(result):
+            eq_(result, False)
+            calls = self.request_mock.call_args_list
+            eq_([args[0] for args, _ in calls],
+                ["DeleteItem", "UpdateItem"])
+            eq_(calls[0][0][1]["Key"]["chidmessageid"], {"S": " :chid"})
+        d.addCallback(check)
+        return d
+
+    def test_get_uaid_and_channel_markers_disabled(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client)
+        messages = [Message(self._table("message"), self.metrics)]
+        self.request_mock.return_value = succeed(
+            {"Responses": {"router": [{"uaid": {"S": "abc"}}]}})
+        d = router.nonblocking.get_uaid_and_channel("abc", "chid", messages)
+
+        def check(result):
+            record, subscribed = result
+            eq_(subscribed, set())
+            items = self.request_mock.call_args[0][1]["RequestItems"]
+            eq_(items.keys(), ["router"])
+        d.addCallback(check)
+        return d
+
+    def test_register_user(self):
+        cache = Mock()
+        router = Router(self._table("router"), self.metrics, cache=cache,
+                        client=self.client)
+        self.request_mock.return_value = succeed(
+            {"Attributes": {"node_id": {"S": "old"}}})
+        d = router.nonblocking.register_user(
+            dict(uaid="abc", node_id="node", connected_at=1,
+                 router_type="simplepush"))
+
+        def check(result):
+            eq_(result, (True, {"node_id": "old"}))
+            cache.invalidate.assert_called_with("abc")
+        d.addCallback(check)
+        return d
+
+    def test_clear_node(self):
+        router = Router(self._table("router"), self.metrics,
+                        client=self.client)
+        self.request_mock.return_value = fail(
+            ConditionalCheckFailedException(400, "Bad Request"))
+        item = dict(uaid="abc", node_id="node", connected_at=1)
+        d = router.nonblocking.clear_node(item)
+        d.addCallback(eq_, False)
+        return d
@@ -7,7 +7,7 @@ import uuid
 import twisted.internet.base
 from cryptography.fernet import Fernet, InvalidToken
 from cyclone.web import Application
-from mock import Mock, patch
+from mock import ANY, Mock, patch
 from moto import mock_dynamodb2, mock_s3
 from nose.tools import eq_, ok_
 from twisted.internet.defer import Deferred
@@ -17,16 +17,23 @@ from txstatsd.metrics.metrics import Metrics
 
 import autopush.endpoint as endpoint
 import autopush.utils as utils
+from autopush.cache import RouterCache, TokenCache
 from autopush.db import (
     ProvisionedThroughputExceededException,
     Router,
     Storage,
     Message,
+    Topic,
     ItemNotFound,
     create_rotating_message_table,
 )
+from autopush.ratelimit import RateLimiter
 from autopush.settings import AutopushSettings
-from autopush.router.interface import IRouter, RouterResponse
+from autopush.router.interface import (
+    IRouter,
+    RouterException,
+    RouterResponse,
+)
 from autopush.senderids import SenderIDs
 from autopush.utils import generate_hash
 
@@ -140,6 +147,46 @@ class MessageTestCase(unittest.TestCase):
         self.message.delete("123-456")
         return self.finish_deferred
 
+    def test_delete_compact_message_id(self):
+        token = self.ap_settings.message_ids.encode("m:123:456")
+        self.message_mock.configure_mock(**{
+            "delete_message.return_value": True})
+
+        def handle_finish(result):
+            eq_(self.fernet_mock.decrypt.called, False)
+            self.message_mock.delete_message.assert_called_with(
+                "123", "456", token)
+            self.status_mock.assert_called_with(204)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.message.delete(token)
+        return self.finish_deferred
+
+    def test_delete_compact_message_id_invalid(self):
+        token = self.ap_settings.endpoint_tokens.encode("123:456")
+
+        def handle_finish(result):
+            eq_(self.message_mock.delete_message.called, False)
+            self.status_mock.assert_called_with(404)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.message.delete(token)
+        return self.finish_deferred
+
+    def test_delete_token_cache_hit(self):
+        cache = self.ap_settings.token_cache = TokenCache(Mock(), size=10)
+        cache.put("123-456", "m:123:456")
+        self.message_mock.configure_mock(**{
+            "delete_message.return_value": True})
+
+        def handle_finish(result):
+            eq_(self.fernet_mock.decrypt.called, False)
+            self.status_mock.assert_called_with(204)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.message.delete("123-456")
+        return self.finish_deferred
+
     def test_delete_db_error(self):
         self.fernet_mock.decrypt.return_value = "m:123:456"
         self.message_mock.configure_mock(**{
@@ -336,6 +383,27 @@ class EndpointTestCase(unittest.TestCase):
         self.finish_deferred.addCallback(handle_finish)
         return self.finish_deferred
 
+    def test_webpush_compact_message_id(self):
+        self.settings.token_version = 1
+        fresult = dict(router_type="webpush")
+        frouter = self.settings.routers["webpush"]
+        frouter.route_notification.return_value = RouterResponse()
+        self.endpoint.uaid = "123"
+        self.endpoint.chid = "fred"
+        self.request_mock.headers["encryption"] = "stuff"
+        self.request_mock.headers["content-encoding"] = "aes128"
+        self.endpoint._uaid_lookup_results(fresult)
+
+        def handle_finish(value):
+            eq_(self.fernet_mock.encrypt.called, False)
+            (_, (notification, _), _) = \
+                frouter.route_notification.mock_calls[0]
+            eq_(self.settings.message_ids.decode(notification.version),
+                "m:123:fred")
+
+        self.finish_deferred.addCallback(handle_finish)
+        return self.finish_deferred
+
     def test_other_payload_encoding(self):
         fresult = dict(router_type="test")
         frouter = Mock(spec=Router)
@@ -430,7 +498,8 @@ class EndpointTestCase(unittest.TestCase):
 
     def test_put_data_too_large(self):
         self.fernet_mock.decrypt.return_value = "123:456"
-        self.endpoint.ap_settings.router.get_uaid.return_value = {}
+        self.endpoint.ap_settings.router.get_uaid_and_channel.return_value = (
+            {}, set())
         self.endpoint.ap_settings.max_data = 3
         self.endpoint.request.body = b'version=1&data=1234'
 
@@ -441,6 +510,45 @@ class EndpointTestCase(unittest.TestCase):
         self.endpoint.put('')
         return self.finish_deferred
 
+    def test_put_sender_throttled(self):
+        self.endpoint.ap_settings.sender_limiter = RateLimiter(
+            overrides={"1.2.3.4": 1})
+        self.request_mock.remote_ip = "1.2.3.4"
+        self.fernet_mock.decrypt.side_effect = InvalidToken
+        self.endpoint.finish = Mock()
+        self.endpoint.put('')
+        self.status_mock.assert_called_with(404)
+
+        self.endpoint.put('')
+        self.status_mock.assert_called_with(429)
+        self._check_error(429, 112, "Too Many Requests")
+        eq_(self.fernet_mock.decrypt.call_count, 1)
+        self.metrics_mock.increment.assert_any_call(
+            "updates.throttled.sender", count=1)
+
+    def test_sender_key(self):
+        self.request_mock.remote_ip = "10.0.0.1"
+        self.request_mock.headers["authorization"] = "Bearer abc"
+        self.request_mock.headers["x-forwarded-for"] = "1.2.3.4, 5.6.7.8"
+        eq_(self.endpoint._sender_key(), "10.0.0.1")
+
+        # Only a trusted proxy picks the address
+        self.endpoint.ap_settings.trusted_proxies = frozenset(["10.0.0.1"])
+        eq_(self.endpoint._sender_key(), "5.6.7.8")
+
+    def test_put_uaid_throttled(self):
+        self.endpoint.ap_settings.uaid_limiter = RateLimiter(rate=1)
+        self.endpoint.ap_settings.uaid_limiter.throttle("123")
+        self.fernet_mock.decrypt.return_value = "123:456"
+
+        def handle_finish(result):
+            self._check_error(429, 112, "Too Many Requests")
+            eq_(self.router_mock.get_uaid_and_channel.called, False)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put('')
+        return self.finish_deferred
+
     @patch_logger
     def test_put_token_error(self, log_mock):
         self.fernet_mock.configure_mock(**{
@@ -487,10 +595,11 @@ class EndpointTestCase(unittest.TestCase):
 
     def test_process_token_client_unknown(self):
         self.router_mock.configure_mock(**{
-            'get_uaid.side_effect': self._throw_item_not_found})
+            'get_uaid_and_channel.side_effect': self._throw_item_not_found})
 
         def handle_finish(result):
-            self.router_mock.get_uaid.assert_called_with('123')
+            self.router_mock.get_uaid_and_channel.assert_called_with(
+                "123", "456", ANY)
             self.status_mock.assert_called_with(404)
             self._check_error(404, 103, "Not Found")
         self.finish_deferred.addCallback(handle_finish)
@@ -500,9 +609,143 @@ class EndpointTestCase(unittest.TestCase):
         self.endpoint._token_valid('123:456')
         return self.finish_deferred
 
+    def test_put_router_cache_hit(self):
+        cache = self.settings.router_cache = RouterCache(Mock(), size=10)
+        cache.put("123", dict(uaid="123"))
+        self.fernet_mock.decrypt.return_value = "123:456"
+        self.sp_router_mock.route_notification.return_value = RouterResponse()
+
+        def handle_finish(result):
+            eq_(self.router_mock.get_uaid_and_channel.called, False)
+            cache.metrics.increment.assert_called_with("router.cache.hit")
+            self.endpoint.set_status.assert_called_with(200)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(dummy_uaid)
+        return self.finish_deferred
+
+    def test_put_router_cache_miss_saves(self):
+        cache = self.settings.router_cache = RouterCache(Mock(), size=10)
+        self.fernet_mock.decrypt.return_value = "123:456"
+        self.router_mock.get_uaid_and_channel.return_value = (
+            dict(uaid="123"), set())
+        self.sp_router_mock.route_notification.return_value = RouterResponse()
+
+        def handle_finish(result):
+            self.router_mock.get_uaid_and_channel.assert_called_with(
+                "123", "456", ANY)
+            eq_(cache.get("123"), dict(uaid="123"))
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(dummy_uaid)
+        return self.finish_deferred
+
+    def test_put_router_update_invalidates_cache(self):
+        cache = self.settings.router_cache = RouterCache(Mock(), size=10)
+        cache.put("123", dict(uaid="123", router_type="simplepush",
+                              router_data=dict()))
+        self.fernet_mock.decrypt.return_value = "123:456"
+        self.sp_router_mock.route_notification.return_value = RouterResponse(
+            status_code=503,
+            router_data=dict(token="new_connect"),
+        )
+
+        def handle_finish(result):
+            self.endpoint.set_status.assert_called_with(503)
+            assert(self.router_mock.register_user.called)
+            eq_(cache.get("123"), None)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(dummy_uaid)
+        return self.finish_deferred
+
+    def test_put_compact_token(self):
+        token = self.settings.endpoint_tokens.encode("123:456")
+        self.router_mock.get_uaid_and_channel.return_value = (dict(), set())
+        self.sp_router_mock.route_notification.return_value = RouterResponse()
+
+        def handle_finish(result):
+            eq_(self.fernet_mock.decrypt.called, False)
+            self.router_mock.get_uaid_and_channel.assert_called_with(
+                "123", "456", ANY)
+            self.endpoint.set_status.assert_called_with(200)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(token)
+        return self.finish_deferred
+
+    def test_put_token_cache_hit(self):
+        cache = self.settings.token_cache = TokenCache(Mock(), size=10)
+        cache.put(dummy_uaid, "123:456")
+        self.router_mock.get_uaid_and_channel.return_value = (dict(), set())
+        self.sp_router_mock.route_notification.return_value = RouterResponse()
+
+        def handle_finish(result):
+            eq_(self.fernet_mock.decrypt.called, False)
+            cache.metrics.increment.assert_called_with("token.cache.hit")
+            self.endpoint.set_status.assert_called_with(200)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(dummy_uaid)
+        return self.finish_deferred
+
+    def test_put_token_cache_miss_saves(self):
+        cache = self.settings.token_cache = TokenCache(Mock(), size=10)
+        self.fernet_mock.decrypt.return_value = "123:456"
+        self.router_mock.get_uaid_and_channel.return_value = (dict(), set())
+        self.sp_router_mock.route_notification.return_value = RouterResponse()
+
+        def handle_finish(result):
+            eq_(cache.get(dummy_uaid), "123:456")
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(dummy_uaid)
+        return self.finish_deferred
+
+    def test_put_token_cache_invalid(self):
+        cache = self.settings.token_cache = TokenCache(Mock(), size=10)
+        self.fernet_mock.decrypt.side_effect = InvalidToken
+
+        def handle_finish(result):
+            self.status_mock.assert_called_with(404)
+            self.assertRaises(InvalidToken, cache.get, dummy_uaid)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(dummy_uaid)
+        return self.finish_deferred
+
+    def test_put_token_cache_negative_hit(self):
+        cache = self.settings.token_cache = TokenCache(Mock(), size=10)
+        cache.put_invalid(dummy_uaid)
+
+        def handle_finish(result):
+            eq_(self.fernet_mock.decrypt.called, False)
+            self.status_mock.assert_called_with(404)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(dummy_uaid)
+        return self.finish_deferred
+
+    def test_put_token_cache_skipped_on_rotation(self):
+        cache = self.settings.token_cache = TokenCache(Mock(), size=10)
+        self.router_mock.get_uaid_and_channel.return_value = (dict(), set())
+        self.sp_router_mock.route_notification.return_value = RouterResponse()
+
+        def rotate(token):
+            self.settings.fernet = Mock(spec=Fernet)
+            return "123:456"
+        self.fernet_mock.decrypt.side_effect = rotate
+
+        def handle_finish(result):
+            eq_(cache.get(dummy_uaid), None)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.put(dummy_uaid)
+        return self.finish_deferred
+
     def test_put_default_router(self):
         self.fernet_mock.decrypt.return_value = "123:456"
-        self.router_mock.get_uaid.return_value = dict()
+        self.router_mock.get_uaid_and_channel.return_value = (dict(), set())
         self.sp_router_mock.route_notification.return_value = RouterResponse()
 
         def handle_finish(result):
@@ -519,10 +762,8 @@ class EndpointTestCase(unittest.TestCase):
         self.request_mock.headers["encryption-key"] = "encKey"
         self.request_mock.body = b' '
         self.fernet_mock.decrypt.return_value = "123:456"
-        self.router_mock.get_uaid.return_value = dict(
-            router_type="webpush",
-            router_data=dict(),
-        )
+        self.router_mock.get_uaid_and_channel.return_value = (
+            dict(router_type="webpush", router_data=dict()), set())
         self.wp_router_mock.route_notification.return_value = RouterResponse(
             status_code=200,
             router_data={},
@@ -538,10 +779,8 @@ class EndpointTestCase(unittest.TestCase):
 
     def test_put_router_needs_change(self):
         self.fernet_mock.decrypt.return_value = "123:456"
-        self.router_mock.get_uaid.return_value = dict(
-            router_type="simplepush",
-            router_data=dict(),
-        )
+        self.router_mock.get_uaid_and_channel.return_value = (
+            dict(router_type="simplepush", router_data=dict()), set())
         self.sp_router_mock.route_notification.return_value = RouterResponse(
             status_code=500,
             router_data={},
@@ -558,10 +797,8 @@ class EndpointTestCase(unittest.TestCase):
 
     def test_put_router_needs_update(self):
         self.fernet_mock.decrypt.return_value = "123:456"
-        self.router_mock.get_uaid.return_value = dict(
-            router_type="simplepush",
-            router_data=dict(),
-        )
+        self.router_mock.get_uaid_and_channel.return_value = (
+            dict(router_type="simplepush", router_data=dict()), set())
         self.sp_router_mock.route_notification.return_value = RouterResponse(
             status_code=503,
             router_data=dict(token="new_connect"),
@@ -583,10 +820,8 @@ class EndpointTestCase(unittest.TestCase):
         self.request_mock.headers["crypto-key"] = "crypKey"
         self.request_mock.body = b' '
         self.fernet_mock.decrypt.return_value = "123:456"
-        self.router_mock.get_uaid.return_value = dict(
-            router_type="webpush",
-            router_data=dict(),
-        )
+        self.router_mock.get_uaid_and_channel.return_value = (
+            dict(router_type="webpush", router_data=dict()), set())
         self.wp_router_mock.route_notification.return_value = RouterResponse(
             status_code=200,
             router_data={},
@@ -605,10 +840,8 @@ class EndpointTestCase(unittest.TestCase):
         self.endpoint.set_header = Mock()
         self.request_mock.headers["encryption"] = "stuff"
         self.request_mock.headers["content-encoding"] = "aes128"
-        self.router_mock.get_uaid.return_value = dict(
-            router_type="webpush",
-            router_data=dict(),
-        )
+        self.router_mock.get_uaid_and_channel.return_value = (
+            dict(router_type="webpush", router_data=dict()), set())
         self.wp_router_mock.route_notification.return_value = RouterResponse(
             status_code=201,
             headers={"Location": "Somewhere"}
@@ -624,6 +857,29 @@ class EndpointTestCase(unittest.TestCase):
         self.endpoint.post(dummy_uaid)
         return self.finish_deferred
 
+    def test_post_webpush_subscribed(self):
+        self.fernet_mock.decrypt.return_value = "123:456"
+        self.endpoint.set_header = Mock()
+        self.request_mock.headers["encryption"] = "stuff"
+        self.request_mock.headers["content-encoding"] = "aes128"
+        self.router_mock.get_uaid_and_channel.return_value = (
+            dict(router_type="webpush", router_data=dict()),
+            set(["message_2016_1"]))
+        self.wp_router_mock.route_notification.return_value = RouterResponse(
+            status_code=201)
+
+        def handle_finish(result):
+            self.endpoint.set_status.assert_called_with(201)
+            args, _ = self.router_mock.get_uaid_and_channel.call_args
+            eq_(list(args[2]), self.settings.message_tables.values())
+            notification, _ = \
+                self.wp_router_mock.route_notification.call_args[0]
+            eq_(notification.subscribed, set(["message_2016_1"]))
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.endpoint.post(dummy_uaid)
+        return self.finish_deferred
+
     @patch("twisted.python.log")
     def test_post_db_error_in_routing(self, mock_log):
         from autopush.router.interface import RouterException
@@ -631,10 +887,8 @@ class EndpointTestCase(unittest.TestCase):
         self.endpoint.set_header = Mock()
         self.request_mock.headers["encryption"] = "stuff"
         self.request_mock.headers["content-encoding"] = "aes128"
-        self.router_mock.get_uaid.return_value = dict(
-            router_type="webpush",
-            router_data=dict(),
-        )
+        self.router_mock.get_uaid_and_channel.return_value = (
+            dict(router_type="webpush", router_data=dict()), set())
 
         def raise_error(*args):
             raise RouterException(
@@ -656,7 +910,8 @@ class EndpointTestCase(unittest.TestCase):
 
     def test_put_db_error(self):
         self.fernet_mock.decrypt.return_value = "123:456"
-        self.router_mock.get_uaid.side_effect = self._throw_provisioned_error
+        self.router_mock.get_uaid_and_channel.side_effect = \
+            self._throw_provisioned_error
 
         def handle_finish(result):
             self.assertTrue(result)
@@ -752,6 +1007,399 @@ class EndpointTestCase(unittest.TestCase):
         self.status_mock.assert_called_with(500)
 
 
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        twisted.internet.base.DelayedCall.debug = True
+        settings = self.settings = AutopushSettings(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        self.metrics_mock = settings.metrics = Mock(spec=Metrics)
+        self.router_mock = settings.router = Mock(spec=Router)
+        self.storage_mock = settings.storage = Mock(spec=Storage)
+        self.sp_router_mock = settings.routers["simplepush"] = \
+            Mock(spec=IRouter)
+        self.wp_router_mock = settings.routers["webpush"] = Mock(spec=IRouter)
+
+        self.request_mock = Mock(body=b'', arguments={}, headers={})
+        self.batch = endpoint.BatchHandler(Application(),
+                                           self.request_mock,
+                                           ap_settings=settings)
+        self.status_mock = self.batch.set_status = Mock()
+        self.write_mock = self.batch.write = Mock()
+
+        d = self.finish_deferred = Deferred()
+        self.batch.finish = lambda: d.callback(True)
+
+    def _token(self, uaid, chid="456"):
+        return self.settings.endpoint_tokens.encode("%s:%s" % (uaid, chid))
+
+    def _post(self, *messages):
+        self.request_mock.body = json.dumps(dict(messages=messages))
+        self.batch.post()
+        return self.finish_deferred
+
+    def _results(self):
+        return json.loads(self.write_mock.call_args[0][0])["results"]
+
+    def test_malformed(self):
+        self.batch.finish = Mock()
+        for body in ["{", "[]", '{"messages": [{}]}',
+                     '{"messages": [{"token": "a", "headers": []}]}']:
+            self.request_mock.body = body
+            self.batch.post()
+            self.status_mock.assert_called_with(400)
+            eq_(json.loads(self.write_mock.call_args[0][0])["errno"], 111)
+
+    def test_too_many(self):
+        self.settings.max_batch = 1
+        self.request_mock.body = json.dumps(dict(messages=[
+            dict(token="a"), dict(token="b")]))
+        self.batch.post()
+        self.status_mock.assert_called_with(413)
+        eq_(json.loads(self.write_mock.call_args[0][0])["errno"], 113)
+
+    def test_throttled(self):
+        self.settings.sender_limiter = RateLimiter(rate=2)
+        self.settings.sender_limiter.throttle(self.request_mock.remote_ip)
+        self.request_mock.body = json.dumps(dict(messages=[
+            dict(token="a"), dict(token="b")]))
+        self.batch.post()
+        self.status_mock.assert_called_with(429)
+        self.metrics_mock.increment.assert_any_call(
+            "updates.throttled.sender", count=2)
+
+    def test_over_sender_limit(self):
+        self.settings.sender_limiter = RateLimiter(rate=1)
+        self.request_mock.body = json.dumps(dict(messages=[
+            dict(token="a"), dict(token="b")]))
+        self.batch.post()
+        self.status_mock.assert_called_with(413)
+        eq_(json.loads(self.write_mock.call_args[0][0])["errno"], 113)
+
+    def test_uaid_throttled(self):
+        self.settings.uaid_limiter = RateLimiter(rate=1)
+        self.settings.uaid_limiter.throttle("a")
+        self.router_mock.get_uaids.return_value = dict(b=dict(uaid="b"))
+        self.sp_router_mock.route_notification.return_value = \
+            RouterResponse(status_code=200)
+
+        def handle_finish(result):
+            eq_(self._results(), [
+                dict(code=429, errno=112, error="Too Many Requests",
+                     message="Rate limit exceeded"),
+                dict(code=200),
+            ])
+            self.router_mock.get_uaids.assert_called_with(["b"])
+            self.metrics_mock.increment.assert_any_call(
+                "updates.throttled.uaid")
+        self.finish_deferred.addCallback(handle_finish)
+
+        return self._post(dict(token=self._token("a")),
+                          dict(token=self._token("b")))
+
+    def test_batch(self):
+        self.router_mock.get_uaids.return_value = {
+            "a": dict(uaid="a", node_id="http://node"),
+            "b": dict(uaid="b", router_type="webpush", node_id="http://node"),
+        }
+        self.sp_router_mock.route_notification.return_value = \
+            RouterResponse(status_code=200)
+        self.wp_router_mock.route_notification.return_value = \
+            RouterResponse(status_code=201, headers={"Location": "loc"})
+
+        def handle_finish(result):
+            eq_(self._results(), [
+                dict(code=200),
+                dict(code=201, headers={"Location": "loc"}),
+                dict(code=404, errno=102, error="Not Found"),
+                dict(code=404, errno=103, error="Not Found"),
+            ])
+            args, _ = self.router_mock.get_uaids.call_args
+            eq_(sorted(args[0]), ["a", "b", "c"])
+            notif = self.sp_router_mock.route_notification.call_args[0][0]
+            eq_((notif.version, notif.data, notif.ttl), (12, "hi", None))
+            notif = self.wp_router_mock.route_notification.call_args[0][0]
+            eq_((notif.channel_id, notif.data, notif.ttl), ("456", "aGk=", 60))
+            self.metrics_mock.increment.assert_any_call(
+                "updates.batch.messages", count=4)
+        self.finish_deferred.addCallback(handle_finish)
+
+        return self._post(
+            dict(token=self._token("a"), version=12, data="hi"),
+            dict(token=self._token("b"), ttl=60, data="aGk",
+                 headers={"content-encoding": "aesgcm128",
+                          "encryption": "salt=x",
+                          "encryption-key": "dh=y"}),
+            dict(token="invalid"),
+            dict(token=self._token("c")),
+        )
+
+    def test_router_cache(self):
+        cache = self.settings.router_cache = RouterCache(Mock(), size=10)
+        cache.put("a", dict(uaid="a"))
+        self.router_mock.get_uaids.return_value = dict(b=dict(uaid="b"))
+        self.sp_router_mock.route_notification.return_value = \
+            RouterResponse(status_code=200)
+
+        def handle_finish(result):
+            self.router_mock.get_uaids.assert_called_with(["b"])
+            eq_(cache.get("b"), dict(uaid="b"))
+            eq_([r["code"] for r in self._results()], [200, 200])
+        self.finish_deferred.addCallback(handle_finish)
+
+        return self._post(dict(token=self._token("a")),
+                          dict(token=self._token("b")))
+
+    def test_item_errors(self):
+        self.router_mock.get_uaids.return_value = {
+            "a": dict(uaid="a", router_type="webpush"),
+            "b": dict(uaid="b", router_type="webpush"),
+            "c": dict(uaid="c", router_type="unknown"),
+            "d": dict(uaid="d", router_type="webpush"),
+            "e": dict(uaid="e"),
+        }
+        self.settings.max_data = 2
+        self.wp_router_mock.route_notification.side_effect = \
+            RouterException("Gone", status_code=410, errno=106,
+                            response_body="Gone", log_exception=False)
+        self.sp_router_mock.route_notification.side_effect = Exception
+
+        def handle_finish(result):
+            eq_([(r["code"], r["errno"]) for r in self._results()],
+                [(400, 101), (410, 106), (400, 108), (413, 104), (500, 999)])
+            eq_(len(self.flushLoggedErrors()), 1)
+        self.finish_deferred.addCallback(handle_finish)
+
+        crypto = {"content-encoding": "aesgcm128", "encryption": "salt=x",
+                  "encryption-key": "dh=y"}
+        return self._post(
+            dict(token=self._token("a"), data="aGk"),
+            dict(token=self._token("b")),
+            dict(token=self._token("c")),
+            dict(token=self._token("d"), data="aGlp", headers=crypto),
+            dict(token=self._token("e")),
+        )
+
+    def test_router_data_update(self):
+        self.router_mock.get_uaids.return_value = {
+            "a": dict(uaid="a", router_type="simplepush",
+                      router_data=dict())}
+        self.sp_router_mock.route_notification.return_value = \
+            RouterResponse(status_code=503,
+                           router_data=dict(token="new_connect"))
+
+        def handle_finish(result):
+            eq_(self._results()[0]["code"], 503)
+            args, _ = self.router_mock.register_user.call_args
+            eq_(args[0]["router_data"], dict(token="new_connect"))
+        self.finish_deferred.addCallback(handle_finish)
+
+        return self._post(dict(token=self._token("a")))
+
+    def test_provisioned_error(self):
+        def throw(uaids):
+            raise ProvisionedThroughputExceededException(None, None)
+        self.router_mock.get_uaids.side_effect = throw
+
+        def handle_finish(result):
+            self.status_mock.assert_called_with(503)
+        self.finish_deferred.addCallback(handle_finish)
+
+        return self._post(dict(token=self._token("a")))
+
+
+class TopicTestCase(unittest.TestCase):
+    def setUp(self):
+        twisted.internet.base.DelayedCall.debug = True
+        settings = self.settings = AutopushSettings(
+            hostname="localhost",
+            statsd_host=None,
+            auth_key=["topic_key"],
+        )
+        self.metrics_mock = settings.metrics = Mock(spec=Metrics)
+        self.router_mock = settings.router = Mock(spec=Router)
+        self.topic_mock = settings.topic = Mock(spec=Topic)
+        self.wp_router_mock = settings.routers["webpush"] = Mock(spec=IRouter)
+        self.name = uuid.uuid4().hex
+
+        self.request_mock = Mock(body=b'', arguments={}, headers={
+            "authorization": "Bearer %s" % generate_hash("topic_key",
+                                                         self.name)})
+        self.handler = endpoint.TopicHandler(Application(),
+                                             self.request_mock,
+                                             ap_settings=settings)
+        self.status_mock = self.handler.set_status = Mock()
+        self.write_mock = self.handler.write = Mock()
+        self.handler.flush = Mock()
+
+        d = self.finish_deferred = Deferred()
+        self.handler.finish = lambda: d.callback(True)
+
+    def _token(self, uaid, chid="456"):
+        return self.settings.endpoint_tokens.encode("%s:%s" % (uaid, chid))
+
+    def _lines(self):
+        return [json.loads(args[0]) for args, _ in
+                self.write_mock.call_args_list]
+
+    def test_create(self):
+        def handle_finish(result):
+            msg = json.loads(self.write_mock.call_args[0][0])
+            eq_(msg["secret"], generate_hash("topic_key", msg["topic"]))
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.handler.post(None)
+        return self.finish_deferred
+
+    def test_unauthorized(self):
+        self.handler.finish = Mock()
+        self.request_mock.headers["authorization"] = "Bearer invalid"
+        for method in (self.handler.post, self.handler.put,
+                       self.handler.delete):
+            method(self.name)
+            self.status_mock.assert_called_with(401)
+
+    def test_update(self):
+        self.request_mock.body = json.dumps(dict(
+            add=[self._token("a"), "invalid"], remove=["old"]))
+
+        def handle_finish(result):
+            eq_(self._lines(), [dict(invalid=["invalid"])])
+            self.topic_mock.add_subscriptions.assert_called_with(
+                self.name, {self._token("a"): ("a", "456")})
+            self.topic_mock.remove_subscriptions.assert_called_with(
+                self.name, ["old"])
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.handler.put(self.name)
+        return self.finish_deferred
+
+    def test_update_malformed(self):
+        self.handler.finish = Mock()
+        for body in ["{", "[]", '{"add": "token"}', '{"remove": [1]}']:
+            self.request_mock.body = body
+            self.handler.put(self.name)
+            self.status_mock.assert_called_with(400)
+
+    def test_update_too_many(self):
+        self.handler.finish = Mock()
+        self.settings.max_batch = 1
+        self.request_mock.body = json.dumps(dict(add=["a"], remove=["b"]))
+        self.handler.put(self.name)
+        self.status_mock.assert_called_with(413)
+        eq_(json.loads(self.write_mock.call_args[0][0])["errno"], 113)
+        eq_(self.topic_mock.add_subscriptions.called, False)
+
+    def test_delete(self):
+        self.topic_mock.delete_topic.return_value = True
+
+        def handle_finish(result):
+            self.topic_mock.delete_topic.assert_called_with(self.name)
+            self.write_mock.assert_called_with({})
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.handler.delete(self.name)
+        return self.finish_deferred
+
+    def test_publish(self):
+        self.settings.topic_chunk_size = 2
+        self.topic_mock.fetch_subscriptions.return_value = iter([
+            [dict(token="ta", uaid="a", chid="1"),
+             dict(token="tb", uaid="b", chid="2")],
+            [dict(token="tc", uaid="c", chid="3")],
+        ])
+        self.router_mock.get_uaids.side_effect = lambda uaids: dict(
+            (uaid, dict(uaid=uaid, router_type="webpush"))
+            for uaid in uaids if uaid != "c")
+
+        def route(notification, uaid_data):
+            if uaid_data["uaid"] == "a":
+                return RouterResponse(status_code=201)
+            raise RouterException("Gone", status_code=410, errno=106,
+                                  response_body="Gone", log_exception=False)
+        self.wp_router_mock.route_notification.side_effect = route
+        self.request_mock.body = b"hi"
+        self.request_mock.headers.update({
+            "content-encoding": "aesgcm128", "encryption": "salt=x",
+            "encryption-key": "dh=y", "ttl": "60"})
+
+        def handle_finish(result):
+            self.topic_mock.fetch_subscriptions.assert_called_with(
+                self.name, 2)
+            eq_(self._lines(), [
+                dict(recipients=2, sent=1, failed=[
+                    dict(token="tb", code=410, errno=106, error="",
+                         message="Gone")]),
+                dict(recipients=1, sent=0, failed=[
+                    dict(token="tc", code=404, errno=103,
+                         error="Not Found")]),
+                dict(recipients=3, sent=1, failed=2, done=True),
+            ])
+            eq_(self.handler.flush.call_count, 3)
+            calls = self.wp_router_mock.route_notification.call_args_list
+            notifs = [args[0] for args, _ in calls]
+            eq_(sorted(n.channel_id for n in notifs), ["1", "2"])
+            eq_(set((n.data, n.ttl) for n in notifs), set([("aGk=", 60)]))
+            ok_(notifs[0].data is notifs[1].data)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.handler.post(self.name)
+        return self.finish_deferred
+
+    def test_publish_missing_crypto_headers(self):
+        self.topic_mock.fetch_subscriptions.return_value = iter([
+            [dict(token="ta", uaid="a", chid="1")]])
+        self.router_mock.get_uaids.return_value = dict(
+            a=dict(uaid="a", router_type="webpush"))
+        self.request_mock.body = b"hi"
+
+        def handle_finish(result):
+            eq_(self._lines()[0]["failed"][0]["errno"], 101)
+            eq_(self.wp_router_mock.route_notification.called, False)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.handler.post(self.name)
+        return self.finish_deferred
+
+    def test_publish_too_large(self):
+        self.handler.finish = Mock()
+        self.settings.max_data = 1
+        self.request_mock.body = b"hi"
+        self.handler.post(self.name)
+        self.status_mock.assert_called_with(413)
+
+    def test_publish_provisioned_error(self):
+        def throw(topic, chunk_size):
+            raise ProvisionedThroughputExceededException(None, None)
+            yield
+        self.topic_mock.fetch_subscriptions.side_effect = throw
+
+        def handle_finish(result):
+            self.status_mock.assert_called_with(503)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.handler.post(self.name)
+        return self.finish_deferred
+
+    def test_publish_stream_error(self):
+        def chunks(topic, chunk_size):
+            yield [dict(token="ta", uaid="a", chid="1")]
+            self.handler._headers_written = True
+            raise Exception("Oops")
+        self.topic_mock.fetch_subscriptions.side_effect = chunks
+        self.router_mock.get_uaids.return_value = {}
+
+        def handle_finish(result):
+            eq_(self._lines()[-1], dict(code=500, errno=999,
+                                        error="Internal Server Error"))
+            eq_(len(self.flushLoggedErrors()), 1)
+        self.finish_deferred.addCallback(handle_finish)
+
+        self.handler.post(self.name)
+        return self.finish_deferred
+
+
 dummy_uaid = "00000000123412341234567812345678"
 dummy_chid = "11111111123412341234567812345678"
 CORS_HEAD = "POST,PUT,DELETE"
@@ -0,0 +1,119 @@
+import threading
+
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from mock import ANY, Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.db import Storage, defer_db
+from autopush.executors import (
+    Executor,
+    ExecutorRejected,
+    Executors,
+    db_executor,
+)
+
+
+class ExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.executor = Executor("bridges", self.metrics, size=1,
+                                 max_queue=1)
+        self.addCleanup(self.executor.stop)
+
+    def _block(self):
+        """Hold the only thread until the returned event is set"""
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocked():
+            started.set()
+            release.wait()
+        d = self.executor.run(blocked)
+        started.wait()
+        return d, release
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, Executor, "bridges", self.metrics,
+                          policy="drop")
+
+    def test_run(self):
+        d = self.executor.run(threading.current_thread)
+
+        def check(thread):
+            ok_(thread.name.startswith("bridges"))
+            self.metrics.timing.assert_any_call("executor.bridges.wait",
+                                                duration=ANY)
+            self.metrics.timing.assert_called_with("executor.bridges.exec",
+                                                   duration=ANY)
+        d.addCallback(check)
+        return d
+
+    def test_run_failed(self):
+        d = self.executor.run(int, "abc")
+        self.assertFailure(d, ValueError)
+        d.addCallback(lambda x: self.metrics.timing.assert_called_with(
+            "executor.bridges.exec", duration=ANY))
+        return d
+
+    def test_rejected(self):
+        running, release = self._block()
+        waiting = self.executor.run(lambda: "waited")
+        eq_(self.executor.queued, 1)
+        d = self.executor.run(lambda: "rejected")
+        self.assertFailure(d, ExecutorRejected)
+        d.addCallback(lambda exc: ok_(isinstance(
+            exc, ProvisionedThroughputExceededException)))
+        self.metrics.increment.assert_called_with("executor.bridges.rejected")
+        release.set()
+        waiting.addCallback(eq_, "waited")
+        return running.addCallback(lambda x: waiting)
+
+    @patch("autopush.executors.deferToThread", return_value=succeed("shared"))
+    def test_shared(self, mock_defer):
+        self.executor.policy = "shared"
+        running, release = self._block()
+        waiting = self.executor.run(lambda: "waited")
+        d = self.executor.run(len, "abc")
+        d.addCallback(eq_, "shared")
+        mock_defer.assert_called_with(len, "abc")
+        self.metrics.increment.assert_called_with("executor.bridges.overflow")
+        release.set()
+        return running.addCallback(lambda x: waiting)
+
+
+class ExecutorsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.executors = Executors(self.metrics, dict(
+            admin=dict(size=1, max_queue=5, policy="shared")))
+        self.executors.clock = Clock()
+        self.addCleanup(self.executors.stop)
+
+    def test_conf(self):
+        admin = self.executors["admin"]
+        eq_((admin.size, admin.max_queue, admin.policy), (1, 5, "shared"))
+        eq_(self.executors["db-read"].size, 20)
+        self.assertRaises(ValueError, Executors, self.metrics,
+                          dict(s3=dict(size=1)))
+
+    def test_report(self):
+        self.executors.start(10)
+        self.metrics.gauge.assert_any_call("executor.admin.queued", 0)
+        self.metrics.gauge.assert_any_call("executor.db-write.busy", 0)
+
+    def test_db_executor(self):
+        eq_(db_executor("get_uaid"), "db-read")
+        eq_(db_executor("fetch_messages"), "db-read")
+        eq_(db_executor("register_user"), "db-write")
+
+    def test_defer_db(self):
+        storage = Storage(Mock(), self.metrics, executors=self.executors)
+        self.executors.run = Mock(return_value=succeed([]))
+        d = defer_db(storage.fetch_notifications, "abc")
+        d.addCallback(eq_, [])
+        self.executors.run.assert_called_with(
+            "db-read", storage.fetch_notifications, "abc")
+        return d
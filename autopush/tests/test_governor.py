@@ -0,0 +1,117 @@
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from mock import Mock
+from nose.tools import eq_
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.db import Storage, defer_db
+from autopush.governor import CapacityGovernor, CapacityShed
+
+
+def throttled():
+    return fail(ProvisionedThroughputExceededException(400, "Bad Request"))
+
+
+class CapacityGovernorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.governor = CapacityGovernor(self.metrics, rate=1, max_queue=2)
+        self.governor.clock = self.clock = Clock()
+
+    def _limit(self, operation):
+        return self.governor.limits[("storage", operation)]
+
+    def test_paced(self):
+        results = []
+        for i in range(3):
+            d = self.governor.call("storage", "save_notification",
+                                   lambda i=i: succeed(i))
+            d.addCallback(results.append)
+        eq_(results, [0])
+        self.clock.advance(0.1)
+        eq_(results, [0])
+        self.clock.advance(1)
+        eq_(results, [0, 1, 2])
+
+        # The rate held the calls back, so it grew
+        eq_(self._limit("save_notification").rate > 1, True)
+
+    def test_priorities(self):
+        order = []
+        for operation in ("fetch_notifications", "fetch_notifications",
+                          "register_user", "register_user"):
+            self.governor.call("storage", operation,
+                               lambda op=operation: succeed(order.append(op)))
+        eq_(order, ["fetch_notifications", "register_user"])
+        self.clock.advance(1)
+        eq_(order, ["fetch_notifications", "register_user", "register_user",
+                    "fetch_notifications"])
+
+    def test_shed(self):
+        def call():
+            return succeed(None)
+
+        waiting = [self.governor.call("storage", "fetch_notifications", call)
+                   for _ in range(3)]
+        eq_(len(self.governor.queues["storage"]), 2)
+
+        # The queue is full, a call of the same priority is shed
+        d = self.governor.call("storage", "fetch_notifications", call)
+        self.assertFailure(d, CapacityShed)
+        self.metrics.increment.assert_called_with(
+            "governor.shed.fetch_notifications")
+
+        # A higher priority call sheds the lowest priority waiting one
+        self.governor.call("storage", "save_notification", call)
+        self.governor.call("storage", "save_notification", call)
+        self.assertFailure(waiting[2], CapacityShed)
+        eq_([entry[2].operation for entry in sorted(
+            self.governor.queues["storage"])],
+            ["save_notification", "fetch_notifications"])
+        eq_(self._limit("fetch_notifications").waiting, 1)
+        self.clock.advance(1)
+        eq_(self.governor.queues["storage"], [])
+        return d
+
+    def test_throttled(self):
+        d = self.governor.call("storage", "delete_notification", throttled)
+        self.assertFailure(d, ProvisionedThroughputExceededException)
+        limit = self._limit("delete_notification")
+        eq_(limit.rate, 1)
+        self.metrics.increment.assert_called_with(
+            "governor.decrease.delete_notification")
+
+        # Decreased at most once a second, never below the minimum
+        self.clock.advance(1)
+        self.governor.call("storage", "delete_notification",
+                           throttled).addErrback(lambda fail: None)
+        self.clock.advance(1)
+        self.governor.call("storage", "delete_notification",
+                           throttled).addErrback(lambda fail: None)
+        eq_(limit.rate, 1)
+        return d
+
+    def test_report(self):
+        for _ in range(2):
+            self.governor.call("storage", "fetch_notifications",
+                               lambda: succeed(None))
+        self.clock.advance(1)
+        self.governor.start(10)
+        self.metrics.gauge.assert_any_call(
+            "governor.rate.storage.fetch_notifications",
+            self._limit("fetch_notifications").rate)
+        self.metrics.gauge.assert_any_call("governor.queued.storage", 0)
+        self.governor.stop()
+
+    def test_defer_db(self):
+        table = Mock(table_name="storage")
+        storage = Storage(table, self.metrics, governor=self.governor)
+        storage.nonblocking = Mock()
+        storage.nonblocking.fetch_notifications.return_value = succeed([])
+        d = defer_db(storage.fetch_notifications, "abc")
+        d.addCallback(eq_, [])
+        eq_(self._limit("fetch_notifications").operation,
+            "fetch_notifications")
+        storage.nonblocking.fetch_notifications.assert_called_with("abc")
+        return d
@@ -0,0 +1,195 @@
+import json
+import struct
+
+from mock import Mock, patch
+from nose.tools import eq_
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from autopush.link import (
+    LinkClientFactory,
+    LinkNodeClient,
+    LinkRequestLost,
+    LinkServerFactory,
+)
+
+
+node_id = "http://node:8081"
+
+
+def frame(**kwargs):
+    data = json.dumps(kwargs)
+    return struct.pack("!I", len(data)) + data
+
+
+def sent_frames(transport):
+    data = transport.value()
+    transport.clear()
+    frames = []
+    while data:
+        length, = struct.unpack("!I", data[:4])
+        frames.append(json.loads(data[4:4 + length]))
+        data = data[4 + length:]
+    return frames
+
+
+class LinkServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.settings = Mock()
+        self.factory = LinkServerFactory(self.settings, window=2)
+        self.proto = self.factory.buildProtocol(None)
+        self.proto.callLater = self.clock.callLater
+        self.transport = StringTransport()
+        self.transport.abortConnection = Mock()
+        self.proto.makeConnection(self.transport)
+
+    def test_hello(self):
+        self.proto.dataReceived(frame(t="hello", heartbeat=5))
+        eq_(sent_frames(self.transport), [dict(t="hello", window=2)])
+        self.clock.advance(14)
+        eq_(self.transport.abortConnection.called, False)
+        self.clock.advance(1)
+        eq_(self.transport.abortConnection.called, True)
+
+    def test_no_hello(self):
+        self.clock.advance(10)
+        eq_(self.transport.abortConnection.called, True)
+
+    def test_ping(self):
+        self.proto.dataReceived(frame(t="ping"))
+        eq_(sent_frames(self.transport), [dict(t="pong")])
+
+    @patch("autopush.link.deliver_notification", return_value=(200, ""))
+    def test_push(self, deliver_mock):
+        self.proto.dataReceived(frame(t="push", id=3, uaid="abc",
+                                      update=dict(version=1)))
+        deliver_mock.assert_called_with(self.settings, "abc",
+                                        dict(version=1))
+        eq_(sent_frames(self.transport), [dict(t="result", id=3, code=200)])
+
+    @patch("autopush.link.check_notifications",
+           return_value=(202, "Notification check started"))
+    def test_notif(self, check_mock):
+        self.proto.dataReceived(frame(t="notif", id=4, uaid="abc"))
+        check_mock.assert_called_with(self.settings, "abc")
+        eq_(sent_frames(self.transport), [dict(t="result", id=4, code=202)])
+
+    def test_invalid_frame(self):
+        self.proto.dataReceived(frame(t="nope"))
+        eq_(self.transport.disconnecting, True)
+        self.flushLoggedErrors()
+
+
+class LinkNodeClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        reactor_patcher = patch("autopush.link.reactor")
+        self.reactor_mock = reactor_patcher.start()
+        self.addCleanup(reactor_patcher.stop)
+        self.settings = Mock()
+        self.request_mock = self.settings.agent.request
+        self.request_mock.return_value = succeed(Mock(code=200))
+        ignore_patcher = patch("autopush.nodes.IgnoreBody.ignore",
+                               side_effect=succeed)
+        ignore_patcher.start()
+        self.addCleanup(ignore_patcher.stop)
+        self.client = LinkNodeClient(self.settings, 8083, heartbeat=5)
+
+    def _connect(self, window=2):
+        factory = LinkClientFactory(self.client, node_id)
+        proto = factory.buildProtocol(None)
+        proto.clock = self.clock
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        eq_(sent_frames(transport), [dict(t="hello", heartbeat=5)])
+        proto.dataReceived(frame(t="hello", window=window))
+        return proto, transport
+
+    def _codes(self, deferreds):
+        codes = []
+        for d in deferreds:
+            d.addCallback(lambda response: codes.append(response.code))
+        return codes
+
+    def test_http_until_linked(self):
+        codes = self._codes([self.client.push(node_id, "a", {})])
+        eq_(codes, [200])
+        args, kwargs = self.request_mock.call_args
+        eq_(args, ("PUT", node_id + "/push/a"))
+        args, kwargs = self.reactor_mock.connectTCP.call_args
+        eq_(args[:2], ("node", 8083))
+
+        # Only one link is connected at once
+        self.client.notify(node_id, "b")
+        eq_(self.reactor_mock.connectTCP.call_count, 1)
+
+    def test_https_node(self):
+        self.client.push("https://node:8081", "a", {})
+        args, kwargs = self.reactor_mock.connectSSL.call_args
+        eq_(args[:2], ("node", 8083))
+
+    def test_linked(self):
+        proto, transport = self._connect()
+        deferreds = [self.client.push(node_id, "a", dict(version=1)),
+                     self.client.notify(node_id, "b")]
+        codes = self._codes(deferreds)
+        eq_(sent_frames(transport), [
+            dict(t="push", id=1, uaid="a", update=dict(version=1)),
+            dict(t="notif", id=2, uaid="b"),
+        ])
+        proto.dataReceived(frame(t="result", id=2, code=202) +
+                           frame(t="result", id=1, code=200))
+        eq_(codes, [202, 200])
+        eq_(self.request_mock.called, False)
+
+    def test_window(self):
+        proto, transport = self._connect(window=1)
+        codes = self._codes([self.client.push(node_id, "a", {}),
+                             self.client.push(node_id, "b", {})])
+        eq_([f["uaid"] for f in sent_frames(transport)], ["a"])
+        proto.dataReceived(frame(t="result", id=1, code=200))
+        eq_([f["uaid"] for f in sent_frames(transport)], ["b"])
+        proto.dataReceived(frame(t="result", id=2, code=404))
+        eq_(codes, [200, 404])
+
+    def test_heartbeat(self):
+        proto, transport = self._connect()
+        self.clock.advance(5)
+        eq_(sent_frames(transport), [dict(t="ping")])
+        proto.dataReceived(frame(t="pong"))
+        self.clock.advance(5)
+        eq_(sent_frames(transport), [dict(t="ping")])
+        eq_(transport.disconnecting, False)
+
+    def test_dead_link(self):
+        proto, transport = self._connect(window=2)
+        sent = self.client.push(node_id, "a", {})
+        deferreds = [self.client.notify(node_id, "b"),
+                     self.client.push(node_id, "c", {})]
+        codes = self._codes(deferreds)
+        transport.abortConnection = Mock()
+        self.clock.advance(15)
+        eq_(transport.abortConnection.called, True)
+
+        # Notification checks in flight and queued requests are retried
+        # over HTTP, pushes in flight may have been delivered
+        proto.connectionLost(None)
+        eq_(codes, [200, 200])
+        eq_(self.request_mock.call_count, 2)
+        eq_(self.client.links, {})
+
+        # HTTP is used for a while before linking again
+        self.client.push(node_id, "d", {})
+        eq_(self.reactor_mock.connectTCP.called, False)
+        return self.assertFailure(sent, LinkRequestLost)
+
+    def test_connect_failed(self):
+        self.client.push(node_id, "a", {})
+        factory = self.reactor_mock.connectTCP.call_args[0][2]
+        factory.clientConnectionFailed(None, None)
+        eq_(self.client._connecting, set())
+        self.client.push(node_id, "b", {})
+        eq_(self.reactor_mock.connectTCP.call_count, 1)
@@ -1,13 +1,15 @@
 import unittest
 
+from cryptography.fernet import Fernet
 from mock import Mock, patch
 from moto import mock_dynamodb2, mock_s3
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 from twisted.trial import unittest as trialtest
 
 from autopush.main import (
     connection_main,
     endpoint_main,
+    json_arg,
     make_settings,
     skip_request_logging,
 )
@@ -44,6 +46,12 @@ class SettingsTestCase(unittest.TestCase):
         ip = resolve_ip("example.com")
         eq_(ip, "example.com")
 
+    def test_crypto_key_update_clears_token_cache(self):
+        settings = AutopushSettings(statsd_host=None, token_cache_size=10)
+        settings.token_cache.put("token", "uaid:chid")
+        settings.update(crypto_key=Fernet.generate_key())
+        eq_(settings.token_cache.get("token"), None)
+
 
 class SettingsAsyncTestCase(trialtest.TestCase):
     def test_update_rotating_tables(self):
@@ -89,6 +97,18 @@ class SettingsAsyncTestCase(trialtest.TestCase):
         d.addCallback(check_tables)
         return d
 
+    def test_defer_make_endpoint(self):
+        settings = AutopushSettings(statsd_host=None)
+        d = settings.defer_make_endpoint("uaid", "chid")
+
+        def check_endpoint(endpoint):
+            prefix = settings.endpoint_url + "/push/"
+            ok_(endpoint.startswith(prefix))
+            eq_(settings.fernet.decrypt(str(endpoint[len(prefix):])),
+                "uaid:chid")
+        d.addCallback(check_endpoint)
+        return d
+
     def test_update_not_needed(self):
         settings = AutopushSettings(
             hostname="google.com", resolve_hostname=True)
@@ -112,6 +132,8 @@ class ConnectionMainTestCase(unittest.TestCase):
         patchers = [
             "autopush.main.task",
             "autopush.main.reactor",
+            "autopush.executors.LoopingCall",
+            "autopush.retries.LoopingCall",
             "autopush.settings.TwistedMetrics",
         ]
         self.mocks = {}
@@ -136,6 +158,23 @@ class ConnectionMainTestCase(unittest.TestCase):
             "--router_ssl_key=keys/server.key",
         ])
 
+    @patch("autopush.main.MessageReaper")
+    def test_reaper(self, reaper_mock):
+        connection_main(["--reaper_interval=300", "--reaper_segments=2",
+                         "--reaper_shards=2", "--reaper_shard=1"])
+        eq_(reaper_mock.call_args[1]["segments"], 2)
+        eq_(reaper_mock.call_args[1]["shard"], 1)
+        eq_(reaper_mock.call_args[1]["shards"], 2)
+        reaper_mock.return_value.start.assert_called_with(300)
+
+    def test_json_options(self):
+        for option in ("--executors", "--db_deadlines", "--retry_caps"):
+            self.assertRaises(SystemExit, connection_main,
+                              ["%s={invalid" % option])
+
+        eq_(json_arg('{"delete_acked": 2}'), {"delete_acked": 2})
+        eq_(json_arg(""), None)
+
     def test_skip_logging(self):
         # Should skip setting up logging on the handler
         mock_handler = Mock()
@@ -181,12 +220,36 @@ class EndpointMainTestCase(unittest.TestCase):
         senderid_list = '{"12345":{"auth":"abcd"}}'
         s3_bucket = "none"
         senderid_expry = 0
+        crypto_mode = "inline"
+        crypto_workers = None
+        token_version = 0
+        dynamodb_async = False
+        dynamodb_connections = 50
+        write_batch_window = 0
+        write_batch_size = 25
+        message_item_version = 1
+        channel_markers = False
+        eventual_reads = ""
+        governor_rate = 0
+        governor_max_rate = 1000
+        governor_queue = 100
+        db_deadline = 0
+        db_deadlines = None
+        hedge_reads = ""
+        hedge_percentile = 95
+        executors = None
+        retry_budget = 100
+        retry_caps = None
+        retry_attempts = 10
+        retry_overflow = 1000
 
     def setUp(self):
         mock_s3().start()
         patchers = [
             "autopush.main.task",
             "autopush.main.reactor",
+            "autopush.executors.LoopingCall",
+            "autopush.retries.LoopingCall",
             "autopush.settings.TwistedMetrics",
             "autopush.settings.preflight_check",
         ]
@@ -205,6 +268,16 @@ class EndpointMainTestCase(unittest.TestCase):
             "--s3_bucket=none",
         ])
 
+    @patch("cyclone.web.Application")
+    def test_topics(self, app_mock):
+        endpoint_main(["--s3_bucket=none"])
+        routes = [handler[0] for handler in app_mock.call_args[0][0]]
+        eq_([route for route in routes if route.startswith("/topic")], [])
+
+        endpoint_main(["--s3_bucket=none", "--topic_tablename=topic"])
+        routes = [handler[0] for handler in app_mock.call_args[0][0]]
+        ok_(r"/topic(?:/([^\/]+))?" in routes)
+
     def test_ssl(self):
         endpoint_main([
             "--ssl_dh_param=keys/dhparam.pem",
@@ -0,0 +1,129 @@
+import json
+
+from mock import Mock, patch
+from nose.tools import eq_
+from twisted.internet.defer import fail, succeed
+from twisted.internet.error import ConnectError
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.nodes import BatchingNodeClient, NodeClient
+
+
+node_id = "http://node:8081"
+
+
+class NodeClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.settings = Mock()
+        self.client = NodeClient(self.settings)
+
+    @patch("autopush.nodes.IgnoreBody.ignore", side_effect=succeed)
+    def test_push(self, ignore_mock):
+        self.settings.agent.request.return_value = succeed(Mock(code=200))
+        d = self.client.push(node_id, "uaid", dict(version=1))
+
+        def check(response):
+            eq_(response.code, 200)
+            args, kwargs = self.settings.agent.request.call_args
+            eq_(args, ("PUT", node_id + "/push/uaid"))
+        d.addCallback(check)
+        return d
+
+    @patch("autopush.nodes.IgnoreBody.ignore", side_effect=succeed)
+    def test_notify(self, ignore_mock):
+        self.settings.agent.request.return_value = succeed(Mock(code=202))
+        d = self.client.notify(node_id, "uaid")
+
+        def check(response):
+            eq_(response.code, 202)
+            self.settings.agent.request.assert_called_with(
+                "PUT", node_id + "/notif/uaid")
+        d.addCallback(check)
+        return d
+
+
+class BatchingNodeClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = patch("autopush.nodes.reactor", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.settings = Mock()
+        self.request_mock = self.settings.agent.request
+        self.client = BatchingNodeClient(self.settings, window=5, size=3)
+
+    def _hold_two(self):
+        return [self.client.push(node_id, "a", dict(version=1)),
+                self.client.notify(node_id, "b")]
+
+    def _codes(self, deferreds):
+        codes = []
+        for d in deferreds:
+            d.addCallback(lambda response: codes.append(response.code))
+        return codes
+
+    @patch("autopush.nodes.readBody")
+    def test_window(self, read_mock):
+        self.request_mock.return_value = succeed(Mock(code=200))
+        read_mock.return_value = succeed(json.dumps([dict(code=200),
+                                                     dict(code=404)]))
+        codes = self._codes(self._hold_two())
+        eq_(self.request_mock.called, False)
+
+        self.clock.advance(0.005)
+        args, kwargs = self.request_mock.call_args
+        eq_(args, ("POST", node_id + "/batch"))
+        eq_(codes, [200, 404])
+        self.settings.metrics.increment.assert_any_call(
+            "router.node.batched", count=2)
+
+    @patch("autopush.nodes.readBody")
+    def test_size(self, read_mock):
+        self.request_mock.return_value = succeed(Mock(code=200))
+        read_mock.return_value = succeed(json.dumps([dict(code=200)] * 3))
+        deferreds = self._hold_two()
+        deferreds.append(self.client.push(node_id, "c", dict(version=2)))
+        eq_(self._codes(deferreds), [200, 200, 200])
+        eq_(self.request_mock.call_count, 1)
+        eq_(self.clock.getDelayedCalls(), [])
+
+    @patch("autopush.nodes.IgnoreBody.ignore", side_effect=succeed)
+    def test_single_delivery(self, ignore_mock):
+        self.request_mock.return_value = succeed(Mock(code=200))
+        codes = self._codes([self.client.push(node_id, "a", {})])
+        self.clock.advance(0.005)
+        eq_(codes, [200])
+        args, kwargs = self.request_mock.call_args
+        eq_(args, ("PUT", node_id + "/push/a"))
+
+    @patch("autopush.nodes.IgnoreBody.ignore", side_effect=succeed)
+    def test_no_batch_route(self, ignore_mock):
+        self.request_mock.side_effect = [
+            succeed(Mock(code=404)),
+            succeed(Mock(code=200)),
+            succeed(Mock(code=202)),
+        ]
+        codes = self._codes(self._hold_two())
+        self.clock.advance(0.005)
+        eq_(codes, [200, 202])
+        eq_([args[0] for args, _ in self.request_mock.call_args_list],
+            ["POST", "PUT", "PUT"])
+
+    def test_connect_error(self):
+        self.request_mock.return_value = fail(ConnectError())
+        deferreds = self._hold_two()
+        self.clock.advance(0.005)
+        for d in deferreds:
+            self.assertFailure(d, ConnectError)
+        return deferreds[1]
+
+    @patch("autopush.nodes.readBody")
+    def test_wrong_results(self, read_mock):
+        self.request_mock.return_value = succeed(Mock(code=200))
+        read_mock.return_value = succeed(json.dumps([dict(code=200)]))
+        deferreds = self._hold_two()
+        self.clock.advance(0.005)
+        for d in deferreds:
+            self.assertFailure(d, ValueError)
+        return deferreds[0]
@@ -0,0 +1,55 @@
+import unittest
+
+from mock import patch
+from nose.tools import eq_
+
+from autopush.ratelimit import RateLimiter
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_disabled(self):
+        limiter = RateLimiter()
+        eq_(limiter.enabled, False)
+        eq_(limiter.throttle("a", cost=1000), 0)
+
+    @patch("autopush.ratelimit.time.time", return_value=100)
+    def test_throttle(self, time_mock):
+        limiter = RateLimiter(rate=60)
+        eq_(limiter.throttle("a", cost=59), 0)
+        eq_(limiter.throttle("a"), 0)
+        eq_(limiter.throttle("a"), 1)
+        eq_(limiter.throttle("a", cost=3), 3)
+
+        # Other keys have their own bucket
+        eq_(limiter.throttle("b"), 0)
+
+        # Buckets refill over time
+        time_mock.return_value = 102
+        eq_(limiter.throttle("a", cost=2), 0)
+        eq_(limiter.throttle("a"), 1)
+
+        # But never beyond a minute worth
+        time_mock.return_value = 1000
+        eq_(limiter.throttle("a", cost=61), 1)
+
+    def test_limit(self):
+        eq_(RateLimiter().limit("a"), 0)
+        limiter = RateLimiter(rate=60, overrides={"a": 1, "b": 0})
+        eq_(limiter.limit("a"), 1)
+        eq_(limiter.limit("b"), 0)
+        eq_(limiter.limit("c"), 60)
+
+    def test_overrides(self):
+        limiter = RateLimiter(overrides={"a": 1, "b": 0})
+        eq_(limiter.enabled, True)
+        eq_(limiter.throttle("a"), 0)
+        eq_(limiter.throttle("a"), 60)
+        eq_(limiter.throttle("b", cost=1000), 0)
+        eq_(limiter.throttle("c", cost=1000), 0)
+
+    @patch("autopush.ratelimit.time.time", return_value=100)
+    def test_size(self, time_mock):
+        limiter = RateLimiter(rate=1, size=1)
+        eq_(limiter.throttle("a"), 0)
+        eq_(limiter.throttle("b"), 0)
+        eq_(limiter.throttle("a"), 0)
@@ -0,0 +1,92 @@
+from mock import Mock, patch
+from nose.tools import eq_
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.db import Message
+from autopush.reaper import MessageReaper
+
+
+class MessageReaperTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("autopush.reaper.defer_db",
+                        side_effect=lambda func, *args: func(*args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.metrics = Mock()
+        self.message = Mock(spec=Message)
+        self.message.table.table_name = "message_2016_1"
+        self.settings = Mock(metrics=self.metrics,
+                             message_tables={"message_2016_1": self.message})
+        self.reaper = MessageReaper(self.settings, segments=2,
+                                    read_budget=10, write_budget=5)
+        self.reaper.clock = self.clock = Clock()
+
+    def test_reap(self):
+        pages = {
+            0: [succeed(([("a", "chid:1")], "key", 10)),
+                succeed(([("b", "chid:2"), ("c", "chid:3")], None, 5))],
+            1: [succeed(([], None, 2))],
+        }
+        self.message.scan_expired.side_effect = \
+            lambda segment, *args: pages[segment].pop(0)
+        self.message.delete_expired.side_effect = \
+            lambda keys: succeed(len(keys))
+        d = self.reaper.reap()
+
+        # The first page of segment 0 used a second of the read budget
+        eq_(d.called, False)
+        self.clock.advance(1)
+
+        def check(result):
+            eq_(result, (3, 17, 3))
+            start_keys = [args[2] for args, _ in
+                          self.message.scan_expired.call_args_list]
+            eq_(sorted(start_keys), [None, None, "key"])
+            self.metrics.gauge.assert_any_call("reaper.reclaimed", 3)
+            self.metrics.gauge.assert_any_call("reaper.capacity.write", 3)
+        d.addCallback(check)
+        return d
+
+    def test_pace_shares_budget(self):
+        # Pages reserve time one after another at the budgeted rate
+        d1 = self.reaper._pace(10, 0)
+        d2 = self.reaper._pace(0, 10)
+        self.clock.advance(1)
+        eq_(d1.called, True)
+        eq_(d2.called, False)
+        self.clock.advance(2)
+        eq_(d2.called, True)
+
+    def test_shards(self):
+        reaper = MessageReaper(self.settings, segments=5, read_budget=10,
+                               write_budget=5, shard=1, shards=2)
+        eq_(reaper.shard_segments, [1, 3])
+        eq_((reaper.read_budget, reaper.write_budget), (5, 2.5))
+        for shard, shards in [(2, 2), (0, 6), (-1, 2)]:
+            self.assertRaises(ValueError, MessageReaper, self.settings,
+                              segments=5, shard=shard, shards=shards)
+
+    def test_reap_segment_failure(self):
+        self.message.scan_expired.side_effect = \
+            lambda *args: fail(Exception("oops"))
+        d = self.reaper.reap()
+
+        def check(result):
+            eq_(result, (0, 0, 0))
+            eq_(len(self.flushLoggedErrors(Exception)), 2)
+        d.addCallback(check)
+        return d
+
+    def test_start_skips_running_pass(self):
+        self.reaper.reap = Mock(return_value=succeed(None))
+        self.reaper._running = Mock()
+        self.reaper.start(60)
+        eq_(self.reaper.reap.called, False)
+
+        self.reaper._running = None
+        self.clock.advance(60)
+        eq_(self.reaper.reap.call_count, 1)
+        eq_(self.reaper._running, None)
+        self.reaper.stop()
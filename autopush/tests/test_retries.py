@@ -0,0 +1,108 @@
+from mock import Mock, patch
+from nose.tools import eq_
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.retries import RetryScheduler
+
+
+class Calls(object):
+    """Table method stand-in answering with the queued results"""
+    def __init__(self, name, *results):
+        self.__name__ = name
+        self.results = list(results)
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+        result = self.results.pop(0)
+        if isinstance(result, Deferred):
+            return result
+        if isinstance(result, Exception):
+            return fail(result)
+        return succeed(result)
+
+
+class RetrySchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock()
+        self.retries = RetryScheduler(self.metrics, budget=2,
+                                      caps=dict(delete_acked=1), attempts=3,
+                                      base_delay=1, max_delay=3,
+                                      max_overflow=1)
+        self.retries.clock = self.clock = Clock()
+        patcher = patch("autopush.retries.random.uniform",
+                        side_effect=lambda low, high: high)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("autopush.retries.defer_db")
+    def test_retried(self, mock_defer):
+        mock_defer.side_effect = lambda func, *args: func(*args)
+        calls = Calls("delete_notification", ValueError("throttled"),
+                      ValueError("throttled"), True)
+        d = self.retries.retry(calls, "uaid", "chid")
+        eq_(calls.count, 1)
+        eq_(self.retries.pending, 1)
+        self.clock.advance(1)
+        eq_(calls.count, 2)
+        # The delay doubled
+        self.clock.advance(1)
+        eq_(calls.count, 2)
+        self.clock.advance(1)
+        eq_(calls.count, 3)
+        eq_(self.retries.pending, 0)
+        self.metrics.increment.assert_called_with(
+            "retry.scheduled.delete_notification")
+        d.addCallback(eq_, True)
+        return d
+
+    @patch("autopush.retries.defer_db")
+    def test_give_up(self, mock_defer):
+        mock_defer.side_effect = lambda func, *args: func(*args)
+        calls = Calls("delete_notification", *[KeyError("oops")] * 3)
+        d = self.retries.retry(calls)
+        self.clock.advance(1)
+        self.clock.advance(2)
+        eq_(calls.count, 3)
+        self.metrics.increment.assert_called_with(
+            "retry.giveup.delete_notification")
+        eq_(self.retries.pending, 0)
+        eq_(len(self.flushLoggedErrors(KeyError)), 1)
+        return self.assertFailure(d, KeyError)
+
+    @patch("autopush.retries.defer_db")
+    def test_budget(self, mock_defer):
+        mock_defer.side_effect = lambda func, *args: func(*args)
+        slow = Deferred()
+        first = Calls("delete_acked", ValueError("throttled"), slow)
+        second = Calls("delete_acked", ValueError("throttled"), True)
+        third = Calls("delete_acked", ValueError("throttled"))
+        results = []
+        for calls in (first, second, third):
+            self.retries.retry(calls).addBoth(results.append)
+
+        # The cap of delete_acked holds the second retry back, the third
+        # doesn't fit the overflow queue
+        eq_(len(self.retries.overflow), 1)
+        self.metrics.increment.assert_any_call(
+            "retry.overflowed.delete_acked")
+        self.metrics.increment.assert_called_with("retry.giveup.delete_acked")
+        eq_(len(self.flushLoggedErrors(ValueError)), 1)
+        eq_(len(results), 1)
+
+        self.clock.advance(1)
+        eq_(second.count, 1)
+        slow.callback(True)
+        eq_(len(self.retries.overflow), 0)
+        self.clock.advance(1)
+        eq_(second.count, 2)
+        eq_(results[1:], [True, True])
+        eq_(self.retries.pending, 0)
+
+    def test_report(self):
+        self.retries.start(10)
+        self.metrics.gauge.assert_any_call("retry.pending", 0)
+        self.metrics.gauge.assert_any_call("retry.overflow", 0)
+        self.retries.stop()
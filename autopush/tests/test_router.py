@@ -12,6 +12,7 @@ from twisted.internet.error import ConnectError
 import apns
 import gcmclient
 
+from autopush.cache import RouteRecord, RouterCache
 from autopush.db import (
     Router,
     Storage,
@@ -523,6 +524,54 @@ class SimplePushRouterTestCase(unittest.TestCase):
         d.addBoth(verify_deliver)
         return d
 
+    def test_route_to_gone_client_invalidates_cache(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.code = 404
+        self.storage_mock.save_notification.return_value = True
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
+        fresh_data = RouteRecord(("uaid", "node_id", "connected_at"),
+                                 dict(uaid=dummy_uaid, connected_at=10))
+        self.router_mock.get_uaid.return_value = fresh_data
+        cache = self.router.ap_settings.router_cache = RouterCache(
+            Mock(), size=10)
+        cache.put(dummy_uaid, router_data)
+
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            ok_(isinstance(result, RouterResponse))
+            eq_(result.status_code, 202)
+            cache.metrics.increment.assert_any_call("router.cache.invalidate")
+            eq_(cache.get(dummy_uaid), None)
+        d.addBoth(verify_deliver)
+        return d
+
+    def test_route_to_busy_node_refreshes_cached_route(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.code = 202
+        self.storage_mock.save_notification.return_value = True
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
+                           router_data=dict(token="abc"))
+        self.router_mock.get_uaid.return_value = RouteRecord(
+            ("uaid", "node_id", "connected_at"),
+            dict(uaid=dummy_uaid, node_id="http://elsewhere",
+                 connected_at=10))
+        cache = self.router.ap_settings.router_cache = RouterCache(
+            Mock(), size=10)
+        cache.put(dummy_uaid, router_data)
+
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            eq_(result.status_code, 202)
+            self.router_mock.get_uaid.assert_called_with(
+                dummy_uaid, attributes=("node_id", "connected_at"))
+            eq_(cache.get(dummy_uaid),
+                dict(uaid=dummy_uaid, node_id="http://elsewhere",
+                     connected_at=10, router_data=dict(token="abc")))
+        d.addBoth(verify_deliver)
+        return d
+
     def test_route_to_busy_node_saves_looks_up_and_sends_check_202(self):
         self.agent_mock.request.return_value = response_mock = Mock()
         response_mock.code = 202
@@ -661,7 +710,7 @@ class WebPushRouterTestCase(unittest.TestCase):
         type(response_mock).code = PropertyMock(
             side_effect=MockAssist([202, 200]))
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.channel_exists.return_value = True
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            current_month=self.settings.current_msg_month)
         self.router_mock.get_uaid.return_value = router_data
@@ -676,6 +725,31 @@ class WebPushRouterTestCase(unittest.TestCase):
                 "router.broadcast.save_hit"
             )
             ok_("Location" in result.headers)
+            self.router_mock.get_uaid.assert_any_call(
+                dummy_uaid, attributes=("current_month",))
+        d.addCallback(verify_deliver)
+        return d
+
+    def test_route_to_busy_node_batched_write(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.addCallback.return_value = response_mock
+        type(response_mock).code = PropertyMock(
+            side_effect=MockAssist([202, 200]))
+        self.message_mock.channel_exists.return_value = True
+        self.settings.write_batcher = batcher = Mock()
+        batcher.store_message.return_value = True
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
+                           current_month=self.settings.current_msg_month)
+        self.router_mock.get_uaid.return_value = router_data
+
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            eq_(result.status_code, 201)
+            eq_(self.message_mock.store_message.called, False)
+            args, kwargs = batcher.store_message.call_args
+            eq_(args, (self.message_mock,))
+            eq_(kwargs["channel_id"], dummy_chid)
         d.addCallback(verify_deliver)
         return d
 
@@ -686,7 +760,7 @@ class WebPushRouterTestCase(unittest.TestCase):
         type(response_mock).code = PropertyMock(
             side_effect=MockAssist([202, 200]))
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.channel_exists.return_value = True
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            current_month=self.settings.current_msg_month)
         self.router_mock.get_uaid.return_value = router_data
@@ -703,13 +777,50 @@ class WebPushRouterTestCase(unittest.TestCase):
         d.addBoth(verify_deliver)
         return d
 
+    def test_route_subscribed(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.addCallback.return_value = response_mock
+        response_mock.code = 200
+        month = self.settings.current_msg_month
+        notif = self.notif._replace(subscribed=set([month]))
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
+                           current_month=month)
+
+        d = self.router.route_notification(notif, router_data)
+
+        def verify_deliver(result):
+            eq_(result.status_code, 201)
+            eq_(self.router_mock.get_uaid.called, False)
+            eq_(self.message_mock.channel_exists.called, False)
+        d.addCallback(verify_deliver)
+        return d
+
+    def test_route_subscribed_without_marker(self):
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.addCallback.return_value = response_mock
+        response_mock.code = 200
+        self.message_mock.channel_exists.return_value = False
+        notif = self.notif._replace(subscribed=set())
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
+                           current_month=self.settings.current_msg_month)
+
+        d = self.router.route_notification(notif, router_data)
+
+        def verify_deliver(fail):
+            eq_(fail.value.status_code, 404)
+            eq_(self.router_mock.get_uaid.called, False)
+            self.message_mock.channel_exists.assert_called_with(
+                dummy_uaid, dummy_chid)
+        d.addBoth(verify_deliver)
+        return d
+
     def test_route_with_invalid_channel_id(self):
         self.agent_mock.request.return_value = response_mock = Mock()
         response_mock.addCallback.return_value = response_mock
         type(response_mock).code = PropertyMock(
             side_effect=MockAssist([202, 200]))
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [])
+        self.message_mock.channel_exists.return_value = False
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
         self.router_mock.get_uaid.return_value = router_data
         self.router.message_id = uuid.uuid4().hex
@@ -0,0 +1,118 @@
+import base64
+import unittest
+import uuid
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from nose.tools import eq_, ok_
+
+from autopush.tokens import (
+    EndpointTokens,
+    MessageIds,
+    decode_endpoint_token,
+    encode_endpoint_token,
+    is_compact_token,
+)
+
+
+class EndpointTokensTestCase(unittest.TestCase):
+    def setUp(self):
+        self.key = Fernet.generate_key()
+        self.tokens = EndpointTokens([self.key])
+
+    def _check_round_trip(self, data):
+        token = self.tokens.encode(data)
+        ok_(is_compact_token(token))
+        eq_(self.tokens.decode(token), data)
+        return token
+
+    def test_uuids(self):
+        hex_dashed = "%s:%s" % (uuid.uuid4().hex, uuid.uuid4())
+        dashed_hex = "%s:%s" % (uuid.uuid4(), uuid.uuid4().hex)
+        token = self._check_round_trip(hex_dashed)
+        self._check_round_trip(dashed_hex)
+        ok_(len(token) < len(Fernet(self.key).encrypt(hex_dashed)) / 2)
+
+    def test_raw(self):
+        self._check_round_trip("uaid:chid")
+        self._check_round_trip("%s:%s" % (str(uuid.uuid4()).upper(),
+                                          uuid.uuid4()))
+        self._check_round_trip("a:b:c")
+
+    def test_rotated_keys(self):
+        token = self.tokens.encode("uaid:chid")
+        rotated = EndpointTokens([Fernet.generate_key(), self.key])
+        eq_(rotated.decode(token), "uaid:chid")
+        ok_(rotated.encode("uaid:chid")[:7] != token[:7])
+
+    def test_unknown_key(self):
+        token = self.tokens.encode("uaid:chid")
+        other = EndpointTokens([Fernet.generate_key()])
+        self.assertRaises(InvalidToken, other.decode, token)
+
+    def test_tampered(self):
+        raw = bytearray(base64.urlsafe_b64decode(
+            self.tokens.encode("uaid:chid") + "=="))
+        raw[5] ^= 0x01
+        token = base64.urlsafe_b64encode(str(raw)).rstrip("=")
+        self.assertRaises(InvalidToken, self.tokens.decode, token)
+
+    def test_malformed(self):
+        self.assertRaises(InvalidToken, self.tokens.decode, "A")
+        self.assertRaises(InvalidToken, self.tokens.decode, "A!!!")
+        self.assertRaises(InvalidToken, self.tokens.decode, "A" * 50)
+
+
+class MessageIdsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.key = Fernet.generate_key()
+        self.ids = MessageIds([self.key])
+
+    def test_round_trip(self):
+        for data in ["m:%s:%s" % (uuid.uuid4().hex, uuid.uuid4()),
+                     "m:uaid:chid", "m:" + "x" * 100]:
+            message_id = self.ids.encode(data)
+            ok_(is_compact_token(message_id))
+            eq_(self.ids.decode(message_id), data)
+
+    def test_unique(self):
+        ok_(self.ids.encode("m:uaid:chid") != self.ids.encode("m:uaid:chid"))
+
+    def test_wrong_kind(self):
+        self.assertRaises(ValueError, self.ids.encode, "uaid:chid")
+
+    def test_rotated_keys(self):
+        message_id = self.ids.encode("m:uaid:chid")
+        rotated = MessageIds([Fernet.generate_key(), self.key])
+        eq_(rotated.decode(message_id), "m:uaid:chid")
+        other = MessageIds([Fernet.generate_key()])
+        self.assertRaises(InvalidToken, other.decode, message_id)
+
+    def test_tampered(self):
+        raw = bytearray(base64.urlsafe_b64decode(
+            self.ids.encode("m:uaid:chid") + "=="))
+        raw[20] ^= 0x01
+        message_id = base64.urlsafe_b64encode(str(raw)).rstrip("=")
+        self.assertRaises(InvalidToken, self.ids.decode, message_id)
+
+    def test_not_an_endpoint_token(self):
+        token = EndpointTokens([self.key]).encode("uaid:chid")
+        self.assertRaises(InvalidToken, self.ids.decode, token)
+
+
+class EndpointTokenTestCase(unittest.TestCase):
+    def setUp(self):
+        self.key = Fernet.generate_key()
+        self.fernet = MultiFernet([Fernet(self.key)])
+        self.tokens = EndpointTokens([self.key])
+
+    def test_legacy_encode(self):
+        token = encode_endpoint_token(self.tokens, self.fernet, "uaid:chid", 0)
+        ok_(not is_compact_token(token))
+        eq_(self.fernet.decrypt(token), "uaid:chid")
+
+    def test_decode_both(self):
+        for version in (0, 1):
+            token = encode_endpoint_token(self.tokens, self.fernet,
+                                          "uaid:chid", version)
+            eq_(decode_endpoint_token(self.tokens, self.fernet, token),
+                "uaid:chid")
@@ -1,6 +1,8 @@
+import binascii
 import json
 import time
 import uuid
+from collections import defaultdict
 
 import twisted.internet.base
 from boto.dynamodb2.exceptions import (
@@ -16,11 +18,12 @@ from twisted.internet.defer import Deferred
 from twisted.internet.error import ConnectError
 from twisted.trial import unittest
 
-from autopush.db import create_rotating_message_table
+from autopush.db import create_rotating_message_table, make_message_item
 from autopush.settings import AutopushSettings
 from autopush.websocket import (
     PushState,
     PushServerProtocol,
+    BatchRouterHandler,
     RouterHandler,
     Notification,
     NotificationHandler,
@@ -1158,12 +1161,49 @@ class WebsocketTestCase(unittest.TestCase):
 
         mock_defer = Mock()
         self.proto.force_retry = Mock(return_value=mock_defer)
-        self.proto.ack_update(dict(
+        eq_(self.proto.ack_update(dict(
             channelID=chid,
             version="bleh:jialsdjfilasjdf"
-        ))
-        assert self.proto.force_retry.called
-        assert mock_defer.addBoth.called
+        )), True)
+        eq_(self.proto.force_retry.called, False)
+        eq_(self.proto.ps._acks[0][:3], (chid, "bleh", "jialsdjfilasjdf"))
+
+    def test_ack_webpush_batched(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.use_webpush = True
+        chid = str(uuid.uuid4())
+        notifs = [Notification(version=str(i), headers={}, data="meh",
+                               channel_id=chid, ttl=200, timestamp=0)
+                  for i in range(3)]
+        self.proto.ps.direct_updates[chid] = []
+        self.proto.ps.updates_sent[chid] = list(notifs)
+        first, second = Deferred(), Deferred()
+        self.proto.force_retry = Mock(side_effect=[first, second])
+
+        self.proto.process_ack(dict(updates=[
+            dict(channelID=chid, version="0:a"),
+            dict(channelID=chid, version="1:b"),
+        ]))
+        self.proto.process_ack(dict(updates=[
+            dict(channelID=chid, version="2:c"),
+        ]))
+        eq_(self.proto.force_retry.call_count, 1)
+        args = self.proto.force_retry.call_args[0]
+        eq_(args[2], [(chid, "0", "a"), (chid, "1", "b")])
+        self.transport_mock.pauseProducing.assert_called_with()
+
+        # The acks aren't cleared until their delete lands
+        eq_(len(self.proto.ps.updates_sent[chid]), 3)
+        first.callback(True)
+        eq_(self.proto.ps.updates_sent[chid], [notifs[2]])
+        eq_(self.proto.force_retry.call_args[0][2], [(chid, "2", "c")])
+        eq_(self.transport_mock.resumeProducing.called, False)
+
+        second.callback(True)
+        eq_(self.proto.ps.updates_sent[chid], [])
+        eq_(self.proto.ps._ack_delete, None)
+        self.transport_mock.resumeProducing.assert_called_with()
 
     def test_ack_remove(self):
         self._connect()
@@ -1171,7 +1211,8 @@ class WebsocketTestCase(unittest.TestCase):
         notif = Notification(version="bleh", headers={}, data="meh",
                              channel_id=chid, ttl=200, timestamp=0)
         self.proto.ps.updates_sent[chid] = [notif]
-        self.proto._handle_webpush_update_remove(None, chid, notif)
+        self.proto._handle_webpush_update_remove(
+            None, [(chid, "bleh", "abc", notif)])
         eq_(self.proto.ps.updates_sent[chid], [])
 
     def test_ack_remove_not_set(self):
@@ -1180,7 +1221,8 @@ class WebsocketTestCase(unittest.TestCase):
         notif = Notification(version="bleh", headers={}, data="meh",
                              channel_id=chid, ttl=200, timestamp=0)
         self.proto.ps.updates_sent[chid] = None
-        self.proto._handle_webpush_update_remove(None, chid, notif)
+        self.proto._handle_webpush_update_remove(
+            None, [(chid, "bleh", "abc", notif)])
 
     def test_ack_fails_first_time(self):
         self._connect()
@@ -1194,7 +1236,7 @@ class WebsocketTestCase(unittest.TestCase):
                 return self.tries != 0
 
         self.proto.ap_settings.storage = Mock(
-            **{"delete_notification.side_effect": FailFirst()})
+            **{"delete_notifications.side_effect": FailFirst()})
 
         chid = str(uuid.uuid4())
 
@@ -1391,6 +1433,74 @@ class WebsocketTestCase(unittest.TestCase):
         ])
         assert self.send_mock.called
 
+    def _messages(self, chid, *versions):
+        return [dict(chidmessageid="%s:%s" % (chid, version), headers={},
+                     data="bleh", ttl=100, timestamp=int(time.time()),
+                     updateid=uuid.uuid4().hex)
+                for version in versions]
+
+    def test_webpush_pages(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.use_webpush = True
+        self.proto.ps.updates_sent = defaultdict(list)
+        self.proto.ps._message_limit = 2
+        self.proto.ap_settings.message_page_max = 3
+        self.send_mock.reset_mock()
+        fetches = [Deferred(), Deferred(), Deferred()]
+        self.proto.deferToThread = Mock(side_effect=fetches)
+
+        # A full page reads the next one right away with a bigger limit
+        self.proto.finish_webpush_notifications(self._messages("a", 1, 2))
+        eq_(len(self.send_mock.mock_calls), 2)
+        eq_(self.proto.ps._message_cursor, "a:2")
+        eq_(self.proto.ps._prefetch, fetches[0])
+        kwargs = self.proto.deferToThread.call_args[1]
+        eq_(kwargs, dict(limit=3, start="a:2"))
+
+        # Once acked, the page read ahead is used
+        self.proto.ps.updates_sent.clear()
+        self.proto.process_notifications(resume=True)
+        eq_(self.proto.deferToThread.call_count, 1)
+        eq_(self.proto.ps._prefetch, None)
+        fetches[0].callback(self._messages("b", 1, 2, 3))
+        eq_(len(self.send_mock.mock_calls), 5)
+        eq_(self.proto.ps._message_limit, 3)
+        eq_(self.proto.deferToThread.call_args[1],
+            dict(limit=3, start="b:3"))
+
+        # Starting over drops the page read ahead and the cursor
+        self.proto.ps.updates_sent.clear()
+        self.proto.process_notifications()
+        ok_(fetches[1].called)
+        eq_(self.proto.deferToThread.call_args[1],
+            dict(limit=self.proto.ap_settings.message_page_size, start=None))
+
+        # A short page is the last one
+        fetches[2].callback(self._messages("c", 1))
+        eq_(self.proto.ps._more_notifications, False)
+        eq_(self.proto.ps._message_cursor, None)
+        eq_(self.proto.ps._prefetch, None)
+
+    def test_webpush_page_expired(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.use_webpush = True
+        self.proto.ps.updates_sent = defaultdict(list)
+        self.proto.ps._message_limit = 1
+        self.proto.force_retry = Mock()
+        self.proto.process_notifications = Mock()
+        self.proto.deferToThread = Mock(return_value=Deferred())
+        self.proto.ps._more_notifications = True
+
+        notifs = self._messages("a", 1)
+        notifs[0]["timestamp"] = 0
+        self.proto.finish_webpush_notifications(notifs)
+
+        # Nothing was sent to ack, so the next page is read right away
+        ok_(self.proto.force_retry.called)
+        self.proto.process_notifications.assert_called_with(resume=True)
+
     def test_notif_finished_with_webpush_with_old_notifications(self):
         self._connect()
         self.proto.ps.uaid = str(uuid.uuid4())
@@ -1400,13 +1510,36 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto.ps.updates_sent["asdf"] = []
 
         self.proto.force_retry = Mock()
+        updateid = uuid.uuid4().hex
         self.proto.finish_webpush_notifications([
             dict(chidmessageid="asdf:fdsa", headers={}, data="bleh", ttl=10,
-                 timestamp=0, updateid=uuid.uuid4().hex)
+                 timestamp=0, updateid=updateid)
         ])
-        assert self.proto.force_retry.called
+        args = self.proto.force_retry.call_args[0]
+        eq_(args[2], [("asdf", "fdsa", updateid)])
         assert not self.send_mock.called
 
+    def test_notif_finished_with_webpush_item_version_2(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.use_webpush = True
+        self.proto.ps.updates_sent = defaultdict(list)
+        self.proto.process_notifications = Mock()
+        item = make_message_item(self.proto.ps.uaid, "asdf", "fdsa", 60,
+                                 data="aGk=",
+                                 headers={"encoding": "aesgcm",
+                                          "encryption": "salt=abc"},
+                                 version=2)
+        self.proto.finish_webpush_notifications([item])
+
+        msg = json.loads(self.send_mock.call_args[0][0])
+        eq_(msg["channelID"], "asdf")
+        eq_(msg["version"], "fdsa:" + binascii.hexlify(item["u"].value))
+        eq_(msg["data"], "aGk=")
+        eq_(msg["headers"], {"encoding": "aesgcm",
+                             "encryption": "salt=abc"})
+        eq_(self.proto.ps.updates_sent["asdf"][0].ttl, 60)
+
     def test_notification_results(self):
         # Populate the database for ourself
         uaid = str(uuid.uuid4())
@@ -1653,3 +1786,38 @@ class NotificationHandlerTestCase(unittest.TestCase):
         mock_client.sendClose = Mock()
         self.handler.delete(uaid, "", now)
         assert(mock_client.sendClose.called)
+
+
+class BatchRouterHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        twisted.internet.base.DelayedCall.debug = True
+
+        self.ap_settings = AutopushSettings(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        self.ap_settings.metrics = Mock(spec=Metrics)
+        h = BatchRouterHandler
+        h.ap_settings = self.ap_settings
+        self.mock_request = Mock()
+        self.handler = h(Application(), self.mock_request)
+        self.handler.write = self.write_mock = Mock()
+
+    def test_batch(self):
+        free, busy, gone = [str(uuid.uuid4()) for _ in range(3)]
+        self.ap_settings.clients[free] = free_mock = Mock(paused=False)
+        self.ap_settings.clients[busy] = Mock(paused=True)
+        self.mock_request.body = json.dumps([
+            dict(type="push", uaid=free, update=dict(channelID="chid")),
+            dict(type="push", uaid=busy, update={}),
+            dict(type="push", uaid=gone, update={}),
+            dict(type="notif", uaid=free),
+            dict(type="notif", uaid=busy),
+        ])
+        self.handler.post()
+        eq_(json.loads(self.write_mock.call_args[0][0]),
+            [dict(code=200), dict(code=503), dict(code=404),
+             dict(code=200), dict(code=202)])
+        free_mock.send_notifications.assert_called_with(
+            dict(channelID="chid"))
+        ok_(free_mock.process_notifications.called)
@@ -0,0 +1,99 @@
+from mock import Mock, patch
+from nose.tools import eq_
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.db import Message, Storage
+from autopush.writes import WriteBatcher
+
+
+class WriteBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = patch("autopush.writes.reactor", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.metrics = Mock()
+        self.batcher = WriteBatcher(self.metrics, window=5, size=3)
+        self.message = Mock(spec=Message)
+        self.message.item_version = 1
+        self.storage = Mock(spec=Storage)
+
+    def _results(self, deferreds):
+        results = []
+        for d in deferreds:
+            d.addBoth(results.append)
+        return results
+
+    @patch("autopush.writes.defer_db", side_effect=lambda f, *a: f(*a))
+    def test_store_messages_window(self, defer_mock):
+        self.message.store_messages.return_value = succeed(True)
+        results = self._results([
+            self.batcher.store_message(self.message, "a", "chid", "1", 60),
+            self.batcher.store_message(self.message, "b", "chid", "2", 60,
+                                       data="hi", headers={}),
+        ])
+        eq_(self.message.store_messages.called, False)
+
+        self.clock.advance(0.005)
+        eq_(results, [True, True])
+        items = self.message.store_messages.call_args[0][0]
+        eq_([item["chidmessageid"] for item in items],
+            ["chid:1", "chid:2"])
+        eq_(items[1]["data"], "hi")
+        self.metrics.increment.assert_any_call("notification.write.batched",
+                                               count=2)
+
+    @patch("autopush.writes.defer_db", side_effect=lambda f, *a: f(*a))
+    def test_store_messages_item_version(self, defer_mock):
+        self.message.item_version = 2
+        self.message.store_messages.return_value = succeed(True)
+        self.batcher.store_message(self.message, "a", "chid", "1", 60,
+                                   data="aGk=", headers={"encoding": "aesgcm"})
+        self.clock.advance(0.005)
+        item = self.message.store_messages.call_args[0][0][0]
+        eq_(item["v"], 2)
+        eq_(item["d"].value, "hi")
+
+    @patch("autopush.writes.defer_db", side_effect=lambda f, *a: f(*a))
+    def test_store_messages_size(self, defer_mock):
+        self.message.store_messages.return_value = succeed(True)
+        results = self._results([
+            self.batcher.store_message(self.message, "a", "chid", str(i), 60)
+            for i in range(3)])
+        eq_(results, [True, True, True])
+        eq_(self.message.store_messages.call_count, 1)
+
+        # The timer finds nothing left to write
+        self.clock.advance(0.005)
+        eq_(self.message.store_messages.call_count, 1)
+
+    @patch("autopush.writes.defer_db", side_effect=lambda f, *a: f(*a))
+    def test_store_messages_fail(self, defer_mock):
+        self.message.store_messages.return_value = fail(Exception("oops"))
+        deferreds = [
+            self.batcher.store_message(self.message, "a", "chid", "1", 60),
+            self.batcher.store_message(self.message, "a", "chid", "2", 60),
+        ]
+        self.clock.advance(0.005)
+        for d in deferreds:
+            self.assertFailure(d, Exception)
+        return deferreds[1]
+
+    @patch("autopush.writes.defer_db", side_effect=lambda f, *a: f(*a))
+    def test_save_notification_coalesced(self, defer_mock):
+        self.storage.save_notification.return_value = succeed(True)
+        results = self._results([
+            self.batcher.save_notification(self.storage, "a", "chid", 12),
+            self.batcher.save_notification(self.storage, "a", "chid", 14),
+            self.batcher.save_notification(self.storage, "a", "chid", 13),
+            self.batcher.save_notification(self.storage, "b", "chid", 1),
+        ])
+        self.clock.advance(0.005)
+        eq_(results, [True] * 4)
+        calls = sorted(args for args, _ in
+                       self.storage.save_notification.call_args_list)
+        eq_(calls, [("a", "chid", 14), ("b", "chid", 1)])
+        self.metrics.increment.assert_called_with(
+            "notification.write.coalesced")
@@ -0,0 +1,323 @@
+"""Versioned compact endpoint tokens and message ids
+
+Legacy endpoint tokens are Fernet tokens of ``uaid:chid``. They carry a
+timestamp that's never checked, and since they don't say which key made
+them :class:`~cryptography.fernet.MultiFernet` has to try every configured
+key in turn, so after a key rotation most pushes first fail against the new
+key.
+
+Compact tokens are the URL safe base64 (without padding) of::
+
+    version (1) | key id (4) | flags (1) | nonce (12) | ciphertext | tag (16)
+
+The key id selects the key directly and the ``uaid:chid`` is encrypted with
+AES-GCM, with the UUIDs packed as 16 binary bytes each when they're in their
+canonical hex or dashed form. The header bytes are authenticated along with
+the payload.
+
+Compact tokens always start with an ``A`` as their version byte is small,
+anything else is treated as a legacy Fernet token (which start with a ``g``
+for their ``0x80`` version byte).
+
+Message ids use the same layout with an HMAC instead of AES-GCM, see
+:class:`MessageIds`.
+
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import struct
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+COMPACT_VERSION = 1
+
+# Payload flags, one pair of bits for the uaid and the chid
+FLAG_UAID_HEX = 0x01
+FLAG_UAID_DASHED = 0x02
+FLAG_CHID_HEX = 0x04
+FLAG_CHID_DASHED = 0x08
+FLAG_RAW = 0x10
+
+_header = struct.Struct("!B4sB")
+_NONCE_SIZE = 12
+_TAG_SIZE = 16
+
+
+def _pack_uuid(value):
+    """Returns the bytes and flag for a canonical UUID, or None
+
+    Parsed by hand as :class:`uuid.UUID` is several times slower.
+
+    """
+    if len(value) == 36 and value[8] == value[13] == value[18] == \
+            value[23] == "-":
+        flag = FLAG_UAID_DASHED
+        value = value.replace("-", "")
+    else:
+        flag = FLAG_UAID_HEX
+    if len(value) != 32 or value != value.lower():
+        return None
+    try:
+        return binascii.unhexlify(value), flag
+    except TypeError:
+        return None
+
+
+def _unpack_uuid(data, hex_flag, dashed_flag, flags):
+    value = binascii.hexlify(data)
+    if flags & hex_flag:
+        return value
+    if flags & dashed_flag:
+        return "-".join([value[:8], value[8:12], value[12:16],
+                         value[16:20], value[20:]])
+    raise InvalidToken()
+
+
+def _pack_data(data):
+    """Returns the payload and flags for ``uaid:chid`` data"""
+    info = data.split(":")
+    if len(info) == 2:
+        uaid, chid = [_pack_uuid(value) for value in info]
+        if uaid and chid:
+            return uaid[0] + chid[0], uaid[1] | (chid[1] << 2)
+    return data, FLAG_RAW
+
+
+def _unpack_data(payload, flags):
+    """Returns the ``uaid:chid`` data of a payload"""
+    if flags & FLAG_RAW:
+        return payload
+    if len(payload) != 32:
+        raise InvalidToken()
+    return ":".join([
+        _unpack_uuid(payload[:16], FLAG_UAID_HEX, FLAG_UAID_DASHED, flags),
+        _unpack_uuid(payload[16:], FLAG_CHID_HEX, FLAG_CHID_DASHED, flags),
+    ])
+
+
+def _hmac(base, msg):
+    """HMAC-SHA256 digest of msg with a copy of a keyed HMAC, which skips
+    the key setup"""
+    mac = base.copy()
+    mac.update(msg)
+    return mac.digest()
+
+
+def _b64decode(token):
+    try:
+        return base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (TypeError, ValueError):
+        raise InvalidToken()
+
+
+def is_compact_token(token):
+    """Whether a token is a compact rather than a legacy Fernet token"""
+    return token[:1] == "A"
+
+
+class EndpointTokens(object):
+    """Encodes and decodes compact endpoint tokens for a set of crypto keys
+
+    The first key is used to encode, any of them decodes.
+
+    """
+    def __init__(self, keys):
+        """Create a new EndpointTokens
+
+        :param keys: Fernet crypto keys, as configured with ``crypto_key``.
+
+        """
+        self._keys = {}
+        self._primary = None
+        for key in keys:
+            key_id, aes_key = self.derive_key(key)
+            self._keys.setdefault(key_id, aes_key)
+            if self._primary is None:
+                self._primary = key_id
+
+    @staticmethod
+    def derive_key(key):
+        """Returns the key id and AES key derived from a Fernet key
+
+        The AES key is derived with HKDF rather than reusing the Fernet
+        key bytes, which already serve as HMAC and AES-CBC keys.
+
+        """
+        raw = base64.urlsafe_b64decode(key)
+        aes_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=16,
+            salt=None,
+            info=b"autopush endpoint token",
+            backend=default_backend()
+        ).derive(raw)
+        return hashlib.sha256(aes_key).digest()[:4], aes_key
+
+    def encode(self, data):
+        """Encode ``uaid:chid`` data into a compact token"""
+        payload, flags = _pack_data(data)
+        header = _header.pack(COMPACT_VERSION, self._primary, flags)
+        nonce = os.urandom(_NONCE_SIZE)
+        encryptor = Cipher(
+            algorithms.AES(self._keys[self._primary]),
+            modes.GCM(nonce),
+            backend=default_backend()
+        ).encryptor()
+        encryptor.authenticate_additional_data(header)
+        ciphertext = encryptor.update(payload) + encryptor.finalize()
+        return base64.urlsafe_b64encode(
+            header + nonce + ciphertext + encryptor.tag).rstrip("=")
+
+    def decode(self, token):
+        """Decode a compact token back into its ``uaid:chid`` data
+
+        :raises:
+            :exc:`~cryptography.fernet.InvalidToken` if the token is
+            malformed, made by an unknown key or fails authentication.
+
+        """
+        raw = _b64decode(token)
+        if len(raw) < _header.size + _NONCE_SIZE + _TAG_SIZE:
+            raise InvalidToken()
+        version, key_id, flags = _header.unpack_from(raw)
+        if version != COMPACT_VERSION or key_id not in self._keys:
+            raise InvalidToken()
+
+        nonce_end = _header.size + _NONCE_SIZE
+        decryptor = Cipher(
+            algorithms.AES(self._keys[key_id]),
+            modes.GCM(raw[_header.size:nonce_end], raw[-_TAG_SIZE:]),
+            backend=default_backend()
+        ).decryptor()
+        decryptor.authenticate_additional_data(raw[:_header.size])
+        try:
+            payload = decryptor.update(raw[nonce_end:-_TAG_SIZE]) + \
+                decryptor.finalize()
+        except InvalidTag:
+            raise InvalidToken()
+
+        return _unpack_data(payload, flags)
+
+
+class MessageIds(object):
+    """Creates and verifies compact message ids for a set of crypto keys
+
+    Message ids only have to round-trip through the app server back to the
+    endpoint, so rather than encrypting with AES they mask the ``uaid:chid``
+    payload with an HMAC-SHA256 keystream and authenticate it with a
+    truncated HMAC-SHA256 tag. Both are cheap enough to run on the reactor.
+    They share the layout of the compact endpoint tokens::
+
+        version (1) | key id (4) | flags (1) | nonce (12) | masked | tag (16)
+
+    The first key is used to create ids, any of them verifies.
+
+    """
+    def __init__(self, keys):
+        """Create a new MessageIds
+
+        :param keys: Fernet crypto keys, as configured with ``crypto_key``.
+
+        """
+        self._keys = {}
+        self._primary = None
+        for key in keys:
+            key_id, mask_key, tag_key = self.derive_keys(key)
+            self._keys.setdefault(key_id, (
+                hmac.new(mask_key, digestmod=hashlib.sha256),
+                hmac.new(tag_key, digestmod=hashlib.sha256),
+            ))
+            if self._primary is None:
+                self._primary = key_id
+
+    @staticmethod
+    def derive_keys(key):
+        """Returns the key id, mask key and tag key derived from a Fernet
+        key"""
+        derived = HKDF(
+            algorithm=hashes.SHA256(),
+            length=64,
+            salt=None,
+            info=b"autopush message id",
+            backend=default_backend()
+        ).derive(base64.urlsafe_b64decode(key))
+        mask_key, tag_key = derived[:32], derived[32:]
+        return hashlib.sha256(tag_key).digest()[:4], mask_key, tag_key
+
+    @staticmethod
+    def _mask(mask_mac, nonce, payload):
+        if not payload:
+            return payload
+        stream = "".join(
+            _hmac(mask_mac, struct.pack("!I", counter) + nonce)
+            for counter in xrange(len(payload) // 32 + 1))
+        masked = int(binascii.hexlify(payload), 16) ^ \
+            int(binascii.hexlify(stream[:len(payload)]), 16)
+        return binascii.unhexlify("%0*x" % (len(payload) * 2, masked))
+
+    def encode(self, data):
+        """Create a message id for ``m:uaid:chid`` data"""
+        kind, _, data = data.partition(":")
+        if kind != "m":
+            raise ValueError("Wrong message token kind")
+        payload, flags = _pack_data(data)
+        mask_mac, tag_mac = self._keys[self._primary]
+        nonce = os.urandom(_NONCE_SIZE)
+        body = _header.pack(COMPACT_VERSION, self._primary, flags) + nonce + \
+            self._mask(mask_mac, nonce, payload)
+        tag = _hmac(tag_mac, body)[:_TAG_SIZE]
+        return base64.urlsafe_b64encode(body + tag).rstrip("=")
+
+    def decode(self, token):
+        """Verify a message id and return its ``m:uaid:chid`` data
+
+        :raises:
+            :exc:`~cryptography.fernet.InvalidToken` if the message id is
+            malformed, made by an unknown key or fails authentication.
+
+        """
+        raw = _b64decode(token)
+        if len(raw) < _header.size + _NONCE_SIZE + _TAG_SIZE:
+            raise InvalidToken()
+        version, key_id, flags = _header.unpack_from(raw)
+        if version != COMPACT_VERSION or key_id not in self._keys:
+            raise InvalidToken()
+
+        mask_mac, tag_mac = self._keys[key_id]
+        body, tag = raw[:-_TAG_SIZE], raw[-_TAG_SIZE:]
+        expected = _hmac(tag_mac, body)
+        if not hmac.compare_digest(expected[:_TAG_SIZE], tag):
+            raise InvalidToken()
+        nonce_end = _header.size + _NONCE_SIZE
+        payload = self._mask(mask_mac, raw[_header.size:nonce_end],
+                             body[nonce_end:])
+        return "m:" + _unpack_data(payload, flags)
+
+
+def encode_endpoint_token(tokens, fernet, data, version):
+    """Encode ``uaid:chid`` data as an endpoint token
+
+    :param tokens: :class:`EndpointTokens` for compact tokens.
+    :param fernet: Fernet for legacy tokens.
+    :param version: 0 for legacy Fernet tokens, otherwise compact tokens.
+
+    """
+    if version:
+        return tokens.encode(data)
+    return fernet.encrypt(data)
+
+
+def decode_endpoint_token(tokens, fernet, token):
+    """Decode a legacy or compact endpoint token into its ``uaid:chid``"""
+    if is_compact_token(token):
+        return tokens.decode(token)
+    return fernet.decrypt(token)
@@ -28,6 +28,19 @@ not be publicly exposed.
     Immediately drop a client of this `uaid` if its connection time matches the
     `connected_at` provided.
 
+.. http:post:: /batch
+
+    Send many notifications and stored notification checks at once. The body
+    is a JSON list of ``{"type": "push", "uaid": uaid, "update": update}``
+    and ``{"type": "notif", "uaid": uaid}`` entries, where `update` is the
+    body of a ``PUT /push/`` call.
+
+    The reply is a JSON list with a ``{"code": code}`` per entry, in the
+    order of the request, where `code` is the status code the ``PUT
+    /push/`` or ``PUT /notif/`` call would have returned.
+
+    :statuscode 200: Every entry has a result.
+
 """
 import json
 import random
@@ -49,13 +62,13 @@ from twisted.internet.error import (
     ConnectError, ConnectionRefusedError, UserError
 )
 from twisted.internet.interfaces import IProducer
-from twisted.internet.threads import deferToThread
 from twisted.protocols import policies
 from twisted.python import failure, log
 from zope.interface import implements
 from twisted.web.resource import Resource
 
 from autopush import __version__
+from autopush.db import defer_db, read_message_item
 from autopush.protocol import IgnoreBody
 from autopush.utils import validate_uaid, ErrorLogger
 from autopush.noseplugin import track_object
@@ -79,6 +92,50 @@ def periodic_reporter(settings):
                            settings.factory.countConnections)
 
 
+def deliver_notification(settings, uaid, update):
+    """Attempt delivery of a notification to a connected client
+
+    :returns: Tuple of (status_code, message).
+
+    """
+    client = settings.clients.get(uaid)
+    if not client:
+        settings.metrics.increment("updates.router.disconnected")
+        return 404, "Client not connected."
+
+    if client.paused:
+        settings.metrics.increment("updates.router.busy")
+        return 503, "Client busy."
+
+    client.send_notifications(update)
+    settings.metrics.increment("updates.router.received")
+    return 200, "Client accepted for delivery"
+
+
+def check_notifications(settings, uaid):
+    """Notify a connected client that it should check storage for new
+    notifications
+
+    :returns: Tuple of (status_code, message).
+
+    """
+    client = settings.clients.get(uaid)
+    if not client:
+        settings.metrics.increment("updates.notification.disconnected")
+        return 404, "Client not connected."
+
+    if client.paused:
+        # Client already busy waiting for stuff, flag for check
+        client._check_notifications = True
+        settings.metrics.increment("updates.notification.flagged")
+        return 202, "Flagged for Notification check"
+
+    # Client is online and idle, start a notification check
+    client.process_notifications()
+    settings.metrics.increment("updates.notification.checking")
+    return 200, "Notification check started"
+
+
 def log_exception(func):
     """Exception Logger Decorator for protocol methods"""
     @wraps(func)
@@ -124,7 +181,12 @@ class PushState(object):
         '_check_notifications',
         '_more_notifications',
         '_notification_fetch',
+        '_message_cursor',
+        '_message_limit',
+        '_prefetch',
         '_register',
+        '_acks',
+        '_ack_delete',
         'updates_sent',
         'direct_updates',
 
@@ -166,6 +228,12 @@ class PushState(object):
         self._check_notifications = False
         self._more_notifications = False
 
+        # Webpush messages are read a page at a time, continuing after the
+        # last message read with the next page possibly already requested
+        self._message_cursor = None
+        self._message_limit = settings.message_page_size
+        self._prefetch = None
+
         # Hanger for common actions we defer
         self._notification_fetch = None
         self._register = None
@@ -176,6 +244,10 @@ class PushState(object):
         # Track Notification's we don't need to delete separately
         self.direct_updates = {}
 
+        # Acks waiting to be deleted from storage, and the running delete
+        self._acks = []
+        self._ack_delete = None
+
     @property
     def message(self):
         """Property to access the currently used message table"""
@@ -203,8 +275,16 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
     # Defer helpers
     def deferToThread(self, func, *args, **kwargs):
-        """deferToThread helper that tracks defers outstanding"""
-        d = deferToThread(func, *args, **kwargs)
+        """deferToThread helper that tracks defers outstanding
+
+        Table methods run their non-blocking variant instead when it's set
+        up, see :func:`autopush.db.defer_db`.
+
+        """
+        return self.trackDeferred(defer_db(func, *args, **kwargs))
+
+    def trackDeferred(self, d):
+        """Track a deferred as outstanding until it fires"""
         self.ps._callbacks.append(d)
 
         def f(result):
@@ -242,22 +322,17 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         fail.trap(CancelledError)
 
     def force_retry(self, func, *args, **kwargs):
-        """Forcefully retry a function in a thread until it doesn't error
+        """Retry a table method until it doesn't error, or is given up
 
-        Note that this does not use ``self.deferToThread``, so this will
-        continue to retry even if the client drops.
+        Retries are scheduled by the settings'
+        :class:`~autopush.retries.RetryScheduler`, with backoff and within
+        its budget. Note that this does not use ``self.deferToThread``, so
+        this will continue to retry even if the client drops. A call given
+        up was already logged, the returned deferred then fires with None.
 
         """
-        def wrapper(result, *w_args, **w_kwargs):
-            if isinstance(result, failure.Failure):
-                # This is an exception, log it
-                self.log_err(result)
-
-            d = deferToThread(func, *args, **kwargs)
-            d.addErrback(wrapper)
-            return d
-        d = deferToThread(func, *args, **kwargs)
-        d.addErrback(wrapper)
+        d = self.ap_settings.retries.retry(func, *args, **kwargs)
+        d.addErrback(lambda fail: None)
         return d
 
     @property
@@ -434,6 +509,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             del self.ap_settings.clients[self.ps.uaid]
 
         # Cancel any outstanding deferreds that weren't already called
+        self._discard_prefetch()
         for d in self.ps._callbacks:
             if not d.called:
                 d.cancel()
@@ -459,7 +535,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
     def _save_webpush_notif(self, notif):
         """Save a direct_update webpush style notification"""
-        return deferToThread(
+        return defer_db(
             self.ps.message.store_message,
             uaid=self.ps.uaid,
             channel_id=notif.channel_id,
@@ -472,7 +548,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
     def _save_simple_notif(self, channel_id, version):
         """Save a simplepush notification"""
-        return deferToThread(
+        return defer_db(
             self.ap_settings.storage.save_notification,
             uaid=self.ps.uaid,
             chid=channel_id,
@@ -483,9 +559,10 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         """Looks up the node to send a notify for it to check storage if
         connected"""
         # Locate the node that has this client connected
-        d = deferToThread(
+        d = defer_db(
             self.ap_settings.router.get_uaid,
-            self.ps.uaid
+            self.ps.uaid,
+            attributes=("node_id", "connected_at"),
         )
         d.addCallback(self._notify_node)
         d.addErrback(self.log_err, extra="Failed to get UAID for redeliver")
@@ -734,21 +811,26 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         self.ps.metrics.increment("updates.client.hello", tags=self.base_tags)
         self.process_notifications()
 
-    def process_notifications(self):
-        """Run a notification check against storage"""
+    def process_notifications(self, resume=False):
+        """Run a notification check against storage
+
+        Webpush messages are read a page at a time, ``resume`` continues
+        after the last page read rather than starting over.
+
+        """
         # Bail immediately if we are closed.
         if self.ps._should_stop:
             return
 
         # Are we paused? Try again later.
         if self.paused:
-            d = self.deferToLater(1, self.process_notifications)
+            d = self.deferToLater(1, self.process_notifications, resume)
             d.addErrback(self.trap_cancel)
             return
 
         # Webpush with any outstanding storage-based must all be cleared
         if self.ps.use_webpush and any(self.ps.updates_sent.values()):
-            d = self.deferToLater(1, self.process_notifications)
+            d = self.deferToLater(1, self.process_notifications, resume)
             d.addErrback(self.trap_cancel)
             return
 
@@ -761,8 +843,16 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         self.ps._more_notifications = True
 
         if self.ps.use_webpush:
-            d = self.deferToThread(self.ps.message.fetch_messages,
-                                   self.ps.uaid)
+            if resume and self.ps._prefetch is not None:
+                d, self.ps._prefetch = self.ps._prefetch, None
+            else:
+                self._discard_prefetch()
+                if not resume:
+                    # Start over, new messages may be before the cursor
+                    self.ps._message_cursor = None
+                    self.ps._message_limit = \
+                        self.ap_settings.message_page_size
+                d = self._fetch_messages()
         else:
             d = self.deferToThread(
                 self.ap_settings.storage.fetch_notifications, self.ps.uaid)
@@ -772,6 +862,21 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         d.addErrback(self.error_notifications)
         self.ps._notification_fetch = d
 
+    def _fetch_messages(self):
+        """Returns a deferred for the page of messages after the cursor"""
+        return self.deferToThread(self.ps.message.fetch_messages,
+                                  self.ps.uaid,
+                                  limit=self.ps._message_limit,
+                                  start=self.ps._message_cursor)
+
+    def _discard_prefetch(self):
+        """Cancel a page of messages read ahead that won't be used"""
+        prefetch, self.ps._prefetch = self.ps._prefetch, None
+        if prefetch is not None:
+            prefetch.cancel()
+            prefetch.addErrback(self.trap_cancel)
+            prefetch.addErrback(self.log_err)
+
     def error_notifications(self, fail):
         """errBack for notification check failing"""
         # If we error'd out on this important check, we drop the connection
@@ -822,6 +927,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         if not notifs:
             # No more notifications, we can stop.
             self.ps._more_notifications = False
+            self.ps._message_cursor = None
             if self.ps._check_notifications:
                 self.ps._check_notifications = False
                 d = self.deferToLater(1, self.process_notifications)
@@ -836,17 +942,26 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
                 self._rotate_message_table()
             return
 
+        # Continue after this page next time, a full page means there may be
+        # more of a backlog, which is read in bigger pages
+        self.ps._message_cursor = notifs[-1]["chidmessageid"]
+        full = len(notifs) >= self.ps._message_limit
+        if full:
+            self.ps._message_limit = min(self.ps._message_limit * 2,
+                                         self.ap_settings.message_page_max)
+
         # Send out all the notifications
         now = int(time.time())
+        expired = []
         for notif in notifs:
+            # Stored as either item version
+            notif = read_message_item(notif)
             # Split off the chid and message id
             chid, version = notif["chidmessageid"].split(":")
 
-            # If the TTL is too old, don't deliver and fire a delete off
+            # If the TTL is too old, don't deliver and delete it
             if now >= (notif["ttl"]+notif["timestamp"]):
-                self.force_retry(
-                    self.ps.message.delete_message, self.ps.uaid,
-                    chid, version, updateid=notif["updateid"])
+                expired.append((chid, version, notif["updateid"]))
                 continue
 
             data = notif.get("data")
@@ -865,6 +980,23 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             )
             self.sendJSON(msg)
 
+        if expired:
+            self.force_retry(self.ps.message.delete_acked, self.ps.uaid,
+                             expired)
+
+        if full:
+            # Read the next page while the client acks this one
+            self.ps._prefetch = self._fetch_messages()
+        elif not self.ps.rotate_message_table:
+            # A short page was the last one, unless the table is rotated
+            # which waits for a read that comes back empty
+            self.ps._more_notifications = False
+            self.ps._message_cursor = None
+
+        # Without any updates to ack, go on right away
+        if not any(self.ps.updates_sent.values()):
+            self.check_missed_notifications(None)
+
     def _rotate_message_table(self):
         """Function to fire off a message table copy of channels + update the
         router current_month entry"""
@@ -939,8 +1071,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             return self.bad_message("register")
         self.transport.pauseProducing()
 
-        d = self.deferToThread(self.ap_settings.make_endpoint, self.ps.uaid,
-                               chid)
+        d = self.trackDeferred(
+            self.ap_settings.defer_make_endpoint(self.ps.uaid, chid))
         d.addCallback(self.finish_register, chid)
         d.addErrback(self.trap_cancel)
         d.addErrback(self.error_register)
@@ -1015,8 +1147,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
     def ack_update(self, update):
         """Helper function for tracking ack'd updates
 
-        Returns either None, if no delete_notification call is needed, or a
-        deferred for the delete_notification call if it was needed.
+        Returns True if the update was queued to be deleted from storage by
+        :meth:`delete_acked`, None otherwise.
 
         """
         if not update:
@@ -1045,19 +1177,10 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         found = filter(ver_filter, self.ps.updates_sent[chid])
         if found:
-            d = self.force_retry(self.ps.message.delete_message,
-                                 uaid=self.ps.uaid,
-                                 channel_id=chid,
-                                 message_id=version,
-                                 updateid=updateid)
-            # We don't remove the update until we know the delete ran
-            # This is because we don't use range queries on dynamodb and we
-            # need to make sure this notification is deleted from the db before
-            # we query it again (to avoid dupes).
-            d.addBoth(self._handle_webpush_update_remove, chid, found[0])
-            return d
+            self.ps._acks.append((chid, version, updateid, found[0]))
+            return True
 
-    def _handle_webpush_update_remove(self, result, chid, notif):
+    def _handle_webpush_update_remove(self, result, acks):
         """Handle clearing out the updates_sent
 
         It's possible the client may leave before this runs, so this is
@@ -1065,7 +1188,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         """
         try:
-            self.ps.updates_sent[chid].remove(notif)
+            for chid, _, _, notif in acks:
+                self.ps.updates_sent[chid].remove(notif)
         except AttributeError:
             pass
 
@@ -1080,8 +1204,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             del self.ps.updates_sent[chid]
         else:
             return
-        return self.force_retry(self.ap_settings.storage.delete_notification,
-                                self.ps.uaid, chid, version)
+        self.ps._acks.append((chid, version))
+        return True
 
     def process_ack(self, data):
         """Process an ack message, delete notifications from storage if
@@ -1091,14 +1215,48 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             return
 
         self.ps.metrics.increment("updates.client.ack", tags=self.base_tags)
-        defers = filter(None, map(self.ack_update, updates))
+        queued = filter(None, map(self.ack_update, updates))
 
-        if defers:
+        if not queued:
+            self.check_missed_notifications(None)
+        elif not self.ps._ack_delete:
             self.transport.pauseProducing()
-            dl = DeferredList(defers)
-            dl.addBoth(self.check_missed_notifications, True)
+            self.delete_acked()
+
+    def delete_acked(self):
+        """Delete the queued acks from storage together
+
+        Acks arriving while a delete runs are queued for the next one, so a
+        client acking a backlog costs a few deletes rather than one for each
+        update.
+
+        """
+        acks, self.ps._acks = self.ps._acks, []
+        if self.ps.use_webpush:
+            d = self.force_retry(
+                self.ps.message.delete_acked, self.ps.uaid,
+                [(chid, version, updateid)
+                 for chid, version, updateid, _ in acks])
+            # We don't remove the updates until we know the delete ran
+            # This is because we don't use range queries on dynamodb and we
+            # need to make sure these notifications are deleted from the db
+            # before we query it again (to avoid dupes).
+            d.addBoth(self._handle_webpush_update_remove, acks)
         else:
-            self.check_missed_notifications(None)
+            d = self.force_retry(
+                self.ap_settings.storage.delete_notifications,
+                self.ps.uaid, acks)
+        self.ps._ack_delete = d
+        d.addBoth(self._finish_delete_acked)
+        return d
+
+    def _finish_delete_acked(self, result):
+        """Delete the acks queued meanwhile, or resume once all are done"""
+        self.ps._ack_delete = None
+        if self.ps._acks:
+            self.delete_acked()
+        else:
+            self.check_missed_notifications(None, True)
 
     def check_missed_notifications(self, results, resume=False):
         """Check to see if notifications were missed"""
@@ -1115,9 +1273,11 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         if self.ps.use_webpush and any(self.ps.updates_sent.values()):
             return
 
-        # Should we check again?
-        if self.ps._check_notifications or self.ps._more_notifications:
+        # Should we check again, or read the next page?
+        if self.ps._check_notifications:
             self.process_notifications()
+        elif self.ps._more_notifications:
+            self.process_notifications(resume=True)
 
     def bad_message(self, typ):
         """Error helper for sending a 401 status back"""
@@ -1178,22 +1338,10 @@ class RouterHandler(cyclone.web.RequestHandler, ErrorLogger):
         Attempt delivery of a notification to a connected client.
 
         """
-        settings = self.ap_settings
-        client = settings.clients.get(uaid)
-        if not client:
-            self.set_status(404)
-            settings.metrics.increment("updates.router.disconnected")
-            return self.write("Client not connected.")
-
-        if client.paused:
-            self.set_status(503)
-            settings.metrics.increment("updates.router.busy")
-            return self.write("Client busy.")
-
         update = json.loads(self.request.body)
-        client.send_notifications(update)
-        settings.metrics.increment("updates.router.received")
-        return self.write("Client accepted for delivery")
+        code, message = deliver_notification(self.ap_settings, uaid, update)
+        self.set_status(code)
+        return self.write(message)
 
 
 class NotificationHandler(cyclone.web.RequestHandler, ErrorLogger):
@@ -1205,24 +1353,9 @@ class NotificationHandler(cyclone.web.RequestHandler, ErrorLogger):
         notifications.
 
         """
-        client = self.ap_settings.clients.get(uaid)
-        settings = self.ap_settings
-        if not client:
-            self.set_status(404)
-            settings.metrics.increment("updates.notification.disconnected")
-            return self.write("Client not connected.")
-
-        if client.paused:
-            # Client already busy waiting for stuff, flag for check
-            client._check_notifications = True
-            self.set_status(202)
-            settings.metrics.increment("updates.notification.flagged")
-            return self.write("Flagged for Notification check")
-
-        # Client is online and idle, start a notification check
-        client.process_notifications()
-        settings.metrics.increment("updates.notification.checking")
-        self.write("Notification check started")
+        code, message = check_notifications(self.ap_settings, uaid)
+        self.set_status(code)
+        self.write(message)
 
     def delete(self, uaid, ignored, connectionTime):
         """HTTP Delete
@@ -1236,6 +1369,34 @@ class NotificationHandler(cyclone.web.RequestHandler, ErrorLogger):
             return self.write("Terminated duplicate")
 
 
+class BatchRouterHandler(cyclone.web.RequestHandler, ErrorLogger):
+    """Batch Router Handler
+
+    Handles routing many notifications, and stored notification checks, to
+    connected clients from an endpoint in a single request.
+
+    """
+
+    def post(self):
+        """HTTP Post
+
+        Attempt every delivery and notification check of the batch.
+
+        """
+        settings = self.ap_settings
+        results = []
+        for entry in json.loads(self.request.body):
+            if entry["type"] == "push":
+                code, _ = deliver_notification(settings, entry["uaid"],
+                                               entry["update"])
+            else:
+                code, _ = check_notifications(settings, entry["uaid"])
+            results.append(dict(code=code))
+        settings.metrics.increment("updates.router.batch")
+        self.set_header("Content-Type", "application/json")
+        return self.write(json.dumps(results))
+
+
 class DefaultResource(Resource):
     """Delegates rendering to a default resource."""
     def __init__(self, resource):
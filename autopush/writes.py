@@ -0,0 +1,108 @@
+"""Group commit of notification writes
+
+Routers store every notification that can't be delivered right away, one
+DynamoDB request each. :class:`WriteBatcher` instead holds the writes for a
+few milliseconds and commits them together:
+
+- Webpush messages for the same message table are stored with a single
+  BatchWriteItem, whose unprocessed items are retried.
+- Simplepush notifications need a conditional write so an older version
+  never replaces a newer one, which BatchWriteItem can't do. Writes for the
+  same channel are coalesced into one conditional write of the newest
+  version instead.
+
+Every write returns a deferred that fires with the result of the commit it
+went out with.
+
+"""
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from autopush.db import defer_db, make_message_item
+
+
+class WriteBatcher(object):
+    """Holds notification writes to commit them together"""
+    def __init__(self, metrics, window=5, size=25):
+        """Create a new WriteBatcher
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param window: Milliseconds a write is held for other writes.
+        :param size: Amount of held messages for a table that are stored
+                     without waiting for the window to end.
+
+        """
+        self.metrics = metrics
+        self.window = window / 1000.0
+        self.size = size
+        self._messages = {}
+        self._notifications = {}
+        self._timer = None
+
+    def store_message(self, message, uaid, channel_id, message_id, ttl,
+                      data=None, headers=None, timestamp=None):
+        """Returns a deferred for storing a webpush message with the other
+        messages held for the :class:`~autopush.db.Message` table"""
+        d = Deferred()
+        item = make_message_item(uaid, channel_id, message_id, ttl, data,
+                                 headers, timestamp, message.item_version)
+        pending = self._messages.setdefault(message, [])
+        pending.append((item, d))
+        if len(pending) >= self.size:
+            self._store_messages(message)
+        else:
+            self._schedule()
+        return d
+
+    def save_notification(self, storage, uaid, chid, version):
+        """Returns a deferred for saving a simplepush notification, coalesced
+        with the other versions held for the channel"""
+        d = Deferred()
+        key = (storage, uaid, chid)
+        held = self._notifications.get(key)
+        if held is None:
+            self._notifications[key] = [version, [d]]
+        else:
+            held[0] = max(held[0], version)
+            held[1].append(d)
+            self.metrics.increment("notification.write.coalesced")
+        self._schedule()
+        return d
+
+    def flush(self):
+        """Commit every held write"""
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        for message in self._messages.keys():
+            self._store_messages(message)
+        notifications, self._notifications = self._notifications, {}
+        for (storage, uaid, chid), (version, waiters) in \
+                notifications.items():
+            d = defer_db(storage.save_notification, uaid, chid, version)
+            d.addBoth(self._committed, waiters)
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = reactor.callLater(self.window, self.flush)
+
+    def _store_messages(self, message):
+        """Store the messages held for a table"""
+        batch = self._messages.pop(message, [])
+        if not batch:
+            return
+        self.metrics.increment("notification.write.batch")
+        self.metrics.increment("notification.write.batched",
+                               count=len(batch))
+        d = defer_db(message.store_messages, [item for item, _ in batch])
+        d.addBoth(self._committed, [waiter for _, waiter in batch])
+
+    def _committed(self, result, waiters):
+        """Fire the deferred of every write of a commit with its result"""
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
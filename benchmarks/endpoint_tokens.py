@@ -0,0 +1,65 @@
+"""Compare legacy Fernet and compact endpoint tokens and message ids
+
+Reports the encode and decode cost of both formats, including decoding
+after a key rotation where the token was made by the second configured
+key, and the length of the resulting endpoint URL path.
+
+    python benchmarks/endpoint_tokens.py [iterations]
+
+"""
+import sys
+import timeit
+import uuid
+
+from cryptography.fernet import Fernet, MultiFernet
+
+from autopush.tokens import EndpointTokens, MessageIds, decode_endpoint_token
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+    fernet = MultiFernet([Fernet(new_key), Fernet(old_key)])
+    tokens = EndpointTokens([new_key, old_key])
+    message_ids = MessageIds([new_key, old_key])
+    data = "%s:%s" % (uuid.uuid4().hex, uuid.uuid4())
+
+    legacy = fernet.encrypt(data)
+    compact = tokens.encode(data)
+    message = "m:" + data
+    message_id = message_ids.encode(message)
+    rotated_legacy = Fernet(old_key).encrypt(data)
+    rotated_compact = EndpointTokens([old_key]).encode(data)
+
+    cases = [
+        ("legacy encode", lambda: fernet.encrypt(data)),
+        ("compact encode", lambda: tokens.encode(data)),
+        ("legacy decode", lambda: decode_endpoint_token(
+            tokens, fernet, legacy)),
+        ("compact decode", lambda: decode_endpoint_token(
+            tokens, fernet, compact)),
+        ("legacy decode, old key", lambda: decode_endpoint_token(
+            tokens, fernet, rotated_legacy)),
+        ("compact decode, old key", lambda: decode_endpoint_token(
+            tokens, fernet, rotated_compact)),
+        ("legacy message id encode", lambda: fernet.encrypt(message)),
+        ("compact message id encode", lambda: message_ids.encode(message)),
+        ("compact message id decode", lambda: message_ids.decode(
+            message_id)),
+    ]
+    print "%-28s %10s" % ("operation", "us/op")
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=iterations)
+        print "%-28s %10.2f" % (name, elapsed / iterations * 1e6)
+
+    print
+    print "%-28s %10s" % ("format", "path bytes")
+    print "%-28s %10d" % ("legacy", len("/push/" + legacy))
+    print "%-28s %10d" % ("compact", len("/push/" + compact))
+    print "%-28s %10d" % ("legacy message id", len("/m/" + fernet.encrypt(
+        message)))
+    print "%-28s %10d" % ("compact message id", len("/m/" + message_id))
+
+
+if __name__ == "__main__":
+    main()
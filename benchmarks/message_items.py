@@ -0,0 +1,76 @@
+"""Compare the size of original and compact webpush message items
+
+Reports the stored size of a message item of both versions for a range of
+payload sizes, along with the write capacity units a PutItem of it and
+the read capacity units a consistent read of it consume.
+
+    python benchmarks/message_items.py
+
+Sizes follow the DynamoDB rules: attribute names count as their UTF-8
+length, strings as their UTF-8 length, binary as its length, numbers
+about one byte per two significant digits plus one, and maps three bytes
+plus a byte per entry.
+
+"""
+import math
+import os
+import time
+import uuid
+from base64 import urlsafe_b64encode
+from decimal import Decimal
+
+from boto.dynamodb.types import Binary
+
+from autopush.db import make_message_item
+
+PAYLOAD_SIZES = (0, 128, 512, 1024, 2048, 3072, 4096)
+HEADERS = dict(
+    encoding="aesgcm",
+    encryption="keyid=p256dh;salt=" + urlsafe_b64encode(os.urandom(16)),
+    encryption_key="keyid=p256dh;dh=" + urlsafe_b64encode(os.urandom(65)),
+)
+
+
+def value_size(value):
+    """Returns the stored size of an attribute value"""
+    if isinstance(value, Binary):
+        return len(value.value)
+    if isinstance(value, basestring):
+        return len(value.encode("utf8"))
+    if isinstance(value, (int, long, float, Decimal)):
+        digits = len(str(abs(value)).replace(".", "").strip("0")) or 1
+        return int(math.ceil(digits / 2.0)) + 1
+    if isinstance(value, dict):
+        return 3 + sum(len(name) + value_size(item) + 1
+                       for name, item in value.items())
+    raise TypeError("Unsupported value %r" % value)
+
+
+def item_size(item):
+    """Returns the stored size of an item"""
+    return sum(len(name) + value_size(value)
+               for name, value in item.items() if value)
+
+
+def main():
+    uaid = uuid.uuid4().hex
+    chid = str(uuid.uuid4())
+    message_id = urlsafe_b64encode(os.urandom(48))
+    ttl, timestamp = 86400, int(time.time())
+
+    print "%-8s %8s %8s %6s %6s %6s %6s" % (
+        "payload", "v1 bytes", "v2 bytes", "v1 WCU", "v2 WCU", "v1 RCU",
+        "v2 RCU")
+    for size in PAYLOAD_SIZES:
+        data = urlsafe_b64encode(os.urandom(size)) if size else None
+        sizes = [item_size(make_message_item(
+            uaid, chid, message_id, ttl, data, HEADERS if data else None,
+            timestamp, version)) for version in (1, 2)]
+        wcus = [int(math.ceil(item / 1024.0)) for item in sizes]
+        rcus = [int(math.ceil(item / 4096.0)) for item in sizes]
+        print "%-8d %8d %8d %6d %6d %6d %6d" % tuple(
+            [size] + sizes + wcus + rcus)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Compare decoding items into boto Items and into plain records
+
+Reports the cost of decoding a router record and a stored webpush message
+of either item version, from the DynamoDB JSON a GetItem or Query answers
+with, into a boto :class:`~boto.dynamodb2.items.Item` as boto's
+``get_item`` and ``query_2`` do, and with
+:func:`autopush.dynamodb.decode_item`.
+
+    python benchmarks/record_decoding.py [iterations]
+
+"""
+import os
+import sys
+import time
+import timeit
+import uuid
+from base64 import urlsafe_b64encode
+
+from boto.dynamodb.types import Dynamizer
+from boto.dynamodb2.items import Item
+from boto.dynamodb2.table import Table
+from mock import Mock
+
+from autopush.db import make_message_item
+from autopush.dynamodb import MessageRecord, UserRecord, decode_item
+
+HEADERS = dict(
+    encoding="aesgcm",
+    encryption="keyid=p256dh;salt=" + urlsafe_b64encode(os.urandom(16)),
+    encryption_key="keyid=p256dh;dh=" + urlsafe_b64encode(os.urandom(65)),
+)
+
+
+def encode(dynamizer, data):
+    return dict((name, dynamizer.encode(value))
+                for name, value in data.items() if value is not None)
+
+
+def load(table, raw):
+    item = Item(table)
+    item.load(dict(Item=raw))
+    return item
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    dynamizer = Dynamizer()
+    table = Table("benchmark", connection=Mock())
+    uaid = uuid.uuid4().hex
+    chid = str(uuid.uuid4())
+    data = urlsafe_b64encode(os.urandom(1024))
+
+    user = encode(dynamizer, dict(
+        uaid=uaid, node_id="http://10.0.0.1:8080", connected_at=1463432400,
+        router_type="webpush", current_month="message_2016_5",
+        last_connect=2016051500))
+    messages = [encode(dynamizer, make_message_item(
+        uaid, chid, uuid.uuid4().hex, 86400, data, HEADERS,
+        int(time.time()), version)) for version in (1, 2)]
+
+    cases = [
+        ("router record, Item", lambda: load(table, user)),
+        ("router record, decode_item", lambda: decode_item(
+            user, UserRecord)),
+    ]
+    for version, message in zip((1, 2), messages):
+        cases.extend([
+            ("v%d message, Item" % version,
+             lambda message=message: load(table, message)),
+            ("v%d message, decode_item" % version,
+             lambda message=message: decode_item(message, MessageRecord)),
+        ])
+    print "%-28s %10s" % ("decoding", "us/item")
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=iterations)
+        print "%-28s %10.2f" % (name, elapsed / iterations * 1e6)
+
+
+if __name__ == "__main__":
+    main()